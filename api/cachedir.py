@@ -0,0 +1,90 @@
+"""
+Size-limited cache directories for the IKAROS api.
+
+Thumbnails and proxied resources are cached as files in a directory. Serving a cached
+file updates its modification time, and once the directory grows beyond its size limit
+the least recently served files are evicted.
+"""
+
+import os
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheDirectory:
+    """
+    Directory of cached files, evicting the least recently used beyond a size limit.
+
+    Files whose names start with a dot are temporary and are neither counted nor evicted.
+
+    Attributes:
+        directory (str): The directory of the cached files.
+        max_bytes (int): The size limit of the cache.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory)
+                         if entry.is_file() and not entry.name.startswith("."))
+
+    def touch(self, path: str) -> bool:
+        """
+        Mark a cached file as used.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            bool: Whether the file is cached.
+        """
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def added(self, path: str, replaced: int = 0):
+        """
+        Count a new cached file, and evict the least recently used if the cache is full.
+
+        Blocking; run on a worker thread.
+
+        Args:
+            path (str): The path of the file, which is not evicted.
+            replaced (int, optional): The size of the file it replaced, if any.
+        """
+        with self._lock:
+            self._size += os.path.getsize(path) - replaced
+            if self._size <= self.max_bytes:
+                return
+            # Evict down to 90% of the limit, so that not every new file evicts
+            entries = sorted((entry.stat().st_mtime, entry.path, entry.stat().st_size)
+                             for entry in os.scandir(self.directory)
+                             if entry.is_file() and not entry.name.startswith("."))
+            evicted = 0
+            for _, entry_path, entry_size in entries:
+                if self._size <= self.max_bytes * 0.9:
+                    break
+                if entry_path == path:
+                    continue
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+                self._size -= entry_size
+                evicted += 1
+            logger.info(f"Evicted {evicted} files from {self.directory}; it holds {self._size} bytes.")
+
+    def stats(self) -> dict:
+        """
+        Get the size of the cache.
+
+        Returns:
+            dict: The number of bytes cached, and the size limit.
+        """
+        return {"bytes": self._size, "max_bytes": self.max_bytes}
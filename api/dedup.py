@@ -0,0 +1,173 @@
+"""
+Deduplication of uploads and derivatives for the IKAROS api.
+
+Uploads are hashed while they are saved. The first upload of some content is kept and
+converted as usual; later uploads of the same content are hard links to the first
+upload, and their derivatives are hard links to the first upload's derivatives, so
+the content is stored once and converted once. Hard links count their references, so
+deleting one name of a file keeps the others.
+
+The index of converted content is kept in a SQLite database next to the derivatives.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+from typing import BinaryIO, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Buffer size used when saving uploads
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def save_and_hash(fileobj: BinaryIO, directory: str) -> Tuple[str, str]:
+    """
+    Save an upload to a temporary file and hash it as it is written.
+
+    Args:
+        fileobj (BinaryIO): The upload.
+        directory (str): The directory to save it in.
+
+    Returns:
+        tuple: The path of the temporary file, and the hex SHA-256 digest of the upload.
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(prefix=".upload-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            while True:
+                chunk = fileobj.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                buffer.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, digest.hexdigest()
+
+
+def link_file(src_path: str, dest_path: str):
+    """
+    Make a path a hard link to a file, replacing anything at the path.
+
+    Args:
+        src_path (str): The path of the file.
+        dest_path (str): The path of the link.
+    """
+    temp_path = os.path.join(os.path.dirname(dest_path), f".link-{os.path.basename(dest_path)}")
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    os.link(src_path, temp_path)
+    os.replace(temp_path, dest_path)
+
+
+def link_outputs(outputs: List[str], base_name: str, new_base_name: str) -> List[str]:
+    """
+    Link the derivatives of one upload under the base name of another.
+
+    Args:
+        outputs (List[str]): The paths of the derivatives, whose file names start with `base_name`.
+        base_name (str): The base name of the converted upload.
+        new_base_name (str): The base name of the duplicate upload.
+
+    Returns:
+        List[str]: The paths of the links.
+    """
+    links = []
+    for output in outputs:
+        name = os.path.basename(output)
+        link_path = os.path.join(os.path.dirname(output), new_base_name + name[len(base_name):])
+        link_file(output, link_path)
+        links.append(link_path)
+    return links
+
+
+class DerivativeIndex:
+    """
+    Index of converted uploads by content digest and derivative kind.
+
+    Attributes:
+        path (str): The path of the SQLite database.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS derivatives (
+                    sha256 TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    source_path TEXT NOT NULL,
+                    base_name TEXT NOT NULL,
+                    job_id TEXT,
+                    outputs TEXT,
+                    PRIMARY KEY (sha256, kind)
+                )
+                """
+            )
+
+    def get(self, sha256: str, kind: str) -> Optional[dict]:
+        """
+        Look up the conversion of some content.
+
+        Args:
+            sha256 (str): The hex SHA-256 digest of the content.
+            kind (str): The kind of derivative.
+
+        Returns:
+            dict: The `source_path`, `base_name` and `job_id` of the first upload, and the
+                `outputs` of its conversion, or None while it is not done; or None if the
+                content has not been converted.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT source_path, base_name, job_id, outputs FROM derivatives WHERE sha256 = ? AND kind = ?",
+                (sha256, kind),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"source_path": row[0], "base_name": row[1], "job_id": row[2],
+                "outputs": json.loads(row[3]) if row[3] else None}
+
+    def register(self, sha256: str, kind: str, source_path: str, base_name: str, job_id: str):
+        """
+        Record that some content is being converted, replacing an earlier conversion.
+
+        Args:
+            sha256 (str): The hex SHA-256 digest of the content.
+            kind (str): The kind of derivative.
+            source_path (str): The path of the upload.
+            base_name (str): The base name of the derivatives.
+            job_id (str): The ID of the conversion job.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO derivatives (sha256, kind, source_path, base_name, job_id, outputs) "
+                "VALUES (?, ?, ?, ?, ?, NULL)",
+                (sha256, kind, source_path, base_name, job_id),
+            )
+
+    def complete(self, sha256: str, kind: str, job_id: str, outputs: List[str]):
+        """
+        Record the derivatives of a finished conversion.
+
+        Args:
+            sha256 (str): The hex SHA-256 digest of the content.
+            kind (str): The kind of derivative.
+            job_id (str): The ID of the conversion job.
+            outputs (List[str]): The paths of the derivatives.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE derivatives SET outputs = ? WHERE sha256 = ? AND kind = ? AND job_id = ?",
+                (json.dumps(outputs), sha256, kind, job_id),
+            )
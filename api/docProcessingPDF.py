@@ -0,0 +1,59 @@
+"""
+PDF and image conversion for the IKAROS api.
+
+Every page of a PDF is rendered with PyMuPDF and written as an LZW-compressed TIFF with
+Pillow. The conversion is CPU-bound and blocking, and is run in the worker processes of
+the job queue.
+"""
+
+import os
+import logging
+from typing import List
+import pymupdf
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+# Resolution at which PDF pages are rendered
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", 72))
+
+
+def convert_image(input_path: str, output_path: str) -> str:
+    """
+    Convert an image to an LZW-compressed TIFF file.
+
+    Args:
+        input_path (str): The path of the image.
+        output_path (str): The path of the TIFF file to write.
+
+    Returns:
+        str: The path of the TIFF file.
+    """
+    with Image.open(input_path) as image:
+        image.save(output_path, format="TIFF", compression="tiff_lzw")
+    return output_path
+
+
+def convert_pdf(input_path: str, output_dir: str, base_name: str) -> List[str]:
+    """
+    Render every page of a PDF to a TIFF file.
+
+    Args:
+        input_path (str): The path of the PDF.
+        output_dir (str): The directory to write the pages to.
+        base_name (str): The base name of the pages, written as `{base_name}-page-{n}.tiff`.
+
+    Returns:
+        List[str]: The paths of the TIFF files, in page order.
+    """
+    output_paths = []
+    with pymupdf.open(input_path) as document:
+        for index, page in enumerate(document):
+            pixmap = page.get_pixmap(dpi=PDF_RENDER_DPI)
+            image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+            output_path = os.path.join(output_dir, f"{base_name}-page-{index + 1}.tiff")
+            image.save(output_path, format="TIFF", compression="tiff_lzw")
+            output_paths.append(output_path)
+    logger.info(f"Converted {len(output_paths)} pages of {input_path}.")
+    return output_paths
@@ -0,0 +1,197 @@
+"""
+JPEG 2000 and pyramidal TIFF conversion for the IKAROS api.
+
+Images are converted to tiled, multi-resolution derivatives that the IIPImage server can
+serve a few tiles at a time. JPEG 2000 files are encoded with `opj_compress` from
+OpenJPEG from an intermediate LZW-compressed TIFF. Pyramidal TIFF files are written
+with libvips. The conversion is CPU-bound and blocking, and is run in the worker
+processes of the job queue.
+
+If pyvips is installed, source images are decoded sequentially in strips, so that large
+orthophotos are never held in memory in full. Otherwise Pillow is used for JPEG 2000
+conversion, and decodes the whole image.
+"""
+
+import os
+import math
+import logging
+import subprocess
+import tempfile
+from typing import List, Tuple
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+# Derivative format, `jp2` or `tiff`
+DERIVATIVE_FORMAT = os.getenv("DERIVATIVE_FORMAT", "jp2")
+
+# Path of the OpenJPEG encoder
+OPJ_COMPRESS = os.getenv("OPJ_COMPRESS", "opj_compress")
+
+# Size in pixels of the square tiles of the derivatives
+TILE_SIZE = int(os.getenv("TILE_SIZE", 256))
+# Number of JPEG 2000 resolution levels, or 0 to reduce until the smallest level fits in a tile
+JP2_RESOLUTIONS = int(os.getenv("JP2_RESOLUTIONS", 0))
+# Compression ratios of the JPEG 2000 quality layers, from the lowest quality to the highest
+JP2_QUALITY_LAYERS = os.getenv("JP2_QUALITY_LAYERS", "5,4,3,2,1,0.5")
+# Width and height of the JPEG 2000 code-blocks
+JP2_CODEBLOCK_SIZE = os.getenv("JP2_CODEBLOCK_SIZE", "64,64")
+# JPEG 2000 precinct sizes, such as `[256,256],[128,128]`, or empty for the encoder's default
+JP2_PRECINCTS = os.getenv("JP2_PRECINCTS", "")
+# JPEG 2000 progression order; resolution-first suits tiled zooming
+JP2_PROGRESSION = os.getenv("JP2_PROGRESSION", "RPCL")
+
+# Compression and JPEG quality of pyramidal TIFF tiles
+TIFF_COMPRESSION = os.getenv("TIFF_COMPRESSION", "jpeg")
+TIFF_QUALITY = int(os.getenv("TIFF_QUALITY", 90))
+
+# Largest image Pillow decodes without treating it as a decompression bomb
+Image.MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 1_000_000_000))
+
+
+def _pyvips():
+    """
+    Import pyvips, or return None if it or libvips is not installed.
+    """
+    try:
+        import pyvips
+    except (ImportError, OSError):
+        return None
+    return pyvips
+
+
+def resolution_levels(width: int, height: int, tile_size: int = TILE_SIZE) -> int:
+    """
+    Get the number of resolution levels needed for the smallest level to fit in one tile.
+
+    The count is capped so that the lowest level of a tile is at least one pixel wide.
+
+    Args:
+        width (int): The width of the image.
+        height (int): The height of the image.
+        tile_size (int, optional): The size of the tiles.
+
+    Returns:
+        int: The number of resolution levels, including the full resolution.
+    """
+    levels = max(1, math.ceil(math.log2(max(width, height) / tile_size)) + 1)
+    return min(levels, int(math.log2(tile_size)) + 1)
+
+
+def opj_options(width: int, height: int) -> List[str]:
+    """
+    Build the opj_compress options for a tiled, multi-resolution JPEG 2000 file.
+
+    Args:
+        width (int): The width of the image.
+        height (int): The height of the image.
+
+    Returns:
+        List[str]: The options.
+    """
+    resolutions = JP2_RESOLUTIONS or resolution_levels(width, height)
+    options = [
+        "-t", f"{TILE_SIZE},{TILE_SIZE}",
+        "-n", str(resolutions),
+        "-r", JP2_QUALITY_LAYERS,
+        "-b", JP2_CODEBLOCK_SIZE,
+        "-p", JP2_PROGRESSION,
+    ]
+    if JP2_PRECINCTS:
+        options += ["-c", JP2_PRECINCTS]
+    return options
+
+
+def _write_tiff(input_path: str, tiff_path: str) -> Tuple[int, int]:
+    """
+    Write an image as an LZW-compressed TIFF, in strips if pyvips is installed.
+
+    Returns:
+        tuple: The width and height of the image.
+    """
+    pyvips = _pyvips()
+    if pyvips is not None:
+        image = pyvips.Image.new_from_file(input_path, access="sequential")
+        image.tiffsave(tiff_path, compression="lzw")
+        return image.width, image.height
+    with Image.open(input_path) as image:
+        image.save(tiff_path, format="TIFF", compression="tiff_lzw")
+        return image.size
+
+
+def convert_image_to_jp2(input_path: str, output_path: str) -> str:
+    """
+    Convert an image to a tiled, multi-resolution JPEG 2000 file.
+
+    Args:
+        input_path (str): The path of the image.
+        output_path (str): The path of the JPEG 2000 file to write.
+
+    Returns:
+        str: The path of the JPEG 2000 file.
+
+    Raises:
+        RuntimeError: If opj_compress fails.
+    """
+    # A temporary TIFF per conversion, so that conversions can run in parallel; the leading dot keeps
+    # it out of the served files and cache scans of the directory
+    fd, temp_tiff_path = tempfile.mkstemp(prefix=".convert-", suffix=".tif", dir=os.path.dirname(output_path) or None)
+    os.close(fd)
+    try:
+        width, height = _write_tiff(input_path, temp_tiff_path)
+        command = [OPJ_COMPRESS, "-i", temp_tiff_path, "-o", output_path, *opj_options(width, height)]
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"opj_compress failed: {result.stderr.strip() or result.stdout.strip()}")
+        logger.info(f"Converted {input_path} ({width}x{height}) to {output_path}.")
+        return output_path
+    finally:
+        os.remove(temp_tiff_path)
+
+
+def convert_image_to_pyramidal_tiff(input_path: str, output_path: str) -> str:
+    """
+    Convert an image to a tiled pyramidal TIFF file.
+
+    The image is decoded sequentially and every level of the pyramid is written as it is
+    reduced, so memory use does not grow with the size of the image.
+
+    Args:
+        input_path (str): The path of the image.
+        output_path (str): The path of the TIFF file to write.
+
+    Returns:
+        str: The path of the TIFF file.
+
+    Raises:
+        RuntimeError: If pyvips is not installed.
+    """
+    pyvips = _pyvips()
+    if pyvips is None:
+        raise RuntimeError("Pyramidal TIFF conversion requires pyvips")
+    image = pyvips.Image.new_from_file(input_path, access="sequential")
+    options = {"compression": TIFF_COMPRESSION}
+    if TIFF_COMPRESSION == "jpeg":
+        options["Q"] = TIFF_QUALITY
+    image.tiffsave(output_path, tile=True, pyramid=True, tile_width=TILE_SIZE, tile_height=TILE_SIZE,
+                   bigtiff=True, **options)
+    logger.info(f"Converted {input_path} ({image.width}x{image.height}) to {output_path}.")
+    return output_path
+
+
+def convert_image_to_derivative(input_path: str, output_dir: str, base_name: str) -> str:
+    """
+    Convert an image to the derivative format set by DERIVATIVE_FORMAT.
+
+    Args:
+        input_path (str): The path of the image.
+        output_dir (str): The directory to write the derivative to.
+        base_name (str): The base name of the derivative, written as `{base_name}.jp2` or `{base_name}.tif`.
+
+    Returns:
+        str: The path of the derivative.
+    """
+    if DERIVATIVE_FORMAT == "tiff":
+        return convert_image_to_pyramidal_tiff(input_path, os.path.join(output_dir, f"{base_name}.tif"))
+    return convert_image_to_jp2(input_path, os.path.join(output_dir, f"{base_name}.jp2"))
@@ -0,0 +1,272 @@
+"""
+Background job queue for the IKAROS api.
+
+Derivative generation, such as JPEG 2000 encoding and PDF rendering, is CPU-bound. Jobs
+are run in a pool of worker processes sized to the cores of the machine, so that uploads
+return as soon as the file is stored and conversions run in parallel without blocking
+the event loop. Failed jobs are retried with an exponential backoff, and every job
+records how long it waited and ran.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from uuid import uuid4
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Optional
+from metrics import JOB_QUEUE_DURATION, JOB_RUN_DURATION, JOBS_FINISHED, JOBS_RETRIED, JOBS_PENDING
+
+
+logger = logging.getLogger(__name__)
+
+# Number of worker processes
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", os.cpu_count() or 1))
+# Number of times a failed job is retried, and the delay before the first retry in seconds
+JOB_RETRIES = int(os.getenv("JOB_RETRIES", 2))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 1))
+# Number of finished jobs whose status is kept
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", 10000))
+
+QUEUED = "queued"
+RETRYING = "retrying"
+DONE = "done"
+FAILED = "failed"
+
+
+def _timed(func: Callable, args: tuple) -> tuple:
+    """
+    Run a job function in a worker process and time it there.
+
+    Returns:
+        tuple: The result, and the start and end times of the run.
+    """
+    started_at = time.time()
+    result = func(*args)
+    return result, started_at, time.time()
+
+
+class Job:
+    """
+    A job in the queue.
+
+    Attributes:
+        id (str): The ID of the job.
+        kind (str): The kind of job, such as `jp2` or `pdf`.
+        status (str): `queued`, `retrying`, `done` or `failed`.
+        attempts (int): The number of times the job has been run.
+        result: The return value of the job function, once done.
+        error (str): The error of the last failed attempt.
+        submitted_at (float): When the job was submitted.
+        started_at (float): When the successful or last attempt started in a worker.
+        finished_at (float): When the job was done or failed for good.
+        run_seconds (float): How long the successful attempt ran in a worker.
+    """
+    def __init__(self, kind: str):
+        self.id = str(uuid4())
+        self.kind = kind
+        self.status = QUEUED
+        self.attempts = 0
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.run_seconds: Optional[float] = None
+        self._callbacks: List[Callable[["Job"], Any]] = []
+
+    def on_done(self, callback: Callable[["Job"], Any]):
+        """
+        Call a function with the job once it is done, or at once if it is done already.
+
+        Callbacks run on the event loop and should be quick. They are not called for failed jobs.
+
+        Args:
+            callback (Callable): The function to call.
+        """
+        if self.status == DONE:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _run_callbacks(self):
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Callback of {self.kind} job {self.id} failed: {str(e)}")
+        self._callbacks = []
+
+    def to_dict(self) -> dict:
+        """
+        Get the status of the job as a JSON-serializable dictionary.
+        """
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "attempts": self.attempts,
+            "result": self.result,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_seconds": self.started_at - self.submitted_at if self.started_at else None,
+            "run_seconds": self.run_seconds,
+        }
+
+
+class JobQueue:
+    """
+    Queue running jobs in a pool of worker processes.
+
+    Job functions and their arguments must be picklable, so they are module-level
+    functions called with paths rather than open files.
+
+    Attributes:
+        workers (int): The number of worker processes.
+        retries (int): The number of times a failed job is retried.
+        retry_delay (float): The delay before the first retry, doubled for every further retry.
+        history (int): The number of finished jobs whose status is kept.
+    """
+    def __init__(self, workers: int = JOB_WORKERS, retries: int = JOB_RETRIES,
+                 retry_delay: float = JOB_RETRY_DELAY, history: int = JOB_HISTORY):
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.history = history
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks = set()
+        self._completed = 0
+        self._run_seconds = 0.0
+        self._queue_seconds = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Spawned workers do not inherit the event loop and threads of the server
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"Started {self.workers} job workers.")
+        return self._executor
+
+    def submit(self, kind: str, func: Callable, *args) -> Job:
+        """
+        Queue a job. Must be called from the event loop.
+
+        Args:
+            kind (str): The kind of job.
+            func (Callable): The module-level function to run.
+            *args: The arguments of the function.
+
+        Returns:
+            Job: The queued job.
+        """
+        job = Job(kind)
+        self.jobs[job.id] = job
+        self._trim()
+        task = asyncio.get_running_loop().create_task(self._run(job, func, args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        JOBS_PENDING.labels(kind).inc()
+        logger.info(f"Queued {kind} job {job.id}.")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Get a job by ID.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            Job: The job, or None if it is unknown or has been dropped from the history.
+        """
+        return self.jobs.get(job_id)
+
+    def _trim(self):
+        """
+        Drop the oldest finished jobs beyond the history size.
+        """
+        excess = len(self.jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [job.id for job in self.jobs.values() if job.status in (DONE, FAILED)][:excess]:
+            del self.jobs[job_id]
+
+    async def _run(self, job: Job, func: Callable, args: tuple):
+        try:
+            await self._attempt(job, func, args)
+        finally:
+            JOBS_PENDING.labels(job.kind).dec()
+            if job.status in (DONE, FAILED):
+                JOBS_FINISHED.labels(job.kind, job.status).inc()
+
+    async def _attempt(self, job: Job, func: Callable, args: tuple):
+        loop = asyncio.get_running_loop()
+        while True:
+            job.attempts += 1
+            try:
+                result, started_at, finished_at = await loop.run_in_executor(self._get_executor(), _timed, func, args)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    # A worker died; start a fresh pool for the retry
+                    self._executor = None
+                job.error = str(e) or type(e).__name__
+                if job.attempts > self.retries:
+                    job.status = FAILED
+                    job.finished_at = time.time()
+                    logger.error(f"{job.kind} job {job.id} failed after {job.attempts} attempts: {job.error}")
+                    return
+                job.status = RETRYING
+                JOBS_RETRIED.labels(job.kind).inc()
+                delay = self.retry_delay * 2 ** (job.attempts - 1)
+                logger.warning(f"{job.kind} job {job.id} failed, retrying in {delay}s: {job.error}")
+                await asyncio.sleep(delay)
+                continue
+
+            job.result = result
+            job.error = None
+            job.started_at = started_at
+            job.run_seconds = finished_at - started_at
+            job.finished_at = time.time()
+            job.status = DONE
+            self._completed += 1
+            self._run_seconds += job.run_seconds
+            self._queue_seconds += started_at - job.submitted_at
+            JOB_QUEUE_DURATION.labels(job.kind).observe(started_at - job.submitted_at)
+            JOB_RUN_DURATION.labels(job.kind).observe(job.run_seconds)
+            logger.info(f"{job.kind} job {job.id} done in {job.run_seconds:.2f}s after {job.attempts} attempts.")
+            job._run_callbacks()
+            return
+
+    def stats(self) -> dict:
+        """
+        Get the number of jobs in each state and their mean timings.
+
+        Returns:
+            dict: The number of workers, the job counts by status, and the mean queue and run seconds of done jobs.
+        """
+        counts = {QUEUED: 0, RETRYING: 0, DONE: 0, FAILED: 0}
+        for job in self.jobs.values():
+            counts[job.status] += 1
+        return {
+            "workers": self.workers,
+            **counts,
+            "completed": self._completed,
+            "mean_queue_seconds": self._queue_seconds / self._completed if self._completed else None,
+            "mean_run_seconds": self._run_seconds / self._completed if self._completed else None,
+        }
+
+    async def shutdown(self):
+        """
+        Wait for the queued jobs to finish and stop the worker processes.
+        """
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor is not None:
+            await asyncio.to_thread(self._executor.shutdown, wait=True)
+            self._executor = None
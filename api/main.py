@@ -1,14 +1,35 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Form
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.proxy import ProxyMiddleware
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 import os
-import shutil
 from pathlib import Path
-from imgProcessingJP2 import convert_image_to_jp2
+from imgProcessingJP2 import convert_image_to_derivative, DERIVATIVE_FORMAT
 from docProcessingPDF import convert_pdf
+from jobs import JobQueue, FAILED
+from dedup import DerivativeIndex, save_and_hash, link_file, link_outputs
+from media import MediaServer, MEDIA_MAX_AGE, is_not_modified
+from metrics import MetricsMiddleware, metrics_response
+from proxy import Proxy, ProxyError
+from thumbnails import ThumbnailCache, THUMBNAIL_PRESETS, THUMBNAIL_MAX_AGE, FORMATS, SOURCE_EXTENSIONS
 
-app = FastAPI()
+# Conversions run in worker processes, so that uploads return before they finish
+job_queue = JobQueue()
+
+
+# Proxy to external resources, over a shared pool of connections
+proxy = Proxy()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    proxy.start()
+    yield
+    await proxy.close()
+    await job_queue.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Array of allowed origins
 allowedDomains = [
@@ -19,62 +40,216 @@ allowedDomains = [
 # CORS options setup
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=allowed_domains,
+    allow_origins=allowedDomains,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# Request timings, body sizes and concurrency by route, exposed at /metrics
+app.add_middleware(MetricsMiddleware, router=app)
+
 # Directory setup
 UPLOAD_DIR = Path("/files")
 PROCESSED_DIR = Path(__file__).parent / "files_processed"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
 
-@app.post("/")
-async def upload_file(uuid: str, file: UploadFile = File(...)):
-    try:
-        file_path = UPLOAD_DIR / file.filename
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+# Index of converted content, so that identical uploads are converted once
+derivative_index = DerivativeIndex(str(PROCESSED_DIR / "derivatives.db"))
+
+# Originals and derivatives, with compressed variants cached next to the derivatives
+media_server = MediaServer(str(UPLOAD_DIR), str(PROCESSED_DIR),
+                           os.getenv("MEDIA_COMPRESSED_DIR", str(PROCESSED_DIR / "compressed")))
+
+# Thumbnails rendered on first request, cached next to the derivatives
+thumbnail_cache = ThumbnailCache(os.getenv("THUMBNAIL_CACHE_DIR", str(PROCESSED_DIR / "thumbnails")))
 
-        ext = file.filename.split('.')[-1]
+def _outputs(result):
+    return result if isinstance(result, list) else [result]
+
+def _find_converted(sha256: str, kind: str):
+    # The conversion of identical content, if its files are still there
+    known = derivative_index.get(sha256, kind)
+    if known is None or not os.path.exists(known["source_path"]):
+        return None
+    if known["outputs"] is None or (known["outputs"] and all(os.path.exists(output) for output in known["outputs"])):
+        return known
+    return None
+
+def _link_duplicate(known: dict, source_path: str, uuid: str) -> list:
+    link_file(known["source_path"], source_path)
+    if known["outputs"]:
+        return link_outputs(known["outputs"], known["base_name"], uuid)
+    return []
+
+@app.post("/", status_code=202)
+async def upload_file(uuid: str = Form(...), file: UploadFile = File(...)):
+    ext = file.filename.split('.')[-1].lower()
+    if ext not in ['jpg', 'jpeg', 'png', 'pdf']:
+        raise HTTPException(status_code=400, detail="Unsupported file format")
+    try:
         new_filename = f"{uuid}.{ext}"
         new_path = UPLOAD_DIR / new_filename
+        temp_path, sha256 = await run_in_threadpool(save_and_hash, file.file, str(UPLOAD_DIR))
+        kind = "pdf" if ext == "pdf" else DERIVATIVE_FORMAT
 
-        if ext in ['jpg', 'jpeg', 'png']:
-            await convert_image_to_jp2(file_path, PROCESSED_DIR / f"{uuid}.jp2")
-        elif ext == 'pdf':
-            await convert_pdf(file_path, PROCESSED_DIR, uuid)
+        # Identical content that is converted, or being converted, is linked instead
+        known = await run_in_threadpool(_find_converted, sha256, kind)
+        known_job = job_queue.get(known["job_id"]) if known else None
+        if known and (known["outputs"] or (known_job is not None and known_job.status != FAILED)):
+            await run_in_threadpool(os.remove, temp_path)
+            await run_in_threadpool(_link_duplicate, known, str(new_path), uuid)
+            media_server.invalidate(str(new_path))
+            if known["outputs"] is None:
+                known_job.on_done(lambda job: link_outputs(_outputs(job.result), known["base_name"], uuid))
+            return {
+                "message": "File uploaded; identical content is already processed.",
+                "file": new_filename,
+                "job_id": known["job_id"],
+                "status_url": f"/jobs/{known['job_id']}",
+                "deduplicated": True,
+            }
+
+        await run_in_threadpool(os.replace, temp_path, new_path)
+        media_server.invalidate(str(new_path))
+        if ext == 'pdf':
+            job = job_queue.submit("pdf", convert_pdf, str(new_path), str(PROCESSED_DIR), uuid)
         else:
-            raise HTTPException(status_code=400, detail="Unsupported file format")
+            job = job_queue.submit(DERIVATIVE_FORMAT, convert_image_to_derivative, str(new_path), str(PROCESSED_DIR), uuid)
+        await run_in_threadpool(derivative_index.register, sha256, kind, str(new_path), uuid, job.id)
+        job.on_done(lambda job: derivative_index.complete(sha256, kind, job.id, _outputs(job.result)))
+        job.on_done(lambda job: [media_server.invalidate(output) for output in _outputs(job.result)])
 
-        os.rename(file_path, new_path)
-        return {"message": "File uploaded and renamed successfully.", "file": new_filename}
+        return {
+            "message": "File uploaded and queued for processing.",
+            "file": new_filename,
+            "job_id": job.id,
+            "status_url": f"/jobs/{job.id}",
+            "deduplicated": False,
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/files/{filename}")
-async def get_file(filename: str):
+@app.get("/jobs")
+async def get_job_stats():
+    return job_queue.stats()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+@app.api_route("/files/{filename}", methods=["GET", "HEAD"])
+async def get_file(filename: str, request: Request):
+    """
+    Get an uploaded file, or a derivative such as a JPEG 2000 or a PDF page.
+
+    Supports byte ranges and conditional requests. Text-like formats, such as OBJ, PLY
+    and JSON, are sent gzip or Brotli compressed to clients that accept it.
+
+    Args:
+        filename (str): The name of the upload or derivative.
+
+    Returns:
+        FileResponse: The file, with a strong ETag and a Cache-Control max-age.
+    """
+    accept_encoding = request.headers.get("accept-encoding", "")
+    found = await run_in_threadpool(media_server.lookup, filename, accept_encoding, "range" in request.headers)
+    if found is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    path, stat_result, media = found
+    headers = {"ETag": media.etag, "Cache-Control": f"public, max-age={MEDIA_MAX_AGE}"}
+    if media_server.compressible(path, stat_result):
+        headers["Vary"] = "Accept-Encoding"
+        if media.encoding is None and "range" not in request.headers:
+            # Compress in the background, for the next requests
+            media_server.compress_later(path, stat_result, accept_encoding)
+    if is_not_modified(request.headers, media.etag, media.mtime):
+        return Response(status_code=304, headers=headers)
+    return media_server.response(media, headers)
+
+@app.get("/thumbnails/{filename}")
+async def get_thumbnail(filename: str, request: Request, size: str = "small", format: str = None):
+    """
+    Get a thumbnail of an uploaded image, or a preview of the first page of a PDF.
+
+    Args:
+        filename (str): The name of the upload.
+        size (str, optional): The size preset, such as `thumb`, `small`, `medium` or `large`.
+        format (str, optional): `webp` or `jpeg`; by default WebP if the client accepts it.
+
+    Returns:
+        FileResponse: The thumbnail, with a strong ETag and a Cache-Control max-age.
+    """
+    if size not in THUMBNAIL_PRESETS:
+        raise HTTPException(status_code=400, detail=f"Unknown size; use one of {', '.join(THUMBNAIL_PRESETS)}")
+    if format is None:
+        format = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+    elif format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format; use one of {', '.join(FORMATS)}")
     file_path = UPLOAD_DIR / filename
-    if file_path.exists():
-        return FileResponse(file_path)
-    raise HTTPException(status_code=404, detail="File not found")
-
-@app.middleware("http")
-async def proxy_middleware(request: Request, call_next):
-    if request.url.path.startswith("/redirect"):
-        target_url = request.query_params.get("url") or request.headers.get("X-Target-URL")
-        if target_url:
-            request.scope["path"] = target_url
-            request.scope["raw_path"] = target_url.encode("utf-8")
-    response = await call_next(request)
-    return response
+    if file_path.parent != UPLOAD_DIR or filename.split('.')[-1].lower() not in SOURCE_EXTENSIONS:
+        raise HTTPException(status_code=404, detail="File not found")
 
-app.add_middleware(
-    ProxyMiddleware,
-    proxy_url="http://example.com",  # Replace with actual proxy URL
-)
+    thumbnail_path = await run_in_threadpool(thumbnail_cache.path, str(file_path), size, format)
+    if thumbnail_path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    # The cache path changes with the source, so it identifies the thumbnail's content
+    headers = {
+        "ETag": f'"{os.path.basename(thumbnail_path)}"',
+        "Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE}",
+        "Vary": "Accept",
+    }
+    if headers["ETag"] in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    try:
+        thumbnail_path = await thumbnail_cache.get(str(file_path), size, format)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not render thumbnail: {str(e)}")
+    if thumbnail_path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(thumbnail_path, media_type=FORMATS[format][1], headers=headers)
+
+@app.get("/stats/media")
+async def get_media_stats():
+    return media_server.stats()
+
+@app.get("/stats/thumbnails")
+async def get_thumbnail_stats():
+    return thumbnail_cache.stats()
+
+@app.api_route("/redirect", methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
+@app.api_route("/redirect/{path:path}", methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
+async def proxy_request(request: Request, path: str = ""):
+    """
+    Proxy a request to an external resource, such as a map tile.
+
+    The target is given by the `url` query parameter or the `X-Target-URL` header; a path
+    after /redirect/ is appended to it. Only hosts in PROXY_ALLOWED_HOSTS are proxied.
+
+    Returns:
+        StreamingResponse: The response of the external host.
+    """
+    target_url = request.query_params.get("url") or request.headers.get("X-Target-URL")
+    if not target_url:
+        raise HTTPException(status_code=400, detail="A url parameter or X-Target-URL header is required")
+    if path:
+        target_url = f"{target_url.rstrip('/')}/{path}"
+    try:
+        return await proxy.forward(request, target_url)
+    except ProxyError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@app.get("/stats/proxy")
+async def get_proxy_stats():
+    return proxy.stats()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,447 @@
+"""
+Serving of uploads and their derivatives for the IKAROS api.
+
+Originals are served from the upload directory and JPEG 2000, TIFF and PDF page
+derivatives from the directory of processed files. Responses carry a strong ETag
+derived from the size and modification time of the file and a Cache-Control max-age,
+so that repeat views are answered with 304 Not Modified, and byte ranges are served
+for viewers that read large files in parts. Files are sent by the server with
+`http.response.pathsend` where it supports it, and read in large chunks otherwise.
+
+Text-like formats, such as OBJ and PLY models and JSON, are served compressed to
+clients that accept it. A gzip or Brotli variant next to a file, as `{name}.gz` or
+`{name}.br`, is used as is; otherwise a variant is compressed in the background after
+the first request and cached, evicting the least recently served beyond a size limit.
+
+The results of `stat` are cached for a short time, so that hot files are served
+without touching the file system until the body is sent. Files written by this
+process are forgotten at once; files replaced by others are seen after at most
+MEDIA_STAT_CACHE_TTL seconds.
+"""
+
+import os
+import gzip
+import stat
+import time
+import asyncio
+import logging
+import mimetypes
+import tempfile
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse
+
+from cachedir import CacheDirectory
+from metrics import MEDIA_REQUESTS
+
+
+logger = logging.getLogger(__name__)
+
+# Number of seconds clients and proxies may reuse a file without revalidating it
+MEDIA_MAX_AGE = int(os.getenv("MEDIA_MAX_AGE", 3600))
+# Number of files whose `stat` results are cached, and for how many seconds
+MEDIA_STAT_CACHE_SIZE = int(os.getenv("MEDIA_STAT_CACHE_SIZE", 4096))
+MEDIA_STAT_CACHE_TTL = float(os.getenv("MEDIA_STAT_CACHE_TTL", 1))
+# Size in bytes of the cache of compressed variants
+MEDIA_COMPRESSED_CACHE_SIZE = int(os.getenv("MEDIA_COMPRESSED_CACHE_SIZE", 1024 * 1024 * 1024))
+# Smallest file in bytes that is compressed
+MEDIA_COMPRESS_MIN_SIZE = int(os.getenv("MEDIA_COMPRESS_MIN_SIZE", 1024))
+
+# Formats served compressed to clients that accept it
+COMPRESSIBLE_EXTENSIONS = {"obj", "mtl", "ply", "stl", "gltf", "json", "geojson", "svg", "txt", "csv", "xml"}
+# Content encodings, by preference: the suffix of their variants
+ENCODINGS = {"br": "br", "gzip": "gz"}
+# Formats of the derivatives written by the conversions
+DERIVATIVE_EXTENSIONS = {"jp2", "tif", "tiff"}
+
+mimetypes.add_type("model/obj", ".obj")
+mimetypes.add_type("model/mtl", ".mtl")
+mimetypes.add_type("model/gltf+json", ".gltf")
+mimetypes.add_type("application/geo+json", ".geojson")
+mimetypes.add_type("application/octet-stream", ".ply")
+mimetypes.add_type("image/jp2", ".jp2")
+
+
+def _brotli():
+    """
+    Import brotli, or return None if it is not installed.
+    """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def available_encodings() -> List[str]:
+    """
+    Get the content encodings variants can be compressed with, by preference.
+    """
+    return [encoding for encoding in ENCODINGS if encoding != "br" or _brotli() is not None]
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """
+    Parse an Accept-Encoding header.
+
+    Args:
+        accept_encoding (str): The header.
+
+    Returns:
+        dict: The quality of each accepted encoding; `*` stands for any other.
+    """
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip()] = quality
+    return accepted
+
+
+def negotiate_encoding(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+    """
+    Choose the encoding to serve from the ones a file has variants in.
+
+    Args:
+        accept_encoding (str): The Accept-Encoding header of the request.
+        encodings (List[str]): The encodings available, by preference.
+
+    Returns:
+        str: The encoding with the highest quality, or None to serve the file as is.
+    """
+    accepted = accepted_encodings(accept_encoding)
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def etag_for(stat_result: os.stat_result, encoding: Optional[str] = None) -> str:
+    """
+    Get the strong ETag of a file, or of its variant in an encoding.
+    """
+    version = f"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"
+    return f'"{version}-{ENCODINGS[encoding]}"' if encoding else f'"{version}"'
+
+
+def is_not_modified(headers, etag: str, mtime: float) -> bool:
+    """
+    Evaluate `If-None-Match` and `If-Modified-Since` against a file's validators.
+
+    `If-Modified-Since` is only considered when `If-None-Match` is absent.
+
+    Args:
+        headers (Headers): The request headers.
+        etag (str): The ETag of the file.
+        mtime (float): The modification time of the file.
+
+    Returns:
+        bool: True if the client's cached copy is current and a 304 response should be sent.
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+    try:
+        since = parsedate_to_datetime(headers.get("if-modified-since", ""))
+    except (TypeError, ValueError):
+        return False
+    return since is not None and int(mtime) <= since.timestamp()
+
+
+class StatCache:
+    """
+    Cache of the `stat` results of regular files, each valid for a few seconds.
+
+    Missing files are not cached, so that a new file is served as soon as it is written.
+    """
+    def __init__(self, max_entries: int = MEDIA_STAT_CACHE_SIZE, ttl: float = MEDIA_STAT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, os.stat_result]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stat(self, path: str) -> Optional[os.stat_result]:
+        """
+        Get the `stat` result of a regular file.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            os.stat_result: The result, or None if there is no regular file at the path.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        try:
+            stat_result = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            stat_result = None
+        with self._lock:
+            if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+                self._entries.pop(path, None)
+                return None
+            self._entries[path] = (now + self.ttl, stat_result)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return stat_result
+
+    def invalidate(self, path: str):
+        """
+        Forget the `stat` result of a file that was written or removed.
+        """
+        with self._lock:
+            self._entries.pop(path, None)
+            for suffix in ENCODINGS.values():
+                self._entries.pop(f"{path}.{suffix}", None)
+
+
+def compress_file(source_path: str, output_path: str, encoding: str) -> str:
+    """
+    Write a compressed variant of a file. Blocking; run on a worker thread.
+
+    Args:
+        source_path (str): The path of the file.
+        output_path (str): The path of the variant to write.
+        encoding (str): `gzip` or `br`.
+
+    Returns:
+        str: The path of the variant.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=".compress-", dir=os.path.dirname(output_path))
+    try:
+        with open(source_path, "rb") as source, os.fdopen(fd, "wb") as output:
+            if encoding == "br":
+                compressor = _brotli().Compressor(quality=9)
+                while chunk := source.read(1024 * 1024):
+                    output.write(compressor.process(chunk))
+                output.write(compressor.finish())
+            else:
+                # mtime=0 so that variants of the same content are identical
+                with gzip.GzipFile(fileobj=output, mode="wb", compresslevel=9, mtime=0) as compressed:
+                    while chunk := source.read(1024 * 1024):
+                        compressed.write(chunk)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return output_path
+
+
+class MediaFile(NamedTuple):
+    """
+    A file, or a variant of it, chosen to be served.
+    """
+    path: str
+    stat: os.stat_result
+    media_type: str
+    encoding: Optional[str]
+    etag: str
+    mtime: float
+
+
+class MediaResponse(FileResponse):
+    """
+    File response reading in larger chunks, for servers that cannot send files themselves.
+    """
+    chunk_size = 1024 * 1024
+
+
+class MediaServer:
+    """
+    Serve originals and derivatives with validators, ranges and compressed variants.
+
+    Attributes:
+        upload_dir (str): The directory of the originals.
+        processed_dir (str): The directory of the derivatives.
+        stat_cache (StatCache): The cached `stat` results.
+        compressed (CacheDirectory): The variants compressed by the api.
+    """
+    def __init__(self, upload_dir: str, processed_dir: str, compressed_dir: str,
+                 compressed_max_bytes: int = MEDIA_COMPRESSED_CACHE_SIZE):
+        self.upload_dir = upload_dir
+        self.processed_dir = processed_dir
+        self.stat_cache = StatCache()
+        self.compressed = CacheDirectory(compressed_dir, compressed_max_bytes)
+        self._compressing: Dict[str, asyncio.Task] = {}
+
+    def lookup(self, filename: str, accept_encoding: str,
+               ranged: bool = False) -> Optional[Tuple[str, os.stat_result, MediaFile]]:
+        """
+        Find a file by name and choose the representation of it to serve, with `resolve` and `select`.
+
+        Blocking, as it may `stat` the file and its variants; run on a worker thread.
+
+        Args:
+            filename (str): The file name.
+            accept_encoding (str): The Accept-Encoding header of the request.
+            ranged (bool, optional): Whether the request is for byte ranges.
+
+        Returns:
+            tuple: The path and `stat` result of the file, and the file or variant to serve,
+                or None if there is no such file.
+        """
+        found = self.resolve(filename)
+        if found is None:
+            return None
+        path, stat_result = found
+        return path, stat_result, self.select(path, stat_result, accept_encoding, ranged)
+
+    def resolve(self, filename: str) -> Optional[Tuple[str, os.stat_result]]:
+        """
+        Find an original, or failing that a derivative, by file name. Blocking.
+
+        Args:
+            filename (str): The file name.
+
+        Returns:
+            tuple: The path and `stat` result of the file, or None if there is none.
+        """
+        if not filename or filename.startswith(".") or os.path.basename(filename) != filename:
+            return None
+        candidates = [os.path.join(self.upload_dir, filename)]
+        if filename.rsplit(".", 1)[-1].lower() in DERIVATIVE_EXTENSIONS:
+            candidates.append(os.path.join(self.processed_dir, filename))
+        for path in candidates:
+            stat_result = self.stat_cache.stat(path)
+            if stat_result is not None:
+                return path, stat_result
+        return None
+
+    def _compressed_path(self, path: str, stat_result: os.stat_result, encoding: str) -> str:
+        version = f"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"
+        return os.path.join(self.compressed.directory,
+                            f"{os.path.basename(path)}.{version}.{ENCODINGS[encoding]}")
+
+    def _variants(self, path: str, stat_result: os.stat_result) -> Dict[str, Tuple[str, os.stat_result]]:
+        """
+        Find the compressed variants of a file that are up to date with it.
+        """
+        variants = {}
+        for encoding, suffix in ENCODINGS.items():
+            # A variant next to the file, compressed ahead of time
+            sibling = self.stat_cache.stat(f"{path}.{suffix}")
+            if sibling is not None and sibling.st_mtime_ns >= stat_result.st_mtime_ns:
+                variants[encoding] = (f"{path}.{suffix}", sibling)
+                continue
+            cached_path = self._compressed_path(path, stat_result, encoding)
+            cached = self.stat_cache.stat(cached_path)
+            if cached is not None:
+                variants[encoding] = (cached_path, cached)
+        return variants
+
+    def select(self, path: str, stat_result: os.stat_result, accept_encoding: str,
+               ranged: bool = False) -> MediaFile:
+        """
+        Choose the representation of a file to serve. Blocking.
+
+        Args:
+            path (str): The path of the file.
+            stat_result (os.stat_result): Its `stat` result.
+            accept_encoding (str): The Accept-Encoding header of the request.
+            ranged (bool, optional): Whether the request is for byte ranges, which are
+                always served from the file as is.
+
+        Returns:
+            MediaFile: The file or variant to serve.
+        """
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if not ranged and self.compressible(path, stat_result):
+            variants = self._variants(path, stat_result)
+            encoding = negotiate_encoding(accept_encoding, [e for e in ENCODINGS if e in variants])
+            if encoding is not None:
+                variant_path, variant_stat = variants[encoding]
+                if variant_path.startswith(self.compressed.directory):
+                    self.compressed.touch(variant_path)
+                return MediaFile(variant_path, variant_stat, media_type, encoding,
+                                 etag_for(stat_result, encoding), stat_result.st_mtime)
+        return MediaFile(path, stat_result, media_type, None, etag_for(stat_result), stat_result.st_mtime)
+
+    def compressible(self, path: str, stat_result: os.stat_result) -> bool:
+        """
+        Check whether a file is of a format that is served compressed.
+        """
+        return (path.rsplit(".", 1)[-1].lower() in COMPRESSIBLE_EXTENSIONS
+                and stat_result.st_size >= MEDIA_COMPRESS_MIN_SIZE)
+
+    def compress_later(self, path: str, stat_result: os.stat_result, accept_encoding: str):
+        """
+        Start compressing the variants of a file that the client would have accepted.
+
+        Variants are compressed once at a time each, in tasks of their own.
+        """
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in available_encodings():
+            if accepted.get(encoding, accepted.get("*", 0.0)) <= 0:
+                continue
+            output_path = self._compressed_path(path, stat_result, encoding)
+            if output_path in self._compressing:
+                continue
+            task = asyncio.ensure_future(self._compress(path, output_path, encoding))
+            self._compressing[output_path] = task
+            task.add_done_callback(lambda _, output_path=output_path: self._compressing.pop(output_path, None))
+
+    async def _compress(self, path: str, output_path: str, encoding: str):
+        try:
+            if await run_in_threadpool(self.stat_cache.stat, output_path) is not None:
+                return
+            await run_in_threadpool(compress_file, path, output_path, encoding)
+            await run_in_threadpool(self.compressed.added, output_path)
+        except Exception as e:
+            logger.error(f"Error compressing {path} with {encoding}: {str(e)}")
+
+    def response(self, media: MediaFile, headers: dict) -> MediaResponse:
+        """
+        Build the response sending a file or variant.
+        """
+        if media.encoding is not None:
+            headers = {**headers, "Content-Encoding": media.encoding}
+        # Variants are validated by the modification time of the file they compress
+        headers = {"Last-Modified": formatdate(media.mtime, usegmt=True), **headers}
+        MEDIA_REQUESTS.labels(media.encoding or "identity").inc()
+        return MediaResponse(media.path, media_type=media.media_type, headers=headers, stat_result=media.stat)
+
+    def invalidate(self, path: str):
+        """
+        Forget what is cached about a file that was written or removed.
+        """
+        self.stat_cache.invalidate(path)
+
+    def stats(self) -> dict:
+        """
+        Get the use of the caches.
+
+        Returns:
+            dict: The hits, misses and entries of the stat cache, and the size of the
+                cache of compressed variants.
+        """
+        return {
+            "stat_cache": {"hits": self.stat_cache.hits, "misses": self.stat_cache.misses,
+                           "entries": len(self.stat_cache._entries)},
+            "compressed": self.compressed.stats(),
+            "encodings": available_encodings(),
+        }
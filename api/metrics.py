@@ -0,0 +1,128 @@
+"""
+Prometheus metrics for the IKAROS api.
+
+Requests are timed by route, with the bytes they receive and send and how many are in
+progress, and the job queue records how long conversions wait and
+run and how many are waiting, so that slow formats and a backed-up queue show up on
+dashboards. Thumbnail and proxy requests are counted by whether they were served from
+the cache, and files by the content encoding they were sent in. The metrics are exposed in the Prometheus text format at /metrics.
+"""
+
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.responses import Response
+from starlette.routing import Match
+
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, until the last byte is sent.",
+    ["method", "route", "status"],
+)
+JOB_QUEUE_DURATION = Histogram(
+    "job_queue_duration_seconds", "Time jobs waited for a worker.", ["kind"],
+    buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+)
+JOB_RUN_DURATION = Histogram(
+    "job_run_duration_seconds", "Time jobs ran in a worker.", ["kind"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+)
+JOBS_FINISHED = Counter(
+    "jobs_finished_total", "Jobs that were done or failed for good.", ["kind", "status"],
+)
+JOBS_RETRIED = Counter(
+    "job_retries_total", "Failed job attempts that were retried.", ["kind"],
+)
+JOBS_PENDING = Gauge(
+    "jobs_pending", "Jobs queued, running or waiting to be retried.", ["kind"],
+)
+REQUEST_BYTES = Counter(
+    "http_request_bytes_total", "Bytes received in request bodies.", ["method", "route"],
+)
+RESPONSE_BYTES = Counter(
+    "http_response_bytes_total", "Bytes sent in response bodies.", ["method", "route"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requests being handled, such as conversions and proxied downloads.",
+    ["method", "route"],
+)
+THUMBNAIL_REQUESTS = Counter(
+    "thumbnail_requests_total", "Thumbnail requests, by whether the thumbnail was cached.", ["preset", "cache"],
+)
+PROXY_REQUESTS = Counter(
+    "proxy_requests_total", "Proxied requests, by whether the response was cached.", ["cache"],
+)
+PROXY_UPSTREAM_DURATION = Histogram(
+    "proxy_upstream_duration_seconds", "Time for proxied hosts to send their response headers.", ["status"],
+)
+MEDIA_REQUESTS = Counter(
+    "media_requests_total", "Files served, by the content encoding they were sent in.", ["encoding"],
+)
+THUMBNAIL_RENDER_DURATION = Histogram(
+    "thumbnail_render_duration_seconds", "Time to render a thumbnail.", ["preset"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+def _route(app, scope) -> str:
+    """
+    Get the path template of the route a request is for, to keep label values bounded.
+    """
+    partial = None
+    for route in getattr(app, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, body sizes and concurrency of requests by route.
+
+    The body sizes are counted as the chunks pass through, so streamed files are
+    measured without being buffered.
+    """
+    def __init__(self, app, router=None):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = _route(self.router, scope) if self.router is not None else "unmatched"
+        status = "500"
+
+        async def receive_counted():
+            message = await receive()
+            if message["type"] == "http.request":
+                REQUEST_BYTES.labels(method, route).inc(len(message.get("body", b"")))
+            return message
+
+        async def send_counted(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            elif message["type"] == "http.response.body":
+                RESPONSE_BYTES.labels(method, route).inc(len(message.get("body", b"")))
+            await send(message)
+
+        in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            in_progress.dec()
+            REQUEST_DURATION.labels(method, route, status).observe(time.perf_counter() - started)
+
+
+def metrics_response() -> Response:
+    """
+    Render the metrics in the Prometheus text format.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
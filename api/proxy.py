@@ -0,0 +1,313 @@
+"""
+Proxy for external resources of the IKAROS api.
+
+The frontend loads map tiles and other external resources through /redirect, so that
+they are served from the origin of the api. Requests are forwarded with one shared
+HTTP client, which keeps a pool of connections open to each upstream host, and the
+request and response bodies are streamed through without being buffered.
+
+Only hosts in PROXY_ALLOWED_HOSTS are proxied, so that the proxy cannot be used to
+reach arbitrary or internal addresses. Successful GET responses can be cached on disk
+in PROXY_CACHE_DIR for as long as their Cache-Control allows, or PROXY_CACHE_TTL
+seconds if it does not say.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from typing import AsyncIterator, Optional
+from urllib.parse import urlsplit
+import httpx
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+from cachedir import CacheDirectory
+from metrics import PROXY_REQUESTS, PROXY_UPSTREAM_DURATION
+
+
+logger = logging.getLogger(__name__)
+
+# Hosts that may be proxied, comma-separated; `*.example.com` matches its subdomains.
+# Nothing is proxied if empty
+PROXY_ALLOWED_HOSTS = [host.strip().lower() for host in os.getenv("PROXY_ALLOWED_HOSTS", "").split(",") if host.strip()]
+# Size of the connection pool, and the number of idle keep-alive connections kept in it
+PROXY_MAX_CONNECTIONS = int(os.getenv("PROXY_MAX_CONNECTIONS", 100))
+PROXY_MAX_KEEPALIVE = int(os.getenv("PROXY_MAX_KEEPALIVE", 20))
+# Seconds an idle connection is kept open
+PROXY_KEEPALIVE_EXPIRY = float(os.getenv("PROXY_KEEPALIVE_EXPIRY", 30))
+# Timeouts in seconds for connecting, for each read and write, and for a free pooled connection
+PROXY_CONNECT_TIMEOUT = float(os.getenv("PROXY_CONNECT_TIMEOUT", 5))
+PROXY_READ_TIMEOUT = float(os.getenv("PROXY_READ_TIMEOUT", 30))
+PROXY_POOL_TIMEOUT = float(os.getenv("PROXY_POOL_TIMEOUT", 10))
+# Directory of the response cache, or empty to cache nothing
+PROXY_CACHE_DIR = os.getenv("PROXY_CACHE_DIR", "")
+# Size in bytes of the response cache
+PROXY_CACHE_SIZE = int(os.getenv("PROXY_CACHE_SIZE", 1024 * 1024 * 1024))
+# Seconds a response without a Cache-Control max-age is cached for
+PROXY_CACHE_TTL = int(os.getenv("PROXY_CACHE_TTL", 86400))
+
+# Headers that apply to one connection and are not forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+    "transfer-encoding", "upgrade",
+}
+# Request headers of the api that are not sent to external hosts
+PRIVATE_HEADERS = {"host", "cookie", "authorization", "x-target-url", "origin", "referer"}
+# Response headers of external hosts that are not passed to clients, as they would apply to the api's origin
+UPSTREAM_PRIVATE_HEADERS = {"set-cookie", "set-cookie2", "strict-transport-security", "alt-svc"}
+# Response headers kept in the cache
+CACHED_HEADERS = {
+    "content-type", "content-encoding", "content-length", "etag", "last-modified", "cache-control", "expires",
+}
+
+
+class ProxyError(Exception):
+    """
+    Raised when a request cannot be proxied; carries the HTTP status to answer with.
+    """
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_allowed(url: str) -> bool:
+    """
+    Check whether a URL may be proxied.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        bool: True if it is an HTTP or HTTPS URL of an allowed host.
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        return False
+    return any(host == allowed or (allowed.startswith("*.") and host.endswith(allowed[1:]))
+               for allowed in PROXY_ALLOWED_HOSTS)
+
+
+def _max_age(headers: httpx.Headers) -> Optional[int]:
+    """
+    Get the number of seconds a response may be cached for, or None if it may not be cached.
+    """
+    directives = {}
+    for directive in headers.get("cache-control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name] = value
+    if "no-store" in directives or "private" in directives or "no-cache" in directives:
+        return None
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return int(directives[name]) or None
+    return PROXY_CACHE_TTL
+
+
+class ResponseCache:
+    """
+    Disk cache of proxied responses, evicting the least recently served beyond a size limit.
+
+    Each response is a file holding a line of JSON, with its status, headers and expiry
+    time, followed by its body.
+
+    Attributes:
+        files (CacheDirectory): The cached responses.
+    """
+    def __init__(self, directory: str, max_bytes: int = PROXY_CACHE_SIZE):
+        self.files = CacheDirectory(directory, max_bytes)
+
+    def path(self, url: str, accept_encoding: str) -> str:
+        """
+        Get the cache path of a response, by URL and the encodings the client accepts.
+        """
+        key = hashlib.sha256(f"{url}\n{accept_encoding}".encode()).hexdigest()
+        return os.path.join(self.files.directory, key)
+
+    def open(self, path: str) -> Optional[Response]:
+        """
+        Get a cached response that has not expired. Blocking; run on a worker thread.
+
+        Returns:
+            Response: The cached response, streamed from disk, or None on a miss.
+        """
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            meta = json.loads(f.readline())
+            if meta["expires_at"] < time.time():
+                f.close()
+                return None
+        except (ValueError, KeyError):
+            f.close()
+            return None
+        self.files.touch(path)
+
+        def iter_body():
+            with f:
+                while chunk := f.read(64 * 1024):
+                    yield chunk
+        return StreamingResponse(iter_body(), status_code=meta["status"],
+                                 headers={**meta["headers"], "X-Cache": "HIT"})
+
+    def writer(self, path: str, response: httpx.Response, max_age: int) -> "CacheWriter":
+        """
+        Start caching a response as its body is streamed.
+        """
+        return CacheWriter(self, path, response, max_age)
+
+
+class CacheWriter:
+    """
+    Write a response to the cache as it is streamed, and keep it only if it is complete.
+    """
+    def __init__(self, cache: ResponseCache, path: str, response: httpx.Response, max_age: int):
+        self.cache = cache
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(prefix=".proxy-", dir=cache.files.directory)
+        self.file = os.fdopen(fd, "wb")
+        headers = {name: value for name, value in response.headers.items() if name in CACHED_HEADERS}
+        meta = {"status": response.status_code, "headers": headers, "expires_at": time.time() + max_age}
+        self.file.write(json.dumps(meta).encode() + b"\n")
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        try:
+            replaced = os.path.getsize(self.path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(self.temp_path, self.path)
+        self.cache.files.added(self.path, replaced)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+class Proxy:
+    """
+    Reverse proxy to allowed external hosts, over a shared pool of keep-alive connections.
+
+    Attributes:
+        client (httpx.AsyncClient): The shared client, created by `start`.
+        cache (ResponseCache): The response cache, or None if caching is disabled.
+    """
+    def __init__(self, cache_dir: str = PROXY_CACHE_DIR):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+
+    def start(self):
+        """
+        Create the shared client. Must be called from the event loop.
+        """
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=PROXY_MAX_CONNECTIONS,
+                                max_keepalive_connections=PROXY_MAX_KEEPALIVE,
+                                keepalive_expiry=PROXY_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(connect=PROXY_CONNECT_TIMEOUT, read=PROXY_READ_TIMEOUT,
+                                  write=PROXY_READ_TIMEOUT, pool=PROXY_POOL_TIMEOUT),
+            follow_redirects=False,
+        )
+
+    async def close(self):
+        """
+        Close the pooled connections.
+        """
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def forward(self, request: Request, url: str) -> Response:
+        """
+        Forward a request to an external URL and stream the response back.
+
+        Args:
+            request (Request): The request to forward.
+            url (str): The URL to forward it to.
+
+        Returns:
+            Response: The response of the external host, streamed.
+
+        Raises:
+            ProxyError: If the URL is not allowed, or the host cannot be reached in time.
+        """
+        if not is_allowed(url):
+            raise ProxyError(403, "The host is not allowed")
+        if request.url.query:
+            # Forward the query of the request without the parameter naming the target
+            query = "&".join(item for item in request.url.query.split("&") if not item.startswith("url="))
+            if query:
+                url = f"{url}{'&' if urlsplit(url).query else '?'}{query}"
+
+        cache_path = None
+        if self.cache is not None and request.method == "GET" and "range" not in request.headers:
+            cache_path = self.cache.path(url, request.headers.get("accept-encoding", ""))
+            cached = await run_in_threadpool(self.cache.open, cache_path)
+            if cached is not None:
+                PROXY_REQUESTS.labels("hit").inc()
+                return cached
+        PROXY_REQUESTS.labels("miss" if cache_path else "bypass").inc()
+
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name not in HOP_BY_HOP_HEADERS and name not in PRIVATE_HEADERS]
+        has_body = request.method not in ("GET", "HEAD") and (
+            "content-length" in request.headers or "transfer-encoding" in request.headers)
+        upstream_request = self.client.build_request(
+            request.method, url, headers=headers, content=request.stream() if has_body else None)
+        started = time.perf_counter()
+        try:
+            upstream = await self.client.send(upstream_request, stream=True)
+        except httpx.TimeoutException:
+            raise ProxyError(504, "The host did not respond in time")
+        except httpx.HTTPError as e:
+            logger.warning(f"Error proxying {url}: {str(e)}")
+            raise ProxyError(502, "The host could not be reached")
+        PROXY_UPSTREAM_DURATION.labels(str(upstream.status_code)).observe(time.perf_counter() - started)
+
+        max_age = _max_age(upstream.headers) if cache_path and upstream.status_code == 200 else None
+        response_headers = {name: value for name, value in upstream.headers.items()
+                            if name not in HOP_BY_HOP_HEADERS and name not in UPSTREAM_PRIVATE_HEADERS}
+        if max_age:
+            response_headers["X-Cache"] = "MISS"
+        return StreamingResponse(self._stream(upstream, cache_path if max_age else None, max_age),
+                                 status_code=upstream.status_code, headers=response_headers,
+                                 background=BackgroundTask(upstream.aclose))
+
+    async def _stream(self, upstream: httpx.Response, cache_path: Optional[str],
+                      max_age: Optional[int]) -> AsyncIterator[bytes]:
+        """
+        Stream the body of an upstream response as received, still encoded, and cache it if complete.
+        """
+        writer = None
+        complete = False
+        try:
+            if cache_path is not None:
+                writer = await run_in_threadpool(self.cache.writer, cache_path, upstream, max_age)
+            async for chunk in upstream.aiter_raw():
+                if writer is not None:
+                    await run_in_threadpool(writer.write, chunk)
+                yield chunk
+            complete = True
+        finally:
+            await upstream.aclose()
+            if writer is not None:
+                await run_in_threadpool(writer.commit if complete else writer.discard)
+
+    def stats(self) -> dict:
+        """
+        Get the size of the response cache.
+
+        Returns:
+            dict: The allowed hosts, and the bytes cached and size limit of the cache, if enabled.
+        """
+        return {"allowed_hosts": PROXY_ALLOWED_HOSTS, "cache": self.cache.files.stats() if self.cache else None}
@@ -0,0 +1,20 @@
+"""
+Configuration for pytest.
+
+The tests exercise the modules of the api directly, without importing the application,
+which creates its upload and processing directories on import. Run them from the api
+directory with `python -m pytest tests/`.
+"""
+
+import pytest
+
+
+@pytest.fixture
+def media_dirs(tmp_path):
+    """
+    Fixture to provide empty directories of uploads, derivatives and cached variants.
+    """
+    directories = {name: tmp_path / name for name in ("uploads", "processed", "compressed")}
+    for directory in directories.values():
+        directory.mkdir()
+    return directories
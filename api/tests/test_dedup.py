@@ -0,0 +1,51 @@
+"""
+Tests for the deduplication of uploads and derivatives.
+"""
+
+import io
+import hashlib
+
+from dedup import DerivativeIndex, save_and_hash, link_outputs
+
+
+def test_derivative_index(tmp_path):
+    """
+    Test that conversions are found by content and kind once registered, with their outputs once complete.
+    """
+    index = DerivativeIndex(str(tmp_path / "derivatives.db"))
+    sha256 = hashlib.sha256(b"image").hexdigest()
+
+    assert index.get(sha256, "jp2") is None
+
+    index.register(sha256, "jp2", "/files/a.jpg", "a", "job-1")
+    assert index.get(sha256, "jp2") == {"source_path": "/files/a.jpg", "base_name": "a", "job_id": "job-1",
+                                        "outputs": None}
+    assert index.get(sha256, "pdf") is None
+
+    # Only the job that is registered completes the conversion
+    index.complete(sha256, "jp2", "job-0", ["/processed/stale.jp2"])
+    assert index.get(sha256, "jp2")["outputs"] is None
+    index.complete(sha256, "jp2", "job-1", ["/processed/a.jp2"])
+    assert index.get(sha256, "jp2")["outputs"] == ["/processed/a.jp2"]
+
+    # A new conversion of the same content replaces the old one
+    index.register(sha256, "jp2", "/files/b.jpg", "b", "job-2")
+    assert index.get(sha256, "jp2")["job_id"] == "job-2"
+    assert index.get(sha256, "jp2")["outputs"] is None
+
+
+def test_duplicate_derivatives_are_links(tmp_path):
+    """
+    Test that uploads are hashed as they are saved, and derivatives linked under the duplicate's name.
+    """
+    temp_path, sha256 = save_and_hash(io.BytesIO(b"content" * 1000), str(tmp_path))
+    assert sha256 == hashlib.sha256(b"content" * 1000).hexdigest()
+    assert open(temp_path, "rb").read() == b"content" * 1000
+
+    outputs = [tmp_path / "first.jp2", tmp_path / "first_page1.tif"]
+    for output in outputs:
+        output.write_bytes(b"derivative")
+    links = link_outputs([str(output) for output in outputs], "first", "second")
+
+    assert links == [str(tmp_path / "second.jp2"), str(tmp_path / "second_page1.tif")]
+    assert (tmp_path / "second_page1.tif").stat().st_ino == outputs[1].stat().st_ino
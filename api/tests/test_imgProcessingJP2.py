@@ -0,0 +1,28 @@
+"""
+Tests for the JPEG 2000 conversion options.
+"""
+
+from imgProcessingJP2 import resolution_levels, opj_options
+
+
+def test_resolution_levels():
+    """
+    Test that the smallest level fits in a tile, without a level narrower than a pixel per tile.
+    """
+    assert resolution_levels(200, 100, tile_size=256) == 1
+    assert resolution_levels(256, 256, tile_size=256) == 1
+    assert resolution_levels(257, 100, tile_size=256) == 2
+    assert resolution_levels(300, 10000, tile_size=256) == 7
+    assert resolution_levels(1, 1, tile_size=256) == 1
+    # 2^9 levels below a 256 pixel tile would be narrower than a pixel
+    assert resolution_levels(10 ** 6, 10 ** 6, tile_size=256) == 9
+    assert resolution_levels(10 ** 6, 10 ** 6, tile_size=64) == 7
+
+
+def test_opj_options():
+    """
+    Test that the tile size and resolution levels are passed to the encoder.
+    """
+    options = opj_options(4000, 3000)
+    assert options[options.index("-n") + 1] == str(resolution_levels(4000, 3000))
+    assert options[options.index("-p") + 1] == "RPCL"
@@ -0,0 +1,84 @@
+"""
+Tests for the background job queue.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import jobs
+from jobs import JobQueue, DONE, FAILED
+
+
+def _queue(monkeypatch, retries):
+    """
+    Create a queue running jobs on a thread, recording the delays it waits before retries.
+    """
+    queue = JobQueue(workers=1, retries=retries, retry_delay=0.5)
+    # A thread instead of spawned processes, so that job functions can count their calls
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(queue, "_get_executor", lambda: executor)
+    delays = []
+    sleep = asyncio.sleep
+
+    async def record_delay(delay):
+        delays.append(delay)
+        await sleep(0)
+    monkeypatch.setattr(jobs.asyncio, "sleep", record_delay)
+    return queue, delays
+
+
+def _run(queue, kind, func, callbacks):
+    async def run():
+        job = queue.submit(kind, func)
+        job.on_done(callbacks.append)
+        await queue.shutdown()
+        return job
+    return asyncio.run(run())
+
+
+def test_failed_jobs_are_retried_with_backoff(monkeypatch):
+    """
+    Test that a failing job is retried with doubling delays, and its callbacks run once it is done.
+    """
+    queue, delays = _queue(monkeypatch, retries=2)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise OSError("opj_compress crashed")
+        return "/files_processed/out.jp2"
+
+    callbacks = []
+    job = _run(queue, "jp2", flaky, callbacks)
+
+    assert job.status == DONE
+    assert job.attempts == 3
+    assert job.result == "/files_processed/out.jp2"
+    assert job.error is None
+    assert delays == [0.5, 1.0]
+    assert callbacks == [job]
+    # A callback added once the job is done runs at once
+    job.on_done(callbacks.append)
+    assert callbacks == [job, job]
+    assert queue.stats()["done"] == 1
+
+
+def test_jobs_fail_after_their_retries(monkeypatch):
+    """
+    Test that a job failing every attempt is marked failed without running its callbacks.
+    """
+    queue, delays = _queue(monkeypatch, retries=1)
+
+    def broken():
+        raise ValueError("not an image")
+
+    callbacks = []
+    job = _run(queue, "pdf", broken, callbacks)
+
+    assert job.status == FAILED
+    assert job.attempts == 2
+    assert job.error == "not an image"
+    assert delays == [0.5]
+    assert callbacks == []
+    assert job.to_dict()["finished_at"] is not None
@@ -0,0 +1,66 @@
+"""
+Tests for serving uploads and their derivatives.
+"""
+
+import gzip
+import os
+
+from media import MediaServer, negotiate_encoding, is_not_modified
+
+
+def test_negotiate_encoding():
+    """
+    Test that the encoding with the highest quality is chosen, by preference on ties.
+    """
+    assert negotiate_encoding("gzip, deflate, br", ["br", "gzip"]) == "br"
+    assert negotiate_encoding("gzip;q=1.0, br;q=0.5", ["br", "gzip"]) == "gzip"
+    assert negotiate_encoding("br;q=0, *", ["br", "gzip"]) == "gzip"
+    assert negotiate_encoding("identity", ["br", "gzip"]) is None
+    assert negotiate_encoding("", ["br", "gzip"]) is None
+    assert negotiate_encoding("gzip;q=bad", ["gzip"]) is None
+    assert negotiate_encoding("br", []) is None
+
+
+def test_not_modified(media_dirs):
+    """
+    Test that a file is answered with 304 by its ETag or modification time until it is replaced.
+    """
+    server = MediaServer(str(media_dirs["uploads"]), str(media_dirs["processed"]), str(media_dirs["compressed"]))
+    path = media_dirs["uploads"] / "photo.jpg"
+    path.write_bytes(b"\xff\xd8" + b"\x00" * 100)
+
+    _, _, media = server.lookup("photo.jpg", "")
+    assert media.encoding is None
+    assert is_not_modified({"if-none-match": media.etag}, media.etag, media.mtime)
+    assert is_not_modified({"if-none-match": f'"other", {media.etag}'}, media.etag, media.mtime)
+    response = server.response(media, {"ETag": media.etag})
+    assert is_not_modified({"if-modified-since": response.headers["last-modified"]}, media.etag, media.mtime)
+
+    path.write_bytes(b"\xff\xd8" + b"\x01" * 200)
+    os.utime(path, (media.mtime + 10, media.mtime + 10))
+    server.invalidate(str(path))
+    _, _, replaced = server.lookup("photo.jpg", "")
+    assert replaced.etag != media.etag
+    assert not is_not_modified({"if-none-match": media.etag}, replaced.etag, replaced.mtime)
+
+
+def test_lookup(media_dirs):
+    """
+    Test that derivatives are found in the processed directory, and precompressed variants served when accepted.
+    """
+    server = MediaServer(str(media_dirs["uploads"]), str(media_dirs["processed"]), str(media_dirs["compressed"]))
+    (media_dirs["processed"] / "scan.jp2").write_bytes(b"jp2")
+    model = b"v 0 0 0\n" * 1000
+    (media_dirs["uploads"] / "mesh.obj").write_bytes(model)
+    (media_dirs["uploads"] / "mesh.obj.gz").write_bytes(gzip.compress(model))
+
+    assert server.lookup("scan.jp2", "")[0] == str(media_dirs["processed"] / "scan.jp2")
+    assert server.lookup("missing.jpg", "") is None
+    assert server.lookup("../uploads/mesh.obj", "") is None
+
+    _, _, compressed = server.lookup("mesh.obj", "gzip, br")
+    assert compressed.encoding == "gzip"
+    assert compressed.path.endswith("mesh.obj.gz")
+    assert compressed.media_type == "model/obj"
+    _, _, ranged = server.lookup("mesh.obj", "gzip", ranged=True)
+    assert ranged.encoding is None and ranged.etag != compressed.etag
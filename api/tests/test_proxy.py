@@ -0,0 +1,77 @@
+"""
+Tests for the proxy to external resources.
+"""
+
+import asyncio
+import httpx
+import pytest
+from starlette.requests import Request
+
+import proxy
+from proxy import Proxy, ProxyError, is_allowed
+
+
+def _request(path="/redirect", query=b""):
+    async def receive():
+        return {"type": "http.request", "body": b""}
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": query,
+                    "headers": [(b"cookie", b"session=secret")]}, receive)
+
+
+def test_is_allowed(monkeypatch):
+    """
+    Test that only HTTP(S) URLs of listed hosts, or subdomains of wildcard entries, are allowed.
+    """
+    monkeypatch.setattr(proxy, "PROXY_ALLOWED_HOSTS", ["tiles.example.org", "*.tile.openstreetmap.org"])
+
+    assert is_allowed("https://tiles.example.org/1/2/3.png")
+    assert is_allowed("http://TILES.example.org/1/2/3.png")
+    assert is_allowed("https://a.tile.openstreetmap.org/1/2/3.png")
+    assert not is_allowed("https://tile.openstreetmap.org/1/2/3.png")
+    assert not is_allowed("https://eviltile.openstreetmap.org/1/2/3.png")
+    assert not is_allowed("https://tiles.example.org.evil.test/1.png")
+    assert not is_allowed("https://tiles.example.org@evil.test/1.png")
+    assert not is_allowed("ftp://tiles.example.org/1.png")
+    assert not is_allowed("file:///etc/passwd")
+
+
+def test_empty_allowlist_is_forbidden(monkeypatch):
+    """
+    Test that nothing is proxied when no host is allowed.
+    """
+    monkeypatch.setattr(proxy, "PROXY_ALLOWED_HOSTS", [])
+    upstream = Proxy(cache_dir="")
+    upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+
+    with pytest.raises(ProxyError) as error:
+        asyncio.run(upstream.forward(_request(), "https://tiles.example.org/1.png"))
+    assert error.value.status_code == 403
+
+
+def test_private_headers_are_not_forwarded(monkeypatch):
+    """
+    Test that cookies go neither to the host nor back from it, and the host's HSTS and Alt-Svc are dropped.
+    """
+    monkeypatch.setattr(proxy, "PROXY_ALLOWED_HOSTS", ["tiles.example.org"])
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(200, content=b"tile", headers=[
+            ("content-type", "image/png"), ("set-cookie", "tracker=1"),
+            ("strict-transport-security", "max-age=31536000"), ("alt-svc", 'h3=":443"'),
+        ])
+
+    async def forward():
+        upstream = Proxy(cache_dir="")
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        response = await upstream.forward(_request(query=b"url=x&z=3"), "https://tiles.example.org/1.png")
+        await upstream.close()
+        return response
+
+    response = asyncio.run(forward())
+
+    assert "cookie" not in sent[0].headers
+    assert sent[0].url == "https://tiles.example.org/1.png?z=3"
+    assert response.headers["content-type"] == "image/png"
+    assert not {"set-cookie", "strict-transport-security", "alt-svc"} & set(response.headers)
@@ -0,0 +1,62 @@
+"""
+Tests for thumbnail rendering and caching.
+"""
+
+import time
+import asyncio
+from PIL import Image
+
+import thumbnails
+from thumbnails import ThumbnailCache, render_thumbnail, THUMBNAIL_PRESETS
+
+
+def test_thumbnail_sizes(tmp_path):
+    """
+    Test that thumbnails fit their preset on the longest side and keep the aspect ratio.
+    """
+    source = tmp_path / "wide.png"
+    Image.new("RGBA", (1000, 500), (200, 100, 50, 128)).save(source)
+
+    render_thumbnail(str(source), str(tmp_path / "wide.webp"), THUMBNAIL_PRESETS["small"], "webp")
+    render_thumbnail(str(source), str(tmp_path / "wide.jpg"), THUMBNAIL_PRESETS["thumb"], "jpeg")
+
+    with Image.open(tmp_path / "wide.webp") as image:
+        assert image.size == (THUMBNAIL_PRESETS["small"], THUMBNAIL_PRESETS["small"] // 2)
+        assert image.mode == "RGBA"
+    with Image.open(tmp_path / "wide.jpg") as image:
+        assert image.size == (THUMBNAIL_PRESETS["thumb"], THUMBNAIL_PRESETS["thumb"] // 2)
+        assert image.mode == "RGB"
+
+    small = tmp_path / "small.png"
+    Image.new("RGB", (40, 80)).save(small)
+    render_thumbnail(str(small), str(tmp_path / "small.webp"), THUMBNAIL_PRESETS["large"], "webp")
+    with Image.open(tmp_path / "small.webp") as image:
+        assert image.size == (40, 80)
+
+
+def test_concurrent_requests_render_once(tmp_path, monkeypatch):
+    """
+    Test that concurrent requests for a thumbnail wait for a single rendering, and later ones hit the cache.
+    """
+    source = tmp_path / "photo.png"
+    Image.new("RGB", (600, 400)).save(source)
+    cache = ThumbnailCache(str(tmp_path / "thumbnails"))
+    rendered = []
+    render = thumbnails.render_thumbnail
+
+    def slow_render(*args):
+        rendered.append(args)
+        time.sleep(0.05)
+        return render(*args)
+    monkeypatch.setattr(thumbnails, "render_thumbnail", slow_render)
+
+    async def requests():
+        first = await asyncio.gather(*[cache.get(str(source), "thumb", "webp") for _ in range(5)])
+        return first, await cache.get(str(source), "thumb", "webp")
+
+    paths, cached = asyncio.run(requests())
+
+    assert len(rendered) == 1
+    assert len(set(paths)) == 1 and cached == paths[0]
+    assert cache.path(str(source), "thumb", "webp") == cached
+    assert asyncio.run(cache.get(str(tmp_path / "missing.png"), "thumb", "webp")) is None
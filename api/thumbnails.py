@@ -0,0 +1,188 @@
+"""
+Thumbnails and previews for the IKAROS api.
+
+Media grids show small previews of many files at once, so serving the originals would
+transfer megabytes per tile. Thumbnails are rendered in a few fixed size presets, as
+WebP or JPEG, on the first request for them. Images are downscaled while they are
+decoded where the format allows it, and PDFs are previewed by their first page.
+
+Rendered thumbnails are cached on disk under a name that includes the size and
+modification time of the source, so a replaced source gets new thumbnails and the old
+ones age out. The cache is kept under a size limit by evicting the least recently
+served thumbnails.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import tempfile
+from typing import Dict, Optional
+import pymupdf
+from PIL import Image, ImageOps
+from starlette.concurrency import run_in_threadpool
+
+from cachedir import CacheDirectory
+from metrics import THUMBNAIL_REQUESTS, THUMBNAIL_RENDER_DURATION
+
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_presets(value: str) -> Dict[str, int]:
+    presets = {}
+    for preset in value.split(","):
+        name, size = preset.split(":")
+        presets[name.strip()] = int(size)
+    return presets
+
+
+# Size presets, as `name:pixels` pairs bounding the longest side of the thumbnail
+THUMBNAIL_PRESETS = _parse_presets(os.getenv("THUMBNAIL_PRESETS", "thumb:128,small:256,medium:512,large:1024"))
+# Quality of WebP and JPEG thumbnails, from 1 to 100
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+# Size in bytes of the thumbnail cache, beyond which the least recently served are evicted
+THUMBNAIL_CACHE_SIZE = int(os.getenv("THUMBNAIL_CACHE_SIZE", 1024 * 1024 * 1024))
+# Number of seconds clients and proxies may reuse a thumbnail without revalidating it
+THUMBNAIL_MAX_AGE = int(os.getenv("THUMBNAIL_MAX_AGE", 86400))
+
+# Output formats, by name: the Pillow format and the content type
+FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+# Source formats a thumbnail can be rendered from
+SOURCE_EXTENSIONS = {"jpg", "jpeg", "png", "pdf"}
+
+
+def _open_image(source_path: str, size: int) -> Image.Image:
+    """
+    Open an image or the first page of a PDF, reduced to about the size of the thumbnail.
+    """
+    if source_path.lower().endswith(".pdf"):
+        with pymupdf.open(source_path) as document:
+            page = document[0]
+            zoom = size / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+            return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    with Image.open(source_path) as image:
+        # Let the JPEG decoder scale down by up to 8 times instead of decoding every pixel
+        image.draft("RGB", (size, size))
+        return ImageOps.exif_transpose(image)
+
+
+def render_thumbnail(source_path: str, output_path: str, size: int, format: str) -> str:
+    """
+    Render the thumbnail of an image or PDF. Blocking; run on a worker thread.
+
+    Args:
+        source_path (str): The path of the image or PDF.
+        output_path (str): The path of the thumbnail to write.
+        size (int): The size in pixels of the longest side of the thumbnail.
+        format (str): The format of the thumbnail, `webp` or `jpeg`.
+
+    Returns:
+        str: The path of the thumbnail.
+    """
+    image = _open_image(source_path, size)
+    try:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if format == "jpeg" or image.mode not in ("RGB", "RGBA"):
+            has_alpha = format != "jpeg" and (image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info)
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        # Write to a temporary file, so that a thumbnail is never served half written
+        fd, temp_path = tempfile.mkstemp(prefix=".thumb-", dir=os.path.dirname(output_path))
+        try:
+            with os.fdopen(fd, "wb") as output:
+                image.save(output, format=FORMATS[format][0], quality=THUMBNAIL_QUALITY)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    finally:
+        image.close()
+    return output_path
+
+
+class ThumbnailCache:
+    """
+    Disk cache of rendered thumbnails, evicting the least recently served beyond a size limit.
+
+    Attributes:
+        directory (str): The directory of the cached thumbnails.
+        files (CacheDirectory): The cached thumbnails.
+    """
+    def __init__(self, directory: str, max_bytes: int = THUMBNAIL_CACHE_SIZE):
+        self.directory = directory
+        self.files = CacheDirectory(directory, max_bytes)
+        self._rendering: Dict[str, asyncio.Task] = {}
+
+    def path(self, source_path: str, preset: str, format: str) -> Optional[str]:
+        """
+        Get the cache path of a thumbnail, which changes whenever the source changes. Blocking.
+
+        Args:
+            source_path (str): The path of the image or PDF.
+            preset (str): The size preset.
+            format (str): The format of the thumbnail.
+
+        Returns:
+            str: The path of the thumbnail, or None if the source does not exist.
+        """
+        try:
+            stat = os.stat(source_path)
+        except FileNotFoundError:
+            return None
+        version = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        return os.path.join(self.directory, f"{os.path.basename(source_path)}.{preset}.{version}.{format}")
+
+    async def get(self, source_path: str, preset: str, format: str) -> Optional[str]:
+        """
+        Get a thumbnail from the cache, rendering it on the first request.
+
+        Concurrent requests for the same thumbnail wait for a single rendering.
+
+        Args:
+            source_path (str): The path of the image or PDF.
+            preset (str): The size preset.
+            format (str): The format of the thumbnail.
+
+        Returns:
+            str: The path of the thumbnail, or None if the source does not exist.
+        """
+        path = await run_in_threadpool(self.path, source_path, preset, format)
+        if path is None:
+            return None
+        if await run_in_threadpool(self.files.touch, path):
+            THUMBNAIL_REQUESTS.labels(preset, "hit").inc()
+            return path
+
+        rendering = self._rendering.get(path)
+        THUMBNAIL_REQUESTS.labels(preset, "hit" if rendering is not None else "miss").inc()
+        if rendering is None:
+            # Render in a task of its own, so that a client disconnecting does not cancel it
+            rendering = asyncio.ensure_future(self._render(source_path, path, preset, format))
+            self._rendering[path] = rendering
+            rendering.add_done_callback(lambda _: self._rendering.pop(path, None))
+        return await asyncio.shield(rendering)
+
+    async def _render(self, source_path: str, path: str, preset: str, format: str) -> str:
+        started = time.perf_counter()
+        try:
+            await run_in_threadpool(render_thumbnail, source_path, path, THUMBNAIL_PRESETS[preset], format)
+        except Exception as e:
+            logger.error(f"Error rendering the {preset} thumbnail of {source_path}: {str(e)}")
+            raise
+        THUMBNAIL_RENDER_DURATION.labels(preset).observe(time.perf_counter() - started)
+        await run_in_threadpool(self.files.added, path)
+        return path
+
+    def stats(self) -> dict:
+        """
+        Get the size of the cache.
+
+        Returns:
+            dict: The number of bytes cached, and the size limit.
+        """
+        return self.files.stats()
@@ -0,0 +1,436 @@
+"""
+Backups of the IKAROS Postgres databases.
+
+Every hour the databases in BACKUP_DATABASES are dumped with `pg_dump` in the directory
+format, which dumps tables in parallel (BACKUP_JOBS) and compresses each table on its
+own (BACKUP_COMPRESSION). The run at midnight dumps every database of the server but
+the restore checks, and its roles, and becomes the daily backup; on Sundays it is also the weekly backup and
+on the first of the month the monthly one. Tiers are hard links to the run, so they
+take no space of their own.
+
+Tables that did not change since the previous run dump to the same compressed file,
+so each file is hashed and, if the previous run has a file with the same content,
+replaced by a hard link to it. Only changed tables take new space.
+
+The daily backup of RESTORE_DATABASE is restored with a parallel `pg_restore` into
+RESTORE_DB_DAILY to check that it can be restored, and on Sundays also into
+RESTORE_DB_WEEKLY.
+
+Each run writes a `manifest.json` with the duration, size and new bytes of every dump
+and restore, and appends it to `history.jsonl` in BACKUP_DIR. A run that starts while
+another is still going exits at once.
+
+Usage:
+    python backup.py run
+    python backup.py run --daily --weekly
+    python backup.py restore ikaros ikaros_restore_test
+    python backup.py restore ikaros ikaros_restore_test --backup /backups/daily/20250101000000
+    python backup.py list
+
+The server is given with POSTGRES_HOST, POSTGRES_PORT, POSTGRES_USER and
+POSTGRES_PASSWORD, so the script can be run against a local Postgres with
+`BACKUP_DIR=/tmp/backups POSTGRES_HOST=localhost python backup.py run --daily`.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import argparse
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger("backup")
+
+# Directory of the backups
+BACKUP_DIR = os.getenv("BACKUP_DIR", "/backups")
+# Databases dumped every hour, comma-separated
+BACKUP_DATABASES = [name.strip() for name in os.getenv("BACKUP_DATABASES", "").split(",") if name.strip()]
+# Number of tables dumped and restored at once
+BACKUP_JOBS = int(os.getenv("BACKUP_JOBS", 4))
+# Compression of the dumped tables, as `pg_dump --compress` takes it, such as `gzip:6` or `zstd:3`
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "gzip:6")
+# Number of backups kept in each tier
+RETENTION = {
+    "hourly": int(os.getenv("BACKUP_RETENTION_HOURLY") or 24),
+    "daily": int(os.getenv("BACKUP_RETENTION_DAILY") or 7),
+    "weekly": int(os.getenv("BACKUP_RETENTION_WEEKLY") or 4),
+    "monthly": int(os.getenv("BACKUP_RETENTION_MONTHLY") or 12),
+}
+# Database whose daily backup is restored to check it, and the databases it is restored into
+RESTORE_DATABASE = os.getenv("RESTORE_DATABASE", "")
+RESTORE_DB_DAILY = os.getenv("RESTORE_DB_DAILY", "")
+RESTORE_DB_WEEKLY = os.getenv("RESTORE_DB_WEEKLY", "")
+
+# Files of a run that are not part of a dump
+MANIFEST = "manifest.json"
+HASHES = "hashes.json"
+GLOBALS = "globals.sql"
+
+# Buffer size used when hashing dumps
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _pg_env() -> dict:
+    """
+    Get the environment the Postgres tools connect to the server with.
+    """
+    env = dict(os.environ)
+    for name, pg_name in (("POSTGRES_HOST", "PGHOST"), ("POSTGRES_PORT", "PGPORT"),
+                          ("POSTGRES_USER", "PGUSER"), ("POSTGRES_PASSWORD", "PGPASSWORD")):
+        if os.getenv(name):
+            env[pg_name] = os.environ[name]
+    return env
+
+
+def run_command(args: List[str]) -> str:
+    """
+    Run a Postgres tool.
+
+    Args:
+        args (List[str]): The command and its arguments.
+
+    Returns:
+        str: What the command wrote to its standard output.
+
+    Raises:
+        RuntimeError: If the command fails.
+    """
+    logger.debug(f"Running {' '.join(args)}")
+    result = subprocess.run(args, capture_output=True, text=True, env=_pg_env())
+    if result.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed with code {result.returncode}: {result.stderr.strip()[-2000:]}")
+    return result.stdout
+
+
+def list_databases() -> List[str]:
+    """
+    Get the databases of the server that can be connected to.
+    """
+    output = run_command(["psql", "-d", "postgres", "-tAc",
+                          "SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate ORDER BY datname"])
+    return [name for name in output.splitlines() if name]
+
+
+def dump_database(database: str, output_dir: str):
+    """
+    Dump a database in the directory format, dumping its tables in parallel.
+
+    Args:
+        database (str): The database.
+        output_dir (str): The directory to write, which must not exist.
+    """
+    run_command(["pg_dump", "--format=directory", f"--jobs={BACKUP_JOBS}", f"--compress={BACKUP_COMPRESSION}",
+                 f"--file={output_dir}", f"--dbname={database}"])
+
+
+def dump_globals(output_path: str):
+    """
+    Dump the roles and tablespaces of the server, which no database dump includes.
+    """
+    run_command(["pg_dumpall", "--globals-only", f"--file={output_path}"])
+
+
+def restore_database(dump_dir: str, database: str) -> dict:
+    """
+    Restore a dump into a new database, replacing any database of that name.
+
+    Args:
+        dump_dir (str): The directory of the dump.
+        database (str): The database to restore into.
+
+    Returns:
+        dict: The duration of the restore and the size of the restored database.
+    """
+    started = time.monotonic()
+    run_command(["dropdb", "--if-exists", database])
+    run_command(["createdb", database])
+    run_command(["pg_restore", f"--jobs={BACKUP_JOBS}", "--no-owner", "--no-privileges",
+                 f"--dbname={database}", dump_dir])
+    size = run_command(["psql", "-d", database, "-tAc", "SELECT pg_database_size(current_database())"])
+    return {"duration": round(time.monotonic() - started, 3), "bytes": int(size.strip())}
+
+
+def hash_file(path: str) -> str:
+    """
+    Get the hex SHA-256 digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def deduplicate(dump_dir: str, known: Dict[Tuple[int, str], str]) -> Tuple[Dict[str, list], int, int]:
+    """
+    Replace the files of a dump that are identical to known files by hard links to them.
+
+    Args:
+        dump_dir (str): The directory of the dump.
+        known (dict): The paths of known files, by size and hex SHA-256 digest.
+
+    Returns:
+        tuple: The size and digest of each file, by path relative to the dump, the number
+            of bytes that were linked, and the number of bytes that are new.
+    """
+    hashes, linked_bytes, new_bytes = {}, 0, 0
+    for name in sorted(os.listdir(dump_dir)):
+        path = os.path.join(dump_dir, name)
+        size = os.path.getsize(path)
+        digest = hash_file(path)
+        hashes[name] = [size, digest]
+        known_path = known.get((size, digest))
+        if known_path is not None and os.path.exists(known_path):
+            temp_path = os.path.join(dump_dir, f".link-{name}")
+            os.link(known_path, temp_path)
+            os.replace(temp_path, path)
+            linked_bytes += size
+        else:
+            new_bytes += size
+    return hashes, linked_bytes, new_bytes
+
+
+def link_tree(src_dir: str, dest_dir: str):
+    """
+    Copy a directory tree as hard links to its files.
+    """
+    shutil.copytree(src_dir, dest_dir, copy_function=os.link)
+
+
+def backups(tier: str) -> List[str]:
+    """
+    Get the complete backups of a tier, oldest first.
+
+    Args:
+        tier (str): `hourly`, `daily`, `weekly` or `monthly`.
+
+    Returns:
+        List[str]: The directories of the backups.
+    """
+    tier_dir = os.path.join(BACKUP_DIR, tier)
+    if not os.path.isdir(tier_dir):
+        return []
+    return [os.path.join(tier_dir, name) for name in sorted(os.listdir(tier_dir))
+            if not name.startswith(".") and os.path.exists(os.path.join(tier_dir, name, MANIFEST))]
+
+
+def apply_retention(tier: str, keep: int) -> List[str]:
+    """
+    Remove all but the newest backups of a tier, and any incomplete runs.
+
+    Args:
+        tier (str): The tier.
+        keep (int): The number of backups to keep.
+
+    Returns:
+        List[str]: The directories removed.
+    """
+    tier_dir = os.path.join(BACKUP_DIR, tier)
+    complete = backups(tier)
+    removed = complete[:max(len(complete) - keep, 0)]
+    if os.path.isdir(tier_dir):
+        removed += [os.path.join(tier_dir, name) for name in os.listdir(tier_dir) if name.startswith(".")]
+    for path in removed:
+        shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+def _known_files(previous_dir: Optional[str]) -> Dict[str, Dict[Tuple[int, str], str]]:
+    """
+    Get the files of each database's dump in a previous run, by size and digest.
+    """
+    known = {}
+    if previous_dir is None:
+        return known
+    try:
+        with open(os.path.join(previous_dir, HASHES)) as f:
+            previous = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return known
+    for database, files in previous.items():
+        known[database] = {(size, digest): os.path.join(previous_dir, database, name)
+                           for name, (size, digest) in files.items()}
+    return known
+
+
+def run_backup(now: datetime, daily: bool, weekly: bool, monthly: bool) -> dict:
+    """
+    Dump the databases, deduplicate the dumps against the previous run, and fill the tiers.
+
+    Args:
+        now (datetime): The time of the run, which names it.
+        daily (bool): Whether to dump every database and the roles, and keep the run as a daily backup.
+        weekly (bool): Whether to also keep the run as a weekly backup.
+        monthly (bool): Whether to also keep the run as a monthly backup.
+
+    Returns:
+        dict: The manifest of the run.
+    """
+    name = now.strftime("%Y%m%d%H%M%S")
+    hourly_dir = os.path.join(BACKUP_DIR, "hourly")
+    run_dir = os.path.join(hourly_dir, f".{name}")
+    os.makedirs(run_dir)
+    previous = backups("hourly")
+    known = _known_files(previous[-1] if previous else None)
+
+    started = time.monotonic()
+    manifest = {"name": name, "started_at": now.isoformat(), "daily": daily, "weekly": weekly,
+                "monthly": monthly, "compression": BACKUP_COMPRESSION, "jobs": BACKUP_JOBS,
+                "databases": {}, "restores": {}}
+    hashes = {}
+    if daily:
+        # The restore checks are copies of the previous backup, not data of their own
+        restore_checks = (RESTORE_DB_DAILY, RESTORE_DB_WEEKLY)
+        databases = [database for database in list_databases() if database not in restore_checks]
+    else:
+        databases = BACKUP_DATABASES
+    for database in databases:
+        dump_started = time.monotonic()
+        dump_dir = os.path.join(run_dir, database)
+        try:
+            dump_database(database, dump_dir)
+            hashes[database], linked_bytes, new_bytes = deduplicate(dump_dir, known.get(database, {}))
+            result = {"status": "done", "bytes": linked_bytes + new_bytes, "new_bytes": new_bytes}
+            logger.info(f"Dumped {database}: {linked_bytes + new_bytes} bytes, {new_bytes} new.")
+        except Exception as e:
+            logger.error(f"Error dumping {database}: {str(e)}")
+            shutil.rmtree(dump_dir, ignore_errors=True)
+            result = {"status": "failed", "error": str(e)}
+        result["duration"] = round(time.monotonic() - dump_started, 3)
+        manifest["databases"][database] = result
+    if daily:
+        try:
+            dump_globals(os.path.join(run_dir, GLOBALS))
+        except Exception as e:
+            logger.error(f"Error dumping roles: {str(e)}")
+            manifest["globals_error"] = str(e)
+    with open(os.path.join(run_dir, HASHES), "w") as f:
+        json.dump(hashes, f)
+
+    manifest["bytes"] = sum(result.get("bytes", 0) for result in manifest["databases"].values())
+    manifest["new_bytes"] = sum(result.get("new_bytes", 0) for result in manifest["databases"].values())
+    manifest["duration"] = round(time.monotonic() - started, 3)
+    _write_manifest(run_dir, manifest)
+    final_dir = os.path.join(hourly_dir, name)
+    os.rename(run_dir, final_dir)
+
+    for tier, due in (("daily", daily), ("weekly", weekly), ("monthly", monthly)):
+        if due:
+            os.makedirs(os.path.join(BACKUP_DIR, tier), exist_ok=True)
+            link_tree(final_dir, os.path.join(BACKUP_DIR, tier, name))
+    for tier, keep in RETENTION.items():
+        for path in apply_retention(tier, keep):
+            logger.info(f"Removed {tier} backup {os.path.basename(path)}.")
+
+    if daily and RESTORE_DATABASE:
+        targets = [RESTORE_DB_DAILY] + ([RESTORE_DB_WEEKLY] if weekly else [])
+        for target in filter(None, targets):
+            manifest["restores"][target] = verify_restore(final_dir, RESTORE_DATABASE, target)
+        manifest["duration"] = round(time.monotonic() - started, 3)
+        for tier, due in (("hourly", True), ("daily", daily), ("weekly", weekly), ("monthly", monthly)):
+            if due:
+                _write_manifest(os.path.join(BACKUP_DIR, tier, name), manifest)
+
+    with open(os.path.join(BACKUP_DIR, "history.jsonl"), "a") as f:
+        f.write(json.dumps(manifest) + "\n")
+    return manifest
+
+
+def verify_restore(backup_dir: str, database: str, target: str) -> dict:
+    """
+    Restore the dump of a database from a backup into another database, to check it.
+
+    Args:
+        backup_dir (str): The directory of the backup.
+        database (str): The database whose dump is restored.
+        target (str): The database to restore into.
+
+    Returns:
+        dict: The status and duration of the restore, and the size of the restored database.
+    """
+    dump_dir = os.path.join(backup_dir, database)
+    if not os.path.isdir(dump_dir):
+        logger.error(f"No dump of {database} to restore in {backup_dir}.")
+        return {"status": "failed", "error": "No dump"}
+    try:
+        result = {"status": "done", **restore_database(dump_dir, target)}
+        logger.info(f"Restored {database} into {target} in {result['duration']}s.")
+    except Exception as e:
+        logger.error(f"Error restoring {database} into {target}: {str(e)}")
+        result = {"status": "failed", "error": str(e)}
+    return result
+
+
+def _write_manifest(backup_dir: str, manifest: dict):
+    # Written beside and renamed, as the tiers share the file through hard links
+    temp_path = os.path.join(backup_dir, f".{MANIFEST}")
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, os.path.join(backup_dir, MANIFEST))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Back up the IKAROS databases.")
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="Run the backup due at this time.")
+    run_parser.add_argument("--daily", action="store_true", help="Run the daily backup, whatever the time.")
+    run_parser.add_argument("--weekly", action="store_true", help="Run the daily backup and keep it as a weekly one.")
+    run_parser.add_argument("--monthly", action="store_true", help="Run the daily backup and keep it as a monthly one.")
+    restore_parser = subparsers.add_parser("restore", help="Restore a database from a backup.")
+    restore_parser.add_argument("database", help="The database whose dump is restored.")
+    restore_parser.add_argument("target", help="The database to restore into; it is replaced.")
+    restore_parser.add_argument("--backup", help="The directory of the backup; by default the newest.")
+    subparsers.add_parser("list", help="List the backups of each tier.")
+    args = parser.parse_args(argv)
+
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s %(message)s",
+                        handlers=[logging.StreamHandler(), logging.FileHandler(os.path.join(BACKUP_DIR, "backup.log"))])
+
+    if args.command == "list":
+        for tier in RETENTION:
+            for path in backups(tier):
+                with open(os.path.join(path, MANIFEST)) as f:
+                    manifest = json.load(f)
+                print(f"{tier}\t{manifest['name']}\t{manifest['bytes']}\t{manifest['new_bytes']}\t{manifest['duration']}s")
+        return 0
+
+    if args.command == "restore":
+        backup_dir = args.backup or next((path for path in reversed(backups("hourly"))
+                                          if os.path.isdir(os.path.join(path, args.database))), None)
+        if backup_dir is None:
+            logger.error(f"No backup of {args.database} found.")
+            return 1
+        return 0 if verify_restore(backup_dir, args.database, args.target)["status"] == "done" else 1
+
+    # Runs that take longer than the interval are not overlapped by the next one
+    lock = open(os.path.join(BACKUP_DIR, ".backup.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.warning("Another backup is still running; skipping this one.")
+        return 0
+
+    now = datetime.now()
+    weekly = args.weekly or (now.hour == 0 and now.isoweekday() == 7)
+    monthly = args.monthly or (now.hour == 0 and now.day == 1)
+    daily = args.daily or weekly or monthly or now.hour == 0
+    logger.info(f"Starting {'daily' if daily else 'hourly'} backup.")
+    with lock:
+        manifest = run_backup(now, daily, weekly, monthly)
+    failed = [name for name, result in {**manifest["databases"], **manifest["restores"]}.items()
+              if result["status"] != "done"]
+    logger.info(f"Backup completed in {manifest['duration']}s: {manifest['bytes']} bytes, "
+                f"{manifest['new_bytes']} new.")
+    return 1 if failed or "globals_error" in manifest else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
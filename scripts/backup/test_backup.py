@@ -0,0 +1,144 @@
+"""
+Tests for the backup orchestrator.
+
+The Postgres tools are replaced by fakes, except in `test_backup_and_restore_postgres`,
+which runs against the server given by POSTGRES_HOST, POSTGRES_USER and
+POSTGRES_PASSWORD, and is skipped if none is given:
+
+    POSTGRES_HOST=localhost POSTGRES_USER=postgres python -m pytest scripts/backup
+"""
+
+import os
+import json
+import shutil
+import subprocess
+import pytest
+from datetime import datetime
+from uuid import uuid4
+
+import backup
+
+TABLES = {"3001.dat.gz": b"unchanged table", "3002.dat.gz": b"changed table", "toc.dat": b"toc"}
+
+
+@pytest.fixture(autouse=True)
+def backup_dir(tmp_path, monkeypatch):
+    """
+    Fixture to write backups to a temporary directory.
+    """
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmp_path))
+    monkeypatch.setattr(backup, "BACKUP_DATABASES", ["ikaros"])
+    monkeypatch.setattr(backup, "RETENTION", {"hourly": 2, "daily": 1, "weekly": 1, "monthly": 1})
+    yield tmp_path
+
+
+@pytest.fixture
+def fake_dumps(monkeypatch):
+    """
+    Fixture replacing `pg_dump` with a fake whose changed table differs in every run.
+    """
+    runs = []
+
+    def dump_database(database, output_dir):
+        os.makedirs(output_dir)
+        for name, content in TABLES.items():
+            if name != "3001.dat.gz":
+                content += str(len(runs)).encode()
+            with open(os.path.join(output_dir, name), "wb") as f:
+                f.write(content)
+        runs.append(database)
+
+    monkeypatch.setattr(backup, "dump_database", dump_database)
+    monkeypatch.setattr(backup, "list_databases", lambda: ["ikaros", "postgres"])
+    monkeypatch.setattr(backup, "dump_globals", lambda path: open(path, "w").close())
+    yield runs
+
+
+def test_unchanged_tables_are_linked(backup_dir, fake_dumps):
+    """
+    Test that dumped tables identical to the previous run's are hard links to them.
+    """
+    first = backup.run_backup(datetime(2025, 1, 1, 10), daily=False, weekly=False, monthly=False)
+    second = backup.run_backup(datetime(2025, 1, 1, 11), daily=False, weekly=False, monthly=False)
+    assert first["databases"]["ikaros"]["new_bytes"] == first["databases"]["ikaros"]["bytes"]
+    assert second["databases"]["ikaros"]["new_bytes"] == second["bytes"] - len(TABLES["3001.dat.gz"])
+
+    unchanged = [os.stat(backup_dir / "hourly" / name / "ikaros" / "3001.dat.gz")
+                 for name in ("20250101100000", "20250101110000")]
+    changed = [os.stat(backup_dir / "hourly" / name / "ikaros" / "3002.dat.gz")
+               for name in ("20250101100000", "20250101110000")]
+    assert unchanged[0].st_ino == unchanged[1].st_ino
+    assert changed[0].st_ino != changed[1].st_ino
+    with open(backup_dir / "history.jsonl") as f:
+        assert [json.loads(line)["name"] for line in f] == ["20250101100000", "20250101110000"]
+
+
+def test_daily_backup_fills_tiers_and_applies_retention(backup_dir, fake_dumps, monkeypatch):
+    """
+    Test that the daily run dumps every database but the restore checks, is linked into its tiers, and old
+    backups are removed.
+    """
+    restored = []
+    monkeypatch.setattr(backup, "RESTORE_DATABASE", "ikaros")
+    monkeypatch.setattr(backup, "RESTORE_DB_DAILY", "ikaros_daily")
+    monkeypatch.setattr(backup, "RESTORE_DB_WEEKLY", "ikaros_weekly")
+    monkeypatch.setattr(backup, "list_databases", lambda: ["ikaros", "ikaros_daily", "ikaros_weekly", "postgres"])
+    monkeypatch.setattr(backup, "restore_database",
+                        lambda dump_dir, target: restored.append((dump_dir, target)) or {"duration": 0, "bytes": 1})
+
+    backup.run_backup(datetime(2025, 1, 4, 23), daily=False, weekly=False, monthly=False)
+    backup.run_backup(datetime(2025, 1, 5, 0), daily=True, weekly=True, monthly=False)
+    manifest = backup.run_backup(datetime(2025, 1, 6, 0), daily=True, weekly=False, monthly=False)
+
+    assert sorted(manifest["databases"]) == ["ikaros", "postgres"]
+    assert [os.path.basename(path) for path in backup.backups("hourly")] == ["20250105000000", "20250106000000"]
+    assert [os.path.basename(path) for path in backup.backups("daily")] == ["20250106000000"]
+    assert [os.path.basename(path) for path in backup.backups("weekly")] == ["20250105000000"]
+    assert os.path.exists(backup_dir / "daily" / "20250106000000" / backup.GLOBALS)
+    assert (os.stat(backup_dir / "daily" / "20250106000000" / "ikaros" / "toc.dat").st_ino
+            == os.stat(backup_dir / "hourly" / "20250106000000" / "ikaros" / "toc.dat").st_ino)
+    assert [target for _, target in restored] == ["ikaros_daily", "ikaros_weekly", "ikaros_daily"]
+    with open(backup_dir / "daily" / "20250106000000" / backup.MANIFEST) as f:
+        assert json.load(f)["restores"]["ikaros_daily"]["status"] == "done"
+
+
+def test_failed_dump_is_recorded(backup_dir, fake_dumps, monkeypatch):
+    """
+    Test that a failed dump is removed and recorded, and the run fails.
+    """
+    def failing_dump(database, output_dir):
+        os.makedirs(output_dir)
+        raise RuntimeError("pg_dump failed with code 1: connection refused")
+
+    monkeypatch.setattr(backup, "dump_database", failing_dump)
+    manifest = backup.run_backup(datetime(2025, 1, 1, 10), daily=False, weekly=False, monthly=False)
+    assert manifest["databases"]["ikaros"]["status"] == "failed"
+    assert not os.path.exists(backup_dir / "hourly" / "20250101100000" / "ikaros")
+
+
+@pytest.mark.skipif(not os.getenv("POSTGRES_HOST") or shutil.which("pg_dump") is None,
+                    reason="No Postgres server given with POSTGRES_HOST")
+def test_backup_and_restore_postgres(backup_dir, monkeypatch):
+    """
+    Test a backup and a verification restore against a Postgres server.
+    """
+    database, target = f"backup_test_{uuid4().hex[:8]}", f"backup_test_restore_{uuid4().hex[:8]}"
+    monkeypatch.setattr(backup, "BACKUP_DATABASES", [database])
+    monkeypatch.setattr(backup, "BACKUP_JOBS", 2)
+    backup.run_command(["createdb", database])
+    try:
+        backup.run_command(["psql", "-d", database, "-c",
+                            "CREATE TABLE a AS SELECT generate_series(1, 1000) AS id;"
+                            "CREATE TABLE b AS SELECT generate_series(1, 10) AS id;"])
+        backup.run_backup(datetime(2025, 1, 1, 10), daily=False, weekly=False, monthly=False)
+        backup.run_command(["psql", "-d", database, "-c", "INSERT INTO b VALUES (11);"])
+        manifest = backup.run_backup(datetime(2025, 1, 1, 11), daily=False, weekly=False, monthly=False)
+        assert manifest["databases"][database]["new_bytes"] < manifest["databases"][database]["bytes"]
+
+        result = backup.verify_restore(backup.backups("hourly")[-1], database, target)
+        assert result["status"] == "done"
+        count = backup.run_command(["psql", "-d", target, "-tAc", "SELECT count(*) FROM b"])
+        assert count.strip() == "11"
+    finally:
+        for name in (database, target):
+            subprocess.run(["dropdb", "--if-exists", name], env=backup._pg_env())
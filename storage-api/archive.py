@@ -0,0 +1,458 @@
+"""
+Bulk export and rebuilding of RO-Crates for the File Storage API.
+
+A group is exported as an RO-Crate zip package: its `ro-crate-metadata.json` and every
+file of the group, named by its entity ID. The package is written as a stream while
+the files are read from storage, so that nothing is staged on disk and a package can
+be sent to a client or stored back to the storage backend however large it is.
+
+For archiving and migrations, every group, or a list of groups, can be exported to
+`{EXPORT_PREFIX}{job_id}/{group_id}.zip` in the storage backend, or have its RO-Crate
+rebuilt from the metadata store. Groups are found by paging through the metadata
+index and processed EXPORT_CONCURRENCY at a time. A rebuild builds the whole crate of
+a group in one pass over its metadata and replaces the snapshot with a conditional
+write, like a compaction, folding in the log.
+
+Jobs run in the background of the worker that started them, which reports their
+progress. Export jobs also write a `manifest.json` next to their packages.
+"""
+
+import io
+import os
+import json
+import time
+import zipfile
+import logging
+from uuid import uuid4
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
+import anyio
+from starlette.concurrency import run_in_threadpool
+
+from blobs import resolve_blob
+from database import get_store
+from metrics import ARCHIVE_GROUP_DURATION
+from models import FileMetadata
+from storage import StorageBackend
+from utils import (LOG_POSITION, compaction_lock, crate_cache, crate_key, crate_log_prefix, get_crate_metadata,
+                   load_crate_document, _file_entities, _new_crate_document, _apply_log_entry)
+
+
+logger = logging.getLogger(__name__)
+
+# Number of groups exported or rebuilt in parallel
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", 8))
+# Number of groups, and of files of a group, read from the metadata store at a time
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", 1000))
+# Storage prefix the packages of export jobs are written under
+EXPORT_PREFIX = os.getenv("EXPORT_PREFIX", "exports/")
+
+# Name of the metadata file in an RO-Crate package
+METADATA_FILE = "ro-crate-metadata.json"
+
+# Jobs started by this worker, by ID
+jobs: Dict[str, "ArchiveJob"] = {}
+
+
+class ArchiveJob:
+    """
+    Progress of a bulk export or rebuild.
+
+    Attributes:
+        id (str): The ID of the job.
+        operation (str): `export` or `rebuild`.
+        status (str): `running`, `done` or `failed`.
+        groups (Dict[str, dict]): The result of each group processed so far.
+    """
+    def __init__(self, operation: str):
+        self.id = str(uuid4())
+        self.operation = operation
+        self.status = "running"
+        self.error: Optional[str] = None
+        self.groups: Dict[str, dict] = {}
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+
+    def to_dict(self, include_groups: bool = True) -> dict:
+        """
+        Get the progress of the job as a JSON-serializable dictionary.
+        """
+        done = sum(1 for result in self.groups.values() if result["status"] == "done")
+        finished_at = self.finished_at or datetime.now(timezone.utc)
+        job = {
+            "job_id": self.id,
+            "operation": self.operation,
+            "status": self.status,
+            "error": self.error,
+            "done": done,
+            "failed": len(self.groups) - done,
+            "bytes": sum(result.get("bytes", 0) for result in self.groups.values()),
+            "started_at": self.started_at.isoformat(),
+            "duration": round((finished_at - self.started_at).total_seconds(), 3),
+        }
+        if include_groups:
+            job["groups"] = self.groups
+        return job
+
+
+async def iter_groups(page_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[str]:
+    """
+    Walk the IDs of all groups with files, one page of the metadata index at a time.
+
+    Yields:
+        str: The next group ID.
+    """
+    after = None
+    while True:
+        page = await run_in_threadpool(get_store().group_ids, after, page_size)
+        for group_id in page:
+            yield group_id
+        if len(page) < page_size:
+            return
+        after = page[-1]
+
+
+async def iter_group_files(group_id: str, page_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[dict]:
+    """
+    Walk the metadata of the files of a group, one page at a time, in file ID order.
+
+    Yields:
+        dict: The metadata row of the next file.
+    """
+    after = None
+    while True:
+        page = await run_in_threadpool(FileMetadata.page, group_id, after, page_size)
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        after = page[-1]["file_id"]
+
+
+def entity_id(row: dict) -> str:
+    """
+    Get the RO-Crate entity ID of a file, `{file_id}{ext}`, which names it in a package.
+    """
+    return f"{row['file_id']}{os.path.splitext(row['file_name'] or '')[1]}"
+
+
+def _row_file_metadata(row: dict, author_names: Dict[str, str]) -> dict:
+    """
+    Convert a metadata row to the file metadata `_file_entities` expects.
+    """
+    author_id = row.get("file_author")
+    properties = {name: row.get(name) for name in ("width", "height", "page_count", "vertex_count", "face_count")
+                  if row.get(name) is not None}
+    location = ({"latitude": row["latitude"], "longitude": row["longitude"]}
+                if row.get("latitude") is not None and row.get("longitude") is not None else None)
+    return {
+        "file_id": row["file_id"],
+        "file_name": row["file_name"] or row["file_id"],
+        "file_encoding": row.get("file_type"),
+        "file_description": row.get("file_description"),
+        "file_version": row.get("file_version") or 1,
+        "file_upload_date": row.get("file_upload_date"),
+        "file_author": {"author_id": author_id, "author_name": author_names.get(author_id, author_id)}
+        if author_id else None,
+        "media_properties": properties,
+        "media_location": location,
+    }
+
+
+async def build_crate_document(group_id: str, storage: StorageBackend,
+                               author_names: Optional[Dict[str, str]] = None) -> Optional[dict]:
+    """
+    Build the JSON-LD of a group's RO-Crate from the metadata of its files, in one pass.
+
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend): The storage backend.
+        author_names (Dict[str, str], optional): The names of the authors, by ID; authors
+            without a name are named by their ID.
+
+    Returns:
+        dict: The crate JSON-LD, or None if the group has no files.
+    """
+    author_names = author_names or {}
+    group_uri = storage.url(group_id)
+    document = None
+    entry = {"file_entity_ids": [], "entities": []}
+    async for row in iter_group_files(group_id):
+        file_metadata = _row_file_metadata(row, author_names)
+        if document is None:
+            document = _new_crate_document(group_id, group_uri, file_metadata)
+        file_entity_id, entities = _file_entities(group_uri, file_metadata)
+        entry["file_entity_ids"].append(file_entity_id)
+        entry["entities"].extend(entities)
+    if document is not None:
+        _apply_log_entry(document, entry)
+    return document
+
+
+class _Sink(io.RawIOBase):
+    """
+    Unseekable file that keeps what is written until it is drained, for streaming a zip.
+    """
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _zip_info(name: str, date: Optional[str], compress: bool) -> zipfile.ZipInfo:
+    try:
+        date_time = datetime.fromisoformat(date).timetuple()[:6]
+    except (TypeError, ValueError):
+        date_time = datetime.now().timetuple()[:6]
+    info = zipfile.ZipInfo(name, date_time=max(date_time, (1980, 1, 1, 0, 0, 0)))
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+async def _start_reading(storage: StorageBackend, key: str) -> Optional[AsyncIterator[bytes]]:
+    """
+    Start streaming an object, reading its first chunk to find out whether it exists.
+    """
+    chunks = storage.get(key)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = b""
+    except FileNotFoundError:
+        return None
+
+    async def content():
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    return content()
+
+
+async def _open_file(row: dict, storage: StorageBackend) -> Optional[AsyncIterator[bytes]]:
+    """
+    Start streaming the content of a file, under its own key or as a shared blob.
+
+    Returns:
+        AsyncIterator[bytes]: The content, or None if the file is missing from storage.
+    """
+    content = await _start_reading(storage, row["file_key"]) if row.get("file_key") else None
+    if content is None:
+        # Files stored as a shared blob are found through their metadata
+        blob = await resolve_blob(FileMetadata(**row))
+        if blob is not None:
+            content = await _start_reading(storage, blob)
+    return content
+
+
+async def crate_package(group_id: str, storage: StorageBackend, missing: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+    """
+    Stream a group's RO-Crate as a zip package holding its metadata and files.
+
+    The metadata is the group's RO-Crate if it has one, and otherwise built from the
+    metadata store. Files are stored uncompressed, as media formats are compressed already.
+
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend): The storage backend.
+        missing (List[str], optional): A list the entity IDs of files missing from storage are added to.
+
+    Yields:
+        bytes: The next chunk of the zip file.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as package:
+        cached = await get_crate_metadata(group_id, storage)
+        if cached is not None:
+            metadata = cached.body
+        else:
+            document = await build_crate_document(group_id, storage)
+            metadata = json.dumps(document or {}).encode("utf-8")
+        package.writestr(_zip_info(METADATA_FILE, None, compress=True), metadata)
+
+        yield sink.drain()
+
+        async for row in iter_group_files(group_id):
+            content = await _open_file(row, storage)
+            if content is None:
+                logger.warning(f"File {row['file_id']} of group {group_id} is missing from storage.")
+                if missing is not None:
+                    missing.append(entity_id(row))
+                continue
+            info = _zip_info(entity_id(row), row.get("file_upload_date"), compress=False)
+            with package.open(info, "w", force_zip64=True) as entry:
+                async for chunk in content:
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            # The headers of the next entry, or the central directory, follow
+            yield sink.drain()
+    yield sink.drain()
+
+
+async def export_group(group_id: str, storage: StorageBackend, key: str) -> dict:
+    """
+    Write a group's RO-Crate package to the storage backend.
+
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend): The storage backend.
+        key (str): The key to write the package to.
+
+    Returns:
+        dict: The key, size and SHA-256 digest of the package, and the files missing from storage.
+    """
+    missing = []
+    stored = await storage.put(key, crate_package(group_id, storage, missing), content_type="application/zip")
+    return {"key": key, "bytes": stored["size"], "sha256": stored["sha256"], "missing": missing}
+
+
+async def rebuild_crate(group_id: str, storage: StorageBackend) -> dict:
+    """
+    Rebuild a group's RO-Crate from the metadata store, replacing its snapshot and log.
+
+    The names of authors are kept from the current crate, if it can still be read. The snapshot is replaced with
+    a conditional write, and the log entries it replaces are deleted once it is written;
+    entries appended meanwhile are kept and applied on top of it.
+
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend): The storage backend.
+
+    Returns:
+        dict: The number of files in the rebuilt crate, and of log entries folded into it.
+
+    Raises:
+        PreconditionFailed: If the snapshot was replaced by another worker meanwhile.
+    """
+    async with compaction_lock(group_id):
+        try:
+            current, snapshot_etag, applied = await load_crate_document(group_id, storage)
+        except Exception as e:
+            # A damaged crate is what a rebuild is for; it is replaced along with its whole log
+            logger.warning(f"Could not read the RO-Crate of group {group_id}, rebuilding it anyway: {str(e)}")
+            snapshot = await storage.head(crate_key(group_id))
+            current, snapshot_etag = None, snapshot.etag if snapshot else None
+            applied = [info.key async for info in storage.list(crate_log_prefix(group_id))]
+        author_names = {entity["@id"]: entity.get("name") for entity in (current or {}).get("@graph", [])
+                        if entity.get("@type") == "Person" and entity.get("name")}
+        document = await build_crate_document(group_id, storage, author_names)
+        if document is None:
+            return {"files": 0, "log_entries": 0}
+        if applied:
+            document[LOG_POSITION] = applied[-1]
+        await storage.write(crate_key(group_id), json.dumps(document).encode("utf-8"),
+                            content_type="application/ld+json",
+                            if_match=snapshot_etag, if_none_match=snapshot_etag is None)
+        crate_cache.invalidate(crate_key(group_id))
+        for key in applied:
+            await storage.delete(key)
+    files = sum(1 for entity in document["@graph"] if entity.get("@type") == "File")
+    logger.info(f"Rebuilt the RO-Crate of group {group_id} with {files} files.")
+    return {"files": files, "log_entries": len(applied)}
+
+
+async def run_job(job: ArchiveJob, storage: StorageBackend, group_ids: Optional[List[str]] = None,
+                  concurrency: int = EXPORT_CONCURRENCY):
+    """
+    Export or rebuild groups in parallel, recording the result of each in the job.
+
+    Args:
+        job (ArchiveJob): The job.
+        storage (StorageBackend): The storage backend.
+        group_ids (List[str], optional): The groups to process; by default every group with files.
+        concurrency (int, optional): The number of groups processed at a time.
+    """
+    semaphore = anyio.Semaphore(concurrency)
+    prefix = f"{EXPORT_PREFIX}{job.id}/"
+
+    async def process(group_id: str):
+        started = time.perf_counter()
+        try:
+            if job.operation == "export":
+                result = await export_group(group_id, storage, f"{prefix}{group_id}.zip")
+            else:
+                result = await rebuild_crate(group_id, storage)
+            result["status"] = "done"
+        except Exception as e:
+            logger.error(f"Error in {job.operation} of group {group_id}: {str(e)}")
+            result = {"status": "failed", "error": f"{type(e).__name__}: {str(e)}"}
+        finally:
+            semaphore.release()
+        result["duration"] = round(time.perf_counter() - started, 3)
+        ARCHIVE_GROUP_DURATION.labels(job.operation, result["status"]).observe(result["duration"])
+        job.groups[group_id] = result
+
+    try:
+        async with anyio.create_task_group() as task_group:
+            groups = iter_groups() if group_ids is None else _iterate(group_ids)
+            async for group_id in groups:
+                # Groups are read lazily, so that only `concurrency` of them are held at a time
+                await semaphore.acquire()
+                task_group.start_soon(process, group_id)
+        job.status = "done"
+    except Exception as e:
+        logger.error(f"{job.operation.capitalize()} job {job.id} failed: {str(e)}")
+        job.status = "failed"
+        job.error = str(e)
+    job.finished_at = datetime.now(timezone.utc)
+    if job.operation == "export":
+        await storage.write(f"{prefix}manifest.json", json.dumps(job.to_dict(), indent=2).encode("utf-8"),
+                            content_type="application/json")
+    summary = job.to_dict(include_groups=False)
+    logger.info(f"{job.operation.capitalize()} job {job.id} {job.status}: {summary['done']} groups done, "
+                f"{summary['failed']} failed in {summary['duration']}s.")
+
+
+async def _iterate(items: List[str]) -> AsyncIterator[str]:
+    for item in items:
+        yield item
+
+
+def start_job(operation: str) -> ArchiveJob:
+    """
+    Register a new export or rebuild job of this worker.
+
+    Args:
+        operation (str): `export` or `rebuild`.
+
+    Returns:
+        ArchiveJob: The job, to be run with `run_job`.
+    """
+    job = ArchiveJob(operation)
+    jobs[job.id] = job
+    return job
+
+
+async def get_job(job_id: str, storage: StorageBackend) -> Optional[dict]:
+    """
+    Get the progress of a job of this worker, or the manifest of a finished export.
+
+    Args:
+        job_id (str): The ID of the job.
+        storage (StorageBackend): The storage backend.
+
+    Returns:
+        dict: The progress of the job, or None if it is not known.
+    """
+    job = jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    data = await storage.read(f"{EXPORT_PREFIX}{job_id}/manifest.json")
+    return json.loads(data) if data is not None else None
@@ -0,0 +1,276 @@
+"""
+Batch ingestion for the File Storage API.
+
+This module stores many files from one request, either uploaded as separate parts of a
+multipart form or packed in a tar or zip archive. Files are streamed to the storage
+backend with bounded concurrency, and their metadata and RO-Crate entries are then
+written with one batched call per group instead of one per file.
+"""
+
+import os
+import logging
+import tarfile
+import zipfile
+import mimetypes
+import threading
+from uuid import uuid4
+from datetime import datetime, timezone
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+import anyio
+from fastapi import UploadFile
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from blobs import store_blob, discard_blob, release_replaced
+from extract import MetadataExtractor
+from models import FileMetadata
+from storage import StorageBackend, object_key
+from streaming import CHUNK_SIZE, iter_upload
+from utils import create_ro_crate_batch
+
+
+logger = logging.getLogger(__name__)
+
+# Number of files of a batch stored in parallel
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+
+# Leading bytes of the gzip, bzip2 and xz streams tar files can be compressed with
+COMPRESSED_SIGNATURES = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")
+
+
+class InvalidArchive(ValueError):
+    """
+    Raised when an uploaded archive is neither a tar nor a zip file.
+    """
+
+
+class BatchItem:
+    """
+    A file to ingest as part of a batch.
+
+    Attributes:
+        name (str): The original name of the file.
+        content_type (str): The content type of the file.
+        upload (UploadFile, optional): The uploaded file, for multipart batches.
+        opener (Callable, optional): A function opening the file for reading, for archive members.
+        lock (threading.Lock, optional): A lock serialising reads from a shared archive.
+        sequential (bool): Whether the file is a member of a compressed stream, which must be
+            read in order, one member at a time.
+    """
+    def __init__(self, name: str, content_type: Optional[str], upload: Optional[UploadFile] = None,
+                 opener: Optional[Callable[[], BinaryIO]] = None, lock: Optional[threading.Lock] = None,
+                 sequential: bool = False):
+        self.name = name
+        self.content_type = content_type or mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.upload = upload
+        self.opener = opener
+        self.lock = lock
+        self.sequential = sequential
+
+    def _read_chunks(self, chunk_size: int) -> Iterator[bytes]:
+        with self.lock:
+            fileobj = self.opener()
+        try:
+            while True:
+                # Members of an archive share its file, so reads must not interleave
+                with self.lock:
+                    chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            fileobj.close()
+
+    async def chunks(self, chunk_size: int = CHUNK_SIZE):
+        """
+        Stream the content of the file.
+
+        Yields:
+            bytes: The next chunk of the file.
+        """
+        if self.upload is not None:
+            async for chunk in iter_upload(self.upload, chunk_size):
+                yield chunk
+        else:
+            async for chunk in iterate_in_threadpool(self._read_chunks(chunk_size)):
+                yield chunk
+
+
+def _is_ingestable(name: str) -> bool:
+    base_name = os.path.basename(name)
+    return bool(base_name) and not base_name.startswith(".") and not name.startswith("__MACOSX/")
+
+
+def open_archive(fileobj: BinaryIO) -> Tuple[List[BatchItem], Callable[[], None]]:
+    """
+    List the regular files of a tar or zip archive.
+
+    The archive is read in place, so it must be seekable, like the spooled temporary
+    files of uploads. Compressed tar files are supported; their members are marked
+    `sequential`, as going back to an earlier member restarts the decompression from
+    the start of the archive.
+
+    Args:
+        fileobj (BinaryIO): The archive.
+
+    Returns:
+        tuple: The files of the archive, and a function closing the archive.
+
+    Raises:
+        InvalidArchive: If the file is not a tar or zip archive.
+    """
+    lock = threading.Lock()
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        archive = zipfile.ZipFile(fileobj)
+        items = [
+            BatchItem(os.path.basename(info.filename), None, opener=lambda info=info: archive.open(info), lock=lock)
+            for info in archive.infolist()
+            if not info.is_dir() and _is_ingestable(info.filename)
+        ]
+        return items, archive.close
+    fileobj.seek(0)
+    compressed = fileobj.read(len(max(COMPRESSED_SIGNATURES, key=len))).startswith(COMPRESSED_SIGNATURES)
+    fileobj.seek(0)
+    try:
+        archive = tarfile.open(fileobj=fileobj, mode="r:*")
+        members = archive.getmembers()
+    except tarfile.TarError as e:
+        raise InvalidArchive(str(e)) from e
+    items = [
+        BatchItem(os.path.basename(member.name), None, opener=lambda member=member: archive.extractfile(member), lock=lock,
+                  sequential=compressed)
+        for member in members
+        if member.isfile() and _is_ingestable(member.name)
+    ]
+    return items, archive.close
+
+
+def upload_metadata(file_id: str, file_name: str, content_type: Optional[str], fields: dict) -> dict:
+    """
+    Build the metadata dictionary of an uploaded file.
+
+    Args:
+        file_id (str): The ID of the file.
+        file_name (str): The original name of the file.
+        content_type (str, optional): The content type of the file.
+        fields (dict): The upload form fields: `media_type`, `media_type_uuid`, `creator`,
+            `captured_at`, `license`, `description`, `parent_type` and `parent`.
+
+    Returns:
+        dict: The file metadata, as stored in the metadata store and the RO-Crate.
+    """
+    return {
+        "media_type": fields.get("media_type"),
+        "media_type_uuid": fields.get("media_type_uuid"),
+        "file_id": file_id,
+        "file_name": file_name,
+        "file_encoding": content_type,
+        "media_description": fields.get("description"),
+        "media_author": {"author_id": fields.get("creator"), "author_name": fields.get("creator")},
+        "file_version": 1,
+        "media_license": fields.get("license"),
+        "media_parent_type": fields.get("parent_type"),
+        "media_parent": fields.get("parent"),
+        "media_captured_at": fields.get("captured_at"),
+        "file_upload_date": str(datetime.now(timezone.utc))
+    }
+
+
+async def _store_item(item: BatchItem, fields: dict, storage: StorageBackend) -> dict:
+    """
+    Store one file of a batch, and report its status instead of raising.
+    """
+    file_id = fields.get("uuid") or str(uuid4())
+    file_extension = os.path.splitext(item.name)[1]
+    if not fields.get("media_type"):
+        return {"file_originalname": item.name, "status": "failed", "detail": "No media_type given"}
+    try:
+        file_metadata = upload_metadata(file_id, item.name, item.content_type, fields)
+        file_key = object_key(fields.get("media_type"), file_id, file_extension)
+        extractor = MetadataExtractor(item.name)
+        stored = await store_blob(storage, file_key, extractor.tee(item.chunks()), content_type=item.content_type)
+        file_metadata["file_size"] = stored["size"]
+        file_metadata["file_checksum"] = f"sha256:{stored['sha256']}"
+        extractor.update_metadata(file_metadata)
+    except Exception as e:
+        logger.error(f"Error storing batch file {item.name}: {str(e)}")
+        return {"file_originalname": item.name, "status": "failed", "detail": str(e)}
+    return {
+        "file_originalname": item.name,
+        "status": "stored",
+        "file_id": file_id,
+        "file_key": file_key,
+        "file_path": storage.uri(stored["key"]),
+        "file_filename": f"{file_id}{file_extension}",
+        "file_metadata": file_metadata,
+        "deduplicated": stored["deduplicated"],
+        "stored": stored,
+    }
+
+
+async def ingest_batch(items: List[BatchItem], fields: dict, manifest: Dict[str, dict],
+                       storage: StorageBackend, concurrency: int = BATCH_CONCURRENCY) -> List[dict]:
+    """
+    Store a batch of files, then index them and add them to their groups' RO-Crates.
+
+    Args:
+        items (List[BatchItem]): The files to store.
+        fields (dict): The upload form fields shared by all files.
+        manifest (Dict[str, dict]): Per-file form fields, such as `uuid` or `description`,
+            keyed by the original file name. They take precedence over the shared fields.
+        storage (StorageBackend): The storage backend.
+        concurrency (int, optional): The number of files stored in parallel. Members of a
+            compressed archive are stored one at a time, in archive order.
+
+    Returns:
+        List[dict]: The status of each file, in the order of the items. Stored files report
+            their ID, path and metadata, and failed files the reason they failed.
+    """
+    results: List[Optional[dict]] = [None] * len(items)
+    if any(item.sequential for item in items):
+        concurrency = 1
+    # The semaphore is fair, so with a concurrency of one the items are stored in order
+    semaphore = anyio.Semaphore(concurrency)
+
+    async def store(index: int, item: BatchItem):
+        async with semaphore:
+            results[index] = await _store_item(item, {**fields, **manifest.get(item.name, {})}, storage)
+
+    started = anyio.current_time()
+    async with anyio.create_task_group() as task_group:
+        for index, item in enumerate(items):
+            task_group.start_soon(store, index, item)
+
+    groups: Dict[str, List[dict]] = {}
+    for result in results:
+        if result["status"] == "stored":
+            groups.setdefault(result["file_metadata"]["media_type"], []).append(result)
+    stored_count = 0
+    for group_id, stored in groups.items():
+        file_metadata = [FileMetadata.from_upload(result["file_metadata"], result.pop("file_key")) for result in stored]
+        # Earlier versions of files uploaded again with the same ID are replaced
+        previous: List[Optional[FileMetadata]] = [None] * len(file_metadata)
+        saved = False
+        try:
+            previous = await run_in_threadpool(lambda: [FileMetadata.get(item.file_id) for item in file_metadata])
+            await run_in_threadpool(FileMetadata.save_many, file_metadata)
+            saved = True
+            await create_ro_crate_batch(group_id, [result["file_metadata"] for result in stored], storage)
+            stored_count += len(stored)
+        except Exception as e:
+            logger.error(f"Error recording batch files of group {group_id}: {str(e)}")
+            # Files that are not recorded must not hold references to their content
+            for item_metadata, item_previous, result in zip(file_metadata, previous, stored):
+                if saved:
+                    await run_in_threadpool(item_previous.save if item_previous is not None else item_metadata.delete)
+                await discard_blob(storage, result["stored"])
+                result.clear()
+                result.update({"file_originalname": item_metadata.file_name, "status": "failed", "detail": str(e)})
+            continue
+        for item_metadata, item_previous in zip(file_metadata, previous):
+            await release_replaced(storage, item_previous, item_metadata)
+    for result in results:
+        result.pop("stored", None)
+
+    logger.info(f"Stored {stored_count} of {len(items)} batch files in {anyio.current_time() - started:.2f}s.")
+    return results
@@ -0,0 +1,549 @@
+"""
+Benchmarks for the File Storage API.
+
+This script starts the API with uvicorn against local storage or an S3 stand-in, and
+measures:
+
+- upload latency and throughput across file sizes and concurrency levels,
+- download time to first byte, latency and throughput of the uploaded files,
+- `/metadata/{group_id}` latency as the RO-Crate of a group grows.
+
+The S3 stand-in is a moto server started in-process, or a MinIO server given with
+`--s3-endpoint`. The results are written as JSON, and can be compared against an
+earlier run to fail on regressions before a deploy.
+
+Usage:
+    python benchmarks/bench.py --backend local --output results.json
+    python benchmarks/bench.py --backend s3 --sizes 1KB,1MB,1GB,4GB --concurrency 1,16
+    python benchmarks/bench.py --backend s3 --s3-endpoint http://localhost:9000
+    python benchmarks/bench.py --url http://localhost:8000
+    python benchmarks/bench.py --output results.json --compare baseline.json --tolerance 0.25
+"""
+
+import os
+import sys
+import logging
+import io
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from uuid import uuid4
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional
+
+import httpx
+
+
+# Directory of the File Storage API
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+# Size of the random block the payloads repeat
+BLOCK_SIZE = 1024 * 1024
+# Size of the chunks downloads are read in
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Metrics that get worse as they grow, and as they shrink
+LOWER_IS_BETTER = ("p50", "p95", "p99", "ttfb_p50")
+HIGHER_IS_BETTER = ("throughput_mib_s",)
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a size such as `1KB`, `64MB` or `4GB`, in binary units.
+
+    Args:
+        value (str): The size.
+
+    Returns:
+        int: The size in bytes.
+
+    Raises:
+        ValueError: If the size cannot be parsed.
+    """
+    value = value.strip().upper()
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * UNITS[unit])
+    return int(value)
+
+
+def format_size(size: int) -> str:
+    for unit in ("GB", "MB", "KB"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return f"{size}B"
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Get a percentile of some values, interpolating between the closest ranks.
+
+    Args:
+        values (List[float]): The values.
+        fraction (float): The percentile as a fraction, such as 0.95.
+
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * fraction
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(latencies: List[float], errors: int, total_bytes: int, wall_seconds: float) -> dict:
+    """
+    Summarize the timings of a benchmark case.
+
+    Args:
+        latencies (List[float]): The latencies of the successful requests, in seconds.
+        errors (int): The number of failed requests.
+        total_bytes (int): The bytes transferred by the successful requests.
+        wall_seconds (float): The time the case took.
+
+    Returns:
+        dict: The request and error counts, latency percentiles, and throughput.
+    """
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies) if latencies else None,
+        "wall_seconds": wall_seconds,
+        "requests_per_second": len(latencies) / wall_seconds if wall_seconds else None,
+        "throughput_mib_s": total_bytes / UNITS["MB"] / wall_seconds if wall_seconds and total_bytes else None,
+    }
+
+
+class Payload(io.RawIOBase):
+    """
+    Readable file of generated content, so that uploads of any size need no memory or disk.
+
+    Every payload starts with a unique prefix, so that uploads are not deduplicated
+    by the API, and repeats a random block after it.
+    """
+    _block = os.urandom(BLOCK_SIZE)
+
+    def __init__(self, size: int):
+        self.size = size
+        self.position = 0
+        self.prefix = uuid4().bytes
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, min(base + offset, self.size))
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self.position
+        end = min(self.position + size, self.size)
+        parts = []
+        while self.position < end:
+            if self.position < len(self.prefix):
+                part = self.prefix[self.position:end]
+            else:
+                offset = (self.position - len(self.prefix)) % BLOCK_SIZE
+                part = self._block[offset:offset + end - self.position]
+            parts.append(part)
+            self.position += len(part)
+        return b"".join(parts)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The API exited with code {process.returncode} on startup")
+        try:
+            if httpx.get(f"{url}/stats/cache", timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"The API did not start within {timeout}s")
+
+
+@contextmanager
+def s3_stand_in(endpoint: Optional[str], bucket: str) -> Iterator[dict]:
+    """
+    Provide an S3 endpoint with an empty bucket.
+
+    Args:
+        endpoint (str): The URL of a running S3 server such as MinIO, or None to start a moto server.
+        bucket (str): The name of the bucket to create.
+
+    Yields:
+        dict: The environment variables configuring the API for the bucket.
+    """
+    import boto3
+
+    server = None
+    if endpoint is None:
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            raise RuntimeError("Benchmarking against S3 requires moto[server], or --s3-endpoint for a MinIO server")
+        # moto serves requests with werkzeug, which logs every request
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        port = _free_port()
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+        server.start()
+        endpoint = f"http://127.0.0.1:{port}"
+    env = {
+        "STORAGE_TYPE": "S3",
+        "AWS_ACCESS_KEY_ID": os.getenv("AWS_ACCESS_KEY_ID", "benchmark"),
+        "AWS_SECRET_ACCESS_KEY": os.getenv("AWS_SECRET_ACCESS_KEY", "benchmark"),
+        "AWS_REGION": os.getenv("AWS_REGION", "us-east-1"),
+        "CLOUDIAN_ENDPOINT_URL": endpoint,
+        "S3_BUCKET_NAME": bucket,
+    }
+    client = boto3.client("s3", aws_access_key_id=env["AWS_ACCESS_KEY_ID"],
+                          aws_secret_access_key=env["AWS_SECRET_ACCESS_KEY"],
+                          region_name=env["AWS_REGION"], endpoint_url=endpoint)
+    client.create_bucket(Bucket=bucket)
+    try:
+        yield env
+    finally:
+        if server is not None:
+            server.stop()
+
+
+@contextmanager
+def api_server(backend: str, s3_endpoint: Optional[str] = None) -> Iterator[str]:
+    """
+    Run the API in a uvicorn process with fresh storage and a fresh metadata store.
+
+    Args:
+        backend (str): `local` or `s3`.
+        s3_endpoint (str, optional): The URL of a running S3 server, for the `s3` backend.
+
+    Yields:
+        str: The base URL of the API.
+    """
+    with tempfile.TemporaryDirectory(prefix="storage-api-bench-") as workdir:
+        env = {**os.environ, "METADATA_DB_URL": f"sqlite:///{os.path.join(workdir, 'metadata.db')}"}
+        # prometheus_client switches to multiprocess mode whenever the variable is set, even to ""
+        env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        with _backend_env(backend, workdir, s3_endpoint) as backend_env:
+            env.update(backend_env)
+            port = _free_port()
+            process = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+                 "--log-level", "warning"],
+                cwd=API_DIR, env=env,
+            )
+            url = f"http://127.0.0.1:{port}"
+            try:
+                _wait_until_up(url, process)
+                yield url
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+
+
+@contextmanager
+def _backend_env(backend: str, workdir: str, s3_endpoint: Optional[str]) -> Iterator[dict]:
+    if backend == "local":
+        path = os.path.join(workdir, "files")
+        os.makedirs(path)
+        yield {"STORAGE_TYPE": "local", "STORAGE_PATH": path}
+    elif backend == "s3":
+        with s3_stand_in(s3_endpoint, f"bench-{uuid4().hex[:12]}") as env:
+            yield env
+    else:
+        raise ValueError(f"Invalid backend: {backend}")
+
+
+async def _gather_limited(concurrency: int, calls: list):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(call):
+        async with semaphore:
+            return await call()
+
+    return await asyncio.gather(*(limited(call) for call in calls))
+
+
+async def _upload(client: httpx.AsyncClient, group_id: str, size: int) -> dict:
+    file_id = str(uuid4())
+    started = time.perf_counter()
+    try:
+        response = await client.post("/", data={"uuid": file_id, "media_type": group_id},
+                                     files={"file": (f"{file_id}.bin", Payload(size), "application/octet-stream")})
+        ok = response.status_code == 200
+    except httpx.HTTPError:
+        ok = False
+    return {"ok": ok, "latency": time.perf_counter() - started, "file_id": file_id}
+
+
+async def _download(client: httpx.AsyncClient, group_id: str, file_id: str) -> dict:
+    started = time.perf_counter()
+    ttfb = None
+    received = 0
+    try:
+        async with client.stream("GET", f"/download/{group_id}/{file_id}.bin") as response:
+            async for chunk in response.aiter_raw(READ_CHUNK_SIZE):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                received += len(chunk)
+            ok = response.status_code == 200
+    except httpx.HTTPError:
+        ok = False
+    return {"ok": ok, "latency": time.perf_counter() - started, "ttfb": ttfb, "bytes": received}
+
+
+async def bench_transfers(client: httpx.AsyncClient, size: int, concurrency: int, requests: int) -> List[dict]:
+    """
+    Upload files of one size at one concurrency level, then download them.
+
+    Args:
+        client (httpx.AsyncClient): The client of the API.
+        size (int): The size of the files.
+        concurrency (int): The number of requests in flight.
+        requests (int): The number of files.
+
+    Returns:
+        List[dict]: The results of the upload and download cases.
+    """
+    group_id = f"bench-{uuid4().hex[:12]}"
+    params = {"size": size, "size_label": format_size(size), "concurrency": concurrency}
+
+    started = time.perf_counter()
+    uploads = await _gather_limited(concurrency, [lambda: _upload(client, group_id, size) for _ in range(requests)])
+    wall = time.perf_counter() - started
+    uploaded = [upload for upload in uploads if upload["ok"]]
+    results = [{
+        "name": "upload", **params,
+        **summarize([upload["latency"] for upload in uploaded], len(uploads) - len(uploaded),
+                    size * len(uploaded), wall),
+    }]
+
+    started = time.perf_counter()
+    downloads = await _gather_limited(concurrency, [
+        lambda file_id=upload["file_id"]: _download(client, group_id, file_id) for upload in uploaded
+    ])
+    wall = time.perf_counter() - started
+    downloaded = [download for download in downloads if download["ok"]]
+    results.append({
+        "name": "download", **params,
+        **summarize([download["latency"] for download in downloaded], len(downloads) - len(downloaded),
+                    sum(download["bytes"] for download in downloaded), wall),
+        "ttfb_p50": percentile([download["ttfb"] for download in downloaded if download["ttfb"] is not None], 0.5),
+    })
+    return results
+
+
+async def _timed_get(client: httpx.AsyncClient, path: str) -> Optional[float]:
+    started = time.perf_counter()
+    response = await client.get(path)
+    await response.aread()
+    return time.perf_counter() - started if response.status_code == 200 else None
+
+
+async def bench_metadata(client: httpx.AsyncClient, crate_sizes: List[int], requests: int,
+                         concurrency: int, file_size: int) -> List[dict]:
+    """
+    Grow the RO-Crate of a group and time its metadata endpoints at each size.
+
+    Args:
+        client (httpx.AsyncClient): The client of the API.
+        crate_sizes (List[int]): The numbers of files to time the metadata at.
+        requests (int): The number of metadata requests at each size.
+        concurrency (int): The number of uploads in flight while the crate grows.
+        file_size (int): The size of the uploaded files.
+
+    Returns:
+        List[dict]: The results of the crate and listing cases at each size.
+    """
+    group_id = f"bench-{uuid4().hex[:12]}"
+    results = []
+    count = 0
+    for crate_size in sorted(crate_sizes):
+        await _gather_limited(concurrency, [lambda: _upload(client, group_id, file_size)
+                                            for _ in range(crate_size - count)])
+        count = crate_size
+        for name, path in (("metadata_crate", f"/metadata/{group_id}"),
+                           ("metadata_page", f"/metadata/{group_id}?limit=100")):
+            # The first request after the uploads revalidates the cached crate
+            first = await _timed_get(client, path)
+            started = time.perf_counter()
+            latencies = [await _timed_get(client, path) for _ in range(requests)]
+            wall = time.perf_counter() - started
+            succeeded = [latency for latency in latencies if latency is not None]
+            results.append({
+                "name": name, "crate_size": crate_size, "first": first,
+                **summarize(succeeded, len(latencies) - len(succeeded), 0, wall),
+            })
+    return results
+
+
+def case_key(result: dict) -> str:
+    """
+    Get the key identifying a benchmark case across runs.
+    """
+    return "/".join(f"{param}={result[param]}" for param in ("name", "size", "concurrency", "crate_size")
+                    if param in result)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Compare results against a baseline run.
+
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The fraction by which a metric may get worse, such as 0.25.
+
+    Returns:
+        List[str]: A description of every regression.
+    """
+    baseline_cases = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        key = case_key(result)
+        before = baseline_cases.get(key)
+        if before is None:
+            continue
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{key}: errors {before['errors']} -> {result['errors']}")
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (metric in LOWER_IS_BETTER and change > tolerance) or (metric in HIGHER_IS_BETTER and -change > tolerance):
+                regressions.append(f"{key}: {metric} {old:.4g} -> {new:.4g} ({change:+.0%})")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=API_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(url: str, args: argparse.Namespace) -> List[dict]:
+    """
+    Run the benchmark cases selected by the command-line arguments against an API.
+
+    Args:
+        url (str): The base URL of the API.
+        args (argparse.Namespace): The command-line arguments.
+
+    Returns:
+        List[dict]: The results of every case.
+    """
+    results = []
+    limits = httpx.Limits(max_connections=max(args.concurrency + [args.metadata_concurrency]))
+    async with httpx.AsyncClient(base_url=url, timeout=None, limits=limits) as client:
+        for size in args.sizes:
+            # Keep the bytes of a case bounded, so that the largest sizes do not run for hours
+            requests = max(1, min(args.requests, args.max_case_bytes // size))
+            for concurrency in args.concurrency:
+                print(f"Transfers of {format_size(size)} x {requests} at concurrency {concurrency}...", file=sys.stderr)
+                results += await bench_transfers(client, size, concurrency, requests)
+        if args.crate_sizes:
+            print(f"Metadata at crate sizes {args.crate_sizes}...", file=sys.stderr)
+            results += await bench_metadata(client, args.crate_sizes, args.metadata_requests,
+                                            args.metadata_concurrency, parse_size("1KB"))
+    return results
+
+
+def _list(parse):
+    return lambda value: [parse(item) for item in value.split(",") if item.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the File Storage API.")
+    parser.add_argument("--backend", choices=("local", "s3"), default="local",
+                        help="Storage backend of the API started for the run")
+    parser.add_argument("--s3-endpoint", help="URL of a running S3 server such as MinIO; moto is started if not set")
+    parser.add_argument("--url", help="Benchmark a running API instead of starting one")
+    parser.add_argument("--sizes", type=_list(parse_size), default=_list(parse_size)("1KB,1MB,64MB"),
+                        help="Comma-separated file sizes, such as 1KB,1MB,1GB")
+    parser.add_argument("--concurrency", type=_list(int), default=[1, 8],
+                        help="Comma-separated numbers of requests in flight")
+    parser.add_argument("--requests", type=int, default=32, help="Number of files of each size and concurrency")
+    parser.add_argument("--max-case-bytes", type=parse_size, default=parse_size("2GB"),
+                        help="Upper bound on the bytes uploaded in one case; fewer files are sent of large sizes")
+    parser.add_argument("--crate-sizes", type=_list(int), default=[10, 100, 1000],
+                        help="Comma-separated numbers of files in a group to time /metadata at")
+    parser.add_argument("--metadata-requests", type=int, default=20, help="Number of metadata requests at each crate size")
+    parser.add_argument("--metadata-concurrency", type=int, default=8, help="Number of uploads in flight while a crate grows")
+    parser.add_argument("--output", help="Path to write the JSON results to; printed if not set")
+    parser.add_argument("--compare", help="Path of the JSON results of a baseline run")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction by which a metric may get worse than the baseline")
+    args = parser.parse_args(argv)
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    if args.url:
+        results = asyncio.run(run(args.url.rstrip("/"), args))
+    else:
+        with api_server(args.backend, args.s3_endpoint) as url:
+            results = asyncio.run(run(url, args))
+
+    report = {
+        "meta": {
+            "started_at": started_at,
+            "backend": "remote" if args.url else args.backend,
+            "url": args.url,
+            "s3_endpoint": args.s3_endpoint,
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
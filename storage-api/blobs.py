@@ -0,0 +1,316 @@
+"""
+Content-addressed storage of uploaded files for the File Storage API.
+
+Uploaded content is stored once as a blob, and the `{media_type}/{file_id}{ext}` key of
+every file with that content refers to the blob. The metadata store counts the references
+to each blob, and the blob is deleted with its last reference.
+
+On local storage blobs are kept under their SHA-256 digest, `blobs/{xx}/{sha256}`, and the
+references are hard links to them. On S3, which cannot link, the first upload of some
+content is written to its own key, which becomes the blob; later uploads of the same
+content are dropped and resolved to it through the file metadata.
+
+Content that clients upload straight to S3 is never seen by the API. It is registered as
+a blob when S3 has checked it against a SHA-256 digest given by the client, and is
+otherwise kept under its file key unhashed. In both cases it is uploaded to a temporary
+key if its file key holds a blob, so that the content other files refer to is never
+overwritten.
+"""
+
+import logging
+from uuid import uuid4
+from typing import AsyncIterator, Optional, Tuple
+from starlette.concurrency import run_in_threadpool
+
+from database import get_store
+from models import FileMetadata
+from storage import StorageBackend
+
+
+logger = logging.getLogger(__name__)
+
+BLOB_PREFIX = "blobs/"
+
+
+def blob_key(sha256: str) -> str:
+    """
+    Build the storage key of the blob with a digest.
+
+    Args:
+        sha256 (str): The hex SHA-256 digest of the content.
+
+    Returns:
+        str: The key `blobs/{first two digits}/{sha256}`.
+    """
+    return f"{BLOB_PREFIX}{sha256[:2]}/{sha256}"
+
+
+async def _store_linked(storage: StorageBackend, key: str, chunks: AsyncIterator[bytes],
+                        content_type: Optional[str]) -> Tuple[dict, str, bool]:
+    """
+    Store content as a `blobs/{xx}/{sha256}` blob, and register a reference to it.
+    """
+    incoming_key = f"{BLOB_PREFIX}incoming/{uuid4()}"
+    stored = await storage.put(incoming_key, chunks, content_type=content_type)
+    store = get_store()
+    try:
+        # The blob is put in place before it is registered, so that a reference never precedes its content
+        moved = await run_in_threadpool(store.get_blob, stored["sha256"]) is None
+        if moved:
+            await storage.move(incoming_key, blob_key(stored["sha256"]))
+    except Exception:
+        await storage.delete(incoming_key)
+        raise
+    stored_key, created = await run_in_threadpool(store.acquire_blob, stored["sha256"], blob_key(stored["sha256"]), stored["size"])
+    try:
+        if not moved:
+            # The blob was unregistered since it was looked up, so this upload stores it again
+            if created:
+                await storage.move(incoming_key, stored_key)
+            else:
+                await storage.delete(incoming_key)
+    except Exception:
+        await run_in_threadpool(store.release_blob, stored["sha256"])
+        raise
+    return stored, stored_key, created
+
+
+async def upload_key_for(key: str) -> str:
+    """
+    Get the key to write new content of a file to on backends that cannot link.
+
+    Args:
+        key (str): The key of the file.
+
+    Returns:
+        str: The key of the file, or a temporary key if the key of the file holds a blob
+            that other files refer to, which must not be overwritten.
+    """
+    if await run_in_threadpool(get_store().is_blob_key, key):
+        return f"{BLOB_PREFIX}incoming/{uuid4()}"
+    return key
+
+
+async def _register_in_place(storage: StorageBackend, key: str, upload_key: str, sha256: str,
+                             size: int) -> Tuple[str, bool]:
+    """
+    Register a reference to content written to a file key, or to the temporary key from `upload_key_for`.
+    """
+    store = get_store()
+    stored_key, created = await run_in_threadpool(store.acquire_blob, sha256, upload_key, size)
+    try:
+        if created and upload_key != key:
+            stored_key = blob_key(sha256)
+            await storage.move(upload_key, stored_key)
+            await run_in_threadpool(store.rekey_blob, sha256, stored_key)
+        elif not created and upload_key != stored_key:
+            await storage.delete(upload_key)
+    except Exception:
+        await run_in_threadpool(store.release_blob, sha256)
+        raise
+    return stored_key, created
+
+
+async def _store_in_place(storage: StorageBackend, key: str, chunks: AsyncIterator[bytes],
+                          content_type: Optional[str]) -> Tuple[dict, str, bool]:
+    """
+    Store content under its file key, which becomes the blob if the content is new, and register a reference to it.
+    """
+    upload_key = await upload_key_for(key)
+    stored = await storage.put(upload_key, chunks, content_type=content_type)
+    stored_key, created = await _register_in_place(storage, key, upload_key, stored["sha256"], stored["size"])
+    return stored, stored_key, created
+
+
+async def store_blob(storage: StorageBackend, key: str, chunks: AsyncIterator[bytes],
+                     content_type: Optional[str] = None) -> dict:
+    """
+    Store uploaded content once, and make a file key refer to it.
+
+    The content is hashed as it is written. If a blob with the same digest exists, the
+    upload is dropped and the existing blob is referenced. On backends that can link,
+    the content is written to a temporary key and moved to its blob key; on others it is
+    written to the file key, so that new content is written exactly once.
+
+    If the file cannot be recorded afterwards, the reference must be dropped with `discard_blob`.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        key (str): The key of the file referring to the content.
+        chunks (AsyncIterator[bytes]): The content.
+        content_type (str, optional): The content type of the content.
+
+    Returns:
+        dict: The `size` and `sha256` of the content, the `blob_key` it is stored under,
+            the `key` to read it from, and whether it was `deduplicated`.
+    """
+    if storage.supports_links:
+        stored, stored_key, created = await _store_linked(storage, key, chunks, content_type)
+        try:
+            linked = await storage.link(stored_key, key)
+        except Exception:
+            await discard_blob(storage, {"sha256": stored["sha256"], "key": stored_key})
+            raise
+    else:
+        stored, stored_key, created = await _store_in_place(storage, key, chunks, content_type)
+        linked = stored_key == key
+    if not created:
+        logger.info(f"Content of {key} is already stored as {stored_key}.")
+    return {
+        "size": stored["size"],
+        "sha256": stored["sha256"],
+        "blob_key": stored_key,
+        "key": key if linked else stored_key,
+        "deduplicated": not created,
+    }
+
+
+async def register_upload(storage: StorageBackend, key: str, upload_key: str, sha256: str, size: int) -> dict:
+    """
+    Make a file key refer to content that was uploaded without the API, on a backend that cannot link.
+
+    The content must have been checked against its digest, and written to the key from
+    `upload_key_for`. If a blob with the same digest exists, the upload is deleted and
+    the existing blob is referenced.
+
+    If the file cannot be recorded afterwards, the reference must be dropped with `discard_blob`.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        key (str): The key of the file referring to the content.
+        upload_key (str): The key the content was uploaded to.
+        sha256 (str): The hex SHA-256 digest of the content.
+        size (int): The size of the content in bytes.
+
+    Returns:
+        dict: The result, as returned by `store_blob`.
+    """
+    stored_key, created = await _register_in_place(storage, key, upload_key, sha256, size)
+    if not created:
+        logger.info(f"Content of {key} is already stored as {stored_key}.")
+    return {"size": size, "sha256": sha256, "blob_key": stored_key, "key": stored_key, "deduplicated": not created}
+
+
+async def place_unhashed(storage: StorageBackend, key: str, upload_key: str):
+    """
+    Move content that was uploaded without the API, and not hashed, to its file key.
+
+    A blob stored under the file key is first moved to its own key, as other files refer to it.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        key (str): The key of the file.
+        upload_key (str): The key the content was uploaded to, from `upload_key_for`.
+    """
+    if upload_key == key:
+        return
+    store = get_store()
+    blob = await run_in_threadpool(store.find_blob, key)
+    if blob is not None:
+        new_key = blob_key(blob["sha256"])
+        await storage.move(key, new_key)
+        await run_in_threadpool(store.rekey_blob, blob["sha256"], new_key)
+        logger.info(f"Moved blob {key} to {new_key}.")
+    await storage.move(upload_key, key)
+
+
+async def discard_blob(storage: StorageBackend, stored: dict):
+    """
+    Drop the reference taken by `store_blob` for a file that could not be recorded.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        stored (dict): The result of `store_blob`.
+    """
+    await _release(storage, stored.get("key"), stored["sha256"])
+
+
+def _sha256(file_metadata: FileMetadata) -> Optional[str]:
+    algorithm, _, digest = (file_metadata.file_checksum or "").partition(":")
+    return digest if algorithm == "sha256" and digest else None
+
+
+async def resolve_blob(file_metadata: FileMetadata) -> Optional[str]:
+    """
+    Get the storage key of the blob holding the content of a file.
+
+    Args:
+        file_metadata (FileMetadata): The metadata of the file.
+
+    Returns:
+        str: The key of the blob, or None if the file was not stored as a blob.
+    """
+    sha256 = _sha256(file_metadata)
+    if sha256 is None:
+        return None
+    blob = await run_in_threadpool(get_store().get_blob, sha256)
+    return blob["blob_key"] if blob else None
+
+
+async def _release(storage: StorageBackend, file_key: Optional[str], sha256: str, keep_key: bool = False):
+    """
+    Delete the key of a file and drop its reference to a blob, deleting the blob with its last reference.
+
+    With `keep_key`, the key is left in place unless it holds the blob, as a new version of the file uses it.
+    """
+    store = get_store()
+    blob = await run_in_threadpool(store.get_blob, sha256)
+    owns_blob = blob is not None and blob["blob_key"] == file_key
+    if file_key and not owns_blob and not keep_key:
+        await storage.delete(file_key)
+    unreferenced_key = await run_in_threadpool(store.release_blob, sha256)
+    if unreferenced_key is not None:
+        await storage.delete(unreferenced_key)
+        logger.info(f"Deleted unreferenced blob {unreferenced_key}.")
+    elif owns_blob and file_key != blob_key(sha256):
+        # Other files refer to the content under this file's key, so it is moved out of the way
+        new_key = blob_key(sha256)
+        await storage.move(file_key, new_key)
+        await run_in_threadpool(store.rekey_blob, sha256, new_key)
+        logger.info(f"Moved blob {file_key} to {new_key}.")
+
+
+async def release_file(storage: StorageBackend, file_metadata: FileMetadata):
+    """
+    Delete the key of a file, and its blob if no other file refers to it.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        file_metadata (FileMetadata): The metadata of the file.
+    """
+    sha256 = _sha256(file_metadata)
+    if sha256 is None:
+        if file_metadata.file_key:
+            await storage.delete(file_metadata.file_key)
+        return
+    await _release(storage, file_metadata.file_key, sha256)
+
+
+async def release_replaced(storage: StorageBackend, previous: Optional[FileMetadata], file_metadata: FileMetadata):
+    """
+    Drop the reference of the earlier version of a file that was uploaded again with the same ID.
+
+    Call it once the new version is recorded. The earlier version's key is kept if the new
+    version is stored under it. Errors are logged rather than raised, as the new version is
+    recorded already; they leave the earlier content stored but unreferenced.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        previous (FileMetadata, optional): The metadata of the earlier version, or None if the file is new.
+        file_metadata (FileMetadata): The metadata of the new version.
+    """
+    if previous is None:
+        return
+    same_key = previous.file_key == file_metadata.file_key
+    sha256 = _sha256(previous)
+    try:
+        if sha256 is None:
+            if previous.file_key and not same_key:
+                await storage.delete(previous.file_key)
+        elif same_key and sha256 == _sha256(file_metadata):
+            # Both versions refer to the same blob under the same key, so only the count changes
+            await run_in_threadpool(get_store().release_blob, sha256)
+        else:
+            await _release(storage, previous.file_key, sha256, keep_key=same_key)
+    except Exception as e:
+        logger.error(f"Error releasing the content replaced by file {file_metadata.file_id}: {str(e)}")
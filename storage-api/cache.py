@@ -0,0 +1,134 @@
+"""
+In-process caches for the File Storage API.
+
+This module provides a bounded least-recently-used cache whose entries carry a version
+and the time they were last validated, so that callers can serve fresh entries directly
+and revalidate older ones cheaply instead of rebuilding them.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class CacheEntry:
+    """
+    A cached value with the version it was built from.
+
+    Attributes:
+        value: The cached value.
+        version: A cheap fingerprint of the source the value was built from.
+        validated_at (float): When the version was last confirmed, from time.monotonic().
+    """
+    __slots__ = ("value", "version", "validated_at")
+
+    def __init__(self, value: Any, version: Hashable):
+        self.value = value
+        self.version = version
+        self.validated_at = time.monotonic()
+
+    def age(self) -> float:
+        """
+        Get the number of seconds since the entry was last validated.
+        """
+        return time.monotonic() - self.validated_at
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe LRU cache of versioned entries with hit and miss counters.
+
+    Attributes:
+        max_entries (int): The maximum number of entries kept.
+        ttl (float): The number of seconds an entry is served without revalidation.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that had to build the value.
+        revalidations (int): The number of stale entries confirmed unchanged.
+        evictions (int): The number of entries dropped to stay within max_entries.
+        invalidations (int): The number of entries dropped because their source changed.
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[CacheEntry]:
+        """
+        Look up an entry and mark it as recently used.
+
+        Args:
+            key (Hashable): The cache key.
+
+        Returns:
+            CacheEntry: The entry, or None if the key is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, value: Any, version: Hashable) -> CacheEntry:
+        """
+        Store a value, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key (Hashable): The cache key.
+            value: The value.
+            version (Hashable): The version of the source the value was built from.
+
+        Returns:
+            CacheEntry: The new entry.
+        """
+        entry = CacheEntry(value, version)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, key: Hashable):
+        """
+        Drop an entry whose source has changed.
+
+        Args:
+            key (Hashable): The cache key.
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """
+        Drop all entries and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.revalidations = self.evictions = self.invalidations = 0
+
+    def stats(self) -> dict:
+        """
+        Get the size and counters of the cache.
+
+        Returns:
+            dict: The number of entries and the hit, miss, revalidation, eviction and invalidation counts.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -1,62 +1,165 @@
 """
 Cloudian S3 Configuration
 
-If the app is configured with S3 as the storage type, 
+If the app is configured with S3 as the storage type,
 this module configures the boto3 client for accessing the Cloudian S3 bucket.
 It reads the S3 credentials, region, and endpoint URL from environment variables.
+
+The connection pool, retries, timeouts, checksums and addressing style of the client are
+configurable through environment variables, and `create_async_s3_client` builds an
+aiobotocore client with the same settings for serving requests without worker threads.
+
+Importing this module has no side effects. boto3 is imported and the shared client,
+`s3`, is created when `s3`, `BUCKET_NAME` or `ENDPOINT_URL` is first accessed.
 """
 
-import boto3
 import os
 import logging
+import threading
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from botocore.config import Config
 
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Check if STORAGE_TYPE is set to 'S3'
-if os.getenv('STORAGE_TYPE') != 'S3':
-    logger.warning('The current instance is not set up with an S3 storage bucket.')
-    s3 = None
-    BUCKET_NAME = None
-    ENDPOINT_URL = None
-else:
-    # Read environment variables
-    aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
-    aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
-    aws_region = os.getenv('AWS_REGION')
-    cloudian_endpoint_url = os.getenv('CLOUDIAN_ENDPOINT_URL')
-    bucket_name = os.getenv('S3_BUCKET_NAME', 'no-bucket-name')
-
-    # Check for missing environment variables
-    missing_vars = []
-    if not aws_access_key_id:
-        missing_vars.append('AWS_ACCESS_KEY_ID')
-    if not aws_secret_access_key:
-        missing_vars.append('AWS_SECRET_ACCESS_KEY')
-    if not aws_region:
-        missing_vars.append('AWS_REGION')
-    if not cloudian_endpoint_url:
-        missing_vars.append('CLOUDIAN_ENDPOINT_URL')
-
-    if missing_vars:
-        logger.error(f'Missing required environment variables: {", ".join(missing_vars)}')
-    else:
-        # Configure the boto3 client
-        try:
-            s3 = boto3.client(
-                's3',
-                aws_access_key_id=aws_access_key_id,
-                aws_secret_access_key=aws_secret_access_key,
-                region_name=aws_region,
-                endpoint_url=cloudian_endpoint_url
-            )
-            BUCKET_NAME = bucket_name
-            ENDPOINT_URL = cloudian_endpoint_url
-            logger.info('S3 client configured successfully.')
-        except Exception as e:
-            logger.error(f'Failed to configure S3 client: {str(e)}')
-            s3 = None
-            BUCKET_NAME = None
-            ENDPOINT_URL = None
\ No newline at end of file
+# Number of pooled connections to the endpoint; every concurrent call, including each
+# part of a multipart upload in flight, holds one
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 32))
+# Retry mode, `legacy`, `standard` or `adaptive`, and the number of attempts per call
+S3_RETRY_MODE = os.getenv('S3_RETRY_MODE', 'adaptive')
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', 5))
+# Timeouts in seconds for connecting and for each read from the socket
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', 5))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', 60))
+# Keep idle pooled connections alive with TCP keepalive probes
+S3_TCP_KEEPALIVE = os.getenv('S3_TCP_KEEPALIVE', 'true').lower() == 'true'
+# Bucket addressing style, `auto`, `path` or `virtual`
+S3_ADDRESSING_STYLE = os.getenv('S3_ADDRESSING_STYLE', 'auto')
+# When to compute and validate CRC checksums, `when_required` or `when_supported`;
+# uploads are already hashed with SHA-256 by the API
+S3_CHECKSUM_MODE = os.getenv('S3_CHECKSUM_MODE', 'when_required')
+
+
+def s3_client_config(**overrides) -> "Config":
+    """
+    Build the botocore configuration of the S3 clients from the environment.
+
+    Args:
+        **overrides: Config arguments replacing the configured ones.
+
+    Returns:
+        Config: The client configuration.
+    """
+    from botocore.config import Config
+    options = {
+        'max_pool_connections': S3_MAX_POOL_CONNECTIONS,
+        'retries': {'mode': S3_RETRY_MODE, 'total_max_attempts': S3_MAX_ATTEMPTS},
+        'connect_timeout': S3_CONNECT_TIMEOUT,
+        'read_timeout': S3_READ_TIMEOUT,
+        'tcp_keepalive': S3_TCP_KEEPALIVE,
+        's3': {'addressing_style': S3_ADDRESSING_STYLE},
+        'request_checksum_calculation': S3_CHECKSUM_MODE,
+        'response_checksum_validation': S3_CHECKSUM_MODE,
+    }
+    options.update(overrides)
+    return Config(**options)
+
+
+def _client_arguments() -> dict:
+    return {
+        'aws_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
+        'aws_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
+        'region_name': os.getenv('AWS_REGION'),
+        'endpoint_url': os.getenv('CLOUDIAN_ENDPOINT_URL'),
+    }
+
+
+def create_s3_client(**overrides):
+    """
+    Create a boto3 S3 client for the configured endpoint.
+
+    Args:
+        **overrides: Config arguments replacing the configured ones.
+
+    Returns:
+        The boto3 S3 client.
+    """
+    import boto3
+    return boto3.client('s3', config=s3_client_config(**overrides), **_client_arguments())
+
+
+@asynccontextmanager
+async def create_async_s3_client(**overrides):
+    """
+    Create an aiobotocore S3 client for the configured endpoint, closing it on exit.
+
+    Args:
+        **overrides: Config arguments replacing the configured ones.
+
+    Yields:
+        The aiobotocore S3 client.
+
+    Raises:
+        RuntimeError: If aiobotocore is not installed.
+    """
+    try:
+        from aiobotocore.session import get_session
+    except ImportError:
+        raise RuntimeError('The async S3 client requires aiobotocore')
+    async with get_session().create_client('s3', config=s3_client_config(**overrides), **_client_arguments()) as client:
+        yield client
+
+
+_lazy_attributes = ("s3", "BUCKET_NAME", "ENDPOINT_URL")
+_configured: Optional[dict] = None
+_configure_lock = threading.Lock()
+
+
+def _configure() -> dict:
+    """
+    Create the shared boto3 client from the environment variables, once.
+
+    Returns:
+        dict: The client as `s3`, and the `BUCKET_NAME` and `ENDPOINT_URL`, all None
+            if S3 is not configured.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured is not None:
+            return _configured
+        configured = {"s3": None, "BUCKET_NAME": None, "ENDPOINT_URL": None}
+
+        # Check if STORAGE_TYPE is set to 'S3'
+        if os.getenv('STORAGE_TYPE') != 'S3':
+            logger.warning('The current instance is not set up with an S3 storage bucket.')
+            _configured = configured
+            return _configured
+
+        # Check for missing environment variables
+        missing_vars = [name for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_REGION', 'CLOUDIAN_ENDPOINT_URL')
+                        if not os.getenv(name)]
+        if missing_vars:
+            logger.error(f'Missing required environment variables: {", ".join(missing_vars)}')
+        else:
+            # Configure the boto3 client
+            try:
+                configured = {
+                    "s3": create_s3_client(),
+                    "BUCKET_NAME": os.getenv('S3_BUCKET_NAME', 'no-bucket-name'),
+                    "ENDPOINT_URL": os.getenv('CLOUDIAN_ENDPOINT_URL'),
+                }
+                logger.info('S3 client configured successfully.')
+            except Exception as e:
+                logger.error(f'Failed to configure S3 client: {str(e)}')
+        _configured = configured
+        return _configured
+
+
+def __getattr__(name: str):
+    # Create the client when `s3`, `BUCKET_NAME` or `ENDPOINT_URL` is first imported or accessed
+    if name in _lazy_attributes:
+        return _configure()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,170 @@
+"""
+EXIF and TIFF tag reading for the File Storage API.
+
+The GPS position, capture time and dimensions of a photo are read from the EXIF block
+of JPEG files, which is a TIFF structure, or from the tags of TIFF files. The block is
+near the start of the file, so only the first bytes of a file are needed.
+"""
+
+import struct
+from typing import Optional, Tuple
+
+
+# TIFF tags of the image dimensions and of the EXIF and GPS IFD pointers
+IMAGE_WIDTH, IMAGE_LENGTH = 0x0100, 0x0101
+EXIF_IFD_TAG, GPS_IFD_TAG = 0x8769, 0x8825
+# EXIF tags of the capture time and its UTC offset
+DATE_TIME_ORIGINAL, OFFSET_TIME_ORIGINAL = 0x9003, 0x9011
+# GPS tags of the position
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+
+# Sizes of the TIFF field types read here: ASCII, SHORT, LONG and RATIONAL
+TYPE_SIZES = {2: 1, 3: 2, 4: 4, 5: 8}
+
+
+def _tiff_block(header: bytes) -> Optional[bytes]:
+    """
+    Find the TIFF structure of a JPEG EXIF block, or of a TIFF file.
+    """
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return header
+    if header[:2] != b"\xff\xd8":
+        return None
+    offset = 2
+    while offset + 4 <= len(header):
+        if header[offset] != 0xFF:
+            return None
+        marker = header[offset + 1]
+        # Standalone markers and padding have no length
+        if marker == 0xFF or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            offset += 1 if marker == 0xFF else 2
+            continue
+        # The image data starts at SOS, after every metadata segment
+        if marker in (0xD9, 0xDA):
+            return None
+        length = struct.unpack(">H", header[offset + 2:offset + 4])[0]
+        segment = header[offset + 4:offset + 2 + length]
+        if marker == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            return segment[6:]
+        offset += 2 + length
+    return None
+
+
+def _read_ifd(tiff: bytes, order: str, offset: int) -> dict:
+    """
+    Read the entries of a TIFF IFD, as the type, count and raw value or offset of each tag.
+    """
+    count = struct.unpack(f"{order}H", tiff[offset:offset + 2])[0]
+    entries = {}
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        tag, field_type, values = struct.unpack(f"{order}HHI", tiff[entry:entry + 8])
+        entries[tag] = (field_type, values, tiff[entry + 8:entry + 12])
+    return entries
+
+
+def _value(tiff: bytes, order: str, entry: Tuple[int, int, bytes]):
+    """
+    Decode the value of an IFD entry, reading it from its offset if it does not fit in the entry.
+    """
+    field_type, count, raw = entry
+    size = TYPE_SIZES.get(field_type)
+    if size is None:
+        return None
+    if size * count > 4:
+        offset = struct.unpack(f"{order}I", raw)[0]
+        raw = tiff[offset:offset + size * count]
+        if len(raw) < size * count:
+            raise ValueError("The value is beyond the bytes read")
+    if field_type == 2:
+        return raw[:count].split(b"\x00")[0].decode("ascii", "replace").strip()
+    if field_type == 5:
+        numbers = struct.unpack(f"{order}{2 * count}I", raw[:8 * count])
+        return [numerator / denominator for numerator, denominator in zip(numbers[::2], numbers[1::2])]
+    return struct.unpack(f"{order}{count}{'H' if field_type == 3 else 'I'}", raw[:size * count])
+
+
+def _degrees(parts, ref: str, negative: str) -> float:
+    degrees = sum(part / 60 ** index for index, part in enumerate(parts))
+    return -degrees if ref.upper().startswith(negative) else degrees
+
+
+def _gps_position(tiff: bytes, order: str, gps: dict) -> Optional[Tuple[float, float]]:
+    latitude = _degrees(_value(tiff, order, gps[GPS_LATITUDE]), _value(tiff, order, gps[GPS_LATITUDE_REF]), "S")
+    longitude = _degrees(_value(tiff, order, gps[GPS_LONGITUDE]), _value(tiff, order, gps[GPS_LONGITUDE_REF]), "W")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return round(latitude, 7), round(longitude, 7)
+
+
+def _capture_time(tiff: bytes, order: str, exif_ifd: dict) -> Optional[str]:
+    # EXIF times are local `YYYY:MM:DD HH:MM:SS`, with the UTC offset in a separate tag
+    value = _value(tiff, order, exif_ifd[DATE_TIME_ORIGINAL])
+    date, time = value.split(" ")
+    captured_at = f"{date.replace(':', '-')}T{time}"
+    if OFFSET_TIME_ORIGINAL in exif_ifd:
+        captured_at += _value(tiff, order, exif_ifd[OFFSET_TIME_ORIGINAL])
+    return captured_at if len(date) == 10 and len(time) == 8 else None
+
+
+def read_tiff(tiff: bytes) -> dict:
+    """
+    Read the dimensions, capture time and GPS position from a TIFF structure.
+
+    Tags that are missing, malformed or beyond the bytes given are left out.
+
+    Args:
+        tiff (bytes): The TIFF structure, from its byte order mark.
+
+    Returns:
+        dict: The `width`, `height`, `captured_at` and `location` found, the location
+            being a tuple of the latitude and longitude in decimal degrees.
+    """
+    found = {}
+    try:
+        order = "<" if tiff[:2] == b"II" else ">"
+        ifd0 = _read_ifd(tiff, order, struct.unpack(f"{order}I", tiff[4:8])[0])
+    except (IndexError, struct.error):
+        return found
+    readers = (
+        ("width", lambda: _value(tiff, order, ifd0[IMAGE_WIDTH])[0]),
+        ("height", lambda: _value(tiff, order, ifd0[IMAGE_LENGTH])[0]),
+        ("captured_at", lambda: _capture_time(tiff, order, _read_ifd(tiff, order, _value(tiff, order, ifd0[EXIF_IFD_TAG])[0]))),
+        ("location", lambda: _gps_position(tiff, order, _read_ifd(tiff, order, _value(tiff, order, ifd0[GPS_IFD_TAG])[0]))),
+    )
+    for name, read in readers:
+        try:
+            value = read()
+        except (KeyError, IndexError, TypeError, ValueError, ZeroDivisionError, AttributeError, struct.error):
+            continue
+        if value is not None:
+            found[name] = value
+    return found
+
+
+def read_exif(header: bytes) -> dict:
+    """
+    Read the EXIF block from the first bytes of a JPEG or TIFF file.
+
+    Args:
+        header (bytes): The first bytes of the file.
+
+    Returns:
+        dict: The tags found by `read_tiff`, or an empty dict if the file has no EXIF block within the bytes given.
+    """
+    tiff = _tiff_block(bytes(header))
+    return read_tiff(tiff) if tiff is not None else {}
+
+
+def read_gps(header: bytes) -> Optional[Tuple[float, float]]:
+    """
+    Read the GPS position from the first bytes of a JPEG or TIFF file.
+
+    Args:
+        header (bytes): The first bytes of the file.
+
+    Returns:
+        tuple: The latitude and longitude in decimal degrees, or None if the file has no
+            GPS position, or it is not within the bytes given.
+    """
+    return read_exif(header).get("location")
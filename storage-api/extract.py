@@ -0,0 +1,280 @@
+"""
+Technical metadata extraction for the File Storage API.
+
+Uploads are passed through a `MetadataExtractor` on their way to storage. It keeps the
+first and last bytes of the content, where the formats read here keep their headers,
+and reads the dimensions, capture time, GPS position, page count or mesh size from
+them once the upload is stored:
+
+- JPEG: the dimensions of the frame, and the EXIF block
+- TIFF: the image dimensions and EXIF tags
+- PNG: the dimensions in IHDR, and the EXIF block of an eXIf chunk
+- PDF: the page count of a linearized file, or of the page tree found in the first or last bytes
+- PLY: the vertex and face counts declared in the header
+- OBJ: the vertex and face counts, from the `v` and `f` lines counted as the upload streams
+
+No format needs a second read of the content; files that did not stream through the
+API are read with ranged requests for the same first and last bytes.
+"""
+
+import os
+import re
+import struct
+import logging
+from typing import AsyncIterator, Callable, Dict, Optional
+
+from exif import read_exif, read_tiff
+from storage import StorageBackend
+
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes kept from the start and the end of an upload
+EXTRACT_HEAD_SIZE = int(os.getenv("EXTRACT_HEAD_SIZE", 128 * 1024))
+EXTRACT_TAIL_SIZE = int(os.getenv("EXTRACT_TAIL_SIZE", 64 * 1024))
+
+# Leading bytes of the formats recognized by their content
+SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"%PDF-", "pdf"),
+    (b"ply\n", "ply"),
+    (b"ply\r\n", "ply"),
+)
+# Extensions of the formats, for the ones without a signature and for files read back from storage
+EXTENSIONS = {
+    ".jpg": "jpeg", ".jpeg": "jpeg", ".tif": "tiff", ".tiff": "tiff", ".png": "png",
+    ".pdf": "pdf", ".ply": "ply", ".obj": "obj",
+}
+
+# JPEG start-of-frame markers, which hold the dimensions of the image
+JPEG_FRAME_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+PDF_LINEARIZED = re.compile(rb"/Linearized\b[^>]*?/N\s+(\d+)")
+PDF_PAGE_TREE = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+PLY_ELEMENT = re.compile(rb"^element\s+(vertex|face)\s+(\d+)\s*$", re.MULTILINE)
+
+
+def _jpeg(head: bytes, tail: bytes) -> dict:
+    found = read_exif(head)
+    offset = 2
+    while offset + 9 <= len(head) and head[offset] == 0xFF:
+        marker = head[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in JPEG_FRAME_MARKERS:
+            found["height"], found["width"] = struct.unpack(">HH", head[offset + 5:offset + 9])
+            break
+        if marker in (0xD9, 0xDA):
+            break
+        offset += 2 + struct.unpack(">H", head[offset + 2:offset + 4])[0]
+    return found
+
+
+def _tiff(head: bytes, tail: bytes) -> dict:
+    return read_tiff(head)
+
+
+def _png(head: bytes, tail: bytes) -> dict:
+    found = {}
+    offset = 8
+    while offset + 8 <= len(head):
+        length, chunk_type = struct.unpack(">I4s", head[offset:offset + 8])
+        data = head[offset + 8:offset + 8 + length]
+        if chunk_type == b"IHDR" and len(data) >= 8:
+            found["width"], found["height"] = struct.unpack(">II", data[:8])
+        elif chunk_type == b"eXIf":
+            found.update({key: value for key, value in read_tiff(data).items() if key not in found})
+        elif chunk_type in (b"IDAT", b"IEND"):
+            break
+        offset += 12 + length
+    return found
+
+
+def _pdf(head: bytes, tail: bytes) -> dict:
+    linearized = PDF_LINEARIZED.search(head[:4096])
+    if linearized:
+        return {"page_count": int(linearized.group(1))}
+    # The root of the page tree has the count of all pages, and the other nodes counts of their subtrees
+    counts = [int(first or second) for part in (head, tail) for first, second in PDF_PAGE_TREE.findall(part)]
+    return {"page_count": max(counts)} if counts else {}
+
+
+def _ply(head: bytes, tail: bytes) -> dict:
+    end = head.find(b"end_header")
+    if end < 0:
+        return {}
+    counts = {kind: int(count) for kind, count in PLY_ELEMENT.findall(head[:end])}
+    return {f"{kind.decode()}_count": count for kind, count in counts.items()}
+
+
+def _obj(head: bytes, tail: bytes) -> dict:
+    # The counts are taken by `MetadataExtractor` as the upload streams
+    return {}
+
+
+# Extractors by format, reading the first and last bytes of a file
+EXTRACTORS: Dict[str, Callable[[bytes, bytes], dict]] = {
+    "jpeg": _jpeg,
+    "tiff": _tiff,
+    "png": _png,
+    "pdf": _pdf,
+    "ply": _ply,
+    "obj": _obj,
+}
+
+
+def detect_format(head: bytes, file_name: Optional[str] = None) -> Optional[str]:
+    """
+    Detect the format of a file from its first bytes, or from its extension.
+
+    Args:
+        head (bytes): The first bytes of the file.
+        file_name (str, optional): The name of the file.
+
+    Returns:
+        str: The format, a key of `EXTRACTORS`, or None if it is not supported.
+    """
+    for signature, file_format in SIGNATURES:
+        if head.startswith(signature):
+            return file_format
+    return EXTENSIONS.get(os.path.splitext(file_name or "")[1].lower())
+
+
+class MetadataExtractor:
+    """
+    Collect the technical metadata of an upload as it streams to storage.
+
+    Attributes:
+        file_name (str): The name of the file, for formats recognized by their extension.
+        head (bytearray): The first bytes of the content.
+        tail (bytes): The last bytes of the content.
+        size (int): The number of bytes streamed.
+    """
+    def __init__(self, file_name: Optional[str] = None, head_size: int = EXTRACT_HEAD_SIZE,
+                 tail_size: int = EXTRACT_TAIL_SIZE):
+        self.file_name = file_name
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = b""
+        self.size = 0
+        self._counts = {"vertex_count": 0, "face_count": 0}
+        self._count_lines = EXTENSIONS.get(os.path.splitext(file_name or "")[1].lower()) == "obj"
+        # The end of the previous chunk, so that lines split across chunks are counted
+        self._carry = b"\n"
+
+    def feed(self, chunk: bytes):
+        """
+        Take the next chunk of the content.
+
+        Args:
+            chunk (bytes): The chunk.
+        """
+        if len(self.head) < self.head_size:
+            self.head += chunk[:self.head_size - len(self.head)]
+        self.tail = (self.tail + chunk)[-self.tail_size:] if len(chunk) < self.tail_size else chunk[-self.tail_size:]
+        self.size += len(chunk)
+        if self._count_lines:
+            # bytes.count is a single pass in C, on chunks the upload holds anyway
+            edge = self._carry + chunk[:2]
+            self._counts["vertex_count"] += chunk.count(b"\nv ") + edge.count(b"\nv ")
+            self._counts["face_count"] += chunk.count(b"\nf ") + edge.count(b"\nf ")
+            self._carry = (self._carry + chunk)[-2:]
+
+    async def tee(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Pass on the content of an upload, taking each chunk.
+
+        Args:
+            chunks (AsyncIterator[bytes]): The content.
+
+        Yields:
+            bytes: The next chunk of the content, unchanged.
+        """
+        async for chunk in chunks:
+            self.feed(chunk)
+            yield chunk
+
+    def extract(self, file_format: Optional[str] = None) -> dict:
+        """
+        Read the technical metadata from the content taken.
+
+        Args:
+            file_format (str, optional): The format of the file; detected from its content by default.
+
+        Returns:
+            dict: The `width`, `height`, `page_count`, `vertex_count`, `face_count`,
+                `captured_at` and `location` found in the file.
+        """
+        head = bytes(self.head)
+        # A file that fits in the head has no separate tail
+        tail = self.tail if self.size > len(head) else b""
+        file_format = file_format or detect_format(head, self.file_name)
+        if file_format is None:
+            return {}
+        try:
+            found = EXTRACTORS[file_format](head, tail)
+        except Exception as e:
+            logger.warning(f"Could not read the {file_format} metadata of {self.file_name}: {str(e)}")
+            return {}
+        if file_format == "obj" and self._count_lines:
+            found.update(self._counts)
+        return found
+
+    def update_metadata(self, file_metadata: dict, file_format: Optional[str] = None):
+        """
+        Add the technical metadata to the metadata of an upload.
+
+        The dimensions and counts are stored as `media_properties`, and the GPS position
+        as `media_location`. The EXIF capture time is used if the client gave none.
+
+        Args:
+            file_metadata (dict): The upload metadata, as built by `upload_metadata`.
+            file_format (str, optional): The format of the file; detected from its content by default.
+        """
+        found = self.extract(file_format)
+        location = found.pop("location", None)
+        if location is not None:
+            file_metadata["media_location"] = {"latitude": location[0], "longitude": location[1]}
+        captured_at = found.pop("captured_at", None)
+        if captured_at is not None and not file_metadata.get("media_captured_at"):
+            file_metadata["media_captured_at"] = captured_at
+        if found:
+            file_metadata["media_properties"] = found
+
+
+async def extract_stored(storage: StorageBackend, key: str, file_metadata: dict, size: Optional[int] = None):
+    """
+    Add the technical metadata of a stored file to its upload metadata, for content that
+    did not stream through the API.
+
+    Only files whose format is known from their name are read, with ranged requests for
+    their first and last bytes. The lines of OBJ files are not counted, as that would
+    need the whole file.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        key (str): The key of the file.
+        file_metadata (dict): The upload metadata, updated in place.
+        size (int, optional): The size of the file in bytes.
+    """
+    file_format = detect_format(b"", file_metadata.get("file_name"))
+    if file_format is None or file_format == "obj":
+        return
+    extractor = MetadataExtractor()
+    try:
+        async for chunk in storage.get(key, 0, extractor.head_size - 1):
+            extractor.feed(chunk)
+        if size is not None and size > extractor.size:
+            extractor.tail = b""
+            async for chunk in storage.get(key, max(size - extractor.tail_size, extractor.size), size - 1):
+                extractor.tail += chunk
+            extractor.size = size
+    except Exception as e:
+        logger.warning(f"Could not read the first and last bytes of {key}: {str(e)}")
+        return
+    extractor.update_metadata(file_metadata, detect_format(bytes(extractor.head)) or file_format)
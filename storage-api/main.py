@@ -3,43 +3,118 @@ File Storage API
 
 This module provides a FastAPI application for handling file data storage.
 It includes endpoints for uploading files, downloading files, and retrieving metadata.
-Files are stored in an S3 bucket, and metadata is managed using RO-Crate.
+Files are stored through a storage backend, either an S3 bucket or the local filesystem,
+and metadata is managed using RO-Crate.
 
 Endpoints:
-- POST /upload: Upload a file to the S3 bucket and update the RO-Crate metadata.
-- GET /download/{type}/{file_id}: Download a file from the S3 bucket.
-- GET /metadata/{type}: Get metadata for all files in a group.
+- POST /upload: Upload a file to storage and update the RO-Crate metadata.
+- POST /batch: Upload many files, or a tar or zip archive, in one request.
+- GET /download/{type}/{file_id}: Download a file from storage.
+- POST /presign/upload: Start a direct upload to S3 through presigned URLs.
+- POST /presign/upload/{token}/complete: Complete a direct upload and record the file.
+- GET /presign/download/{type}/{file_id}: Get a presigned URL to download a file from S3.
+- POST /uploads: Create a resumable upload session.
+- HEAD /uploads/{session_id}: Get the offset a resumable upload has received.
+- PATCH /uploads/{session_id}: Send content to a resumable upload from that offset.
+- POST /uploads/{session_id}/complete: Finish a resumable upload and record the file.
+- DELETE /uploads/{session_id}: Cancel a resumable upload.
+- DELETE /{type}/{file_id}: Delete a file and its metadata.
+- GET /metadata/{type}: Get the RO-Crate of a group, or a page of its indexed file metadata.
+- GET /metadata/{type}/{file_id}: Get the indexed metadata of a single file.
+- GET /search: Search the indexed file metadata of all groups by parent, creator, license, date or location.
+- GET /archive/{type}: Download the RO-Crate zip package of a group.
+- POST /archive/export: Export the RO-Crate packages of many groups to storage.
+- POST /archive/rebuild: Rebuild the RO-Crates of many groups from the metadata store.
+- GET /archive/jobs/{job_id}: Get the progress of an export or rebuild.
+- GET /stats/cache: Get the hit/miss counters of the RO-Crate cache.
+- GET /stats/startup: Get the startup timings of the worker.
+- GET /metrics: Get the metrics of the service in the Prometheus text format.
 """
 
+import time
+# Taken before the other imports, to time the import of the application
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import re
+import asyncio
 import logging
 from uuid import uuid4
-from datetime import datetime, timezone
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import StreamingResponse, JSONResponse
-from rocrate.rocrate import ROCrate
+import json
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Depends, BackgroundTasks, Query
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+# Import the RO-Crate functions and cache from the utils module
+from utils import create_ro_crate, get_crate_metadata, compact_ro_crate_if_due, crate_cache, remove_from_ro_crate
+# Import the streaming helper for chunked uploads
+from streaming import iter_upload
+# Import the range and conditional request helpers for downloads
+from ranges import range_response
+# Import the pagination helpers for metadata listings
+from pagination import (PAGE_SIZE, MAX_PAGE_SIZE, FORMATS, InvalidCursor, encode_cursor, decode_cursor,
+                        iter_json_page, iter_ndjson)
+# Import the batch ingestion helpers
+from batch import BatchItem, InvalidArchive, ingest_batch, open_archive, upload_metadata
+# Import the technical metadata extraction
+from extract import MetadataExtractor
+# Import the content-addressed blob helpers
+from blobs import store_blob, discard_blob, resolve_blob, release_file, release_replaced
+# Import the direct transfer helpers for presigned URLs
+from presign import (PRESIGN_EXPIRES, DirectUploadError, start_direct_upload, complete_direct_upload,
+                     expire_direct_uploads)
+# Import the resumable upload sessions
+from resumable import (UploadConflict, UploadSessionError, create_session, get_session, append_to_session,
+                       finish_session, cancel_session, expire_sessions)
+# Import the bulk RO-Crate export and rebuild
+from archive import crate_package, start_job, run_job, get_job
+# Import the file metadata model
+from models import FileMetadata, utc_timestamp
+from database import COLUMNS
+# Import the metrics middleware
+from metrics import MetricsMiddleware, metrics_response
+# Import the storage backends
+from storage import StorageBackend, get_storage, open_storage, close_storage, object_key, STORAGE_TYPE, STORAGE_PATH
+# Import the startup timing and warm-up helpers
+import startup
+
 
-# Import the create_ro_crate and get_ro_crate functions from the utils module
-from utils import create_ro_crate, get_ro_crate
-# Import the S3 client and bucket name
-from config.aws_config import s3, BUCKET_NAME
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Open the storage backend and warm up the worker on startup, and close the S3 client on shutdown.
+    """
+    started = time.perf_counter()
+    await open_storage()
+    if startup.STARTUP_WARMUP == "eager":
+        await run_in_threadpool(startup.warm_up)
+    startup.record("lifespan", time.perf_counter() - started)
+    startup.record_ready()
+    warm_up = None
+    if startup.STARTUP_WARMUP == "background":
+        warm_up = asyncio.create_task(run_in_threadpool(startup.warm_up))
+    yield
+    if warm_up is not None:
+        await warm_up
+    await close_storage()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware, router=app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Environment variables
-STORAGE_TYPE = os.getenv("STORAGE_TYPE", "S3")
-STORAGE_PATH = os.getenv("STORAGE_PATH", "/files")
-
 logger.info(f"Storage type is set to {STORAGE_TYPE}, with path {STORAGE_PATH}.")
 
 
 @app.post("/")
 async def upload_file(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...), 
     uuid: str = Form(None), 
     media_type: str = Form(None), 
@@ -50,9 +125,10 @@ async def upload_file(
     description: str = Form(None), 
     parent_type: str = Form(None),
     parent: str = Form(None),
+    storage: StorageBackend = Depends(get_storage),
 ):
     """
-    Upload a file to the S3 bucket or local storage and update the RO-Crate metadata.
+    Upload a file to the storage backend and update the RO-Crate metadata.
 
     Args:
         uuid (str, optional): The UUID of the file. If not provided, a new UUID will be generated.
@@ -67,48 +143,50 @@ async def upload_file(
     """
     logger.info(f"Received file upload request for file {file.filename}.")
     file_id = uuid or str(uuid4())
-    file_version = 1
     file_extension = os.path.splitext(file.filename)[1]
-    file_metadata = {
+    file_metadata = upload_metadata(file_id, file.filename, file.content_type, {
         "media_type": media_type,
         "media_type_uuid": media_type_uuid,
-        "file_id": file_id,
-        "file_name": file.filename,
-        "file_encoding": file.content_type,
-        "media_description": description,
-        "media_author": {"author_id": creator, "author_name": creator},
-        "file_version": file_version,
-        "media_license": license,
-        "media_parent_type": parent_type,
-        "media_parent": parent,
-        "media_captured_at": captured_at,
-        "file_upload_date": str(datetime.now(timezone.utc))
-    }
+        "creator": creator,
+        "captured_at": captured_at,
+        "license": license,
+        "description": description,
+        "parent_type": parent_type,
+        "parent": parent,
+    })
     logger.info(f"File metadata: {file_metadata}")
+    stored = None
+    saved = False
     try:
+        # Stream the file to the storage backend
+        file_key = object_key(media_type, file_id, file_extension)
+        extractor = MetadataExtractor(file.filename)
+        stored = await store_blob(storage, file_key, extractor.tee(iter_upload(file)), content_type=file.content_type)
+        file_metadata["file_size"] = stored["size"]
+        file_metadata["file_checksum"] = f"sha256:{stored['sha256']}"
+        extractor.update_metadata(file_metadata)
+        file_path = storage.uri(stored["key"])
+        logger.info(f"File stored at {file_path}.")
+
+        # Index the file metadata, replacing any earlier version uploaded with the same ID
+        previous = await run_in_threadpool(FileMetadata.get, file_id)
+        await run_in_threadpool(FileMetadata.from_upload(file_metadata, file_key).save)
+        saved = True
+
         # Pass the file metadata to create_ro_crate
-        #create_ro_crate(type, file_metadata)
-        #logger.info(f"RO-Crate metadata created for file {file_id}.")
-
-
-        if STORAGE_TYPE == "local":
-            # Save the file to local storage
-            file_path = f"{media_type}/{file_id}{file_extension}"
-            local_file_path = os.path.join(STORAGE_PATH, file_path)
-            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-            with open(local_file_path, "wb") as f:
-                f.write(await file.read())
-            logger.info(f"File saved to local storage at {local_file_path}.")
-        elif STORAGE_TYPE == "S3":
-            # Upload the file to the S3 bucket
-            s3.upload_fileobj(file.file, BUCKET_NAME, f"{media_type}/{file_id}{file_extension}", ExtraArgs={"ContentType": file.content_type})
-            logger.info(f"File uploaded to S3 bucket {BUCKET_NAME} with key {media_type}/{file_id}{file_extension}.")
-            file_path = f"s3://{BUCKET_NAME}/{media_type}/{file_id}{file_extension}"
-        else:
-            raise HTTPException(status_code=500, detail="Invalid STORAGE_TYPE")
-    
+        await create_ro_crate(media_type, file_metadata, storage)
+        logger.info(f"RO-Crate metadata created for file {file_id}.")
+        background_tasks.add_task(compact_ro_crate_if_due, media_type, storage)
+
     except Exception as e:
+        # A file that is not recorded must not hold a reference to its content
+        if saved:
+            await run_in_threadpool(previous.save if previous is not None
+                                    else FileMetadata.from_upload(file_metadata, file_key).delete)
+        if stored is not None:
+            await discard_blob(storage, stored)
         raise HTTPException(status_code=500, detail=str(e))
+    await release_replaced(storage, previous, FileMetadata.from_upload(file_metadata, file_key))
 
     return {
         "message": "File uploaded successfully",
@@ -116,84 +194,583 @@ async def upload_file(
         "file_path": file_path,
         "file_originalname": file.filename,
         "file_filename": f"{file_id}{file_extension}",
-        "file_metadata": file_metadata
+        "file_metadata": file_metadata,
+        "deduplicated": stored["deduplicated"]
+    }
+
+@app.post("/batch")
+async def upload_batch(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    manifest: str = Form(None),
+    media_type: str = Form(None),
+    media_type_uuid: str = Form(None),
+    creator: str = Form(None),
+    captured_at: str = Form(None),
+    license: str = Form(None),
+    description: str = Form(None),
+    parent_type: str = Form(None),
+    parent: str = Form(None),
+    storage: StorageBackend = Depends(get_storage),
+):
+    """
+    Upload a batch of files to the storage backend and update the RO-Crate metadata.
+
+    The files are sent as repeated `files` parts, or packed in a tar or zip `archive`.
+    The form fields apply to every file, and can be overridden per file in the manifest.
+
+    Args:
+        files (List[UploadFile], optional): The files to upload.
+        archive (UploadFile, optional): A tar or zip archive of the files to upload.
+        manifest (str, optional): A JSON object mapping file names to per-file form fields,
+            such as `uuid`, `description` or `captured_at`.
+        media_type (str, optional): The type of the files.
+
+    Returns:
+        dict: The number of files stored and the status of each file.
+    """
+    try:
+        manifest_fields = json.loads(manifest) if manifest else {}
+        if not isinstance(manifest_fields, dict):
+            raise ValueError("The manifest must be a JSON object")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid manifest: {str(e)}")
+
+    close_archive = None
+    items = [BatchItem(file.filename, file.content_type, upload=file) for file in files or []]
+    if archive is not None:
+        try:
+            archive_items, close_archive = await run_in_threadpool(open_archive, archive.file)
+        except InvalidArchive as e:
+            raise HTTPException(status_code=400, detail=f"Invalid archive: {str(e)}")
+        items.extend(archive_items)
+    if not items:
+        raise HTTPException(status_code=400, detail="No files given")
+    logger.info(f"Received batch upload request for {len(items)} files.")
+
+    fields = {
+        "media_type": media_type,
+        "media_type_uuid": media_type_uuid,
+        "creator": creator,
+        "captured_at": captured_at,
+        "license": license,
+        "description": description,
+        "parent_type": parent_type,
+        "parent": parent,
+    }
+    try:
+        results = await ingest_batch(items, fields, manifest_fields, storage)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if close_archive is not None:
+            close_archive()
+
+    groups = {result["file_metadata"]["media_type"] for result in results if result["status"] == "stored"}
+    for group_id in groups:
+        background_tasks.add_task(compact_ro_crate_if_due, group_id, storage)
+    stored = sum(1 for result in results if result["status"] == "stored")
+    return {
+        "message": f"{stored} of {len(results)} files uploaded successfully",
+        "stored": stored,
+        "failed": len(results) - stored,
+        "files": results,
     }
 
+async def _find_file(type: str, file_id: str, storage: StorageBackend):
+    """
+    Find the stored object of a file, under its own key or as a shared blob.
+
+    Args:
+        type (str): The ID of the group to which the file belongs.
+        file_id (str): The name of the file, its ID and extension.
+        storage (StorageBackend): The storage backend.
+
+    Returns:
+        tuple: The key, the `ObjectInfo` and the content type of the stored object.
+
+    Raises:
+        HTTPException: If the file is not found.
+    """
+    file_key = f"{type}/{file_id}"
+    file_info = await storage.head(file_key)
+    content_type = file_info.content_type if file_info else None
+    if file_info is None:
+        # Files stored as a shared blob are found through their metadata
+        file_metadata = await run_in_threadpool(FileMetadata.get, os.path.splitext(file_id)[0])
+        if file_metadata is not None and file_metadata.group_id == type and file_metadata.file_key == file_key:
+            blob = await resolve_blob(file_metadata)
+            if blob is not None:
+                file_key = blob
+                file_info = await storage.head(file_key)
+                content_type = file_metadata.file_type
+    if file_info is None:
+        logger.warning(f"File not found with key {file_key}.")
+        raise HTTPException(status_code=404, detail="File not found")
+    logger.info(f"File found with key {file_key}.")
+    return file_key, file_info, content_type
+
+
 @app.get("/download/{type}/{file_id}")
-async def download_file(type: str, file_id: str):
+async def download_file(type: str, file_id: str, request: Request, storage: StorageBackend = Depends(get_storage)):
     """
-    Download a file from the S3 bucket.
+    Download a file from the storage backend.
+
+    Supports single and multiple byte ranges through the `Range` header, and
+    conditional requests through `If-None-Match`, `If-Modified-Since` and `If-Range`.
 
     Args:
         type (str): The ID of the group to which the file belongs.
         file_id (str): The ID of the file to download.
 
     Returns:
-        StreamingResponse: The file content.
+        StreamingResponse: The file content, or the requested ranges of it.
     """
     logger.info(f"Received download request for file {file_id} in group {type}.")
-    crate_file_key = f"{type}/ro-crate-metadata.json"
-    try:    
-        #crate = get_ro_crate(crate_file_key)
-        #if crate is None:
-            #logger.warning(f"No metadata found for group {type}.")
-            #raise HTTPException(status_code=404, detail="No metadata found for this group")
-        
-        #print(f"Crate metadata: {crate.metadata.generate()}")        
-        #file_metadata = crate.dereference(file_id)
-        #if not file_metadata:
-            #logger.warning(f"File metadata not found for file {file_id}.")
-            #raise HTTPException(status_code=404, detail="File metadata not found")
-
-        #print(f"File properties: {file_metadata.properties()}")
-        #file_name = file_metadata.get("@id")
-
-        if STORAGE_TYPE == "local":
-            # Read the file from local storage
-            local_file_path = os.path.join(STORAGE_PATH, f"{type}/{file_id}")
-            if not os.path.exists(local_file_path):
-                logger.warning(f"File not found at {local_file_path}.")
-                raise HTTPException(status_code=404, detail="File not found")
-            logger.info(f"File found at {local_file_path}.")
-            return StreamingResponse(open(local_file_path, "rb"), media_type="application/octet-stream")
-        elif STORAGE_TYPE == "S3":
-            # Download the file from the S3 bucket
-            file_key = f"{type}/{file_id}"
-            print(f"File key: {file_key}")
-            file_obj = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
-            logger.info(f"File downloaded from S3 bucket {BUCKET_NAME} with key {file_key}.")
-            return StreamingResponse(file_obj['Body'], media_type=file_obj['ContentType'], headers={
-                "Content-Disposition": f'attachment; filename="{file_id}"'
-            })
-        else:
-            raise HTTPException(status_code=500, detail="Invalid STORAGE_TYPE")
+    try:
+        file_key, file_info, content_type = await _find_file(type, file_id, storage)
+
+        local_file_path = storage.local_path(file_key)
 
+        def full_response(headers):
+            if local_file_path and "range" not in request.headers:
+                # Let the server send whole local files directly where it supports it
+                return FileResponse(local_file_path, media_type=content_type, headers=headers)
+            # Read the whole object without a Range header, which S3 would otherwise have to honour
+            return StreamingResponse(storage.get(file_key), media_type=content_type or "application/octet-stream",
+                                     headers=headers)
+
+        return range_response(
+            request,
+            size=file_info.size,
+            etag=file_info.etag,
+            last_modified=file_info.last_modified,
+            content_type=content_type or "application/octet-stream",
+            read_range=lambda start, end: storage.get(file_key, start, end),
+            headers={"Content-Disposition": f'attachment; filename="{file_id}"'},
+            full_response=full_response
+        )
+
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error downloading file: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/presign/upload")
+async def presign_upload(
+    background_tasks: BackgroundTasks,
+    file_name: str = Form(...),
+    content_type: str = Form(None),
+    size: int = Form(None),
+    sha256: str = Form(None),
+    uuid: str = Form(None),
+    media_type: str = Form(None),
+    media_type_uuid: str = Form(None),
+    creator: str = Form(None),
+    captured_at: str = Form(None),
+    license: str = Form(None),
+    description: str = Form(None),
+    parent_type: str = Form(None),
+    parent: str = Form(None),
+    storage: StorageBackend = Depends(get_storage),
+):
+    """
+    Start a direct upload of a file to S3, and get the presigned URLs to upload it to.
+
+    Files larger than `PRESIGN_MULTIPART_THRESHOLD` are uploaded in parts, each to its own
+    URL. Once uploaded, the upload is completed at /presign/upload/{token}/complete.
+
+    Args:
+        file_name (str): The name of the file.
+        content_type (str, optional): The content type of the file, sent with the upload.
+        size (int, optional): The size of the file in bytes, checked when the upload is completed.
+        sha256 (str, optional): The hex SHA-256 digest of the file. S3 checks a single PUT
+            against it, and the file is deduplicated like an upload through the API.
+        uuid (str, optional): The UUID of the file. If not provided, a new UUID will be generated.
+        media_type (str): The type of the file.
+
+    Returns:
+        dict: The upload token, and the URL or part URLs to upload the file to.
+    """
+    if not media_type:
+        raise HTTPException(status_code=400, detail="No media_type given")
+    if size is not None and size < 0:
+        raise HTTPException(status_code=400, detail="Invalid size")
+    if sha256 is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", sha256):
+        raise HTTPException(status_code=400, detail="Invalid sha256")
+    logger.info(f"Received direct upload request for file {file_name}.")
+    file_id = uuid or str(uuid4())
+    file_key = object_key(media_type, file_id, os.path.splitext(file_name)[1])
+    file_metadata = upload_metadata(file_id, file_name, content_type, {
+        "media_type": media_type,
+        "media_type_uuid": media_type_uuid,
+        "creator": creator,
+        "captured_at": captured_at,
+        "license": license,
+        "description": description,
+        "parent_type": parent_type,
+        "parent": parent,
+    })
+    try:
+        upload = await start_direct_upload(storage, file_key, file_metadata, size, sha256.lower() if sha256 else None)
+    except NotImplementedError:
+        raise HTTPException(status_code=400, detail="Presigned URLs require the S3 storage backend")
+    except Exception as e:
+        logger.error(f"Error starting direct upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    background_tasks.add_task(expire_direct_uploads, storage)
+    return upload
+
+
+@app.post("/presign/upload/{token}/complete")
+async def complete_presigned_upload(
+    token: str,
+    background_tasks: BackgroundTasks,
+    parts: str = Form(None),
+    storage: StorageBackend = Depends(get_storage),
+):
+    """
+    Complete a direct upload, and record the metadata and RO-Crate entry of the file.
+
+    Args:
+        token (str): The upload token returned when the upload was started.
+        parts (str, optional): A JSON list of the `PartNumber` and `ETag` of every part
+            of a multipart upload, the ETag being returned by S3 for each part URL.
+
+    Returns:
+        dict: A message indicating the file was uploaded successfully and the file ID.
+    """
+    try:
+        part_list = json.loads(parts) if parts else None
+        if part_list is not None and not isinstance(part_list, list):
+            raise ValueError("The parts must be a JSON list")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid parts: {str(e)}")
+    try:
+        completed = await complete_direct_upload(storage, token, part_list)
+    except DirectUploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error completing direct upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if completed is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    file_metadata = completed["file_metadata"]
+    background_tasks.add_task(compact_ro_crate_if_due, file_metadata["media_type"], storage)
+
+    file_id = file_metadata["file_id"]
+    file_extension = os.path.splitext(file_metadata["file_name"])[1]
+    return {
+        "message": "File uploaded successfully",
+        "file_id": file_id,
+        "file_path": completed["file_path"],
+        "file_originalname": file_metadata["file_name"],
+        "file_filename": f"{file_id}{file_extension}",
+        "file_metadata": file_metadata,
+        "deduplicated": completed["deduplicated"]
+    }
+
+
+@app.get("/presign/download/{type}/{file_id}")
+async def presign_download(type: str, file_id: str, redirect: bool = False,
+                           storage: StorageBackend = Depends(get_storage)):
+    """
+    Get a presigned URL to download a file directly from S3.
+
+    Args:
+        type (str): The ID of the group to which the file belongs.
+        file_id (str): The ID of the file to download.
+        redirect (bool, optional): Redirect to the URL instead of returning it.
+
+    Returns:
+        dict: The presigned URL and the number of seconds it is valid for.
+    """
+    file_key, _, content_type = await _find_file(type, file_id, storage)
+    params = {"ResponseContentDisposition": f'attachment; filename="{file_id}"'}
+    if content_type:
+        params["ResponseContentType"] = content_type
+    try:
+        url = await storage.presign("get_object", file_key, PRESIGN_EXPIRES, **params)
+    except NotImplementedError:
+        raise HTTPException(status_code=400, detail="Presigned URLs require the S3 storage backend")
+    if redirect:
+        return RedirectResponse(url, status_code=307)
+    return {"url": url, "expires_in": PRESIGN_EXPIRES}
+
+
+@app.post("/uploads", status_code=201)
+async def create_upload_session(
+    response: Response,
+    background_tasks: BackgroundTasks,
+    file_name: str = Form(...),
+    content_type: str = Form(None),
+    size: int = Form(None),
+    uuid: str = Form(None),
+    media_type: str = Form(None),
+    media_type_uuid: str = Form(None),
+    creator: str = Form(None),
+    captured_at: str = Form(None),
+    license: str = Form(None),
+    description: str = Form(None),
+    parent_type: str = Form(None),
+    parent: str = Form(None),
+    storage: StorageBackend = Depends(get_storage),
+):
+    """
+    Create a resumable upload session.
+
+    The content is then sent with PATCH requests to the session's URL, given in the
+    `Location` header, and the session is finished at /uploads/{session_id}/complete.
+
+    Args:
+        file_name (str): The name of the file.
+        content_type (str, optional): The content type of the file.
+        size (int, optional): The size of the file in bytes, if known in advance.
+        uuid (str, optional): The UUID of the file. If not provided, a new UUID will be generated.
+        media_type (str): The type of the file.
+
+    Returns:
+        dict: The session ID, the file ID, and the offset received so far.
+    """
+    if not media_type:
+        raise HTTPException(status_code=400, detail="No media_type given")
+    if size is not None and size < 0:
+        raise HTTPException(status_code=400, detail="Invalid size")
+    logger.info(f"Received resumable upload request for file {file_name}.")
+    file_id = uuid or str(uuid4())
+    file_key = object_key(media_type, file_id, os.path.splitext(file_name)[1])
+    file_metadata = upload_metadata(file_id, file_name, content_type, {
+        "media_type": media_type,
+        "media_type_uuid": media_type_uuid,
+        "creator": creator,
+        "captured_at": captured_at,
+        "license": license,
+        "description": description,
+        "parent_type": parent_type,
+        "parent": parent,
+    })
+    try:
+        session = await create_session(storage, file_key, file_metadata, size)
+    except Exception as e:
+        logger.error(f"Error creating upload session: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    background_tasks.add_task(expire_sessions, storage)
+    response.headers["Location"] = f"/uploads/{session['session_id']}"
+    response.headers["Upload-Offset"] = "0"
+    return session
+
+
+def _session_headers(offset: int, size: Optional[int] = None) -> dict:
+    headers = {"Upload-Offset": str(offset), "Cache-Control": "no-store"}
+    if size is not None:
+        headers["Upload-Length"] = str(size)
+    return headers
+
+
+@app.api_route("/uploads/{session_id}", methods=["GET", "HEAD"])
+async def get_upload_session(session_id: str, response: Response):
+    """
+    Get the offset a resumable upload has received, to resume it from after a connection drops.
+
+    Args:
+        session_id (str): The ID of the session.
+
+    Returns:
+        dict: The offset received so far and the declared size, also sent as the
+            `Upload-Offset` and `Upload-Length` headers.
+    """
+    session = await get_session(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    response.headers.update(_session_headers(session["offset"], session["size"]))
+    return session
+
+
+@app.patch("/uploads/{session_id}")
+async def append_upload_session(session_id: str, request: Request, storage: StorageBackend = Depends(get_storage)):
+    """
+    Send content to a resumable upload, starting at the offset it has received so far.
+
+    The request body is the content, and the `Upload-Offset` header the offset it starts at.
+    The bytes that arrive are kept even if the connection drops.
+
+    Args:
+        session_id (str): The ID of the session.
+
+    Returns:
+        Response: 204 No Content, with the offset received so far as `Upload-Offset`.
+    """
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="An Upload-Offset header is required")
+    try:
+        received = await append_to_session(storage, session_id, offset, request.stream())
+    except UploadConflict as e:
+        session = await get_session(session_id)
+        headers = _session_headers(session["offset"]) if session else None
+        raise HTTPException(status_code=409, detail=str(e), headers=headers)
+    except UploadSessionError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ClientDisconnect:
+        logger.info(f"Connection to upload session {session_id} dropped; the bytes received are kept.")
+        return Response(status_code=400)
+    except Exception as e:
+        logger.error(f"Error writing to upload session: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if received is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return Response(status_code=204, headers=_session_headers(received))
+
+
+@app.post("/uploads/{session_id}/complete")
+async def complete_upload_session(session_id: str, background_tasks: BackgroundTasks,
+                                  storage: StorageBackend = Depends(get_storage)):
+    """
+    Finish a resumable upload, and record the metadata and RO-Crate entry of the file.
+
+    Args:
+        session_id (str): The ID of the session.
+
+    Returns:
+        dict: A message indicating the file was uploaded successfully and the file ID.
+    """
+    try:
+        finished = await finish_session(storage, session_id)
+    except UploadConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except UploadSessionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error finishing upload session: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if finished is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    file_metadata = finished["file_metadata"]
+    background_tasks.add_task(compact_ro_crate_if_due, file_metadata["media_type"], storage)
+
+    file_id = file_metadata["file_id"]
+    file_extension = os.path.splitext(file_metadata["file_name"])[1]
+    return {
+        "message": "File uploaded successfully",
+        "file_id": file_id,
+        "file_path": finished["file_path"],
+        "file_originalname": file_metadata["file_name"],
+        "file_filename": f"{file_id}{file_extension}",
+        "file_metadata": file_metadata,
+        "deduplicated": finished["deduplicated"]
+    }
+
+
+@app.delete("/uploads/{session_id}", status_code=204)
+async def cancel_upload_session(session_id: str, storage: StorageBackend = Depends(get_storage)):
+    """
+    Cancel a resumable upload and discard the content it has received.
+
+    Args:
+        session_id (str): The ID of the session.
+    """
+    try:
+        cancelled = await cancel_session(storage, session_id)
+    except UploadConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not cancelled:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return Response(status_code=204)
+
+
+@app.delete("/{type}/{file_id}")
+async def delete_file(type: str, file_id: str, storage: StorageBackend = Depends(get_storage)):
+    """
+    Delete a file, its metadata and its entry in the RO-Crate metadata.
+
+    The stored content is only deleted once no other file refers to it.
+
+    Args:
+        type (str): The ID of the group to which the file belongs.
+        file_id (str): The ID of the file.
+
+    Returns:
+        dict: A message indicating the file was deleted and the file ID.
+    """
+    logger.info(f"Received delete request for file {file_id} in group {type}.")
+    file_metadata = await run_in_threadpool(FileMetadata.get, file_id)
+    if file_metadata is None or file_metadata.group_id != type:
+        logger.warning(f"File metadata not found for file {file_id}.")
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        await release_file(storage, file_metadata)
+        await run_in_threadpool(file_metadata.delete)
+        await remove_from_ro_crate(type, f"{file_id}{os.path.splitext(file_metadata.file_name)[1]}", storage)
+    except Exception as e:
+        logger.error(f"Error deleting file: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"message": "File deleted successfully", "file_id": file_id}
+
+
 @app.get("/metadata/{type}")
-async def get_metadata(type: str):
+async def get_metadata(
+    type: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    format: Optional[str] = None,
+    media_type_uuid: Optional[str] = None,
+    parent_type: Optional[str] = None,
+    parent: Optional[str] = None,
+    captured_from: Optional[str] = None,
+    captured_to: Optional[str] = None,
+    creator: Optional[str] = None,
+    license: Optional[str] = None,
+    bbox: Optional[str] = None,
+    storage: StorageBackend = Depends(get_storage),
+):
     """
     Get metadata for all files in a group.
 
+    Without query parameters, the RO-Crate of the group is returned. With any of the
+    query parameters, the indexed metadata of the files is returned one page at a time,
+    and the cursor of the next page is sent in the `Link` header and the JSON body.
+
     Args:
         type (str): The ID of the group.
+        limit (int, optional): The number of files in a page.
+        cursor (str, optional): The cursor of the page, from the previous page.
+        fields (str, optional): A comma-separated list of the fields to return.
+        format (str, optional): `json` for a JSON document, or `ndjson` for one JSON line per file.
+        media_type_uuid (str, optional): Only return files with this media type UUID.
+        parent_type (str, optional): Only return files attached to this type of entity.
+        parent (str, optional): Only return files attached to this entity.
+        captured_from (str, optional): Only return files captured at or after this ISO 8601 date or time.
+        captured_to (str, optional): Only return files captured at or before this ISO 8601 date or time;
+            a date includes the whole day.
+        creator (str, optional): Only return files by this author.
+        license (str, optional): Only return files under this license.
+        bbox (str, optional): Only return files captured within this box, given as
+            `min_longitude,min_latitude,max_longitude,max_latitude`.
 
     Returns:
-        list: A list of file metadata.
+        The RO-Crate metadata, or a page of file metadata.
     """
     logger.info(f"Received metadata request for group {type}.")
-    crate_file_key = f"{type}/ro-crate-metadata.json"
+    if request.query_params:
+        return await list_metadata(
+            type, request, limit or PAGE_SIZE, cursor, fields, format or "json",
+            media_type_uuid=media_type_uuid, parent_type=parent_type, parent=parent,
+            captured_from=captured_from, captured_to=captured_to, creator=creator,
+            license=license, bbox=_parse_bbox(bbox),
+        )
     try:
-        crate = get_ro_crate(crate_file_key)
-        if crate is None:
+        cached = await get_crate_metadata(type, storage)
+        if cached is None:
             logger.warning(f"No metadata found for group {type}.")
             raise HTTPException(status_code=404, detail="No metadata found for this group")
-        data = crate.metadata.generate()
         logger.info(f"Metadata retrieved for group {type}.")
-        return JSONResponse(content = data)
+        return Response(content=cached.body, media_type="application/json")
     except HTTPException as e:
         logger.error(f"HTTP error retrieving metadata: {str(e)}")
         raise e
@@ -202,6 +779,270 @@ async def get_metadata(type: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _parse_bbox(bbox: Optional[str]) -> Optional[tuple]:
+    """
+    Parse a `min_longitude,min_latitude,max_longitude,max_latitude` bounding box query parameter.
+    """
+    if bbox is None:
+        return None
+    try:
+        min_longitude, min_latitude, max_longitude, max_latitude = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid bbox: must be min_longitude,min_latitude,max_longitude,max_latitude")
+    if not (-90 <= min_latitude <= max_latitude <= 90 and -180 <= min_longitude <= 180 and -180 <= max_longitude <= 180):
+        raise HTTPException(status_code=400, detail="Invalid bbox: coordinates out of range")
+    return min_longitude, min_latitude, max_longitude, max_latitude
+
+
+async def list_metadata(type: Optional[str], request: Request, limit: int, cursor: Optional[str],
+                        fields: Optional[str], format: str, **filters) -> StreamingResponse:
+    """
+    Stream a page of the indexed file metadata of a group, or of all groups.
+
+    Args:
+        type (str, optional): The ID of the group, or None for all groups.
+        request (Request): The request, used to build the link to the next page.
+        limit (int): The number of files in the page.
+        cursor (str, optional): The cursor of the page.
+        fields (str, optional): A comma-separated list of the fields to return.
+        format (str): `json` or `ndjson`.
+        **filters: The filters passed to `FileMetadata.page`.
+
+    Returns:
+        StreamingResponse: The page.
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    columns = COLUMNS
+    if fields:
+        columns = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = set(columns) - set(COLUMNS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    try:
+        after = decode_cursor(cursor)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    for name in ("captured_from", "captured_to"):
+        if filters.get(name) is not None:
+            try:
+                utc_timestamp(filters[name])
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid {name}: must be an ISO 8601 date or time")
+
+    # One extra row tells whether there is a next page
+    rows = await run_in_threadpool(FileMetadata.page, type, after, limit + 1, columns, **filters)
+    next_cursor = encode_cursor(rows[limit - 1]["file_id"]) if len(rows) > limit else None
+    rows = rows[:limit]
+    logger.info(f"Listing {len(rows)} files of {f'group {type}' if type is not None else 'all groups'}.")
+
+    headers = {}
+    if next_cursor is not None:
+        headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    body = iter_ndjson(rows) if format == "ndjson" else iter_json_page(rows, next_cursor)
+    return StreamingResponse(body, media_type=FORMATS[format], headers=headers)
+
+
+@app.get("/search")
+async def search_metadata(
+    request: Request,
+    group: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    format: str = "json",
+    media_type_uuid: Optional[str] = None,
+    parent_type: Optional[str] = None,
+    parent: Optional[str] = None,
+    captured_from: Optional[str] = None,
+    captured_to: Optional[str] = None,
+    creator: Optional[str] = None,
+    license: Optional[str] = None,
+    bbox: Optional[str] = None,
+):
+    """
+    Search the indexed file metadata of all groups, one page at a time.
+
+    The filters are those of the `/metadata/{type}` listing, and the cursor of the next
+    page is sent in the `Link` header and the JSON body.
+
+    Args:
+        group (str, optional): Only return files of this group.
+        limit (int, optional): The number of files in a page.
+        cursor (str, optional): The cursor of the page, from the previous page.
+        fields (str, optional): A comma-separated list of the fields to return.
+        format (str, optional): `json` for a JSON document, or `ndjson` for one JSON line per file.
+        media_type_uuid (str, optional): Only return files with this media type UUID.
+        parent_type (str, optional): Only return files attached to this type of entity.
+        parent (str, optional): Only return files attached to this entity.
+        captured_from (str, optional): Only return files captured at or after this ISO 8601 date or time.
+        captured_to (str, optional): Only return files captured at or before this ISO 8601 date or time;
+            a date includes the whole day.
+        creator (str, optional): Only return files by this author.
+        license (str, optional): Only return files under this license.
+        bbox (str, optional): Only return files captured within this box, given as
+            `min_longitude,min_latitude,max_longitude,max_latitude`.
+
+    Returns:
+        StreamingResponse: A page of file metadata.
+    """
+    return await list_metadata(
+        group, request, limit, cursor, fields, format,
+        media_type_uuid=media_type_uuid, parent_type=parent_type, parent=parent,
+        captured_from=captured_from, captured_to=captured_to, creator=creator,
+        license=license, bbox=_parse_bbox(bbox),
+    )
+
+
+@app.get("/archive/{type}")
+async def download_archive(type: str, storage: StorageBackend = Depends(get_storage)):
+    """
+    Download the RO-Crate of a group as a zip package of its metadata and files.
+
+    The package is streamed as the files are read from storage.
+
+    Args:
+        type (str): The ID of the group.
+
+    Returns:
+        StreamingResponse: The zip package.
+    """
+    logger.info(f"Received archive request for group {type}.")
+    rows = await run_in_threadpool(FileMetadata.page, type, None, 1, ["file_id"])
+    if not rows and await get_crate_metadata(type, storage) is None:
+        raise HTTPException(status_code=404, detail="No files found for this group")
+    return StreamingResponse(crate_package(type, storage), media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="{type}.zip"'})
+
+
+def _parse_groups(groups: Optional[str]) -> Optional[List[str]]:
+    """
+    Parse the JSON list of group IDs of a bulk archive request, or None for every group.
+    """
+    if not groups:
+        return None
+    try:
+        group_ids = json.loads(groups)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid groups: {str(e)}")
+    if not isinstance(group_ids, list) or not all(isinstance(group_id, str) for group_id in group_ids):
+        raise HTTPException(status_code=400, detail="Invalid groups: must be a JSON list of group IDs")
+    return group_ids
+
+
+@app.post("/archive/export", status_code=202)
+async def export_archives(background_tasks: BackgroundTasks, groups: str = Form(None),
+                          storage: StorageBackend = Depends(get_storage)):
+    """
+    Export the RO-Crate zip packages of many groups to the storage backend, in the background.
+
+    Args:
+        groups (str, optional): A JSON list of the group IDs to export; by default every group with files.
+
+    Returns:
+        dict: The ID of the job and the URL of its progress.
+    """
+    group_ids = _parse_groups(groups)
+    job = start_job("export")
+    background_tasks.add_task(run_job, job, storage, group_ids)
+    logger.info(f"Started export job {job.id}.")
+    return {"job_id": job.id, "status_url": f"/archive/jobs/{job.id}"}
+
+
+@app.post("/archive/rebuild", status_code=202)
+async def rebuild_archives(background_tasks: BackgroundTasks, groups: str = Form(None),
+                           storage: StorageBackend = Depends(get_storage)):
+    """
+    Rebuild the RO-Crates of many groups from the metadata store, in the background.
+
+    Args:
+        groups (str, optional): A JSON list of the group IDs to rebuild; by default every group with files.
+
+    Returns:
+        dict: The ID of the job and the URL of its progress.
+    """
+    group_ids = _parse_groups(groups)
+    job = start_job("rebuild")
+    background_tasks.add_task(run_job, job, storage, group_ids)
+    logger.info(f"Started rebuild job {job.id}.")
+    return {"job_id": job.id, "status_url": f"/archive/jobs/{job.id}"}
+
+
+@app.get("/archive/jobs/{job_id}")
+async def get_archive_job(job_id: str, storage: StorageBackend = Depends(get_storage)):
+    """
+    Get the progress of an export or rebuild, and the result of each group processed.
+
+    Rebuilds are only known to the worker running them; exports are also found by their manifest.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        dict: The status of the job and of each group.
+    """
+    job = await get_job(job_id, storage)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/stats/cache")
+async def get_cache_stats():
+    """
+    Get the size and hit/miss counters of the RO-Crate cache.
+
+    Returns:
+        dict: The cache statistics.
+    """
+    return crate_cache.stats()
+
+
+@app.get("/stats/startup")
+async def get_startup_stats():
+    """
+    Get the startup timings of the worker serving the request.
+
+    Returns:
+        dict: The durations of the import, lifespan and warm-up phases, and the CPU time used until ready.
+    """
+    return startup.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Get the metrics of the service in the Prometheus text format.
+
+    Returns:
+        Response: The metrics.
+    """
+    return metrics_response()
+
+
+@app.get("/metadata/{type}/{file_id}")
+async def get_file_metadata(type: str, file_id: str):
+    """
+    Get the indexed metadata of a single file.
+
+    Args:
+        type (str): The ID of the group to which the file belongs.
+        file_id (str): The ID of the file.
+
+    Returns:
+        FileMetadata: The metadata of the file.
+    """
+    logger.info(f"Received metadata request for file {file_id} in group {type}.")
+    file_metadata = await run_in_threadpool(FileMetadata.get, file_id)
+    if file_metadata is None or file_metadata.group_id != type:
+        logger.warning(f"File metadata not found for file {file_id}.")
+        raise HTTPException(status_code=404, detail="File metadata not found")
+    return file_metadata
+
+
+startup.record("import", time.perf_counter() - IMPORT_STARTED)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=80)
@@ -0,0 +1,175 @@
+"""
+Prometheus metrics for the File Storage API.
+
+This module defines the metrics of the service and the middleware that records, for
+every route, how long requests take, how many bytes they receive and send, and how many
+are in progress. S3 calls are timed through botocore's event hooks, and RO-Crate work is
+timed where it is done. The metrics are exposed in the Prometheus text format at /metrics.
+
+If PROMETHEUS_MULTIPROC_DIR is set, metrics are collected across all worker processes.
+"""
+
+import os
+import time
+import logging
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from starlette.responses import Response
+from starlette.routing import Match
+
+
+logger = logging.getLogger(__name__)
+
+# S3 calls taking longer than this many seconds are logged
+S3_SLOW_CALL_SECONDS = float(os.getenv("S3_SLOW_CALL_SECONDS", 1))
+
+# Buckets for request and S3 call latencies, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, until the last byte is sent.",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+REQUEST_BYTES = Counter(
+    "http_request_bytes_total", "Bytes received in request bodies.", ["method", "route"],
+)
+RESPONSE_BYTES = Counter(
+    "http_response_bytes_total", "Bytes sent in response bodies.", ["method", "route"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requests being handled, such as active uploads and downloads.",
+    ["method", "route"], multiprocess_mode="livesum",
+)
+S3_DURATION = Histogram(
+    "s3_request_duration_seconds", "Time of S3 API calls.", ["operation"], buckets=LATENCY_BUCKETS,
+)
+S3_ERRORS = Counter(
+    "s3_request_errors_total", "S3 API calls that failed.", ["operation", "code"],
+)
+STARTUP_SECONDS = Gauge(
+    "startup_seconds", "Duration of the startup phases of a worker: import, lifespan and warmup.", ["phase"],
+)
+STARTUP_CPU_SECONDS = Gauge(
+    "startup_cpu_seconds", "CPU time a worker used from the start of its process until it was ready.",
+)
+CRATE_DURATION = Histogram(
+    "rocrate_duration_seconds", "Time to materialize, parse and generate RO-Crate metadata.", ["operation"],
+)
+ARCHIVE_GROUP_DURATION = Histogram(
+    "archive_group_duration_seconds", "Time to export or rebuild the RO-Crate of a group.", ["operation", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def _route(app, scope) -> str:
+    """
+    Get the path template of the route a request is for, to keep label values bounded.
+    """
+    partial = None
+    for route in getattr(app, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, body sizes and concurrency of requests by route.
+
+    The body sizes are counted as the chunks pass through, so streamed uploads and
+    downloads are measured without being buffered.
+    """
+    def __init__(self, app, router=None):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = _route(self.router, scope) if self.router is not None else "unmatched"
+        status = "500"
+
+        async def receive_counted():
+            message = await receive()
+            if message["type"] == "http.request":
+                REQUEST_BYTES.labels(method, route).inc(len(message.get("body", b"")))
+            return message
+
+        async def send_counted(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            elif message["type"] == "http.response.body":
+                RESPONSE_BYTES.labels(method, route).inc(len(message.get("body", b"")))
+            await send(message)
+
+        in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            in_progress.dec()
+            REQUEST_DURATION.labels(method, route, status).observe(time.perf_counter() - started)
+
+
+def instrument_s3_client(client):
+    """
+    Time the calls of an S3 client and count their errors by operation.
+
+    Calls slower than S3_SLOW_CALL_SECONDS are logged as warnings, and every call at debug level.
+
+    Args:
+        client: The boto3 or aiobotocore S3 client.
+    """
+    def observe(operation: str, started: float):
+        seconds = time.perf_counter() - started
+        S3_DURATION.labels(operation).observe(seconds)
+        if seconds >= S3_SLOW_CALL_SECONDS:
+            logger.warning(f"Slow S3 call: {operation} took {seconds:.2f}s.")
+        else:
+            logger.debug(f"S3 call {operation} took {seconds * 1000:.1f}ms.")
+
+    def before_call(model, context, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        started = context.pop("metrics_started", None)
+        if started is not None:
+            observe(model.name, started)
+        if http_response is not None and http_response.status_code >= 300:
+            code = (parsed or {}).get("Error", {}).get("Code") or str(http_response.status_code)
+            S3_ERRORS.labels(model.name, code).inc()
+
+    def after_call_error(exception, context, event_name, **kwargs):
+        # Raised before a response was received, such as on connection errors
+        operation = event_name.rsplit(".", 1)[-1]
+        started = context.pop("metrics_started", None)
+        if started is not None:
+            observe(operation, started)
+        S3_ERRORS.labels(operation, type(exception).__name__).inc()
+
+    events = client.meta.events
+    events.register("before-call.s3", before_call, unique_id="metrics-before-call")
+    events.register("after-call.s3", after_call, unique_id="metrics-after-call")
+    events.register("after-call-error.s3", after_call_error, unique_id="metrics-after-call-error")
+
+
+def metrics_response() -> Response:
+    """
+    Render the metrics in the Prometheus text format.
+
+    Returns:
+        Response: The metrics.
+    """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
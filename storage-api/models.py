@@ -1,18 +1,68 @@
 """
 Data models for the File Storage API.
 
-This module defines the data models for file metadata.
+This module defines the data models for file metadata and stored objects.
 """
 
-from pydantic import BaseModel
-from typing import List
-from datetime import datetime
+from pydantic import BaseModel, field_validator
+from typing import List, Optional, Sequence, Tuple
+from datetime import datetime, time, timezone
+from database import get_store, COLUMNS
+
+
+def utc_timestamp(value: str, end_of_day: bool = False) -> str:
+    """
+    Normalise an ISO 8601 date or time to a UTC timestamp that sorts in time order as text.
+
+    Times without a UTC offset are taken as UTC, and dates as midnight. A trailing `Z` is read as UTC.
+
+    Args:
+        value (str): The date or time.
+        end_of_day (bool, optional): Take a date as the last instant of the day instead of midnight,
+            for inclusive upper bounds.
+
+    Returns:
+        str: The time as `YYYY-MM-DDTHH:MM:SS[.ffffff]+00:00`.
+
+    Raises:
+        ValueError: If the value is not an ISO 8601 date or time.
+    """
+    value = value.strip()
+    # Python before 3.11 does not parse the `Z` of UTC times, as written by JavaScript's toISOString
+    if value[-1:] in ("Z", "z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if end_of_day and "T" not in value.upper() and " " not in value:
+        parsed = datetime.combine(parsed.date(), time.max)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat()
+
+
+class ObjectInfo(BaseModel):
+    """
+    Model representing an object in the storage backend.
+
+    Attributes:
+        key (str): The key of the object.
+        size (int): The size of the object in bytes.
+        etag (str, optional): The ETag of the object.
+        last_modified (datetime, optional): The modification time of the object.
+        content_type (str, optional): The content type of the object.
+    """
+    key: str
+    size: int
+    etag: Optional[str] = None
+    last_modified: Optional[datetime] = None
+    content_type: Optional[str] = None
 
 
 class FileMetadata(BaseModel):
     """
     Model representing the metadata for a file.
 
+    The metadata is kept in the indexed metadata store from the `database` module.
+
     Attributes:
         group_id (str): The ID of the group to which the file belongs.
         file_id (str): The ID of the file.
@@ -22,24 +72,122 @@ class FileMetadata(BaseModel):
         file_author (str): The author of the file.
         file_version (int): The version of the file.
         file_upload_date (str): The upload date of the file.
+        media_type_uuid (str, optional): The UUID of the media type of the file.
+        file_key (str, optional): The storage key of the file.
+        file_license (str, optional): The license of the file.
+        file_size (int, optional): The size of the file in bytes.
+        file_checksum (str, optional): The checksum of the file, as `algorithm:hexdigest`.
+        parent_type (str, optional): The type of the entity the file belongs to.
+        parent (str, optional): The ID of the entity the file belongs to.
+        captured_at (str, optional): When the media was captured, as a UTC timestamp if it was given in ISO 8601.
+        latitude (float, optional): The latitude the media was captured at, from its EXIF GPS position.
+        longitude (float, optional): The longitude the media was captured at, from its EXIF GPS position.
+        width (int, optional): The width of an image in pixels.
+        height (int, optional): The height of an image in pixels.
+        page_count (int, optional): The number of pages of a document.
+        vertex_count (int, optional): The number of vertices of a mesh.
+        face_count (int, optional): The number of faces of a mesh.
     """
     group_id: str
     file_id: str
     file_name: str
-    file_type: str
-    file_description: str
-    file_author: str
-    file_version: int
+    file_type: Optional[str] = None
+    file_description: Optional[str] = None
+    file_author: Optional[str] = None
+    file_version: int = 1
     file_upload_date: str
+    media_type_uuid: Optional[str] = None
+    file_key: Optional[str] = None
+    file_license: Optional[str] = None
+    file_size: Optional[int] = None
+    file_checksum: Optional[str] = None
+    parent_type: Optional[str] = None
+    parent: Optional[str] = None
+    captured_at: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    page_count: Optional[int] = None
+    vertex_count: Optional[int] = None
+    face_count: Optional[int] = None
+
+    @field_validator("captured_at")
+    @classmethod
+    def _normalise_captured_at(cls, value: Optional[str]) -> Optional[str]:
+        # Stored as UTC so that capture date filters compare times, not their spelling
+        if value is None:
+            return None
+        try:
+            return utc_timestamp(value)
+        except ValueError:
+            return value
+
+    @classmethod
+    def from_upload(cls, file_metadata: dict, file_key: Optional[str] = None) -> 'FileMetadata':
+        """
+        Build the model from the metadata dictionary assembled by the upload endpoint.
+
+        Args:
+            file_metadata (dict): The upload metadata.
+            file_key (str, optional): The storage key of the file.
+
+        Returns:
+            FileMetadata: The metadata of the file.
+        """
+        author = file_metadata.get("media_author") or {}
+        location = file_metadata.get("media_location") or {}
+        properties = file_metadata.get("media_properties") or {}
+        return cls(
+            group_id=file_metadata["media_type"],
+            file_id=file_metadata["file_id"],
+            file_name=file_metadata["file_name"],
+            file_type=file_metadata.get("file_encoding"),
+            file_description=file_metadata.get("media_description"),
+            file_author=author.get("author_id"),
+            file_version=file_metadata.get("file_version", 1),
+            file_upload_date=file_metadata["file_upload_date"],
+            media_type_uuid=file_metadata.get("media_type_uuid"),
+            file_key=file_key,
+            file_license=file_metadata.get("media_license"),
+            file_size=file_metadata.get("file_size"),
+            file_checksum=file_metadata.get("file_checksum"),
+            parent_type=file_metadata.get("media_parent_type"),
+            parent=file_metadata.get("media_parent"),
+            captured_at=file_metadata.get("media_captured_at"),
+            latitude=location.get("latitude"),
+            longitude=location.get("longitude"),
+            width=properties.get("width"),
+            height=properties.get("height"),
+            page_count=properties.get("page_count"),
+            vertex_count=properties.get("vertex_count"),
+            face_count=properties.get("face_count"),
+        )
 
     def save(self):
         """
-        Save the file metadata to a database (e.g., MongoDB).
+        Save the file metadata to the metadata store, replacing any earlier version.
+        """
+        get_store().upsert_many([self.model_dump()])
+
+    def delete(self):
+        """
+        Delete the file metadata from the metadata store.
+        """
+        get_store().delete(self.file_id)
+
+    @staticmethod
+    def save_many(items: List['FileMetadata']):
+        """
+        Save the metadata of several files in a single transaction.
+
+        Args:
+            items (List[FileMetadata]): The metadata to save.
         """
-        pass
+        get_store().upsert_many([item.model_dump() for item in items])
 
     @staticmethod
-    def get(file_id: str):
+    def get(file_id: str) -> Optional['FileMetadata']:
         """
         Retrieve file metadata from the database.
 
@@ -47,9 +195,10 @@ class FileMetadata(BaseModel):
             file_id (str): The ID of the file.
 
         Returns:
-            FileMetadata: The metadata of the file.
+            FileMetadata: The metadata of the file, or None if it is not found.
         """
-        pass
+        rows = get_store().select("file_id = ?", (file_id,), limit=1)
+        return FileMetadata(**rows[0]) if rows else None
 
     @staticmethod
     def filter(group_id: str) -> List['FileMetadata']:
@@ -62,4 +211,76 @@ class FileMetadata(BaseModel):
         Returns:
             List[FileMetadata]: A list of file metadata.
         """
-        pass
+        rows = get_store().select("group_id = ?", (group_id,))
+        return [FileMetadata(**row) for row in rows]
+
+    @staticmethod
+    def page(group_id: Optional[str], after: Optional[str] = None, limit: int = 100,
+             fields: Sequence[str] = COLUMNS, media_type_uuid: Optional[str] = None,
+             parent_type: Optional[str] = None, parent: Optional[str] = None,
+             captured_from: Optional[str] = None, captured_to: Optional[str] = None,
+             creator: Optional[str] = None, license: Optional[str] = None,
+             bbox: Optional[Tuple[float, float, float, float]] = None) -> List[dict]:
+        """
+        Retrieve one page of the metadata of a group, or of all groups, in file ID order.
+
+        The page is read from the (group_id, file_id) index, or the file ID key across groups,
+        starting after the last file ID of the previous page, so every page costs the same
+        however deep it is. Filters on the parent, creator, capture date or location are
+        served by their own indexes.
+
+        Args:
+            group_id (str, optional): The ID of the group, or None to search every group.
+            after (str, optional): The last file ID of the previous page.
+            limit (int, optional): The maximum number of files to return.
+            fields (Sequence[str], optional): The columns to return. The file ID is always returned.
+            media_type_uuid (str, optional): Only return files with this media type UUID.
+            parent_type (str, optional): Only return files attached to this type of entity.
+            parent (str, optional): Only return files attached to this entity.
+            captured_from (str, optional): Only return files captured at or after this ISO 8601 date or time.
+            captured_to (str, optional): Only return files captured at or before this ISO 8601 date or time;
+                a date includes the whole day.
+            creator (str, optional): Only return files by this author.
+            license (str, optional): Only return files under this license.
+            bbox (tuple, optional): Only return files captured within this box, given as its
+                minimum longitude, minimum latitude, maximum longitude and maximum latitude.
+
+        Returns:
+            List[dict]: The requested columns of the matching files.
+
+        Raises:
+            ValueError: If a capture date bound is not an ISO 8601 date or time.
+        """
+        conditions = []
+        params = []
+        if group_id is not None:
+            conditions.append("group_id = ?")
+            params.append(group_id)
+        if after is not None:
+            conditions.append("file_id > ?")
+            params.append(after)
+        for column, value in (("media_type_uuid", media_type_uuid), ("parent_type", parent_type),
+                              ("parent", parent), ("file_author", creator), ("file_license", license)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if captured_from is not None:
+            conditions.append("captured_at >= ?")
+            params.append(utc_timestamp(captured_from))
+        if captured_to is not None:
+            conditions.append("captured_at <= ?")
+            params.append(utc_timestamp(captured_to, end_of_day=True))
+        if bbox is not None:
+            min_longitude, min_latitude, max_longitude, max_latitude = bbox
+            conditions.append("latitude BETWEEN ? AND ?")
+            params.extend((min_latitude, max_latitude))
+            # A box crossing the antimeridian has its minimum longitude east of its maximum
+            if min_longitude <= max_longitude:
+                conditions.append("longitude BETWEEN ? AND ?")
+                params.extend((min_longitude, max_longitude))
+            else:
+                conditions.append("(longitude >= ? OR longitude <= ?)")
+                params.extend((min_longitude, max_longitude))
+        columns = ["file_id"] + [field for field in fields if field != "file_id"]
+        return get_store().select(" AND ".join(conditions), params, order_by="file_id",
+                                  limit=limit, columns=columns)
@@ -0,0 +1,320 @@
+"""
+S3 multipart upload engine for the File Storage API.
+
+This module uploads streams to S3 as multipart uploads, transferring several parts
+in parallel. Blocking boto3 calls run on worker threads so that they never hold up the
+event loop, and aiobotocore calls are awaited directly. An interrupted upload is left open on the bucket, and a later upload to
+the same key resumes from the parts that were already transferred. Open uploads older
+than S3_UPLOAD_RESUME_TTL are aborted instead of resumed; uploads to keys that are never
+written again are only removed by a lifecycle rule on the bucket.
+
+Parts grow as an upload goes on, doubling every PART_GROWTH_EVERY parts, so that streams
+of unknown length stay within the 10,000 parts S3 allows. The sizes depend only on the
+part number, so a resumed upload splits the stream the same way.
+"""
+
+import os
+import time
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
+import anyio
+
+from s3calls import s3_call, s3_pages
+
+
+logger = logging.getLogger(__name__)
+
+# S3 rejects parts smaller than 5 MiB, except for the last part of an upload
+MIN_PART_SIZE = 5 * 1024 * 1024
+# S3 allows at most 10,000 parts per upload, of at most 5 GiB each
+MAX_PARTS = 10000
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+# Number of parts after which the part size doubles
+PART_GROWTH_EVERY = 1000
+
+# Size of each part and number of parts transferred in parallel
+PART_SIZE = max(int(os.getenv("S3_PART_SIZE", 16 * 1024 * 1024)), MIN_PART_SIZE)
+PART_CONCURRENCY = max(int(os.getenv("S3_PART_CONCURRENCY", 4)), 1)
+
+# Seconds after which an open multipart upload is aborted instead of resumed
+S3_UPLOAD_RESUME_TTL = int(os.getenv("S3_UPLOAD_RESUME_TTL", 24 * 3600))
+
+# Error codes of S3 when the condition of a write does not hold
+PRECONDITION_ERRORS = ("PreconditionFailed", "ConditionalRequestConflict")
+
+
+class MultipartUploadError(Exception):
+    """
+    Raised when a multipart upload fails. Unless the stream was too large, the upload is
+    left open so it can be resumed.
+
+    Attributes:
+        key (str): The S3 key of the upload.
+        upload_id (str): The ID of the multipart upload.
+    """
+    def __init__(self, key: str, upload_id: str, message: str):
+        super().__init__(message)
+        self.key = key
+        self.upload_id = upload_id
+
+
+class MultipartUpload:
+    """
+    A resumable, parallel multipart upload of a stream to an S3 key.
+
+    Attributes:
+        client: The boto3 or aiobotocore S3 client.
+        bucket (str): The name of the bucket.
+        key (str): The S3 key to upload to.
+        content_type (str): The content type stored with the object.
+        part_size (int): The size of the first parts in bytes; later parts are larger.
+        concurrency (int): The maximum number of parts in flight at once.
+        upload_id (str): The ID of the multipart upload, once started.
+    """
+    def __init__(self, client, bucket: str, key: str, content_type: Optional[str] = None,
+                 part_size: int = PART_SIZE, concurrency: int = PART_CONCURRENCY):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type or "application/octet-stream"
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.upload_id = None
+        self._finished: Dict[int, str] = {}
+
+    async def upload(self, chunks: AsyncIterator[bytes], conditions: Optional[dict] = None) -> dict:
+        """
+        Upload a stream of chunks to the S3 key.
+
+        Streams that fit in a single part are uploaded with one PUT. Larger streams are
+        split into parts, and at most `concurrency` parts are held in memory at once.
+        Parts that a previous, interrupted upload to the same key already transferred
+        are verified against their ETag and skipped.
+
+        If the conditions do not hold when the upload is completed, it is aborted, as
+        its parts would only be resumed by a write against an outdated object.
+
+        Args:
+            chunks (AsyncIterator[bytes]): The content to upload.
+            conditions (dict, optional): `IfMatch` and/or `IfNoneMatch` arguments for the
+                request that makes the object visible.
+
+        Returns:
+            dict: The size, SHA-256 digest, number of parts, duration and throughput of the upload.
+
+        Raises:
+            MultipartUploadError: If a part cannot be transferred, or the stream needs more than MAX_PARTS parts.
+        """
+        started = time.monotonic()
+        digest = hashlib.sha256()
+        size = 0
+        part_number = 0
+        skipped = 0
+        uploaded: List[dict] = []
+        slots = anyio.Semaphore(self.concurrency)
+        conditions = conditions or {}
+
+        parts = self._iter_parts(chunks)
+        first = await anext(parts, None)
+        second = await anext(parts, None) if first is not None else None
+        if second is None:
+            # The whole stream fits in one part
+            body = first or b""
+            digest.update(body)
+            await s3_call(self.client, "put_object", Bucket=self.bucket, Key=self.key, Body=body,
+                          ContentType=self.content_type, **conditions)
+            return self._report(started, len(body), digest.hexdigest(), 1, 0)
+
+        await self._start()
+        try:
+            async with anyio.create_task_group() as tg:
+                async for body in _prepend([first, second], parts):
+                    part_number += 1
+                    if part_number > MAX_PARTS:
+                        raise ValueError(f"The stream needs more than {MAX_PARTS} parts")
+                    digest.update(body)
+                    size += len(body)
+                    if self._is_finished(part_number, body):
+                        uploaded.append({"PartNumber": part_number, "ETag": self._finished[part_number]})
+                        skipped += 1
+                        continue
+                    # Wait for a free slot before reading further, so memory stays bounded
+                    await slots.acquire()
+                    tg.start_soon(self._upload_part, part_number, body, uploaded, slots)
+        except Exception as e:
+            logger.error(f"Multipart upload {self.upload_id} of {self.key} failed after {len(uploaded)} parts: {e}")
+            upload_id = self.upload_id
+            if part_number > MAX_PARTS:
+                # Resuming could never complete it
+                await self.abort()
+            raise MultipartUploadError(self.key, upload_id, str(e)) from e
+
+        uploaded.sort(key=lambda part: part["PartNumber"])
+        try:
+            await s3_call(self.client, "complete_multipart_upload", Bucket=self.bucket, Key=self.key,
+                          UploadId=self.upload_id, MultipartUpload={"Parts": uploaded}, **conditions)
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in PRECONDITION_ERRORS:
+                await self.abort()
+            raise
+        return self._report(started, size, digest.hexdigest(), part_number, skipped)
+
+    async def copy(self, source_key: str, size: int) -> dict:
+        """
+        Copy an object of the bucket to the S3 key, copying ranges of it in parallel on the server.
+
+        Used for objects larger than a single CopyObject call accepts.
+
+        Args:
+            source_key (str): The key of the object to copy.
+            size (int): The size of the object.
+
+        Returns:
+            dict: The size and number of parts of the copy.
+        """
+        # Grow the parts if needed to stay within the part limit
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        response = await s3_call(self.client, "create_multipart_upload", Bucket=self.bucket, Key=self.key,
+                                 ContentType=self.content_type)
+        self.upload_id = response["UploadId"]
+        copied: List[dict] = []
+        slots = anyio.Semaphore(self.concurrency)
+
+        async def copy_part(part_number: int, start: int):
+            try:
+                response = await s3_call(
+                    self.client, "upload_part_copy", Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    PartNumber=part_number, CopySource={"Bucket": self.bucket, "Key": source_key},
+                    CopySourceRange=f"bytes={start}-{min(start + part_size, size) - 1}",
+                )
+                copied.append({"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]})
+            finally:
+                slots.release()
+
+        try:
+            async with anyio.create_task_group() as tg:
+                for part_number, start in enumerate(range(0, size, part_size), start=1):
+                    await slots.acquire()
+                    tg.start_soon(copy_part, part_number, start)
+        except Exception:
+            await self.abort()
+            raise
+
+        copied.sort(key=lambda part: part["PartNumber"])
+        await s3_call(self.client, "complete_multipart_upload", Bucket=self.bucket, Key=self.key,
+                      UploadId=self.upload_id, MultipartUpload={"Parts": copied})
+        logger.info(f"Copied {size} bytes from {source_key} to {self.key} in {len(copied)} parts.")
+        return {"size": size, "parts": len(copied)}
+
+    async def abort(self):
+        """
+        Abort the multipart upload and discard its transferred parts.
+        """
+        if self.upload_id:
+            await s3_call(self.client, "abort_multipart_upload", Bucket=self.bucket, Key=self.key,
+                          UploadId=self.upload_id)
+            logger.info(f"Aborted multipart upload {self.upload_id} of {self.key}.")
+            self.upload_id = None
+
+    async def _start(self):
+        """
+        Resume an open multipart upload to the key, or create a new one.
+
+        Uploads to the key started more than S3_UPLOAD_RESUME_TTL seconds ago are aborted.
+        """
+        response = await s3_call(self.client, "list_multipart_uploads", Bucket=self.bucket, Prefix=self.key)
+        now = datetime.now(timezone.utc)
+        for upload in response.get("Uploads", []):
+            if upload["Key"] != self.key:
+                continue
+            initiated = upload.get("Initiated")
+            if initiated is not None and (now - initiated).total_seconds() > S3_UPLOAD_RESUME_TTL:
+                await s3_call(self.client, "abort_multipart_upload", Bucket=self.bucket, Key=self.key,
+                              UploadId=upload["UploadId"])
+                logger.info(f"Aborted stale multipart upload {upload['UploadId']} of {self.key}, started {initiated}.")
+            elif self.upload_id is None:
+                self.upload_id = upload["UploadId"]
+
+        if self.upload_id:
+            pages = await s3_pages(self.client, "list_parts", Bucket=self.bucket, Key=self.key,
+                                   UploadId=self.upload_id)
+            for page in pages:
+                for part in page.get("Parts", []):
+                    self._finished[part["PartNumber"]] = part["ETag"]
+            logger.info(f"Resuming multipart upload {self.upload_id} of {self.key} with {len(self._finished)} finished parts.")
+        else:
+            response = await s3_call(self.client, "create_multipart_upload", Bucket=self.bucket, Key=self.key,
+                                     ContentType=self.content_type)
+            self.upload_id = response["UploadId"]
+            logger.info(f"Started multipart upload {self.upload_id} of {self.key}.")
+
+    def _is_finished(self, part_number: int, body: bytes) -> bool:
+        """
+        Check whether a part was already transferred with the same content.
+        """
+        etag = self._finished.get(part_number)
+        return etag is not None and etag.strip('"') == hashlib.md5(body).hexdigest()
+
+    async def _upload_part(self, part_number: int, body: bytes, uploaded: List[dict], slots: anyio.Semaphore):
+        """
+        Upload one part and record its ETag.
+        """
+        try:
+            response = await s3_call(self.client, "upload_part", Bucket=self.bucket, Key=self.key,
+                                     UploadId=self.upload_id, PartNumber=part_number, Body=body)
+            uploaded.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        finally:
+            slots.release()
+
+    def _part_size(self, part_number: int) -> int:
+        """
+        Get the size of a part, doubling every PART_GROWTH_EVERY parts up to MAX_PART_SIZE.
+        """
+        return min(self.part_size << ((part_number - 1) // PART_GROWTH_EVERY), MAX_PART_SIZE)
+
+    async def _iter_parts(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Regroup a stream of chunks into parts of the sizes given by `_part_size`.
+        """
+        buffer = bytearray()
+        part_number = 1
+        async for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= self._part_size(part_number):
+                part_size = self._part_size(part_number)
+                yield bytes(buffer[:part_size])
+                del buffer[:part_size]
+                part_number += 1
+        if buffer:
+            yield bytes(buffer)
+
+    def _report(self, started: float, size: int, checksum: str, parts: int, skipped: int) -> dict:
+        """
+        Log and return the transfer statistics of a completed upload.
+        """
+        seconds = time.monotonic() - started
+        throughput = size / seconds if seconds > 0 else 0.0
+        logger.info(
+            f"Uploaded {size} bytes to {self.key} in {parts} parts ({skipped} resumed) "
+            f"in {seconds:.2f}s ({throughput / (1024 * 1024):.2f} MiB/s)."
+        )
+        return {
+            "size": size,
+            "sha256": checksum,
+            "parts": parts,
+            "resumed_parts": skipped,
+            "seconds": seconds,
+            "throughput": throughput,
+        }
+
+
+async def _prepend(items: List[bytes], rest: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Yield the parts that were read ahead, followed by the remaining parts.
+    """
+    for item in items:
+        yield item
+    async for item in rest:
+        yield item
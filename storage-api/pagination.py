@@ -0,0 +1,98 @@
+"""
+Cursor pagination and streaming JSON encoders for the File Storage API.
+
+Listings are paginated with opaque cursors that hold the last key of the previous page,
+so that the next page is read from an index instead of skipping over earlier rows.
+Pages are written out one item at a time as a JSON document or as NDJSON, so the memory
+used by a response depends on the page size only.
+"""
+
+import os
+import json
+import base64
+import binascii
+from typing import Iterable, Iterator, Optional
+
+
+# Default and maximum number of items in a page
+PAGE_SIZE = int(os.getenv("METADATA_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("METADATA_MAX_PAGE_SIZE", 1000))
+
+# Media types of the supported output formats
+FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a pagination cursor cannot be decoded.
+    """
+
+
+def encode_cursor(key: str) -> str:
+    """
+    Encode the last key of a page as an opaque cursor.
+
+    Args:
+        key (str): The last key of the page.
+
+    Returns:
+        str: The URL-safe cursor.
+    """
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[str]:
+    """
+    Decode a cursor produced by `encode_cursor`.
+
+    Args:
+        cursor (str, optional): The cursor.
+
+    Returns:
+        str: The last key of the previous page, or None if no cursor was given.
+
+    Raises:
+        InvalidCursor: If the cursor is malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        return base64.b64decode(cursor + "=" * (-len(cursor) % 4), altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+def iter_json_page(items: Iterable[dict], next_cursor: Optional[str]) -> Iterator[bytes]:
+    """
+    Write a page as a JSON document, one item at a time.
+
+    The document has the form `{"items": [...], "next_cursor": ...}`.
+
+    Args:
+        items (Iterable[dict]): The items of the page.
+        next_cursor (str, optional): The cursor of the next page, or None on the last page.
+
+    Yields:
+        bytes: The next fragment of the document.
+    """
+    yield b'{"items":['
+    for index, item in enumerate(items):
+        yield (b"," if index else b"") + json.dumps(item, default=str).encode("utf-8")
+    yield b'],"next_cursor":' + json.dumps(next_cursor).encode("utf-8") + b"}"
+
+
+def iter_ndjson(items: Iterable[dict]) -> Iterator[bytes]:
+    """
+    Write items as newline-delimited JSON.
+
+    Args:
+        items (Iterable[dict]): The items.
+
+    Yields:
+        bytes: One JSON line per item.
+    """
+    for item in items:
+        yield json.dumps(item, default=str).encode("utf-8") + b"\n"
@@ -0,0 +1,258 @@
+"""
+Direct transfers between clients and S3 for the File Storage API.
+
+Instead of streaming media through the API, clients can ask for presigned URLs and
+transfer the content straight to and from the bucket, so that the API only handles
+small control requests. A direct upload is started with the metadata of the file and
+returns a presigned PUT URL, or presigned part URLs for a multipart upload of a large
+file. Once the client has uploaded the content, it completes the upload, and the API
+checks the object and records its metadata and RO-Crate entry as for an upload through
+the API.
+
+The API never sees the content of a direct upload to hash it. A client can give the
+SHA-256 digest of a file uploaded with a single PUT, which S3 checks the content against;
+such uploads are stored as content-addressed blobs like uploads through the API. Other
+direct uploads are stored under their file key, unhashed. Either way the content is
+uploaded to a temporary key if the file key holds a blob that other files refer to.
+Direct uploads that are not completed in time are aborted and their content deleted.
+"""
+
+import os
+import json
+import time
+import base64
+import logging
+from uuid import uuid4
+from typing import List, Optional
+from starlette.concurrency import run_in_threadpool
+
+from blobs import upload_key_for, register_upload, place_unhashed, discard_blob, release_replaced
+from database import get_store
+from extract import extract_stored
+from models import FileMetadata
+from multipart import PART_SIZE, MAX_PARTS
+from storage import StorageBackend, object_key
+from utils import create_ro_crate
+
+
+logger = logging.getLogger(__name__)
+
+# Number of seconds presigned URLs are valid for
+PRESIGN_EXPIRES = int(os.getenv("PRESIGN_EXPIRES", 3600))
+# Size in bytes above which direct uploads are split into presigned parts
+PRESIGN_MULTIPART_THRESHOLD = int(os.getenv("PRESIGN_MULTIPART_THRESHOLD", 64 * 1024 * 1024))
+# Number of seconds after its URLs expire that a direct upload can still be completed
+PRESIGN_COMPLETE_GRACE = int(os.getenv("PRESIGN_COMPLETE_GRACE", 3600))
+
+
+class DirectUploadError(Exception):
+    """
+    Raised when a direct upload cannot be completed, for example because the content is missing.
+    """
+
+
+def part_size_for(size: int) -> int:
+    """
+    Get the part size of a multipart direct upload, grown if needed to stay within the part limit.
+
+    Args:
+        size (int): The size of the file.
+
+    Returns:
+        int: The size of every part but the last.
+    """
+    return max(PART_SIZE, -(-size // MAX_PARTS))
+
+
+def _file_key(file_metadata: dict) -> str:
+    extension = os.path.splitext(file_metadata["file_name"])[1]
+    return object_key(file_metadata["media_type"], file_metadata["file_id"], extension)
+
+
+async def start_direct_upload(storage: StorageBackend, file_key: str, file_metadata: dict,
+                              size: Optional[int] = None, sha256: Optional[str] = None) -> dict:
+    """
+    Start a direct upload of a file and presign the URLs to upload it to.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        file_key (str): The key to store the file under.
+        file_metadata (dict): The metadata of the file, recorded when the upload is completed.
+        size (int, optional): The size of the file. Required for a multipart upload.
+        sha256 (str, optional): The hex SHA-256 digest of the file, which S3 checks a single
+            PUT against so that the file is stored as a blob. It is not used for multipart
+            uploads, whose parts S3 cannot check against the digest of the whole file.
+
+    Returns:
+        dict: The `upload_token` to complete the upload with, and either the `url` and
+            `headers` of a single PUT, or the `part_size` and `parts` of a multipart upload.
+
+    Raises:
+        NotImplementedError: If the backend does not support direct uploads.
+    """
+    content_type = file_metadata.get("file_encoding") or "application/octet-stream"
+    token = str(uuid4())
+    upload_id = None
+    # The pending upload keeps the key the content is uploaded to; the file key follows from the metadata
+    upload_key = await upload_key_for(file_key)
+    upload = {
+        "upload_token": token,
+        "file_id": file_metadata["file_id"],
+        "file_key": file_key,
+        "method": "PUT",
+        "expires_in": PRESIGN_EXPIRES,
+    }
+    if size is not None and size > PRESIGN_MULTIPART_THRESHOLD:
+        upload_id = await storage.start_upload(upload_key, content_type)
+        part_size = part_size_for(size)
+        upload["multipart"] = True
+        upload["part_size"] = part_size
+        upload["parts"] = [
+            {
+                "part_number": part_number,
+                "size": min(part_size, size - start),
+                "url": await storage.presign("upload_part", upload_key, PRESIGN_EXPIRES,
+                                             UploadId=upload_id, PartNumber=part_number),
+            }
+            for part_number, start in enumerate(range(0, size, part_size), start=1)
+        ]
+    else:
+        upload["multipart"] = False
+        upload["headers"] = {"Content-Type": content_type}
+        params = {"ContentType": content_type}
+        if sha256 is not None:
+            # S3 refuses content that does not match the digest, so the file can be stored as a blob
+            params["ChecksumSHA256"] = base64.b64encode(bytes.fromhex(sha256)).decode()
+            upload["headers"]["x-amz-checksum-sha256"] = params["ChecksumSHA256"]
+            file_metadata = {**file_metadata, "file_checksum": f"sha256:{sha256}"}
+        upload["url"] = await storage.presign("put_object", upload_key, PRESIGN_EXPIRES, **params)
+
+    try:
+        await run_in_threadpool(get_store().add_pending_upload, {
+            "token": token,
+            "file_key": upload_key,
+            "upload_id": upload_id,
+            "size": size,
+            "metadata": json.dumps(file_metadata),
+            "expires_at": time.time() + PRESIGN_EXPIRES + PRESIGN_COMPLETE_GRACE,
+        })
+    except Exception:
+        if upload_id is not None:
+            await storage.abort_upload(upload_key, upload_id)
+        raise
+    logger.info(f"Started direct upload {token} of {file_key} to {upload_key}, multipart: {upload['multipart']}.")
+    return upload
+
+
+async def complete_direct_upload(storage: StorageBackend, token: str, parts: Optional[List[dict]] = None) -> Optional[dict]:
+    """
+    Complete a direct upload, and record the metadata and RO-Crate entry of the file.
+
+    Completing an upload twice, even at the same time, records it once: the upload is claimed
+    before its content is checked, and is pending again if it cannot be completed.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        token (str): The token of the upload.
+        parts (List[dict], optional): The `PartNumber` and `ETag` of every part of a multipart upload.
+
+    Returns:
+        dict: The `file_metadata` of the file, its `file_path` and whether it was
+            `deduplicated`, or None if no upload with the token is pending.
+
+    Raises:
+        DirectUploadError: If the content has not been uploaded, or its size differs from the declared size.
+    """
+    store = get_store()
+    upload = await run_in_threadpool(store.get_pending_upload, token)
+    # The upload is claimed by removing it, so that of concurrent calls only one records it
+    if upload is None or not await run_in_threadpool(store.delete_pending_upload, token):
+        return None
+    try:
+        return await _complete(storage, upload, parts)
+    except Exception:
+        # The upload is pending again, to be completed once the cause is fixed
+        await run_in_threadpool(store.add_pending_upload, upload)
+        raise
+
+
+async def _complete(storage: StorageBackend, upload: dict, parts: Optional[List[dict]]) -> dict:
+    """
+    Check the content of a claimed direct upload, and record the file.
+    """
+    upload_key = upload["file_key"]
+    if upload["upload_id"]:
+        if not parts:
+            raise DirectUploadError("The PartNumber and ETag of every part are required to complete a multipart upload")
+        await storage.complete_upload(upload_key, upload["upload_id"], parts)
+
+    info = await storage.head(upload_key)
+    if info is None:
+        raise DirectUploadError("The file has not been uploaded")
+    if upload["size"] is not None and info.size != upload["size"]:
+        raise DirectUploadError(f"The uploaded file has {info.size} bytes, not the declared {upload['size']}")
+
+    file_metadata = json.loads(upload["metadata"])
+    file_key = _file_key(file_metadata)
+    file_metadata["file_size"] = info.size
+    await extract_stored(storage, upload_key, file_metadata, info.size)
+    algorithm, _, sha256 = (file_metadata.get("file_checksum") or "").partition(":")
+    if algorithm == "sha256" and sha256:
+        stored = await register_upload(storage, file_key, upload_key, sha256, info.size)
+    else:
+        await place_unhashed(storage, file_key, upload_key)
+        stored = {"key": file_key, "deduplicated": False}
+
+    # An earlier version of a file uploaded again with the same ID is replaced
+    previous = await run_in_threadpool(FileMetadata.get, file_metadata["file_id"])
+    saved = False
+    try:
+        await run_in_threadpool(FileMetadata.from_upload(file_metadata, file_key).save)
+        saved = True
+        await create_ro_crate(file_metadata["media_type"], file_metadata, storage)
+    except Exception:
+        # A file that is not recorded must not hold a reference to its content
+        if saved:
+            await run_in_threadpool(previous.save if previous is not None
+                                    else FileMetadata.from_upload(file_metadata, file_key).delete)
+        if "sha256" in stored:
+            await discard_blob(storage, stored)
+        elif upload_key != file_key:
+            await storage.move(file_key, upload_key)
+        raise
+    await release_replaced(storage, previous, FileMetadata.from_upload(file_metadata, file_key))
+    logger.info(f"Completed direct upload {upload['token']} of {file_key} with {info.size} bytes.")
+    return {
+        "file_metadata": file_metadata,
+        "file_path": storage.uri(stored["key"]),
+        "deduplicated": stored["deduplicated"],
+    }
+
+
+async def _is_recorded(upload: dict) -> bool:
+    file_id = json.loads(upload["metadata"])["file_id"]
+    file_metadata = await run_in_threadpool(FileMetadata.get, file_id)
+    return file_metadata is not None and file_metadata.file_key == upload["file_key"]
+
+
+async def expire_direct_uploads(storage: StorageBackend):
+    """
+    Abort the direct uploads that were not completed in time, and delete their content.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+    """
+    store = get_store()
+    for upload in await run_in_threadpool(store.expired_pending_uploads, time.time()):
+        # Only the caller that removes the row cleans up, so that workers do not race
+        if not await run_in_threadpool(store.delete_pending_upload, upload["token"]):
+            continue
+        try:
+            if upload["upload_id"]:
+                await storage.abort_upload(upload["file_key"], upload["upload_id"])
+            elif not await _is_recorded(upload):
+                # Keep the content if another upload of the same file was completed
+                await storage.delete(upload["file_key"])
+            logger.info(f"Expired direct upload {upload['token']} of {upload['file_key']}.")
+        except Exception as e:
+            logger.error(f"Error expiring direct upload {upload['token']}: {str(e)}")
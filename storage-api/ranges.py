@@ -0,0 +1,272 @@
+"""
+HTTP range and conditional request helpers for the File Storage API.
+
+This module parses `Range` headers, evaluates `If-None-Match`, `If-Modified-Since` and
+`If-Range` against a file's validators, and builds partial and `multipart/byteranges`
+responses for files in any storage backend.
+"""
+
+import secrets
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+from starlette.responses import Response, StreamingResponse
+
+# Maximum number of ranges served in one response; larger requests get the whole file
+MAX_RANGES = 100
+
+
+class RangeNotSatisfiable(Exception):
+    """
+    Raised when none of the requested ranges overlap the file.
+
+    Attributes:
+        size (int): The size of the file in bytes.
+    """
+    def __init__(self, size: int):
+        super().__init__(f"Requested range not satisfiable for size {size}")
+        self.size = size
+
+
+def parse_range_header(header: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a `Range` header into a list of byte ranges.
+
+    Overlapping and adjacent ranges are merged. A missing or malformed header, or one
+    with more than MAX_RANGES ranges, is ignored so that the whole file is served.
+
+    Args:
+        header (str): The value of the `Range` header.
+        size (int): The size of the file in bytes.
+
+    Returns:
+        list: A list of (start, end) tuples with inclusive offsets, or None to serve the whole file.
+
+    Raises:
+        RangeNotSatisfiable: If no requested range overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec or spec.count(",") >= MAX_RANGES:
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if end < start:
+                    return None
+            else:
+                # Suffix range: the last N bytes
+                length = int(last)
+                start = max(size - length, 0)
+                end = size - 1 if length else -1
+        except ValueError:
+            return None
+        if start < 0:
+            return None
+        if start < size and end >= start:
+            ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable(size)
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def format_http_date(value: datetime) -> str:
+    """
+    Format a timezone-aware datetime as an HTTP date.
+    """
+    # botocore returns dates in its own UTC zone, which format_datetime does not accept as GMT
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return parsedate_to_datetime(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _etag_in(header: str, etag: str) -> bool:
+    """
+    Check whether an ETag matches a list header, using weak comparison.
+    """
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in header.split(","))
+
+
+def is_not_modified(headers, etag: Optional[str], last_modified: Optional[datetime]) -> bool:
+    """
+    Evaluate `If-None-Match` and `If-Modified-Since` against a file's validators.
+
+    `If-Modified-Since` is only considered when `If-None-Match` is absent.
+
+    Args:
+        headers (Headers): The request headers.
+        etag (str): The ETag of the file.
+        last_modified (datetime): The modification time of the file.
+
+    Returns:
+        bool: True if the client's cached copy is current and a 304 response should be sent.
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag is not None and _etag_in(if_none_match, etag)
+    since = _parse_http_date(headers.get("if-modified-since"))
+    if since is None or last_modified is None:
+        return False
+    return last_modified.replace(microsecond=0) <= since
+
+
+def if_range_matches(headers, etag: Optional[str], last_modified: Optional[datetime]) -> bool:
+    """
+    Evaluate `If-Range`, which only allows a partial response for an unchanged file.
+
+    Args:
+        headers (Headers): The request headers.
+        etag (str): The ETag of the file.
+        last_modified (datetime): The modification time of the file.
+
+    Returns:
+        bool: True if the requested ranges may be served.
+    """
+    if_range = headers.get("if-range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Strong comparison is required for If-Range
+        return etag is not None and not etag.startswith("W/") and if_range == etag
+    date = _parse_http_date(if_range)
+    return date is not None and last_modified is not None and last_modified.replace(microsecond=0) == date
+
+
+def content_range(start: int, end: int, size: int) -> str:
+    """
+    Format a `Content-Range` header value for an inclusive byte range.
+    """
+    return f"bytes {start}-{end}/{size}"
+
+
+def multipart_byteranges(
+    ranges: List[Tuple[int, int]],
+    size: int,
+    content_type: str,
+    read_range: Callable[[int, int], AsyncIterator[bytes]],
+) -> Tuple[str, int, AsyncIterator[bytes]]:
+    """
+    Build a `multipart/byteranges` response body.
+
+    Args:
+        ranges (list): The (start, end) ranges to send, with inclusive offsets.
+        size (int): The size of the file in bytes.
+        content_type (str): The content type of the file.
+        read_range (callable): Returns the content of the inclusive range (start, end) as chunks.
+
+    Returns:
+        tuple: The response content type, the content length and an iterator over the body.
+    """
+    boundary = secrets.token_hex(13)
+    headers = [
+        (
+            f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Range: {content_range(start, end, size)}\r\n\r\n"
+        ).encode("latin-1")
+        for start, end in ranges
+    ]
+    trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+    separator = b"\r\n"
+    length = sum(len(header) + end - start + 1 for header, (start, end) in zip(headers, ranges))
+    length += len(separator) * (len(ranges) - 1) + len(trailer)
+
+    async def body() -> AsyncIterator[bytes]:
+        for index, ((start, end), header) in enumerate(zip(ranges, headers)):
+            if index:
+                yield separator
+            yield header
+            async for chunk in read_range(start, end):
+                yield chunk
+        yield trailer
+
+    return f"multipart/byteranges; boundary={boundary}", length, body()
+
+
+def range_response(
+    request,
+    size: int,
+    etag: Optional[str],
+    last_modified: Optional[datetime],
+    content_type: str,
+    read_range: Callable[[int, int], AsyncIterator[bytes]],
+    headers: Optional[dict] = None,
+    full_response: Optional[Callable[[dict], Response]] = None,
+) -> Response:
+    """
+    Build the response to a GET request for a file, honouring range and conditional headers.
+
+    Args:
+        request (Request): The request.
+        size (int): The size of the file in bytes.
+        etag (str): The ETag of the file.
+        last_modified (datetime): The modification time of the file.
+        content_type (str): The content type of the file.
+        read_range (callable): Returns the content of the inclusive range (start, end) as chunks.
+            It is only called while the response body is sent.
+        headers (dict, optional): Additional headers to send with the file.
+        full_response (callable, optional): Builds the response for the whole file from the headers.
+            By default the whole file is streamed through `read_range`, which is not called for empty files.
+
+    Returns:
+        Response: A 200, 206, 304 or 416 response.
+    """
+    validators = {}
+    if etag:
+        validators["ETag"] = etag
+    if last_modified:
+        validators["Last-Modified"] = format_http_date(last_modified)
+    headers = {**(headers or {}), **validators, "Accept-Ranges": "bytes"}
+
+    if is_not_modified(request.headers, etag, last_modified):
+        return Response(status_code=304, headers=validators)
+
+    ranges = None
+    if if_range_matches(request.headers, etag, last_modified):
+        try:
+            ranges = parse_range_header(request.headers.get("range"), size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        if full_response is not None:
+            return full_response(headers)
+        if size == 0:
+            return Response(b"", media_type=content_type, headers=headers)
+        return StreamingResponse(read_range(0, size - 1), media_type=content_type, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = content_range(start, end, size)
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(read_range(start, end), status_code=206, media_type=content_type, headers=headers)
+
+    multipart_type, length, body = multipart_byteranges(ranges, size, content_type, read_range)
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(body, status_code=206, media_type=multipart_type, headers=headers)
@@ -0,0 +1,428 @@
+"""
+Resumable uploads for the File Storage API.
+
+Uploads from the field run over connections that drop. A resumable upload is sent in a
+session: the client creates it with the metadata of the file, sends the content in
+PATCH requests that each start at the offset the API has received so far, asks for
+that offset after a connection drops, and finishes the session once everything is
+sent. The bytes received before a connection drops are kept, so the client resumes
+from there rather than from the start.
+
+With local storage, the content is staged in a file under UPLOAD_SESSION_DIR, and is
+stored through the same deduplicating path as a plain upload when the session is
+finished. With S3, it is sent on to a multipart upload whenever a full part has been
+received, and only the tail that does not fill a part is staged. As the API never has
+the content as a whole then, it is not hashed or deduplicated, and if the file key holds
+a blob that other files refer to, the multipart upload goes to a temporary key that is
+moved to the file key when the session is finished. Sessions that receive nothing for
+UPLOAD_SESSION_TTL seconds are removed with their staged content.
+
+A session is written by one request at a time; a concurrent request for the same
+session is refused rather than interleaved.
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+from uuid import uuid4
+from contextlib import contextmanager
+from typing import AsyncIterator, List, Optional, Tuple
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from blobs import store_blob, discard_blob, release_replaced, upload_key_for, place_unhashed
+from extract import MetadataExtractor, extract_stored
+from database import get_store
+from models import FileMetadata
+from multipart import PART_SIZE
+from storage import StorageBackend, object_key
+from streaming import iter_file_range
+from utils import create_ro_crate
+
+
+logger = logging.getLogger(__name__)
+
+# Directory where the received content of resumable uploads is staged
+UPLOAD_SESSION_DIR = os.getenv("UPLOAD_SESSION_DIR", os.path.join(tempfile.gettempdir(), "storage-api-uploads"))
+# Number of seconds after which a resumable upload that received nothing is removed
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+
+
+class UploadConflict(Exception):
+    """
+    Raised when a request does not start at the received offset, or another request is writing to the session.
+    """
+
+
+class UploadSessionError(Exception):
+    """
+    Raised when the content does not fit the session, for example beyond the declared size.
+    """
+
+
+def _tail_path(session_id: str, base: int) -> str:
+    # The staged tail of a session holds its content from the offset `base` on
+    return os.path.join(UPLOAD_SESSION_DIR, f"{session_id}.{base}")
+
+
+@contextmanager
+def _locked(session_id: str):
+    """
+    Hold the lock of a session, shared by the workers of the API.
+
+    Raises:
+        UploadConflict: If another request holds the lock.
+    """
+    os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+    fd = os.open(os.path.join(UPLOAD_SESSION_DIR, f"{session_id}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadConflict("Another request is writing to the upload")
+        yield
+    finally:
+        os.close(fd)
+
+
+def _open_tail(session_id: str, base: int) -> str:
+    """
+    Get the staged tail of a session, removing tails left by interrupted requests.
+
+    Raises:
+        UploadSessionError: If the staged content was lost.
+    """
+    path = _tail_path(session_id, base)
+    if not os.path.exists(path):
+        raise UploadSessionError("The content received by the upload was lost")
+    for name in os.listdir(UPLOAD_SESSION_DIR):
+        if name.startswith(f"{session_id}.") and not name.endswith(".lock") and name != os.path.basename(path):
+            os.remove(os.path.join(UPLOAD_SESSION_DIR, name))
+    return path
+
+
+def _remove_files(session_id: str):
+    for name in os.listdir(UPLOAD_SESSION_DIR):
+        if name.startswith(f"{session_id}."):
+            os.remove(os.path.join(UPLOAD_SESSION_DIR, name))
+
+
+def _read(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        return os.pread(f.fileno(), length, start)
+
+
+def _copy_rest(path: str, start: int, dest_path: str):
+    with open(path, "rb") as src, open(dest_path, "wb") as dest:
+        src.seek(start)
+        while chunk := src.read(PART_SIZE):
+            dest.write(chunk)
+        dest.flush()
+        os.fsync(dest.fileno())
+
+
+async def _send_parts(storage: StorageBackend, session: dict, parts: List[dict], path: str,
+                      final: bool = False) -> Tuple[List[dict], str]:
+    """
+    Upload the full parts of the staged tail of a session, or all of it if final.
+
+    Returns:
+        tuple: The parts uploaded so far, and the path of the remaining tail, which is a
+            new file if any part was uploaded. The previous tail is kept until the parts
+            are recorded.
+    """
+    parts = list(parts)
+    base = sum(part["Size"] for part in parts)
+    size = os.path.getsize(path)
+    start = 0
+    while size - start >= PART_SIZE or (final and (start < size or not parts)):
+        length = min(PART_SIZE, size - start)
+        body = await run_in_threadpool(_read, path, start, length)
+        etag = await storage.upload_part(session["file_key"], session["upload_id"], len(parts) + 1, body)
+        parts.append({"PartNumber": len(parts) + 1, "ETag": etag, "Size": length})
+        start += length
+    if start == 0:
+        return parts, path
+    rest_path = _tail_path(session["session_id"], base + start)
+    await run_in_threadpool(_copy_rest, path, start, rest_path)
+    return parts, rest_path
+
+
+async def _record(session: dict, received: int, parts: List[dict], path: str, new_path: str):
+    """
+    Record the bytes received and the parts uploaded by a session, then switch to its new tail.
+
+    Raises:
+        UploadConflict: If another request recorded bytes for the session first.
+    """
+    advanced = await run_in_threadpool(get_store().advance_upload_session, session["session_id"],
+                                       session["received"], received, json.dumps(parts), time.time())
+    if new_path != path:
+        os.remove(path if advanced else new_path)
+    if not advanced:
+        raise UploadConflict("Another request wrote to the upload")
+
+
+def _file_key(file_metadata: dict) -> str:
+    extension = os.path.splitext(file_metadata["file_name"])[1]
+    return object_key(file_metadata["media_type"], file_metadata["file_id"], extension)
+
+
+async def create_session(storage: StorageBackend, file_key: str, file_metadata: dict,
+                         size: Optional[int] = None) -> dict:
+    """
+    Create a resumable upload session.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        file_key (str): The key to store the file under.
+        file_metadata (dict): The metadata of the file, recorded when the session is finished.
+        size (int, optional): The size of the file, if known in advance.
+
+    Returns:
+        dict: The `session_id`, the `file_id` and `file_key` of the file, the `offset`
+            received so far, the declared `size`, and the idle `expires_in` seconds.
+    """
+    session_id = uuid4().hex
+    # The session keeps the key the content is uploaded to; the file key follows from the metadata
+    upload_key = await upload_key_for(file_key)
+    try:
+        upload_id = await storage.start_upload(upload_key, file_metadata.get("file_encoding"))
+    except NotImplementedError:
+        upload_id = None
+        upload_key = file_key
+    os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+    open(_tail_path(session_id, 0), "wb").close()
+    try:
+        await run_in_threadpool(get_store().add_upload_session, {
+            "session_id": session_id,
+            "file_key": upload_key,
+            "upload_id": upload_id,
+            "size": size,
+            "received": 0,
+            "parts": "[]",
+            "metadata": json.dumps(file_metadata),
+            "updated_at": time.time(),
+        })
+    except Exception:
+        _remove_files(session_id)
+        if upload_id is not None:
+            await storage.abort_upload(upload_key, upload_id)
+        raise
+    logger.info(f"Created upload session {session_id} for {file_key} to {upload_key}, "
+                f"multipart: {upload_id is not None}.")
+    return {
+        "session_id": session_id,
+        "file_id": file_metadata["file_id"],
+        "file_key": file_key,
+        "offset": 0,
+        "size": size,
+        "expires_in": UPLOAD_SESSION_TTL,
+    }
+
+
+async def get_session(session_id: str) -> Optional[dict]:
+    """
+    Get the progress of a resumable upload session.
+
+    Args:
+        session_id (str): The ID of the session.
+
+    Returns:
+        dict: The `session_id`, the `offset` received so far and the declared `size`,
+            or None if the session is unknown, finished or expired.
+    """
+    session = await run_in_threadpool(get_store().get_upload_session, session_id)
+    if session is None:
+        return None
+    return {"session_id": session_id, "offset": session["received"], "size": session["size"]}
+
+
+async def append_to_session(storage: StorageBackend, session_id: str, offset: int,
+                            chunks: AsyncIterator[bytes]) -> Optional[int]:
+    """
+    Append content to a resumable upload session.
+
+    The content received is kept even if the stream fails partway, so that the client
+    can resume after the last byte that arrived.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        session_id (str): The ID of the session.
+        offset (int): The offset the content starts at, which must be the offset received so far.
+        chunks (AsyncIterator[bytes]): The content.
+
+    Returns:
+        int: The offset received so far, or None if the session is unknown.
+
+    Raises:
+        UploadConflict: If the offset is not the offset received so far, or another
+            request is writing to the session.
+        UploadSessionError: If the content goes beyond the declared size.
+    """
+    store = get_store()
+    with _locked(session_id):
+        session = await run_in_threadpool(store.get_upload_session, session_id)
+        if session is None:
+            _remove_files(session_id)
+            return None
+        if offset != session["received"]:
+            raise UploadConflict(f"The upload has received {session['received']} bytes, not {offset}")
+        parts = json.loads(session["parts"])
+        base = sum(part["Size"] for part in parts)
+        path = await run_in_threadpool(_open_tail, session_id, base)
+        received = offset
+        try:
+            with open(path, "r+b") as tail:
+                # Drop any bytes written past the recorded offset by an interrupted request
+                tail.seek(received - base)
+                tail.truncate()
+                try:
+                    async for chunk in chunks:
+                        if session["size"] is not None and received + len(chunk) > session["size"]:
+                            raise UploadSessionError(f"The upload goes beyond its size of {session['size']} bytes")
+                        await run_in_threadpool(tail.write, chunk)
+                        received += len(chunk)
+                finally:
+                    await run_in_threadpool(tail.flush)
+                    await run_in_threadpool(os.fsync, tail.fileno())
+        finally:
+            new_path = path
+            if session["upload_id"]:
+                try:
+                    parts, new_path = await _send_parts(storage, session, parts, path)
+                except Exception as e:
+                    # The tail is kept, and the parts are sent with the next request
+                    logger.warning(f"Error sending parts of upload session {session_id}: {str(e)}")
+            await _record(session, received, parts, path, new_path)
+    logger.info(f"Upload session {session_id} received {received - offset} bytes, {received} in total.")
+    return received
+
+
+async def finish_session(storage: StorageBackend, session_id: str) -> Optional[dict]:
+    """
+    Finish a resumable upload session, and record the metadata and RO-Crate entry of the file.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        session_id (str): The ID of the session.
+
+    Returns:
+        dict: The `file_metadata` of the file, its `file_path` and whether it was
+            `deduplicated`, or None if the session is unknown.
+
+    Raises:
+        UploadConflict: If another request is writing to the session.
+        UploadSessionError: If the session has not received all of the declared size.
+    """
+    store = get_store()
+    with _locked(session_id):
+        session = await run_in_threadpool(store.get_upload_session, session_id)
+        if session is None:
+            _remove_files(session_id)
+            return None
+        received = session["received"]
+        if session["size"] is not None and received != session["size"]:
+            raise UploadSessionError(f"The upload has received {received} of {session['size']} bytes")
+        upload_key = session["file_key"]
+        file_metadata = json.loads(session["metadata"])
+        file_key = _file_key(file_metadata)
+        parts = json.loads(session["parts"])
+        path = await run_in_threadpool(_open_tail, session_id, sum(part["Size"] for part in parts))
+
+        if session["upload_id"]:
+            parts, new_path = await _send_parts(storage, session, parts, path, final=True)
+            await _record(session, received, parts, path, new_path)
+            await storage.complete_upload(upload_key, session["upload_id"], parts)
+            info = await storage.head(upload_key)
+            if info is None or info.size != received:
+                raise UploadSessionError(f"The stored file does not have the {received} bytes received")
+            file_metadata["file_size"] = received
+            # The first parts were sent to S3 as they arrived, so their headers are read back
+            await extract_stored(storage, upload_key, file_metadata, received)
+            await place_unhashed(storage, file_key, upload_key)
+            stored = {"key": file_key, "deduplicated": False}
+        else:
+            extractor = MetadataExtractor(file_metadata.get("file_name"))
+            chunks = extractor.tee(iterate_in_threadpool(iter_file_range(path, 0, received - 1)))
+            stored = await store_blob(storage, file_key, chunks, content_type=file_metadata.get("file_encoding"))
+            file_metadata["file_size"] = stored["size"]
+            file_metadata["file_checksum"] = f"sha256:{stored['sha256']}"
+            extractor.update_metadata(file_metadata)
+
+        # An earlier version of a file uploaded again with the same ID is replaced
+        previous = await run_in_threadpool(FileMetadata.get, file_metadata["file_id"])
+        saved = False
+        try:
+            await run_in_threadpool(FileMetadata.from_upload(file_metadata, file_key).save)
+            saved = True
+            await create_ro_crate(file_metadata["media_type"], file_metadata, storage)
+        except Exception:
+            # A file that is not recorded must not hold a reference to its content
+            if saved:
+                await run_in_threadpool(previous.save if previous is not None
+                                        else FileMetadata.from_upload(file_metadata, file_key).delete)
+            if "sha256" in stored:
+                await discard_blob(storage, stored)
+            elif upload_key != file_key:
+                await storage.move(file_key, upload_key)
+            raise
+        await release_replaced(storage, previous, FileMetadata.from_upload(file_metadata, file_key))
+        await run_in_threadpool(store.delete_upload_session, session_id)
+        await run_in_threadpool(_remove_files, session_id)
+    logger.info(f"Finished upload session {session_id} of {file_key} with {received} bytes.")
+    return {
+        "file_metadata": file_metadata,
+        "file_path": storage.uri(stored["key"]),
+        "deduplicated": stored["deduplicated"],
+    }
+
+
+async def cancel_session(storage: StorageBackend, session_id: str) -> bool:
+    """
+    Cancel a resumable upload session and discard its content.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+        session_id (str): The ID of the session.
+
+    Returns:
+        bool: Whether the session existed.
+
+    Raises:
+        UploadConflict: If another request is writing to the session.
+    """
+    store = get_store()
+    with _locked(session_id):
+        session = await run_in_threadpool(store.get_upload_session, session_id)
+        if session is None or not await run_in_threadpool(store.delete_upload_session, session_id):
+            _remove_files(session_id)
+            return False
+        if session["upload_id"]:
+            await storage.abort_upload(session["file_key"], session["upload_id"])
+        await run_in_threadpool(_remove_files, session_id)
+    logger.info(f"Cancelled upload session {session_id}.")
+    return True
+
+
+async def expire_sessions(storage: StorageBackend):
+    """
+    Remove the resumable upload sessions that received nothing for UPLOAD_SESSION_TTL seconds.
+
+    Args:
+        storage (StorageBackend): The storage backend.
+    """
+    store = get_store()
+    for session in await run_in_threadpool(store.stale_upload_sessions, time.time() - UPLOAD_SESSION_TTL):
+        # Only the caller that removes the row cleans up, so that workers do not race
+        if not await run_in_threadpool(store.delete_upload_session, session["session_id"]):
+            continue
+        try:
+            if session["upload_id"]:
+                await storage.abort_upload(session["file_key"], session["upload_id"])
+            await run_in_threadpool(_remove_files, session["session_id"])
+            logger.info(f"Expired upload session {session['session_id']} of {session['file_key']}.")
+        except Exception as e:
+            logger.error(f"Error expiring upload session {session['session_id']}: {str(e)}")
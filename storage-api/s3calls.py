@@ -0,0 +1,104 @@
+"""
+Calls to S3 clients for the File Storage API.
+
+The S3 storage backend works with a boto3 client or an aiobotocore client. boto3 calls
+block, so they are run on worker threads; aiobotocore calls are awaited on the event
+loop. The helpers in this module hide the difference from the callers.
+"""
+
+import inspect
+from typing import AsyncIterator, List
+from anyio.to_thread import run_sync
+from starlette.concurrency import iterate_in_threadpool
+
+
+def is_async_client(client) -> bool:
+    """
+    Check whether an S3 client is an aiobotocore client.
+
+    Args:
+        client: The S3 client.
+
+    Returns:
+        bool: True if the calls of the client are coroutines.
+    """
+    return inspect.iscoroutinefunction(getattr(client, "_make_api_call", None))
+
+
+async def s3_call(client, operation: str, **kwargs) -> dict:
+    """
+    Call an S3 operation.
+
+    Args:
+        client: The boto3 or aiobotocore S3 client.
+        operation (str): The name of the client method, such as `head_object`.
+        **kwargs: The arguments of the operation.
+
+    Returns:
+        dict: The response of the operation.
+    """
+    method = getattr(client, operation)
+    if is_async_client(client):
+        return await method(**kwargs)
+    return await run_sync(lambda: method(**kwargs))
+
+
+async def s3_pages(client, operation: str, **kwargs) -> List[dict]:
+    """
+    Get every page of a paginated S3 operation.
+
+    Args:
+        client: The boto3 or aiobotocore S3 client.
+        operation (str): The name of the operation, such as `list_parts`.
+        **kwargs: The arguments of the operation.
+
+    Returns:
+        List[dict]: The pages of the response.
+    """
+    paginator = client.get_paginator(operation)
+    if is_async_client(client):
+        return [page async for page in paginator.paginate(**kwargs)]
+    return await run_sync(lambda: list(paginator.paginate(**kwargs)))
+
+
+async def iter_body(client, body, chunk_size: int) -> AsyncIterator[bytes]:
+    """
+    Read the body of a GetObject response in chunks, and close it.
+
+    Args:
+        client: The boto3 or aiobotocore S3 client the response came from.
+        body: The `Body` of the response.
+        chunk_size (int): The size of the chunks.
+
+    Yields:
+        bytes: The chunks of the body.
+    """
+    if is_async_client(client):
+        async with body as stream:
+            async for chunk in stream.iter_chunks(chunk_size):
+                yield chunk
+        return
+    try:
+        async for chunk in iterate_in_threadpool(body.iter_chunks(chunk_size)):
+            yield chunk
+    finally:
+        body.close()
+
+
+async def presigned_url(client, operation: str, params: dict, expires_in: int) -> str:
+    """
+    Sign a URL for an S3 operation. Signing is local and needs no request to S3.
+
+    Args:
+        client: The boto3 or aiobotocore S3 client.
+        operation (str): The name of the client method, such as `get_object`.
+        params (dict): The parameters of the operation.
+        expires_in (int): The number of seconds the URL is valid for.
+
+    Returns:
+        str: The presigned URL.
+    """
+    url = client.generate_presigned_url(operation, Params=params, ExpiresIn=expires_in)
+    if is_async_client(client):
+        url = await url
+    return url
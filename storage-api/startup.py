@@ -0,0 +1,81 @@
+"""
+Startup timing and warm-up of the File Storage API workers.
+
+Heavy dependencies, such as the rocrate package and the boto3 client with its service
+models, are loaded on first use rather than when the application is imported, so that
+a worker is ready to serve soon after it starts. Once it is, they are loaded in the
+background so that the first requests do not wait for them.
+
+The time spent importing the application, running its startup hook and warming up is
+recorded per worker, logged, and exposed as metrics and at /stats/startup.
+"""
+
+import os
+import time
+import logging
+
+from metrics import STARTUP_SECONDS, STARTUP_CPU_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+# When to load heavy dependencies: `background` after startup, `eager` before the
+# worker is ready, or `off` to load them on first use only
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "background")
+
+# Startup phases of this worker and their durations in seconds
+timings: dict = {}
+
+
+def record(phase: str, seconds: float):
+    """
+    Record the duration of a startup phase.
+
+    Args:
+        phase (str): The phase, such as `import`, `lifespan` or `warmup`.
+        seconds (float): The duration of the phase.
+    """
+    timings[phase] = seconds
+    STARTUP_SECONDS.labels(phase).set(seconds)
+
+
+def record_ready():
+    """
+    Record that the worker is ready, with the CPU time it has used since the process started.
+
+    The CPU time covers the interpreter, the server and the application imports, which
+    is most of the cold-start cost of a worker.
+    """
+    cpu_seconds = time.process_time()
+    timings["ready_cpu"] = cpu_seconds
+    STARTUP_CPU_SECONDS.set(cpu_seconds)
+    phases = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in timings.items() if phase != "ready_cpu")
+    logger.info(f"Worker {os.getpid()} ready after {cpu_seconds:.3f}s of CPU time ({phases}).")
+
+
+def warm_up():
+    """
+    Load the rocrate package and create the storage backend. Blocking; run on a worker thread.
+    """
+    from utils import _rocrate
+    from storage import get_storage
+
+    started = time.perf_counter()
+    try:
+        _rocrate()
+        get_storage()
+    except Exception as e:
+        logger.error(f"Warm-up of worker {os.getpid()} failed: {str(e)}")
+        return
+    record("warmup", time.perf_counter() - started)
+    logger.info(f"Worker {os.getpid()} warmed up in {timings['warmup']:.3f}s.")
+
+
+def stats() -> dict:
+    """
+    Get the startup timings of this worker.
+
+    Returns:
+        dict: The process ID, the warm-up mode and the duration of each startup phase.
+    """
+    return {"pid": os.getpid(), "warmup_mode": STARTUP_WARMUP, **timings}
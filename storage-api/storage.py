@@ -0,0 +1,619 @@
+"""
+Storage backends for the File Storage API.
+
+This module defines the interface the API uses to store and retrieve objects, with a
+driver for the local filesystem and one for S3. Both drivers stream content in chunks
+and keep blocking I/O off the event loop, so every endpoint behaves the same whichever
+backend the service is deployed with.
+"""
+
+import os
+import logging
+import threading
+import mimetypes
+from abc import ABC, abstractmethod
+from contextlib import AsyncExitStack
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional
+from anyio.to_thread import run_sync
+from starlette.concurrency import iterate_in_threadpool
+from botocore.exceptions import ClientError
+
+from models import ObjectInfo
+from streaming import CHUNK_SIZE, iter_file_range, write_stream_atomic
+from multipart import MultipartUpload
+from s3calls import s3_call, iter_body, presigned_url
+
+
+logger = logging.getLogger(__name__)
+
+# Environment variables
+STORAGE_TYPE = os.getenv("STORAGE_TYPE", "S3")
+STORAGE_PATH = os.getenv("STORAGE_PATH", "/files")
+# Serve S3 requests with an aiobotocore client on the event loop instead of boto3 on worker threads
+S3_ASYNC = os.getenv("S3_ASYNC", "false").lower() == "true"
+
+# Largest object S3 copies with a single CopyObject call
+MAX_COPY_SIZE = 5 * 1024 ** 3
+
+
+class PreconditionFailed(Exception):
+    """
+    Raised when a conditional write finds the object changed since it was read.
+    """
+
+
+def object_key(media_type: str, file_id: str, extension: str = "") -> str:
+    """
+    Build the storage key of an uploaded file.
+
+    Args:
+        media_type (str): The media type group of the file.
+        file_id (str): The ID of the file.
+        extension (str, optional): The file extension, including the leading dot.
+
+    Returns:
+        str: The key `{media_type}/{file_id}{extension}`.
+    """
+    return f"{media_type}/{file_id}{extension}"
+
+
+async def _single_chunk(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+class StorageBackend(ABC):
+    """
+    Interface for object storage.
+
+    Keys are slash-separated paths relative to the root of the storage, such as
+    `{media_type}/{file_id}{ext}`. Missing keys raise FileNotFoundError, except in
+    `head`, which returns None.
+    """
+
+    @abstractmethod
+    async def put(self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str] = None,
+                  if_match: Optional[str] = None, if_none_match: bool = False) -> dict:
+        """
+        Store a stream of chunks under a key, replacing any existing object.
+
+        Args:
+            key (str): The key to store the object under.
+            chunks (AsyncIterator[bytes]): The content of the object.
+            content_type (str, optional): The content type of the object.
+            if_match (str, optional): Only replace the object if its ETag still has this value.
+            if_none_match (bool, optional): Only store the object if the key does not exist yet.
+
+        Returns:
+            dict: The size and hex SHA-256 digest of the stored content, as `size` and `sha256`.
+
+        Raises:
+            PreconditionFailed: If a condition does not hold. Nothing is stored.
+        """
+
+    @abstractmethod
+    def get(self, key: str, start: Optional[int] = None, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """
+        Stream the content of an object, or an inclusive byte range of it.
+
+        Args:
+            key (str): The key of the object.
+            start (int, optional): The offset of the first byte to read.
+            end (int, optional): The offset of the last byte to read.
+
+        Yields:
+            bytes: The next chunk of the content.
+        """
+
+    @abstractmethod
+    async def head(self, key: str) -> Optional[ObjectInfo]:
+        """
+        Get the size, validators and content type of an object.
+
+        Args:
+            key (str): The key of the object.
+
+        Returns:
+            ObjectInfo: The object information, or None if the object does not exist.
+        """
+
+    @abstractmethod
+    def list(self, prefix: str = "", start_after: Optional[str] = None) -> AsyncIterator[ObjectInfo]:
+        """
+        List the objects whose keys start with a prefix in key order, one page at a time.
+
+        Args:
+            prefix (str, optional): The prefix to list.
+            start_after (str, optional): Only list keys that sort after this key.
+
+        Yields:
+            ObjectInfo: The next object.
+        """
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """
+        Delete an object. Deleting a missing object is not an error.
+
+        Args:
+            key (str): The key of the object.
+        """
+
+    @abstractmethod
+    async def move(self, src_key: str, dest_key: str):
+        """
+        Move an object to a new key, replacing any object there.
+
+        Args:
+            src_key (str): The key of the object.
+            dest_key (str): The new key of the object.
+        """
+
+    # Whether `link` can make a second key refer to an object's content
+    supports_links = False
+
+    async def link(self, src_key: str, dest_key: str) -> bool:
+        """
+        Make a second key refer to the content of an object without copying it, if the backend can.
+
+        Args:
+            src_key (str): The key of the object.
+            dest_key (str): The key of the reference.
+
+        Returns:
+            bool: Whether the reference was made.
+        """
+        return False
+
+    async def presign(self, operation: str, key: str, expires_in: int, **params) -> str:
+        """
+        Create a URL that lets a client call an operation on an object directly, without the API.
+
+        Args:
+            operation (str): `get_object`, `put_object` or `upload_part`.
+            key (str): The key of the object.
+            expires_in (int): The number of seconds the URL is valid for.
+            **params: Further parameters of the operation, such as `ContentType`, or `UploadId` and `PartNumber`.
+
+        Returns:
+            str: The presigned URL.
+
+        Raises:
+            NotImplementedError: If the backend does not support presigned URLs.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support presigned URLs")
+
+    async def start_upload(self, key: str, content_type: Optional[str] = None) -> str:
+        """
+        Start a multipart upload whose parts the client uploads directly.
+
+        Args:
+            key (str): The key to upload to.
+            content_type (str, optional): The content type of the object.
+
+        Returns:
+            str: The ID of the multipart upload.
+
+        Raises:
+            NotImplementedError: If the backend does not support direct uploads.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support direct uploads")
+
+    async def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        """
+        Upload one part of a multipart upload.
+
+        Args:
+            key (str): The key of the upload.
+            upload_id (str): The ID of the multipart upload.
+            part_number (int): The number of the part, from 1.
+            body (bytes): The content of the part.
+
+        Returns:
+            str: The ETag of the part.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support direct uploads")
+
+    async def complete_upload(self, key: str, upload_id: str, parts: List[dict]):
+        """
+        Complete a multipart upload from the parts the client uploaded.
+
+        Args:
+            key (str): The key of the upload.
+            upload_id (str): The ID of the multipart upload.
+            parts (List[dict]): The `PartNumber` and `ETag` of every part.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support direct uploads")
+
+    async def abort_upload(self, key: str, upload_id: str):
+        """
+        Abort a multipart upload and discard its parts.
+
+        Args:
+            key (str): The key of the upload.
+            upload_id (str): The ID of the multipart upload.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support direct uploads")
+
+    @abstractmethod
+    def uri(self, key: str) -> str:
+        """
+        Get the location of an object as reported to clients.
+        """
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        """
+        Get the URL of an object, used as an identifier in RO-Crate metadata.
+        """
+
+    def local_path(self, key: str) -> Optional[str]:
+        """
+        Get the filesystem path of an object, if the backend stores objects as local files.
+        """
+        return None
+
+    async def read(self, key: str) -> Optional[bytes]:
+        """
+        Read a small object into memory.
+
+        Args:
+            key (str): The key of the object.
+
+        Returns:
+            bytes: The content of the object, or None if the object does not exist.
+        """
+        try:
+            return b"".join([chunk async for chunk in self.get(key)])
+        except FileNotFoundError:
+            return None
+
+    async def write(self, key: str, data: bytes, content_type: Optional[str] = None,
+                    if_match: Optional[str] = None, if_none_match: bool = False) -> dict:
+        """
+        Store a small in-memory object.
+
+        Args:
+            key (str): The key to store the object under.
+            data (bytes): The content of the object.
+            content_type (str, optional): The content type of the object.
+            if_match (str, optional): Only replace the object if its ETag still has this value.
+            if_none_match (bool, optional): Only store the object if the key does not exist yet.
+
+        Returns:
+            dict: The size and hex SHA-256 digest of the stored content.
+        """
+        return await self.put(key, _single_chunk(data), content_type=content_type,
+                              if_match=if_match, if_none_match=if_none_match)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Storage backend that keeps objects as files below a root directory.
+
+    Attributes:
+        root (str): The root directory of the storage.
+    """
+    supports_links = True
+
+    def __init__(self, root: str = STORAGE_PATH):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([self.root, path]) != self.root or path == self.root:
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def _info(self, key: str, stat_result: os.stat_result) -> ObjectInfo:
+        return ObjectInfo(
+            key=key,
+            size=stat_result.st_size,
+            etag=f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"',
+            last_modified=datetime.fromtimestamp(stat_result.st_mtime, timezone.utc),
+            content_type=mimetypes.guess_type(key)[0] or "application/octet-stream",
+        )
+
+    async def put(self, key, chunks, content_type=None, if_match=None, if_none_match=False):
+        path = self._path(key)
+
+        def check_precondition():
+            try:
+                current = self._info(key, os.stat(path)).etag
+            except FileNotFoundError:
+                current = None
+            if (if_none_match and current is not None) or (if_match is not None and current != if_match):
+                raise PreconditionFailed(key)
+        precondition = check_precondition if if_match is not None or if_none_match else None
+        size, checksum = await write_stream_atomic(chunks, path, precondition)
+        return {"size": size, "sha256": checksum}
+
+    async def get(self, key, start=None, end=None):
+        path = self._path(key)
+        if start is None:
+            start = 0
+        if end is None:
+            stat_result = await run_sync(os.stat, path)
+            end = stat_result.st_size - 1
+        async for chunk in iterate_in_threadpool(iter_file_range(path, start, end)):
+            yield chunk
+
+    async def head(self, key):
+        try:
+            stat_result = await run_sync(os.stat, self._path(key))
+        except FileNotFoundError:
+            return None
+        return self._info(key, stat_result)
+
+    def _walk(self, directory: str):
+        """
+        Yield the paths of the files below a directory in key order.
+        """
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        # Keys of files in a subdirectory sort as if the directory name ended in a slash
+        entries.sort(key=lambda entry: entry.name + "/" if entry.is_dir() else entry.name)
+        for entry in entries:
+            if entry.is_dir():
+                yield from self._walk(entry.path)
+            elif not entry.name.startswith(".upload-"):
+                yield entry.path
+
+    async def list(self, prefix="", start_after=None):
+        base = os.path.join(self.root, os.path.dirname(prefix))
+        async for path in iterate_in_threadpool(self._walk(base)):
+            key = os.path.relpath(path, self.root).replace(os.sep, "/")
+            if not key.startswith(prefix) or (start_after is not None and key <= start_after):
+                continue
+            try:
+                stat_result = await run_sync(os.stat, path)
+            except FileNotFoundError:
+                continue
+            yield self._info(key, stat_result)
+
+    async def delete(self, key):
+        try:
+            await run_sync(os.remove, self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def move(self, src_key, dest_key):
+        src_path = self._path(src_key)
+        dest_path = self._path(dest_key)
+
+        def move():
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            os.replace(src_path, dest_path)
+        await run_sync(move)
+
+    async def link(self, src_key, dest_key):
+        src_path = self._path(src_key)
+        dest_path = self._path(dest_key)
+
+        def link():
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            # Renaming a link over another link to the same file does nothing, leaving the temporary link behind
+            try:
+                if os.path.samefile(src_path, dest_path):
+                    return True
+            except FileNotFoundError:
+                pass
+            # Link under a temporary name first, so that an existing file is replaced atomically
+            temp_path = os.path.join(os.path.dirname(dest_path), f".upload-link-{os.path.basename(dest_path)}")
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(src_path, temp_path)
+            except OSError as e:
+                logger.warning(f"Cannot hard link {src_key} to {dest_key}: {str(e)}")
+                return False
+            os.replace(temp_path, dest_path)
+            return True
+        return await run_sync(link)
+
+    def uri(self, key):
+        return key
+
+    def url(self, key):
+        return f"file://{self._path(key)}"
+
+    def local_path(self, key):
+        return self._path(key)
+
+
+class S3Storage(StorageBackend):
+    """
+    Storage backend that keeps objects in an S3 bucket.
+
+    The client is shared by all requests and keeps a pool of connections to the endpoint.
+    The calls of a boto3 client run on worker threads; the calls of an aiobotocore client
+    are awaited on the event loop.
+
+    Attributes:
+        client: The boto3 or aiobotocore S3 client.
+        bucket (str): The name of the bucket.
+        endpoint_url (str): The endpoint URL of the S3 service.
+    """
+    def __init__(self, client, bucket: str, endpoint_url: Optional[str] = None):
+        self.client = client
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+
+    async def put(self, key, chunks, content_type=None, if_match=None, if_none_match=False):
+        conditions = {}
+        if if_match is not None:
+            conditions["IfMatch"] = if_match
+        if if_none_match:
+            conditions["IfNoneMatch"] = "*"
+        upload = MultipartUpload(self.client, self.bucket, key, content_type=content_type)
+        try:
+            transfer = await upload.upload(chunks, conditions)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise PreconditionFailed(key) from e
+            raise
+        return {"size": transfer["size"], "sha256": transfer["sha256"]}
+
+    async def get(self, key, start=None, end=None):
+        kwargs = {"Bucket": self.bucket, "Key": key}
+        if start is not None or end is not None:
+            kwargs["Range"] = f"bytes={start or 0}-{'' if end is None else end}"
+        try:
+            file_obj = await s3_call(self.client, "get_object", **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(key) from e
+            raise
+        async for chunk in iter_body(self.client, file_obj['Body'], CHUNK_SIZE):
+            yield chunk
+
+    async def head(self, key):
+        try:
+            file_head = await s3_call(self.client, "head_object", Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return ObjectInfo(
+            key=key,
+            size=file_head['ContentLength'],
+            etag=file_head.get('ETag'),
+            last_modified=file_head.get('LastModified'),
+            content_type=file_head.get('ContentType'),
+        )
+
+    async def list(self, prefix="", start_after=None):
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        if start_after is not None:
+            kwargs["StartAfter"] = start_after
+        while True:
+            page = await s3_call(self.client, "list_objects_v2", **kwargs)
+            for item in page.get('Contents', []):
+                yield ObjectInfo(
+                    key=item['Key'],
+                    size=item['Size'],
+                    etag=item.get('ETag'),
+                    last_modified=item.get('LastModified'),
+                )
+            if not page.get('IsTruncated'):
+                break
+            kwargs["ContinuationToken"] = page['NextContinuationToken']
+
+    async def delete(self, key):
+        await s3_call(self.client, "delete_object", Bucket=self.bucket, Key=key)
+
+    async def move(self, src_key, dest_key):
+        info = await self.head(src_key)
+        if info is None:
+            raise FileNotFoundError(src_key)
+        if info.size <= MAX_COPY_SIZE:
+            await s3_call(self.client, "copy_object", Bucket=self.bucket, Key=dest_key,
+                          CopySource={"Bucket": self.bucket, "Key": src_key})
+        else:
+            await MultipartUpload(self.client, self.bucket, dest_key, content_type=info.content_type).copy(src_key, info.size)
+        await self.delete(src_key)
+
+    async def presign(self, operation, key, expires_in, **params):
+        return await presigned_url(self.client, operation, {"Bucket": self.bucket, "Key": key, **params}, expires_in)
+
+    async def start_upload(self, key, content_type=None):
+        response = await s3_call(self.client, "create_multipart_upload", Bucket=self.bucket, Key=key,
+                                 ContentType=content_type or "application/octet-stream")
+        return response["UploadId"]
+
+    async def upload_part(self, key, upload_id, part_number, body):
+        response = await s3_call(self.client, "upload_part", Bucket=self.bucket, Key=key,
+                                 UploadId=upload_id, PartNumber=part_number, Body=body)
+        return response["ETag"]
+
+    async def complete_upload(self, key, upload_id, parts):
+        parts = sorted(({"PartNumber": int(part["PartNumber"]), "ETag": part["ETag"]} for part in parts),
+                       key=lambda part: part["PartNumber"])
+        await s3_call(self.client, "complete_multipart_upload", Bucket=self.bucket, Key=key,
+                      UploadId=upload_id, MultipartUpload={"Parts": parts})
+
+    async def abort_upload(self, key, upload_id):
+        try:
+            await s3_call(self.client, "abort_multipart_upload", Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+    def url(self, key):
+        return f"{self.endpoint_url}/{self.bucket}/{key}"
+
+
+_backend: Optional[StorageBackend] = None
+_backend_lock = threading.Lock()
+_async_client: Optional[AsyncExitStack] = None
+
+
+def get_storage() -> StorageBackend:
+    """
+    Get the storage backend configured by STORAGE_TYPE.
+
+    The backend is created on first use and shared by all requests. With S3_ASYNC, the
+    backend is created by `open_storage` on startup instead. Safe to call from several
+    threads; the backend is only created once.
+
+    Returns:
+        StorageBackend: The storage backend.
+
+    Raises:
+        ValueError: If STORAGE_TYPE is not `local` or `S3`.
+        RuntimeError: If S3_ASYNC is set and the backend has not been opened.
+    """
+    global _backend
+    if _backend is not None:
+        return _backend
+    with _backend_lock:
+        if _backend is None:
+            if STORAGE_TYPE == "local":
+                _backend = LocalStorage(STORAGE_PATH)
+            elif STORAGE_TYPE == "S3" and S3_ASYNC:
+                raise RuntimeError("The async S3 client is opened on startup with open_storage")
+            elif STORAGE_TYPE == "S3":
+                from config.aws_config import s3, BUCKET_NAME, ENDPOINT_URL
+                from metrics import instrument_s3_client
+                if s3 is not None:
+                    instrument_s3_client(s3)
+                _backend = S3Storage(s3, BUCKET_NAME, ENDPOINT_URL)
+            else:
+                raise ValueError(f"Invalid STORAGE_TYPE: {STORAGE_TYPE}")
+            logger.info(f"Using {type(_backend).__name__} storage backend.")
+    return _backend
+
+
+async def open_storage():
+    """
+    Open the aiobotocore client of the storage backend on startup, if S3_ASYNC is set.
+
+    Other backends are created by `get_storage` on first use.
+    """
+    global _backend, _async_client
+    if _backend is None and STORAGE_TYPE == "S3" and S3_ASYNC:
+        from config.aws_config import create_async_s3_client, BUCKET_NAME, ENDPOINT_URL
+        from metrics import instrument_s3_client
+        _async_client = AsyncExitStack()
+        client = await _async_client.enter_async_context(create_async_s3_client())
+        instrument_s3_client(client)
+        _backend = S3Storage(client, BUCKET_NAME, ENDPOINT_URL)
+        logger.info("Using S3Storage storage backend with an async client.")
+
+
+async def close_storage():
+    """
+    Close the aiobotocore client of the storage backend on shutdown, if one was opened.
+    """
+    global _backend, _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+        _backend = None
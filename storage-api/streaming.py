@@ -0,0 +1,124 @@
+"""
+Streaming helpers for the File Storage API.
+
+This module provides helpers for moving uploaded files to storage in fixed-size
+chunks, so that memory use per upload stays constant regardless of file size.
+"""
+
+import os
+import fcntl
+import hashlib
+import logging
+import tempfile
+from typing import AsyncIterator, Callable, Iterator, Optional, Tuple
+from starlette.concurrency import run_in_threadpool
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the buffer used when reading uploads and writing them to storage
+CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+
+async def iter_upload(file, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Read an uploaded file in chunks.
+
+    Args:
+        file (UploadFile): The uploaded file.
+        chunk_size (int, optional): The maximum size of each chunk in bytes.
+
+    Yields:
+        bytes: The next chunk of the file.
+    """
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def write_stream_atomic(chunks: AsyncIterator[bytes], dest_path: str,
+                              precondition: Optional[Callable[[], None]] = None) -> Tuple[int, str]:
+    """
+    Write a stream of chunks to a local file, hashing the content as it is written.
+
+    The content is written to a temporary file in the destination directory, which is
+    renamed into place once the stream is complete. A partially written file is never
+    visible at the destination path, and the temporary file is removed on failure.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The content to write.
+        dest_path (str): The final path of the file.
+        precondition (callable, optional): Called right before the file is renamed into place,
+            while holding an exclusive lock on the destination directory. Raising from it
+            discards the write.
+
+    Returns:
+        tuple: The size of the file in bytes and the hex SHA-256 digest of its content.
+    """
+    dest_dir = os.path.dirname(dest_path)
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=".upload-", suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                await run_in_threadpool(f.write, chunk)
+            await run_in_threadpool(f.flush)
+            await run_in_threadpool(os.fsync, f.fileno())
+        if precondition is None:
+            os.replace(tmp_path, dest_path)
+        else:
+            await run_in_threadpool(_replace_if, precondition, tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.info(f"Wrote {size} bytes to {dest_path}.")
+    return size, digest.hexdigest()
+
+
+def _replace_if(precondition: Callable[[], None], tmp_path: str, dest_path: str):
+    """
+    Rename a file into place if a precondition holds, under a lock on the destination directory.
+    """
+    dir_fd = os.open(os.path.dirname(dest_path), os.O_RDONLY)
+    try:
+        fcntl.flock(dir_fd, fcntl.LOCK_EX)
+        precondition()
+        os.replace(tmp_path, dest_path)
+    finally:
+        os.close(dir_fd)
+
+
+def iter_file_range(path: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Read an inclusive byte range of a local file in chunks.
+
+    The range is read with positional reads, so no seek or read-ahead buffer is involved
+    and only the requested bytes are read from disk.
+
+    Args:
+        path (str): The path of the file.
+        start (int): The offset of the first byte.
+        end (int): The offset of the last byte.
+        chunk_size (int, optional): The maximum size of each chunk in bytes.
+
+    Yields:
+        bytes: The next chunk of the range.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = start
+        while offset <= end:
+            chunk = os.pread(fd, min(chunk_size, end - offset + 1), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
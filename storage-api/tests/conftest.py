@@ -10,6 +10,9 @@ import os
 from fastapi.testclient import TestClient
 from datetime import datetime, timezone
 from main import app
+from storage import LocalStorage, get_storage
+from database import MetadataStore, set_store
+from utils import crate_cache, _log_positions
 from config.aws_config import s3, BUCKET_NAME
 
 # Define global variables
@@ -46,6 +49,41 @@ def test_client():
     yield client
 
 
+@pytest.fixture(autouse=True)
+def metadata_store():
+    """
+    Fixture to keep file metadata in an in-memory SQLite database for each test.
+    """
+    store = MetadataStore("sqlite:///:memory:")
+    set_store(store)
+    yield store
+    set_store(None)
+    store.close()
+
+
+@pytest.fixture(autouse=True)
+def empty_crate_cache():
+    """
+    Fixture to start each test with an empty RO-Crate cache and no known log positions.
+    """
+    crate_cache.clear()
+    _log_positions.clear()
+    yield crate_cache
+    crate_cache.clear()
+    _log_positions.clear()
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    """
+    Fixture to run the application against local storage in a temporary directory.
+    """
+    storage = LocalStorage(str(tmp_path))
+    app.dependency_overrides[get_storage] = lambda: storage
+    yield storage
+    app.dependency_overrides.pop(get_storage, None)
+
+
 @pytest.fixture(scope="module")
 def s3_client():
     """
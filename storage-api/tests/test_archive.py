@@ -0,0 +1,113 @@
+"""
+Tests for the bulk RO-Crate export and rebuild.
+"""
+
+import io
+import json
+import asyncio
+import zipfile
+
+import archive
+from models import FileMetadata
+
+
+def _upload(test_client, group_id, count, creator="author-a"):
+    files = [("files", (f"photo-{i}.jpg", f"{group_id} photo {i}".encode(), "image/jpeg")) for i in range(count)]
+    response = test_client.post("/batch", files=files, data={"media_type": group_id, "creator": creator})
+    assert response.status_code == 200
+    return [result["file_id"] for result in response.json()["files"]]
+
+
+def test_download_archive(test_client, local_storage):
+    """
+    Test that a group's package holds its RO-Crate and every file, named by its entity ID.
+    """
+    file_ids = _upload(test_client, "images", 3)
+
+    response = test_client.get("/archive/images")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as package:
+        assert package.testzip() is None
+        names = package.namelist()
+        assert names[0] == archive.METADATA_FILE
+        assert sorted(names[1:]) == sorted(f"{file_id}.jpg" for file_id in file_ids)
+        crate = json.loads(package.read(archive.METADATA_FILE))
+        files = {entity["@id"] for entity in crate["@graph"] if entity["@type"] == "File"}
+        assert files == set(names[1:])
+        for index, file_id in enumerate(file_ids):
+            assert package.read(f"{file_id}.jpg") == f"images photo {index}".encode()
+
+    assert test_client.get("/archive/unknown").status_code == 404
+
+
+def test_export_archives(test_client, local_storage, tmp_path, monkeypatch):
+    """
+    Test that an export job writes a package per group and a manifest, and reports missing files.
+    """
+    monkeypatch.setattr(archive, "EXPORT_PAGE_SIZE", 2)
+    _upload(test_client, "images", 3)
+    _upload(test_client, "documents", 1)
+    missing_id = _upload(test_client, "models", 2)[0]
+    # Files are hard links to their blob, so both are removed
+    lost = (tmp_path / "models" / f"{missing_id}.jpg").stat().st_ino
+    for path in list(tmp_path.rglob("*")):
+        if path.is_file() and path.stat().st_ino == lost:
+            path.unlink()
+
+    # Background tasks finish before the test client returns
+    response = test_client.post("/archive/export")
+    assert response.status_code == 202
+    job = test_client.get(response.json()["status_url"]).json()
+    assert job["status"] == "done"
+    assert sorted(job["groups"]) == ["documents", "images", "models"]
+    assert job["groups"]["models"]["missing"] == [f"{missing_id}.jpg"]
+
+    export_dir = tmp_path / "exports" / job["job_id"]
+    with zipfile.ZipFile(export_dir / "images.zip") as package:
+        assert len(package.namelist()) == 4
+    assert job["groups"]["images"]["bytes"] == (export_dir / "images.zip").stat().st_size
+    manifest = json.loads((export_dir / "manifest.json").read_bytes())
+    assert manifest["done"] == 3
+
+    # Finished exports are still found by their manifest in other workers
+    archive.jobs.clear()
+    assert test_client.get(f"/archive/jobs/{job['job_id']}").json()["done"] == 3
+
+    response = test_client.post("/archive/export", data={"groups": json.dumps(["documents"])})
+    assert sorted(test_client.get(response.json()["status_url"]).json()["groups"]) == ["documents"]
+    assert test_client.post("/archive/export", data={"groups": "documents"}).status_code == 400
+
+
+def test_rebuild_crates(test_client, local_storage, tmp_path):
+    """
+    Test that a lost RO-Crate is rebuilt from the metadata store, and the log folded into it.
+    """
+    file_ids = _upload(test_client, "images", 2) + _upload(test_client, "images", 1)
+    (tmp_path / "images" / "ro-crate-metadata.json").write_text(json.dumps({"@graph": []}))
+    assert len(list((tmp_path / "images" / "ro-crate-log").iterdir())) == 2
+
+    response = test_client.post("/archive/rebuild", data={"groups": json.dumps(["images"])})
+    job = test_client.get(response.json()["status_url"]).json()
+    assert job["groups"]["images"] == {"status": "done", "files": 3, "log_entries": 2,
+                                       "duration": job["groups"]["images"]["duration"]}
+    assert list((tmp_path / "images" / "ro-crate-log").iterdir()) == []
+
+    graph = test_client.get("/metadata/images").json()["@graph"]
+    root = next(entity for entity in graph if entity["@id"] == "./")
+    assert sorted(part["@id"] for part in root["hasPart"]) == sorted(f"{file_id}.jpg" for file_id in file_ids)
+    assert any(entity["@type"] == "Person" and entity["@id"] == "author-a" for entity in graph)
+
+
+def test_iter_groups_pages(test_client, local_storage):
+    """
+    Test that groups are walked in order across pages of the metadata index.
+    """
+    for group_id in ("c", "a", "b"):
+        _upload(test_client, group_id, 2)
+
+    async def walk():
+        return [group_id async for group_id in archive.iter_groups(page_size=2)]
+
+    assert asyncio.run(walk()) == ["a", "b", "c"]
+    assert len(FileMetadata.filter("a")) == 2
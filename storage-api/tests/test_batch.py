@@ -0,0 +1,160 @@
+"""
+Tests for the batch upload endpoint.
+"""
+
+import io
+import json
+import asyncio
+import tarfile
+import hashlib
+import zipfile
+import batch
+from database import get_store
+from models import FileMetadata
+
+
+def _files(count):
+    return [("files", (f"photo-{i}.jpg", f"photo {i}".encode(), "image/jpeg")) for i in range(count)]
+
+
+def test_upload_batch_files(test_client, local_storage, tmp_path):
+    """
+    Test that many files are stored, indexed and added to the crate with one log entry.
+    """
+    response = test_client.post(
+        "/batch",
+        files=_files(12),
+        data={"media_type": "images", "creator": "author-a",
+              "manifest": json.dumps({"photo-3.jpg": {"uuid": "photo-three", "description": "Trench 3"}})},
+    )
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["stored"] == 12
+    assert [result["file_originalname"] for result in body["files"]] == [f"photo-{i}.jpg" for i in range(12)]
+    assert body["files"][3]["file_id"] == "photo-three"
+    assert (tmp_path / "images" / "photo-three.jpg").read_bytes() == b"photo 3"
+    assert FileMetadata.get("photo-three").file_description == "Trench 3"
+    assert len(FileMetadata.filter("images")) == 12
+    assert len(list((tmp_path / "images" / "ro-crate-log").iterdir())) == 1
+
+    graph = test_client.get("/metadata/images").json()["@graph"]
+    root = next(entity for entity in graph if entity["@id"] == "./")
+    assert len(root["hasPart"]) == 12
+
+
+def test_upload_batch_archives(test_client, local_storage, tmp_path):
+    """
+    Test that the regular files of zip and compressed tar archives are stored.
+    """
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w") as archive:
+        archive.writestr("day1/a.txt", b"alpha")
+        archive.writestr("day1/b.txt", b"beta")
+        archive.writestr("__MACOSX/day1/._a.txt", b"")
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode="w:gz") as archive:
+        info = tarfile.TarInfo("day2/c.txt")
+        info.size = 5
+        archive.addfile(info, io.BytesIO(b"gamma"))
+
+    by_zip = test_client.post("/batch", files={"archive": ("day1.zip", zip_buffer.getvalue())},
+                              data={"media_type": "documents"})
+    by_tar = test_client.post("/batch", files={"archive": ("day2.tar.gz", tar_buffer.getvalue())},
+                              data={"media_type": "documents"})
+
+    assert [result["file_originalname"] for result in by_zip.json()["files"]] == ["a.txt", "b.txt"]
+    assert [result["file_originalname"] for result in by_tar.json()["files"]] == ["c.txt"]
+    stored = {result["file_filename"]: result for result in by_zip.json()["files"] + by_tar.json()["files"]}
+    assert sorted((tmp_path / "documents" / name).read_bytes() for name in stored) == [b"alpha", b"beta", b"gamma"]
+    assert stored[next(iter(stored))]["file_metadata"]["file_encoding"] == "text/plain"
+
+
+def test_upload_batch_partial_failure(test_client, local_storage):
+    """
+    Test that files that cannot be stored are reported without failing the others.
+    """
+    response = test_client.post(
+        "/batch",
+        files=_files(2),
+        data={"manifest": json.dumps({"photo-0.jpg": {"media_type": "images"}})},
+    )
+
+    statuses = [result["status"] for result in response.json()["files"]]
+    assert statuses == ["stored", "failed"]
+    assert response.json()["failed"] == 1
+
+
+def test_upload_batch_again_releases_earlier_versions(test_client, local_storage, tmp_path):
+    """
+    Test that files uploaded again with the same IDs drop the references of their earlier content.
+    """
+    manifest = json.dumps({"photo-0.jpg": {"uuid": "photo-zero"}})
+    test_client.post("/batch", files=_files(1), data={"media_type": "images", "manifest": manifest})
+    first = hashlib.sha256(b"photo 0").hexdigest()
+    assert get_store().get_blob(first)["refcount"] == 1
+
+    files = [("files", ("photo-0.jpg", b"edited photo 0", "image/jpeg"))]
+    response = test_client.post("/batch", files=files, data={"media_type": "images", "manifest": manifest})
+    assert response.json()["stored"] == 1
+    assert get_store().get_blob(first) is None
+    assert not (tmp_path / "blobs" / first[:2] / first).exists()
+    assert (tmp_path / "images" / "photo-zero.jpg").read_bytes() == b"edited photo 0"
+
+
+def test_upload_batch_invalid(test_client, local_storage):
+    """
+    Test that empty batches, bad manifests and bad archives are rejected.
+    """
+    assert test_client.post("/batch", data={"media_type": "images"}).status_code == 400
+    assert test_client.post("/batch", files=_files(1), data={"manifest": "[1]"}).status_code == 400
+    assert test_client.post("/batch", files={"archive": ("x.zip", b"not an archive")}).status_code == 400
+
+
+def test_compressed_tar_members_are_read_in_order(local_storage):
+    """
+    Test that the members of a compressed tar are stored one at a time, in archive order.
+    """
+    def tar(mode):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode=mode) as archive:
+            for index in range(5):
+                info = tarfile.TarInfo(f"member-{index}.txt")
+                info.size = 1
+                archive.addfile(info, io.BytesIO(b"x"))
+        buffer.seek(0)
+        return buffer
+
+    plain_items, close = batch.open_archive(tar("w"))
+    close()
+    assert not any(item.sequential for item in plain_items)
+
+    items, close = batch.open_archive(tar("w:gz"))
+    assert all(item.sequential for item in items)
+    opened, reading = [], []
+
+    class Member:
+        def __init__(self, fileobj):
+            self.fileobj = fileobj
+
+        def read(self, size):
+            assert reading == [self]
+            return self.fileobj.read(size)
+
+        def close(self):
+            reading.remove(self)
+
+    def open_member(opener, name):
+        opened.append(name)
+        member = Member(opener())
+        reading.append(member)
+        return member
+
+    for item in items:
+        item.opener = lambda opener=item.opener, name=item.name: open_member(opener, name)
+    try:
+        results = asyncio.run(batch.ingest_batch(items, {"media_type": "documents"}, {}, local_storage))
+    finally:
+        close()
+    assert opened == [f"member-{index}.txt" for index in range(5)]
+    assert all(result["status"] == "stored" for result in results)
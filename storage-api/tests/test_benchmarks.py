@@ -0,0 +1,47 @@
+"""
+Tests for the helpers of the benchmark suite.
+"""
+
+from benchmarks.bench import Payload, case_key, compare, parse_size, percentile
+
+
+def test_parse_size():
+    assert parse_size("1KB") == 1024
+    assert parse_size("64mb") == 64 * 1024 ** 2
+    assert parse_size("1.5GB") == 3 * 1024 ** 3 // 2
+    assert parse_size("100") == 100
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile([0, 10], 0.95) == 9.5
+
+
+def test_payload_is_unique_and_sized():
+    """
+    Test that payloads have the requested size, can be rewound, and differ from each other.
+    """
+    first, second = Payload(3 * 1024 * 1024 + 7), Payload(3 * 1024 * 1024 + 7)
+    content = first.read()
+    assert len(content) == first.size
+    assert first.seek(0, 2) == first.size
+    first.seek(0)
+    assert b"".join(iter(lambda: first.read(65536), b"")) == content
+    assert second.read() != content
+
+
+def test_compare_reports_regressions():
+    baseline = {"results": [
+        {"name": "upload", "size": 1024, "concurrency": 1, "errors": 0, "p50": 0.1, "throughput_mib_s": 10},
+        {"name": "metadata_crate", "crate_size": 100, "errors": 0, "p50": 0.01},
+    ]}
+    results = {"results": [
+        {"name": "upload", "size": 1024, "concurrency": 1, "errors": 0, "p50": 0.11, "throughput_mib_s": 5},
+        {"name": "metadata_crate", "crate_size": 100, "errors": 1, "p50": 0.05},
+    ]}
+    regressions = compare(results, baseline, tolerance=0.25)
+    assert case_key(results["results"][0]) == "name=upload/size=1024/concurrency=1"
+    assert len(regressions) == 3
+    assert any("throughput_mib_s" in regression for regression in regressions)
+    assert not any("upload" in regression and "p50" in regression for regression in regressions)
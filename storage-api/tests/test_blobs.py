@@ -0,0 +1,204 @@
+"""
+Tests for content-addressed storage of uploaded files.
+"""
+
+import os
+import hashlib
+from main import app
+from storage import LocalStorage, get_storage
+from database import get_store
+
+CONTENT = b"The same photo, uploaded twice."
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+def _upload(test_client, file_id, content=CONTENT):
+    return test_client.post(
+        "/",
+        files={"file": ("photo.jpg", content, "image/jpeg")},
+        data={"uuid": file_id, "media_type": "images"},
+    )
+
+
+def test_duplicate_upload_stored_once(test_client, local_storage, tmp_path):
+    """
+    Test that identical uploads share one blob, referred to by hard links.
+    """
+    first = _upload(test_client, "photo-1")
+    second = _upload(test_client, "photo-2")
+
+    assert first.json()["deduplicated"] is False
+    assert second.json()["deduplicated"] is True
+    blob_path = tmp_path / "blobs" / SHA256[:2] / SHA256
+    assert blob_path.read_bytes() == CONTENT
+    assert os.stat(tmp_path / "images" / "photo-1.jpg").st_ino == os.stat(blob_path).st_ino
+    assert os.stat(tmp_path / "images" / "photo-2.jpg").st_ino == os.stat(blob_path).st_ino
+    assert os.listdir(tmp_path / "blobs" / "incoming") == []
+    assert get_store().get_blob(SHA256)["refcount"] == 2
+
+
+def test_delete_releases_blob(test_client, local_storage, tmp_path):
+    """
+    Test that the blob is kept until the last file referring to it is deleted.
+    """
+    _upload(test_client, "photo-1")
+    _upload(test_client, "photo-2")
+    blob_path = tmp_path / "blobs" / SHA256[:2] / SHA256
+
+    assert test_client.delete("/images/photo-1").status_code == 200
+    assert blob_path.exists()
+    assert test_client.get("/download/images/photo-2.jpg").content == CONTENT
+    assert test_client.get("/metadata/images/photo-1").status_code == 404
+
+    assert test_client.delete("/images/photo-2").status_code == 200
+    assert not blob_path.exists()
+    assert get_store().get_blob(SHA256) is None
+    assert test_client.delete("/images/photo-2").status_code == 404
+    graph = test_client.get("/metadata/images").json()["@graph"]
+    assert [entity["@id"] for entity in graph if entity.get("@type") == "File"] == []
+
+
+def test_download_resolves_blob_without_links(test_client, tmp_path):
+    """
+    Test that files are served from their blob on backends without links, like S3.
+    """
+    class UnlinkedStorage(LocalStorage):
+        async def link(self, src_key, dest_key):
+            return False
+
+    app.dependency_overrides[get_storage] = lambda: UnlinkedStorage(str(tmp_path))
+    try:
+        upload = _upload(test_client, "photo-1")
+        response = test_client.get("/download/images/photo-1.jpg")
+    finally:
+        app.dependency_overrides.pop(get_storage, None)
+
+    assert upload.json()["file_path"] == f"blobs/{SHA256[:2]}/{SHA256}"
+    assert not (tmp_path / "images" / "photo-1.jpg").exists()
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["content-type"] == "image/jpeg"
+
+
+def test_unlinked_backend_stores_in_place(test_client, tmp_path):
+    """
+    Test that on backends without links, like S3, new content is written once under its file key.
+    """
+    moves = []
+
+    class UnlinkedStorage(LocalStorage):
+        supports_links = False
+
+        async def move(self, src_key, dest_key):
+            moves.append((src_key, dest_key))
+            await super().move(src_key, dest_key)
+
+    app.dependency_overrides[get_storage] = lambda: UnlinkedStorage(str(tmp_path))
+    try:
+        first = _upload(test_client, "photo-1")
+        second = _upload(test_client, "photo-2")
+        assert moves == []
+        assert first.json()["file_path"] == "images/photo-1.jpg"
+        assert second.json()["file_path"] == "images/photo-1.jpg"
+        assert not (tmp_path / "images" / "photo-2.jpg").exists()
+        assert get_store().get_blob(SHA256)["blob_key"] == "images/photo-1.jpg"
+
+        # The blob is moved out of a deleted file's key while other files refer to it
+        assert test_client.delete("/images/photo-1").status_code == 200
+        assert get_store().get_blob(SHA256)["blob_key"] == f"blobs/{SHA256[:2]}/{SHA256}"
+        assert test_client.get("/download/images/photo-1.jpg").status_code == 404
+        assert test_client.get("/download/images/photo-2.jpg").content == CONTENT
+
+        # Uploading again to a key that holds a blob does not overwrite it
+        _upload(test_client, "scan-1", b"scan")
+        _upload(test_client, "scan-2", b"scan")
+        edited = _upload(test_client, "scan-1", b"edited scan")
+        assert edited.json()["file_path"].startswith("blobs/")
+        assert test_client.get("/download/images/scan-2.jpg").content == b"scan"
+    finally:
+        app.dependency_overrides.pop(get_storage, None)
+
+
+def test_failed_upload_releases_blob(test_client, local_storage, tmp_path, monkeypatch):
+    """
+    Test that an upload that cannot be recorded drops its reference to the stored content.
+    """
+    import main
+
+    async def failing_create_ro_crate(*args, **kwargs):
+        raise RuntimeError("crate unavailable")
+
+    monkeypatch.setattr(main, "create_ro_crate", failing_create_ro_crate)
+    assert _upload(test_client, "photo-1").status_code == 500
+
+    assert get_store().get_blob(SHA256) is None
+    assert not (tmp_path / "images" / "photo-1.jpg").exists()
+    assert not (tmp_path / "blobs" / SHA256[:2] / SHA256).exists()
+    assert test_client.get("/metadata/images/photo-1").status_code == 404
+
+
+def test_upload_again_releases_earlier_version(test_client, local_storage, tmp_path):
+    """
+    Test that uploading a file again with the same ID drops the earlier content's reference, on either backend.
+    """
+    edited = b"The same photo, edited."
+    edited_sha256 = hashlib.sha256(edited).hexdigest()
+    _upload(test_client, "photo-1")
+    assert _upload(test_client, "photo-1", edited).status_code == 200
+
+    assert get_store().get_blob(SHA256) is None
+    assert not (tmp_path / "blobs" / SHA256[:2] / SHA256).exists()
+    assert get_store().get_blob(edited_sha256)["refcount"] == 1
+    assert test_client.get("/download/images/photo-1.jpg").content == edited
+
+    # Uploading the same content again keeps a single reference
+    _upload(test_client, "photo-1", edited)
+    assert get_store().get_blob(edited_sha256)["refcount"] == 1
+    assert test_client.get("/download/images/photo-1.jpg").content == edited
+
+    assert test_client.delete("/images/photo-1").status_code == 200
+    assert get_store().get_blob(edited_sha256) is None
+    assert not (tmp_path / "blobs" / edited_sha256[:2] / edited_sha256).exists()
+
+    class UnlinkedStorage(LocalStorage):
+        supports_links = False
+
+    app.dependency_overrides[get_storage] = lambda: UnlinkedStorage(str(tmp_path))
+    try:
+        _upload(test_client, "scan-1", b"scan")
+        _upload(test_client, "scan-2", b"scan")
+        _upload(test_client, "scan-1", b"edited scan")
+        _upload(test_client, "scan-3", b"other scan")
+        _upload(test_client, "scan-3", b"another scan")
+        assert get_store().get_blob(hashlib.sha256(b"scan").hexdigest())["refcount"] == 1
+        assert get_store().get_blob(hashlib.sha256(b"other scan").hexdigest()) is None
+        assert test_client.get("/download/images/scan-1.jpg").content == b"edited scan"
+        assert test_client.get("/download/images/scan-2.jpg").content == b"scan"
+        assert test_client.get("/download/images/scan-3.jpg").content == b"another scan"
+
+        for file_id in ("scan-1", "scan-2", "scan-3"):
+            assert test_client.delete(f"/images/{file_id}").status_code == 200
+    finally:
+        app.dependency_overrides.pop(get_storage, None)
+    assert [files for _, _, files in os.walk(tmp_path / "blobs") if files] == []
+    assert [name for name in os.listdir(tmp_path / "images") if name.endswith(".jpg")] == []
+
+
+def test_failed_upload_again_keeps_earlier_version(test_client, local_storage, tmp_path, monkeypatch):
+    """
+    Test that a file whose new version cannot be recorded keeps its earlier metadata and content.
+    """
+    import main
+
+    _upload(test_client, "photo-1")
+
+    async def failing_create_ro_crate(*args, **kwargs):
+        raise RuntimeError("crate unavailable")
+
+    monkeypatch.setattr(main, "create_ro_crate", failing_create_ro_crate)
+    assert _upload(test_client, "photo-1", b"edited").status_code == 500
+
+    assert test_client.get("/metadata/images/photo-1").json()["file_checksum"] == f"sha256:{SHA256}"
+    assert test_client.get("/download/images/photo-1.jpg").content == CONTENT
+    assert get_store().get_blob(SHA256)["refcount"] == 1
+    assert get_store().get_blob(hashlib.sha256(b"edited").hexdigest()) is None
@@ -0,0 +1,97 @@
+"""
+Tests for the in-process cache of materialized RO-Crates.
+"""
+
+import json
+import asyncio
+from cache import LRUCache
+from utils import create_ro_crate, get_crate_metadata, crate_cache
+from tests.conftest import FILE_METADATA
+
+
+def _metadata(file_id):
+    return {**FILE_METADATA, "file_id": file_id, "file_name": f"{file_id}.txt"}
+
+
+def test_lru_cache_eviction():
+    """
+    Test that the least recently used entry is evicted when the cache is full.
+    """
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.put("a", 1, "v1")
+    cache.put("b", 2, "v1")
+    cache.get("a")
+    cache.put("c", 3, "v1")
+
+    assert cache.get("b") is None
+    assert cache.get("a").value == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_crate_cache_hit(local_storage):
+    """
+    Test that repeated reads are served from the cache without rebuilding the crate.
+    """
+    asyncio.run(create_ro_crate("documents", _metadata("file-1"), local_storage))
+
+    first = asyncio.run(get_crate_metadata("documents", local_storage))
+    second = asyncio.run(get_crate_metadata("documents", local_storage))
+
+    assert second is first
+    assert crate_cache.stats()["misses"] == 1
+    assert crate_cache.stats()["hits"] == 1
+
+
+def test_crate_cache_invalidated_by_append(local_storage):
+    """
+    Test that appending to a crate drops the cached copy.
+    """
+    asyncio.run(create_ro_crate("documents", _metadata("file-1"), local_storage))
+    asyncio.run(get_crate_metadata("documents", local_storage))
+    asyncio.run(create_ro_crate("documents", _metadata("file-2"), local_storage))
+
+    cached = asyncio.run(get_crate_metadata("documents", local_storage))
+
+    ids = [entity["@id"] for entity in json.loads(cached.body)["@graph"]]
+    assert "file-2.txt" in ids
+    assert crate_cache.stats()["invalidations"] == 1
+
+
+def test_crate_cache_revalidation(local_storage, monkeypatch):
+    """
+    Test that stale entries are revalidated, and rebuilt only if the storage changed.
+    """
+    monkeypatch.setattr(crate_cache, "ttl", 0)
+    asyncio.run(create_ro_crate("documents", _metadata("file-1"), local_storage))
+    first = asyncio.run(get_crate_metadata("documents", local_storage))
+
+    unchanged = asyncio.run(get_crate_metadata("documents", local_storage))
+    assert unchanged is first
+    assert crate_cache.stats()["revalidations"] == 1
+
+    # A write by another process does not invalidate this process's cache
+    entry = crate_cache.get("documents/ro-crate-metadata.json")
+    asyncio.run(create_ro_crate("documents", _metadata("file-2"), local_storage))
+    crate_cache.put("documents/ro-crate-metadata.json", entry.value, entry.version)
+
+    changed = asyncio.run(get_crate_metadata("documents", local_storage))
+    assert changed is not first
+    assert b"file-2.txt" in changed.body
+
+
+def test_get_metadata_cached(test_client, local_storage):
+    """
+    Test that the metadata endpoint serves the cached JSON-LD and reports the counters.
+    """
+    asyncio.run(create_ro_crate("documents", _metadata("file-1"), local_storage))
+
+    first = test_client.get("/metadata/documents")
+    second = test_client.get("/metadata/documents")
+    stats = test_client.get("/stats/cache").json()
+
+    assert first.status_code == 200
+    assert first.content == second.content
+    assert first.headers["content-type"] == "application/json"
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert test_client.get("/metadata/unknown").status_code == 404
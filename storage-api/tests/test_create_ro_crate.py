@@ -1,33 +1,155 @@
+import json
+import asyncio
 import pytest
-from unittest.mock import patch, MagicMock
-from botocore.exceptions import ClientError
-from utils import create_ro_crate
-from config.aws_config import BUCKET_NAME
+from unittest.mock import MagicMock
+import utils
+from utils import create_ro_crate, get_ro_crate, compact_ro_crate, compact_ro_crate_if_due
+from storage import S3Storage
 from tests.conftest import GROUP_ID, FILE_METADATA
 
-@patch('utils.s3')
-def test_create_ro_crate(mock_s3, setup_test_file):
+BUCKET_NAME = "test-bucket"
+
+
+def _file_metadata(file_id):
+    return {**FILE_METADATA, "file_id": file_id, "file_name": f"{file_id}.txt"}
+
+
+def _file_ids(crate):
+    return sorted(entity.id for entity in crate.data_entities)
+
+
+def test_create_ro_crate(setup_test_file):
     """
     Test the create_ro_crate function.
     """
-    crate_file_key = f"{GROUP_ID}/ro-crate-metadata.json"
+    log_prefix = f"{GROUP_ID}/ro-crate-log/"
+
+    # Mock the S3 put_object method
+    mock_s3 = MagicMock()
+    mock_s3.put_object = MagicMock()
+
+    asyncio.run(create_ro_crate(GROUP_ID, FILE_METADATA, S3Storage(mock_s3, BUCKET_NAME)))
+
+    # Check that the existing crate was not downloaded
+    assert not mock_s3.get_object.called
+
+    # Check that only the log entry for the file was uploaded
+    assert mock_s3.put_object.call_count == 1
+    kwargs = mock_s3.put_object.call_args.kwargs
+    assert kwargs["Bucket"] == BUCKET_NAME
+    assert kwargs["Key"].startswith(log_prefix)
+    entry = json.loads(kwargs["Body"])
+    assert entry["entities"][0]["name"] == FILE_METADATA["file_name"]
+
+
+def test_create_ro_crate_local(local_storage, tmp_path):
+    """
+    Test that create_ro_crate entries are materialized when the crate is read.
+    """
+    asyncio.run(create_ro_crate(GROUP_ID, FILE_METADATA, local_storage))
+
+    crate = asyncio.run(get_ro_crate(f"{GROUP_ID}/ro-crate-metadata.json", local_storage))
+    assert crate.root_dataset["identifier"] == GROUP_ID
+    assert _file_ids(crate) == [f"{FILE_METADATA['file_id']}.txt"]
+    assert crate.get("test-author-id")["name"] == "Test Author"
+
+
+def test_create_ro_crate_concurrent(local_storage):
+    """
+    Test that concurrent additions to the same group are all kept.
+    """
+    async def add_all():
+        await asyncio.gather(*[create_ro_crate(GROUP_ID, _file_metadata(f"file-{i}"), local_storage) for i in range(20)])
+
+    asyncio.run(add_all())
+
+    crate = asyncio.run(get_ro_crate(f"{GROUP_ID}/ro-crate-metadata.json", local_storage))
+    assert _file_ids(crate) == sorted(f"file-{i}.txt" for i in range(20))
+
+
+def test_compact_ro_crate(local_storage, tmp_path):
+    """
+    Test that compaction folds the log into the snapshot without losing entries.
+    """
+    for i in range(3):
+        asyncio.run(create_ro_crate(GROUP_ID, _file_metadata(f"file-{i}"), local_storage))
+
+    assert asyncio.run(compact_ro_crate(GROUP_ID, local_storage, grace=0)) == 3
+    assert list((tmp_path / GROUP_ID / "ro-crate-log").iterdir()) == []
+    assert (tmp_path / GROUP_ID / "ro-crate-metadata.json").exists()
+
+    asyncio.run(create_ro_crate(GROUP_ID, _file_metadata("file-3"), local_storage))
+
+    crate = asyncio.run(get_ro_crate(f"{GROUP_ID}/ro-crate-metadata.json", local_storage))
+    assert _file_ids(crate) == [f"file-{i}.txt" for i in range(4)]
+
+
+def test_compact_ro_crate_respects_grace(local_storage):
+    """
+    Test that recent log entries are left for a later compaction.
+    """
+    asyncio.run(create_ro_crate(GROUP_ID, FILE_METADATA, local_storage))
+
+    assert asyncio.run(compact_ro_crate(GROUP_ID, local_storage, grace=60)) == 0
+
+
+def test_compaction_is_due_from_the_log(local_storage, tmp_path, monkeypatch):
+    """
+    Test that compaction is started by the number of entries waiting in the log, and leaves no lock behind.
+    """
+    monkeypatch.setattr(utils, "CRATE_COMPACT_EVERY", 3)
+    log_dir = tmp_path / GROUP_ID / "ro-crate-log"
+    clock = iter(range(1, 10))
+
+    def append(file_id):
+        # Entries old enough to be compacted, as appended by any worker
+        with monkeypatch.context() as patched:
+            patched.setattr(utils.time, "time_ns", lambda: next(clock) * 10 ** 9)
+            asyncio.run(create_ro_crate(GROUP_ID, _file_metadata(file_id), local_storage))
+
+    append("file-0")
+    append("file-1")
+    asyncio.run(compact_ro_crate_if_due(GROUP_ID, local_storage))
+    assert len(list(log_dir.iterdir())) == 2
 
-    # Mock the S3 get_object and upload_fileobj methods
-    mock_s3.get_object = MagicMock(side_effect=ClientError(
-        {"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}},
-        "GetObject"
-    ))
-    mock_s3.upload_fileobj = MagicMock()
+    append("file-2")
+    asyncio.run(compact_ro_crate_if_due(GROUP_ID, local_storage))
+    assert list(log_dir.iterdir()) == []
+    assert utils._compaction_locks == {}
+
+    crate = asyncio.run(get_ro_crate(f"{GROUP_ID}/ro-crate-metadata.json", local_storage))
+    assert _file_ids(crate) == [f"file-{i}.txt" for i in range(3)]
+
+
+def test_revalidation_lists_after_log_position(local_storage, monkeypatch):
+    """
+    Test that a cached crate is revalidated from the log entries after its snapshot, and
+    rebuilt when another worker appends one.
+    """
+    for i in range(3):
+        asyncio.run(create_ro_crate(GROUP_ID, _file_metadata(f"file-{i}"), local_storage))
+    asyncio.run(compact_ro_crate(GROUP_ID, local_storage, grace=0))
+    asyncio.run(create_ro_crate(GROUP_ID, _file_metadata("file-3"), local_storage))
+    asyncio.run(get_ro_crate(f"{GROUP_ID}/ro-crate-metadata.json", local_storage))
 
-    create_ro_crate(GROUP_ID, FILE_METADATA)   
+    listed = []
+    list_log = local_storage.list
 
-    # Check that the get_object method was called with the correct parameters
-    mock_s3.get_object.assert_called_with(Bucket=BUCKET_NAME, Key=crate_file_key)
+    def list_after(prefix="", start_after=None):
+        listed.append(start_after)
+        return list_log(prefix, start_after)
+    monkeypatch.setattr(local_storage, "list", list_after)
+    monkeypatch.setattr(utils.crate_cache, "ttl", 0)
 
-    # Check that the upload_fileobj method was called
-    assert mock_s3.upload_fileobj.called
+    asyncio.run(get_ro_crate(f"{GROUP_ID}/ro-crate-metadata.json", local_storage))
+    assert utils.crate_cache.revalidations == 1
+    position = utils._log_positions.get(GROUP_ID).value
+    assert position.startswith(f"{GROUP_ID}/ro-crate-log/") and listed == [position]
 
-    # Check that the RO-Crate file was created and uploaded
-    args, kwargs = mock_s3.upload_fileobj.call_args
-    assert args[1] == BUCKET_NAME
-    assert args[2] == crate_file_key
+    # An entry appended by another worker, whose cache this one does not share
+    entry = {"group_uri": local_storage.url(GROUP_ID), "file_metadata": FILE_METADATA,
+             "file_entity_id": "file-4.txt", "entities": [{"@id": "file-4.txt", "@type": "File"}]}
+    asyncio.run(local_storage.write(f"{GROUP_ID}/ro-crate-log/{utils.time.time_ns():020d}-file-4.json",
+                                    json.dumps(entry).encode("utf-8")))
+    crate = asyncio.run(get_ro_crate(f"{GROUP_ID}/ro-crate-metadata.json", local_storage))
+    assert _file_ids(crate) == [f"file-{i}.txt" for i in range(5)]
@@ -0,0 +1,102 @@
+"""
+Tests for the EXIF location extraction and the location index.
+"""
+
+import struct
+import sqlite3
+import pytest
+
+import exif
+from database import MetadataStore
+
+
+def _rationals(order, value):
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round(((value - degrees) * 60 - minutes) * 60 * 10000)
+    return struct.pack(f"{order}6I", degrees, 1, minutes, 1, seconds, 10000)
+
+
+def _tiff(latitude, longitude, order="<"):
+    """
+    Build a TIFF structure whose IFD0 points to a GPS IFD holding a position.
+    """
+    header = (b"II*\x00" if order == "<" else b"MM\x00*") + struct.pack(f"{order}I", 8)
+    ifd0 = struct.pack(f"{order}HHHII", 1, exif.GPS_IFD_TAG, 4, 1, 26) + struct.pack(f"{order}I", 0)
+    gps = struct.pack(f"{order}H", 4)
+    gps += struct.pack(f"{order}HHI", 1, 2, 2) + (b"N" if latitude >= 0 else b"S") + b"\x00\x00\x00"
+    gps += struct.pack(f"{order}HHII", 2, 5, 3, 80)
+    gps += struct.pack(f"{order}HHI", 3, 2, 2) + (b"E" if longitude >= 0 else b"W") + b"\x00\x00\x00"
+    gps += struct.pack(f"{order}HHII", 4, 5, 3, 104)
+    gps += struct.pack(f"{order}I", 0)
+    return header + ifd0 + gps + _rationals(order, latitude) + _rationals(order, longitude)
+
+
+def _jpeg(latitude, longitude):
+    """
+    Build a JPEG header with a JFIF segment and an EXIF block holding a position.
+    """
+    jfif = b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    block = b"Exif\x00\x00" + _tiff(latitude, longitude, order=">")
+    return (b"\xff\xd8" + b"\xff\xe0" + struct.pack(">H", len(jfif) + 2) + jfif
+            + b"\xff\xe1" + struct.pack(">H", len(block) + 2) + block
+            + b"\xff\xda\x00\x02" + b"\x00" * 1024 + b"\xff\xd9")
+
+
+def test_read_gps():
+    """
+    Test that positions are read from JPEG and TIFF files, in both byte orders and hemispheres.
+    """
+    assert exif.read_gps(_jpeg(37.9715, 23.7257)) == pytest.approx((37.9715, 23.7257), abs=1e-6)
+    assert exif.read_gps(_tiff(-33.8568, -70.6483)) == pytest.approx((-33.8568, -70.6483), abs=1e-6)
+    assert exif.read_gps(_tiff(51.5, 0.1, order=">")) == pytest.approx((51.5, 0.1), abs=1e-6)
+
+    assert exif.read_gps(b"\x89PNG\r\n\x1a\n") is None
+    assert exif.read_gps(b"\xff\xd8\xff\xda\x00\x02") is None
+    # A block cut off by the end of the header is ignored
+    assert exif.read_gps(_jpeg(37.9715, 23.7257)[:60]) is None
+
+
+def test_upload_records_location(test_client, local_storage):
+    """
+    Test that the position of an uploaded photo is indexed and found by bounding box.
+    """
+    files = [
+        ("files", ("trench.jpg", _jpeg(37.9715, 23.7257), "image/jpeg")),
+        ("files", ("lab.jpg", _jpeg(48.8566, 2.3522), "image/jpeg")),
+        ("files", ("notes.txt", b"no position", "text/plain")),
+    ]
+    response = test_client.post("/batch", files=files, data={"media_type": "images"})
+    results = {result["file_originalname"]: result for result in response.json()["files"]}
+    assert results["trench.jpg"]["file_metadata"]["media_location"] == {"latitude": 37.9715, "longitude": 23.7257}
+    assert "media_location" not in results["notes.txt"]["file_metadata"]
+
+    response = test_client.get("/search", params={"bbox": "23.7,37.9,23.8,38.0", "fields": "latitude,longitude"})
+    assert response.json()["items"] == [{"file_id": results["trench.jpg"]["file_id"],
+                                         "latitude": 37.9715, "longitude": 23.7257}]
+    assert test_client.get("/search", params={"bbox": "23.7,37.9"}).status_code == 400
+    assert test_client.get("/search", params={"bbox": "0,95,1,96"}).status_code == 400
+
+
+def test_location_columns_are_added(tmp_path):
+    """
+    Test that a database created before the location columns is upgraded on startup.
+    """
+    path = tmp_path / "metadata.db"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE file_metadata (file_id TEXT PRIMARY KEY, group_id TEXT NOT NULL, "
+                       "media_type_uuid TEXT, file_key TEXT, file_name TEXT, file_type TEXT, file_description TEXT, "
+                       "file_author TEXT, file_version INTEGER, file_license TEXT, file_size BIGINT, "
+                       "file_checksum TEXT, parent_type TEXT, parent TEXT, captured_at TEXT, file_upload_date TEXT)")
+    connection.execute("INSERT INTO file_metadata (file_id, group_id) VALUES ('old', 'images')")
+    connection.commit()
+    connection.close()
+
+    store = MetadataStore(f"sqlite:///{path}")
+    store.upsert_many([{"file_id": "new", "group_id": "images", "latitude": 1.5, "longitude": 2.5}])
+    rows = store.select(columns=("file_id", "latitude", "longitude"))
+    store.close()
+
+    assert rows == [{"file_id": "new", "latitude": 1.5, "longitude": 2.5},
+                    {"file_id": "old", "latitude": None, "longitude": None}]
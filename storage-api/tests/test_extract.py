@@ -0,0 +1,117 @@
+"""
+Tests for the technical metadata extraction at ingest.
+"""
+
+import zlib
+import struct
+import asyncio
+
+import extract
+from test_exif import _jpeg
+
+OBJ = b"# cube\nv 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nvn 0 0 1\nvt 0 0\nf 1 2 3\nf 1 3 4\n"
+
+
+def _png(width, height):
+    def chunk(chunk_type, data):
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\x00" * (width * 3 + 1) * height)) + chunk(b"IEND", b""))
+
+
+def _pdf(pages, filler=0):
+    # The page tree is written after the content, as most writers do
+    return (b"%PDF-1.7\n1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n"
+            + b"3 0 obj\n<< /Length %d >>\nstream\n" % filler + b"x" * filler + b"\nendstream\nendobj\n"
+            + b"2 0 obj\n<< /Type /Pages /Kids [] /Count %d >>\nendobj\ntrailer\n<< /Root 1 0 R >>\n%%%%EOF\n" % pages)
+
+
+def _extract(content, file_name, chunk_size=1024 * 1024):
+    extractor = extract.MetadataExtractor(file_name)
+    for start in range(0, len(content), chunk_size):
+        extractor.feed(content[start:start + chunk_size])
+    return extractor.extract()
+
+
+def test_extractors():
+    """
+    Test that each format's dimensions, counts and EXIF tags are read.
+    """
+    jpeg = _jpeg(37.9715, 23.7257)
+    # A baseline frame after the EXIF block
+    jpeg = jpeg[:jpeg.index(b"\xff\xda")] + b"\xff\xc0\x00\x11\x08" + struct.pack(">HH", 480, 640) + b"\x00" * 10 + jpeg[jpeg.index(b"\xff\xda"):]
+    found = _extract(jpeg, "photo.JPG")
+    assert (found["width"], found["height"]) == (640, 480)
+    assert found["location"] == (37.9715, 23.7257)
+
+    assert _extract(_png(31, 17), "scan.png") == {"width": 31, "height": 17}
+    assert _extract(_pdf(12), "report.pdf") == {"page_count": 12}
+    assert _extract(b"%PDF-1.5\n1 0 obj\n<< /Linearized 1 /L 5000 /N 7 /T 4000 >>\nendobj\n", "a.pdf") == {"page_count": 7}
+    ply = b"ply\nformat binary_little_endian 1.0\nelement vertex 8\nproperty float x\nelement face 6\nend_header\n\x00\x01"
+    assert _extract(ply, "mesh.ply") == {"vertex_count": 8, "face_count": 6}
+    assert _extract(OBJ, "cube.obj") == {"vertex_count": 4, "face_count": 2}
+    assert _extract(b"plain text", "notes.txt") == {}
+    assert _extract(b"\xff\xd8\xff\xe1\x00", "broken.jpg") == {}
+
+
+def test_large_files_are_read_at_both_ends():
+    """
+    Test that only the first and last bytes are kept, and OBJ lines split across chunks are counted.
+    """
+    content = _pdf(250, filler=3 * extract.EXTRACT_HEAD_SIZE)
+    extractor = extract.MetadataExtractor("large.pdf")
+    for start in range(0, len(content), 65536):
+        extractor.feed(content[start:start + 65536])
+    assert len(extractor.head) == extract.EXTRACT_HEAD_SIZE
+    assert len(extractor.tail) == extract.EXTRACT_TAIL_SIZE
+    assert extractor.extract() == {"page_count": 250}
+
+    for chunk_size in (1, 2, 3, 7):
+        assert _extract(OBJ * 3, "cube.obj", chunk_size) == {"vertex_count": 12, "face_count": 6}
+
+
+def test_upload_records_properties(test_client, local_storage):
+    """
+    Test that the extracted metadata is indexed and added to the RO-Crate, and removed with the file.
+    """
+    files = [
+        ("files", ("scan.png", _png(31, 17), "image/png")),
+        ("files", ("report.pdf", _pdf(3), "application/pdf")),
+        ("files", ("cube.obj", OBJ, "model/obj")),
+        ("files", ("photo.jpg", _jpeg(37.9715, 23.7257), "image/jpeg")),
+    ]
+    response = test_client.post("/batch", files=files, data={"media_type": "finds"})
+    ids = {result["file_originalname"]: result["file_id"] for result in response.json()["files"]}
+
+    assert test_client.get(f"/metadata/finds/{ids['scan.png']}").json()["width"] == 31
+    assert test_client.get(f"/metadata/finds/{ids['report.pdf']}").json()["page_count"] == 3
+    assert test_client.get(f"/metadata/finds/{ids['cube.obj']}").json()["vertex_count"] == 4
+
+    graph = {entity["@id"]: entity for entity in test_client.get("/metadata/finds").json()["@graph"]}
+    assert graph[f"{ids['scan.png']}.png"]["height"] == 17
+    assert graph[f"{ids['report.pdf']}.pdf"]["numberOfPages"] == 3
+    mesh = graph[f"{ids['cube.obj']}.obj"]
+    assert sorted(graph[part["@id"]]["value"] for part in mesh["additionalProperty"]) == [2, 4]
+    place = graph[graph[f"{ids['photo.jpg']}.jpg"]["contentLocation"]["@id"]]
+    assert (place["latitude"], place["longitude"]) == (37.9715, 23.7257)
+
+    assert test_client.delete(f"/finds/{ids['cube.obj']}").status_code == 200
+    graph = test_client.get("/metadata/finds").json()["@graph"]
+    assert not any(entity["@id"].startswith(f"#{ids['cube.obj']}") for entity in graph)
+
+
+def test_extract_stored(local_storage):
+    """
+    Test that a file stored without streaming through the API is read with two ranged reads.
+    """
+    content = _pdf(40, filler=2 * extract.EXTRACT_HEAD_SIZE)
+
+    async def stored_metadata():
+        async def chunks():
+            yield content
+        await local_storage.put("documents/direct.pdf", chunks())
+        file_metadata = {"file_name": "direct.pdf"}
+        await extract.extract_stored(local_storage, "documents/direct.pdf", file_metadata, len(content))
+        return file_metadata
+
+    assert asyncio.run(stored_metadata())["media_properties"] == {"page_count": 40}
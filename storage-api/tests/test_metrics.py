@@ -0,0 +1,66 @@
+"""
+Tests for the Prometheus metrics.
+"""
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from prometheus_client import REGISTRY
+from metrics import instrument_s3_client
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_request_metrics(test_client, local_storage, tmp_path):
+    """
+    Test that requests are timed and their bytes counted by route template.
+    """
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "file.bin").write_bytes(b"x" * 1000)
+    route = "/download/{type}/{file_id}"
+    count = _sample("http_request_duration_seconds_count", method="GET", route=route, status="200")
+    sent = _sample("http_response_bytes_total", method="GET", route=route)
+
+    test_client.get("/download/images/file.bin")
+    test_client.get("/download/images/file.bin", headers={"Range": "bytes=0-99"})
+
+    assert _sample("http_request_duration_seconds_count", method="GET", route=route, status="200") == count + 1
+    assert _sample("http_response_bytes_total", method="GET", route=route) == sent + 1100
+    assert _sample("http_requests_in_progress", method="GET", route=route) == 0
+
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert 'route="/download/{type}/{file_id}"' in response.text
+    assert "rocrate_duration_seconds" in response.text
+
+
+class EmptyBody:
+    def stream(self, **kwargs):
+        yield b""
+
+
+def test_s3_metrics():
+    """
+    Test that S3 calls are timed and failed calls counted by operation.
+    """
+    client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")
+    instrument_s3_client(client)
+    calls = _sample("s3_request_duration_seconds_count", operation="HeadObject")
+    errors = _sample("s3_request_errors_total", operation="HeadObject", code="404")
+
+    statuses = iter([200, 404])
+
+    def send(request, **kwargs):
+        # Answer the requests without a network, after the client has signed them
+        return AWSResponse(request.url, next(statuses), {}, EmptyBody())
+
+    client.meta.events.register("before-send.s3", send)
+    client.head_object(Bucket="bucket", Key="a")
+    try:
+        client.head_object(Bucket="bucket", Key="b")
+    except client.exceptions.ClientError:
+        pass
+
+    assert _sample("s3_request_duration_seconds_count", operation="HeadObject") == calls + 2
+    assert _sample("s3_request_errors_total", operation="HeadObject", code="404") == errors + 1
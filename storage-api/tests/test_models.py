@@ -0,0 +1,74 @@
+"""
+Tests for the file metadata model and the metadata store.
+"""
+
+from models import FileMetadata
+
+
+def _metadata(file_id, group_id="images", parent=None, upload_date="2024-05-01 10:00:00+00:00"):
+    return FileMetadata(
+        group_id=group_id,
+        file_id=file_id,
+        file_name=f"{file_id}.jpg",
+        file_upload_date=upload_date,
+        parent_type="context" if parent else None,
+        parent=parent,
+    )
+
+
+def test_save_and_get():
+    """
+    Test that saved metadata can be retrieved by file ID and is replaced on save.
+    """
+    _metadata("a").save()
+    updated = _metadata("a")
+    updated.file_description = "Updated"
+    updated.save()
+
+    assert FileMetadata.get("a").file_description == "Updated"
+    assert FileMetadata.get("missing") is None
+
+
+def test_save_many_and_filter():
+    """
+    Test that batched metadata is saved in one call and filtered by group.
+    """
+    FileMetadata.save_many([_metadata("b"), _metadata("a"), _metadata("c", group_id="documents")])
+
+    assert [item.file_id for item in FileMetadata.filter("images")] == ["a", "b"]
+    assert [item.file_id for item in FileMetadata.filter("documents")] == ["c"]
+
+
+def test_indexes(metadata_store):
+    """
+    Test that lookups by file and group use the indexes.
+    """
+    FileMetadata.save_many([_metadata(str(i)) for i in range(100)])
+
+    with metadata_store._cursor() as cursor:
+        by_file = cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM file_metadata WHERE file_id = ?", ("1",)).fetchall()
+        by_group = cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM file_metadata WHERE group_id = ?", ("images",)).fetchall()
+
+    assert "USING INDEX" in str(by_file)
+    assert "file_metadata_group_idx" in str(by_group)
+
+
+def test_upload_indexes_metadata(test_client, local_storage):
+    """
+    Test that an upload is recorded in the metadata store and served by file ID.
+    """
+    response = test_client.post(
+        "/",
+        files={"file": ("photo.jpg", b"jpeg", "image/jpeg")},
+        data={"uuid": "photo-1", "media_type": "images", "parent_type": "context", "parent": "ctx-1"}
+    )
+    assert response.status_code == 200
+
+    file_metadata = test_client.get("/metadata/images/photo-1")
+    wrong_group = test_client.get("/metadata/documents/photo-1")
+
+    assert file_metadata.status_code == 200
+    assert file_metadata.json()["file_key"] == "images/photo-1.jpg"
+    assert file_metadata.json()["parent"] == "ctx-1"
+    assert file_metadata.json()["file_size"] == 4
+    assert wrong_group.status_code == 404
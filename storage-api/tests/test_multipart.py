@@ -0,0 +1,177 @@
+"""
+Tests for the S3 multipart upload engine.
+"""
+
+import asyncio
+import hashlib
+import pytest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+
+import multipart
+from multipart import MultipartUpload, MultipartUploadError
+
+KEY = "images/test-file.bin"
+PARTS = [b"aaaa", b"bbbb", b"cccc", b"dd"]
+
+
+async def _chunks(parts):
+    for part in parts:
+        yield part
+
+
+def _mock_s3(finished_parts=None):
+    """
+    Create a mock S3 client, optionally with an open upload holding finished parts.
+    """
+    s3 = MagicMock()
+    if finished_parts is None:
+        s3.list_multipart_uploads.return_value = {}
+    else:
+        s3.list_multipart_uploads.return_value = {"Uploads": [{"Key": KEY, "UploadId": "open-upload"}]}
+        s3.get_paginator.return_value.paginate.return_value = [{"Parts": finished_parts}]
+    s3.create_multipart_upload.return_value = {"UploadId": "new-upload"}
+    s3.upload_part.side_effect = lambda **kwargs: {"ETag": f'"{hashlib.md5(kwargs["Body"]).hexdigest()}"'}
+    return s3
+
+
+def test_multipart_upload():
+    """
+    Test that a stream larger than one part is uploaded in parts and completed in order.
+    """
+    s3 = _mock_s3()
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=4, concurrency=2)
+
+    result = asyncio.run(upload.upload(_chunks([b"aaaab", b"bbbcccc", b"dd"])))
+
+    content = b"".join(PARTS)
+    assert result["size"] == len(content)
+    assert result["sha256"] == hashlib.sha256(content).hexdigest()
+    assert result["parts"] == 4
+    assert s3.upload_part.call_count == 4
+    bodies = {call.kwargs["PartNumber"]: call.kwargs["Body"] for call in s3.upload_part.call_args_list}
+    assert bodies == {1: b"aaaa", 2: b"bbbb", 3: b"cccc", 4: b"dd"}
+    completed = s3.complete_multipart_upload.call_args.kwargs
+    assert completed["UploadId"] == "new-upload"
+    assert [part["PartNumber"] for part in completed["MultipartUpload"]["Parts"]] == [1, 2, 3, 4]
+
+
+def test_multipart_upload_single_part():
+    """
+    Test that a stream that fits in one part is uploaded with a single PUT.
+    """
+    s3 = _mock_s3()
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=4)
+
+    result = asyncio.run(upload.upload(_chunks([b"aa"])))
+
+    assert result["parts"] == 1
+    s3.put_object.assert_called_once()
+    assert not s3.create_multipart_upload.called
+
+
+def test_multipart_upload_resume():
+    """
+    Test that a resumed upload skips the parts that were already transferred.
+    """
+    finished = [
+        {"PartNumber": 1, "ETag": f'"{hashlib.md5(b"aaaa").hexdigest()}"'},
+        {"PartNumber": 2, "ETag": f'"{hashlib.md5(b"bbbb").hexdigest()}"'},
+    ]
+    s3 = _mock_s3(finished)
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=4)
+
+    result = asyncio.run(upload.upload(_chunks(PARTS)))
+
+    assert result["resumed_parts"] == 2
+    assert not s3.create_multipart_upload.called
+    assert sorted(call.kwargs["PartNumber"] for call in s3.upload_part.call_args_list) == [3, 4]
+    completed = s3.complete_multipart_upload.call_args.kwargs
+    assert completed["UploadId"] == "open-upload"
+    assert len(completed["MultipartUpload"]["Parts"]) == 4
+
+
+def test_multipart_upload_failure():
+    """
+    Test that a failed part leaves the upload open and reports its ID.
+    """
+    s3 = _mock_s3()
+    s3.upload_part.side_effect = ConnectionError("Connection reset")
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=4)
+
+    with pytest.raises(MultipartUploadError) as error:
+        asyncio.run(upload.upload(_chunks(PARTS)))
+
+    assert error.value.upload_id == "new-upload"
+    assert not s3.complete_multipart_upload.called
+    assert not s3.abort_multipart_upload.called
+
+
+def test_multipart_copy():
+    """
+    Test that a large object is copied as parts covering all of its bytes.
+    """
+    s3 = _mock_s3()
+    s3.upload_part_copy.side_effect = lambda **kwargs: {"CopyPartResult": {"ETag": f'"{kwargs["PartNumber"]}"'}}
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=4, concurrency=2)
+
+    result = asyncio.run(upload.copy("blobs/incoming/source", 10))
+
+    assert result == {"size": 10, "parts": 3}
+    ranges = sorted(call.kwargs["CopySourceRange"] for call in s3.upload_part_copy.call_args_list)
+    assert ranges == ["bytes=0-3", "bytes=4-7", "bytes=8-9"]
+    completed = s3.complete_multipart_upload.call_args.kwargs
+    assert [part["PartNumber"] for part in completed["MultipartUpload"]["Parts"]] == [1, 2, 3]
+
+
+def test_multipart_part_sizes_grow(monkeypatch):
+    """
+    Test that parts double in size as an upload goes on, and a stream needing too many parts is aborted.
+    """
+    monkeypatch.setattr(multipart, "PART_GROWTH_EVERY", 2)
+    s3 = _mock_s3()
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=2)
+
+    asyncio.run(upload.upload(_chunks([b"x" * 19])))
+
+    sizes = {call.kwargs["PartNumber"]: len(call.kwargs["Body"]) for call in s3.upload_part.call_args_list}
+    assert sizes == {1: 2, 2: 2, 3: 4, 4: 4, 5: 7}
+
+    monkeypatch.setattr(multipart, "MAX_PARTS", 3)
+    s3 = _mock_s3()
+    with pytest.raises(MultipartUploadError) as error:
+        asyncio.run(MultipartUpload(s3, "bucket", KEY, part_size=2).upload(_chunks([b"x" * 19])))
+    assert error.value.upload_id == "new-upload"
+    s3.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key=KEY, UploadId="new-upload")
+
+
+def test_multipart_upload_precondition_failed():
+    """
+    Test that an upload whose condition fails on completion is aborted.
+    """
+    s3 = _mock_s3()
+    s3.complete_multipart_upload.side_effect = ClientError(
+        {"Error": {"Code": "PreconditionFailed"}}, "CompleteMultipartUpload")
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=4)
+
+    with pytest.raises(ClientError):
+        asyncio.run(upload.upload(_chunks(PARTS), {"IfNoneMatch": "*"}))
+
+    s3.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key=KEY, UploadId="new-upload")
+
+
+def test_multipart_upload_stale_is_not_resumed():
+    """
+    Test that an open upload older than S3_UPLOAD_RESUME_TTL is aborted and a new one started.
+    """
+    s3 = _mock_s3([{"PartNumber": 1, "ETag": f'"{hashlib.md5(b"aaaa").hexdigest()}"'}])
+    initiated = datetime.now(timezone.utc) - timedelta(seconds=multipart.S3_UPLOAD_RESUME_TTL + 60)
+    s3.list_multipart_uploads.return_value = {"Uploads": [{"Key": KEY, "UploadId": "open-upload", "Initiated": initiated}]}
+    upload = MultipartUpload(s3, "bucket", KEY, part_size=4)
+
+    result = asyncio.run(upload.upload(_chunks(PARTS)))
+
+    assert result["resumed_parts"] == 0
+    s3.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key=KEY, UploadId="open-upload")
+    assert s3.complete_multipart_upload.call_args.kwargs["UploadId"] == "new-upload"
@@ -0,0 +1,173 @@
+"""
+Tests for the paginated metadata listing.
+"""
+
+import json
+from models import FileMetadata, utc_timestamp
+from pagination import encode_cursor, decode_cursor
+
+
+def _save_files(count, group_id="images", prefix="file"):
+    FileMetadata.save_many([
+        FileMetadata(
+            group_id=group_id,
+            file_id=f"{prefix}-{i:03d}",
+            file_name=f"file-{i:03d}.jpg",
+            file_upload_date="2024-05-01 10:00:00+00:00",
+            file_author="author-a" if i % 2 else "author-b",
+            parent_type="context",
+            parent=f"context-{i % 3}",
+            captured_at=f"2024-05-{i % 28 + 1:02d}",
+        )
+        for i in range(count)
+    ])
+
+
+def test_cursor_roundtrip():
+    """
+    Test that cursors are opaque and decode to the key they were made from.
+    """
+    cursor = encode_cursor("file/ä-001")
+
+    assert "/" not in cursor
+    assert decode_cursor(cursor) == "file/ä-001"
+    assert decode_cursor(None) is None
+
+
+def test_list_metadata_pages(test_client):
+    """
+    Test that following the cursors returns every file exactly once.
+    """
+    _save_files(25)
+    _save_files(5, group_id="documents", prefix="document")
+
+    file_ids = []
+    cursor = None
+    pages = 0
+    while True:
+        params = {"limit": 10}
+        if cursor:
+            params["cursor"] = cursor
+        response = test_client.get("/metadata/images", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        file_ids += [item["file_id"] for item in page["items"]]
+        pages += 1
+        cursor = page["next_cursor"]
+        assert ("link" in response.headers) == (cursor is not None)
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert file_ids == [f"file-{i:03d}" for i in range(25)]
+
+
+def test_list_metadata_filters_and_fields(test_client):
+    """
+    Test that filters select the files and fields select the columns.
+    """
+    _save_files(30)
+
+    response = test_client.get("/metadata/images", params={
+        "creator": "author-a", "parent": "context-1", "captured_from": "2024-05-10",
+        "fields": "file_name,captured_at",
+    })
+
+    items = response.json()["items"]
+    assert items
+    for item in items:
+        assert set(item) == {"file_id", "file_name", "captured_at"}
+        assert item["captured_at"] >= "2024-05-10"
+    assert test_client.get("/metadata/images", params={"fields": "password"}).status_code == 400
+    assert test_client.get("/metadata/images", params={"cursor": "%%%"}).status_code == 400
+
+
+def test_list_metadata_ndjson(test_client):
+    """
+    Test that NDJSON output holds one file per line.
+    """
+    _save_files(3)
+
+    response = test_client.get("/metadata/images", params={"format": "ndjson", "fields": "file_name"})
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["file_name"] for line in lines] == ["file-000.jpg", "file-001.jpg", "file-002.jpg"]
+
+
+def test_page_uses_group_index(metadata_store):
+    """
+    Test that a page after a cursor is read from the group index.
+    """
+    _save_files(50)
+
+    with metadata_store._cursor() as cursor:
+        plan = cursor.execute(
+            "EXPLAIN QUERY PLAN SELECT file_id FROM file_metadata WHERE group_id = ? AND file_id > ? ORDER BY file_id LIMIT 10",
+            ("images", "file-010"),
+        ).fetchall()
+
+    assert "file_metadata_group_idx" in str(plan)
+    assert "TEMP B-TREE" not in str(plan)
+
+
+def test_search_across_groups(test_client):
+    """
+    Test that a search returns the matching files of every group, and pages through them.
+    """
+    _save_files(10)
+    _save_files(10, group_id="documents", prefix="document")
+
+    response = test_client.get("/search", params={"parent": "context-1", "captured_from": "2024-05-05", "limit": 2})
+    page = response.json()
+    next_page = test_client.get("/search", params={"parent": "context-1", "captured_from": "2024-05-05",
+                                                   "limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [item["file_id"] for item in page["items"] + next_page["items"]] == ["document-004", "document-007",
+                                                                                "file-004", "file-007"]
+    assert next_page["next_cursor"] is None
+
+    response = test_client.get("/search", params={"group": "images", "creator": "author-b", "fields": "group_id"})
+    assert {item["group_id"] for item in response.json()["items"]} == {"images"}
+    assert len(response.json()["items"]) == 5
+
+
+def test_capture_bounds_are_compared_in_utc(test_client):
+    """
+    Test that capture times with UTC offsets are compared as times, and a date upper bound includes its day.
+    """
+    FileMetadata.save_many([
+        FileMetadata(group_id="images", file_id="athens", file_name="athens.jpg",
+                     file_upload_date="2024-05-01 10:00:00+00:00", captured_at="2024-05-10T01:30:00+03:00"),
+        FileMetadata(group_id="images", file_id="evening", file_name="evening.jpg",
+                     file_upload_date="2024-05-01 10:00:00+00:00", captured_at="2024-05-10T18:00:00"),
+        FileMetadata(group_id="images", file_id="next-day", file_name="next-day.jpg",
+                     file_upload_date="2024-05-01 10:00:00+00:00", captured_at="2024-05-11"),
+    ])
+
+    def file_ids(**params):
+        response = test_client.get("/metadata/images", params=params)
+        return [item["file_id"] for item in response.json()["items"]]
+
+    # 01:30 in Athens is still the 9th in UTC
+    assert file_ids(captured_from="2024-05-10") == ["evening", "next-day"]
+    assert file_ids(captured_to="2024-05-10") == ["athens", "evening"]
+    assert file_ids(captured_from="2024-05-10T20:00:00+02:00", captured_to="2024-05-11") == ["evening", "next-day"]
+    assert test_client.get("/metadata/images/athens").json()["captured_at"] == "2024-05-09T22:30:00+00:00"
+    assert test_client.get("/metadata/images", params={"captured_to": "last week"}).status_code == 400
+
+
+def test_capture_times_in_zulu_form(test_client):
+    """
+    Test that times ending in `Z`, as sent by browsers, are read as UTC whatever the Python version.
+    """
+    assert utc_timestamp("2024-05-01T00:00:00Z") == "2024-05-01T00:00:00+00:00"
+    assert utc_timestamp("2024-05-01t23:59:59.500z") == "2024-05-01T23:59:59.500000+00:00"
+
+    FileMetadata(group_id="images", file_id="browser", file_name="browser.jpg",
+                 file_upload_date="2024-05-01 10:00:00+00:00", captured_at="2024-05-10T06:00:00.000Z").save()
+    assert FileMetadata.get("browser").captured_at == "2024-05-10T06:00:00+00:00"
+
+    response = test_client.get("/metadata/images", params={"captured_from": "2024-05-10T05:00:00Z",
+                                                            "captured_to": "2024-05-10T07:00:00Z"})
+    assert response.status_code == 200
+    assert [item["file_id"] for item in response.json()["items"]] == ["browser"]
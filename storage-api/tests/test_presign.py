@@ -0,0 +1,255 @@
+"""
+Tests for direct uploads and downloads through presigned S3 URLs.
+"""
+
+import json
+import base64
+import asyncio
+import hashlib
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+
+import presign
+from main import app
+from models import FileMetadata
+from storage import S3Storage, get_storage
+
+GROUP_ID = "images"
+
+
+def _not_found(operation):
+    return ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, operation)
+
+
+@pytest.fixture
+def s3_storage(monkeypatch):
+    """
+    Fixture to run the application against S3 storage with a mock client, whose objects are
+    listed in `objects` by key and size, and to record RO-Crate entries instead of writing them.
+    """
+    s3 = MagicMock()
+    s3.objects = {}
+    s3.generate_presigned_url.side_effect = (
+        lambda operation, Params, ExpiresIn: f"https://s3.test/{Params['Key']}?op={operation}"
+                                             f"&part={Params.get('PartNumber', '')}&expires={ExpiresIn}"
+    )
+    s3.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+    s3.list_objects_v2.return_value = {"Contents": [], "IsTruncated": False}
+
+    def head_object(Bucket, Key):
+        if Key not in s3.objects:
+            raise _not_found("HeadObject")
+        return {"ContentLength": s3.objects[Key], "ETag": '"etag"',
+                "LastModified": datetime.now(timezone.utc), "ContentType": "image/png"}
+    s3.head_object.side_effect = head_object
+    s3.copy_object.side_effect = lambda Bucket, Key, CopySource: s3.objects.update({Key: s3.objects[CopySource["Key"]]})
+    s3.delete_object.side_effect = lambda Bucket, Key: s3.objects.pop(Key, None)
+
+    crates = []
+
+    async def create_ro_crate(group_id, file_metadata, storage):
+        crates.append((group_id, file_metadata["file_id"]))
+    monkeypatch.setattr(presign, "create_ro_crate", create_ro_crate)
+    s3.crates = crates
+
+    storage = S3Storage(s3, "bucket", "https://s3.test")
+    app.dependency_overrides[get_storage] = lambda: storage
+    yield s3
+    app.dependency_overrides.pop(get_storage, None)
+
+
+def test_presigned_upload(test_client, s3_storage):
+    """
+    Test that a small file gets a single presigned PUT URL, and is recorded once completed.
+    """
+    response = test_client.post("/presign/upload", data={
+        "file_name": "photo.png", "content_type": "image/png", "size": "10", "media_type": GROUP_ID})
+    assert response.status_code == 200
+    upload = response.json()
+    assert upload["multipart"] is False
+    assert upload["file_key"] == f"{GROUP_ID}/{upload['file_id']}.png"
+    assert upload["url"].startswith(f"https://s3.test/{upload['file_key']}?op=put_object")
+    assert upload["headers"] == {"Content-Type": "image/png"}
+    s3_storage.generate_presigned_url.assert_called_with(
+        "put_object", Params={"Bucket": "bucket", "Key": upload["file_key"], "ContentType": "image/png"},
+        ExpiresIn=presign.PRESIGN_EXPIRES)
+
+    # Completing before the content is uploaded fails, and the upload stays pending
+    response = test_client.post(f"/presign/upload/{upload['upload_token']}/complete")
+    assert response.status_code == 400
+
+    s3_storage.objects[upload["file_key"]] = 10
+    response = test_client.post(f"/presign/upload/{upload['upload_token']}/complete")
+    assert response.status_code == 200
+    assert response.json()["file_metadata"]["file_size"] == 10
+    assert response.json()["deduplicated"] is False
+    file_metadata = FileMetadata.get(upload["file_id"])
+    assert file_metadata.file_key == upload["file_key"]
+    assert file_metadata.file_checksum is None
+    assert s3_storage.crates == [(GROUP_ID, upload["file_id"])]
+
+    # The upload is no longer pending once completed
+    response = test_client.post(f"/presign/upload/{upload['upload_token']}/complete")
+    assert response.status_code == 404
+
+
+def test_presigned_upload_with_digest(test_client, s3_storage, metadata_store):
+    """
+    Test that a file uploaded with its digest, which S3 checks, is stored as a blob and deduplicated.
+    """
+    sha256 = hashlib.sha256(b"photo").hexdigest()
+    checksum = base64.b64encode(hashlib.sha256(b"photo").digest()).decode()
+    uploads = []
+    for file_id in ("photo-1", "photo-2"):
+        upload = test_client.post("/presign/upload", data={
+            "file_name": "photo.png", "content_type": "image/png", "size": "5", "uuid": file_id,
+            "sha256": sha256, "media_type": GROUP_ID}).json()
+        assert upload["headers"] == {"Content-Type": "image/png", "x-amz-checksum-sha256": checksum}
+        assert s3_storage.generate_presigned_url.call_args.kwargs["Params"]["ChecksumSHA256"] == checksum
+        s3_storage.objects[upload["file_key"]] = 5
+        uploads.append(test_client.post(f"/presign/upload/{upload['upload_token']}/complete").json())
+
+    assert [upload["deduplicated"] for upload in uploads] == [False, True]
+    assert uploads[1]["file_path"] == f"s3://bucket/{GROUP_ID}/photo-1.png"
+    assert FileMetadata.get("photo-2").file_checksum == f"sha256:{sha256}"
+    assert metadata_store.get_blob(sha256) == {"sha256": sha256, "blob_key": f"{GROUP_ID}/photo-1.png",
+                                               "size": 5, "refcount": 2}
+    assert f"{GROUP_ID}/photo-2.png" not in s3_storage.objects
+
+    response = test_client.post("/presign/upload", data={"file_name": "a.png", "sha256": "abc", "media_type": GROUP_ID})
+    assert response.status_code == 400
+
+
+def test_presigned_upload_keeps_blobs(test_client, s3_storage, metadata_store):
+    """
+    Test that a direct upload to a key holding a blob is staged, and the blob moved out of the way.
+    """
+    sha256 = hashlib.sha256(b"photo").hexdigest()
+    for file_id in ("photo-1", "photo-2"):
+        upload = test_client.post("/presign/upload", data={
+            "file_name": "photo.png", "size": "5", "uuid": file_id, "sha256": sha256, "media_type": GROUP_ID}).json()
+        s3_storage.objects[upload["file_key"]] = 5
+        test_client.post(f"/presign/upload/{upload['upload_token']}/complete")
+
+    # An edited photo-1, uploaded without its digest
+    upload = test_client.post("/presign/upload", data={
+        "file_name": "photo.png", "size": "6", "uuid": "photo-1", "media_type": GROUP_ID}).json()
+    assert upload["file_key"] == f"{GROUP_ID}/photo-1.png"
+    staged_key = upload["url"].split("/", 3)[3].split("?")[0]
+    assert staged_key.startswith("blobs/incoming/")
+    s3_storage.objects[staged_key] = 6
+    response = test_client.post(f"/presign/upload/{upload['upload_token']}/complete")
+    assert response.status_code == 200
+
+    blob_key = f"blobs/{sha256[:2]}/{sha256}"
+    assert s3_storage.objects == {f"{GROUP_ID}/photo-1.png": 6, blob_key: 5}
+    assert metadata_store.get_blob(sha256)["blob_key"] == blob_key
+    assert metadata_store.get_blob(sha256)["refcount"] == 1
+    assert FileMetadata.get("photo-1").file_checksum is None
+
+    # Deleting either file leaves the other's content
+    assert test_client.delete(f"/{GROUP_ID}/photo-1").status_code == 200
+    assert s3_storage.objects == {blob_key: 5}
+    assert test_client.delete(f"/{GROUP_ID}/photo-2").status_code == 200
+    assert s3_storage.objects == {}
+
+
+def test_concurrent_completions_record_once(test_client, s3_storage):
+    """
+    Test that an upload completed by concurrent requests is recorded by one of them.
+    """
+    upload = test_client.post("/presign/upload", data={"file_name": "photo.png", "media_type": GROUP_ID}).json()
+    s3_storage.objects[upload["file_key"]] = 10
+    storage = S3Storage(s3_storage, "bucket", "https://s3.test")
+
+    async def complete_twice():
+        return await asyncio.gather(*[presign.complete_direct_upload(storage, upload["upload_token"]) for _ in range(2)])
+
+    results = asyncio.run(complete_twice())
+    assert sorted(result is None for result in results) == [False, True]
+    assert s3_storage.crates == [(GROUP_ID, upload["file_id"])]
+
+
+def test_presigned_upload_size_mismatch(test_client, s3_storage):
+    """
+    Test that an upload whose size differs from the declared size is not recorded.
+    """
+    upload = test_client.post("/presign/upload", data={
+        "file_name": "photo.png", "size": "10", "media_type": GROUP_ID}).json()
+    s3_storage.objects[upload["file_key"]] = 11
+    response = test_client.post(f"/presign/upload/{upload['upload_token']}/complete")
+    assert response.status_code == 400
+    assert FileMetadata.get(upload["file_id"]) is None
+
+
+def test_presigned_multipart_upload(test_client, s3_storage, monkeypatch):
+    """
+    Test that a large file gets a presigned URL per part, and is completed from the part ETags.
+    """
+    monkeypatch.setattr(presign, "PRESIGN_MULTIPART_THRESHOLD", 10)
+    monkeypatch.setattr(presign, "PART_SIZE", 8)
+    upload = test_client.post("/presign/upload", data={
+        "file_name": "scan.tif", "size": "20", "media_type": GROUP_ID}).json()
+    assert upload["multipart"] is True
+    assert upload["part_size"] == 8
+    assert [(part["part_number"], part["size"]) for part in upload["parts"]] == [(1, 8), (2, 8), (3, 4)]
+    assert "op=upload_part&part=2" in upload["parts"][1]["url"]
+
+    # The ETags of every part are required
+    response = test_client.post(f"/presign/upload/{upload['upload_token']}/complete")
+    assert response.status_code == 400
+
+    s3_storage.objects[upload["file_key"]] = 20
+    parts = [{"PartNumber": number, "ETag": f'"etag-{number}"'} for number in (3, 1, 2)]
+    response = test_client.post(f"/presign/upload/{upload['upload_token']}/complete",
+                                data={"parts": json.dumps(parts)})
+    assert response.status_code == 200
+    s3_storage.complete_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key=upload["file_key"], UploadId="upload-1",
+        MultipartUpload={"Parts": sorted(parts, key=lambda part: part["PartNumber"])})
+
+
+def test_expire_direct_uploads(test_client, s3_storage, metadata_store, monkeypatch):
+    """
+    Test that uploads not completed in time are aborted or deleted.
+    """
+    monkeypatch.setattr(presign, "PRESIGN_MULTIPART_THRESHOLD", 10)
+    single = test_client.post("/presign/upload", data={"file_name": "a.png", "media_type": GROUP_ID}).json()
+    multi = test_client.post("/presign/upload", data={"file_name": "b.png", "size": "20", "media_type": GROUP_ID}).json()
+    monkeypatch.setattr(presign.time, "time", lambda: 1e12)
+    asyncio.run(presign.expire_direct_uploads(S3Storage(s3_storage, "bucket")))
+
+    s3_storage.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key=multi["file_key"], UploadId="upload-1")
+    s3_storage.delete_object.assert_called_once_with(Bucket="bucket", Key=single["file_key"])
+    assert metadata_store.get_pending_upload(single["upload_token"]) is None
+    assert metadata_store.get_pending_upload(multi["upload_token"]) is None
+
+
+def test_presigned_download(test_client, s3_storage):
+    """
+    Test that a presigned download URL is returned, or redirected to.
+    """
+    s3_storage.objects[f"{GROUP_ID}/photo.png"] = 10
+    response = test_client.get(f"/presign/download/{GROUP_ID}/photo.png")
+    assert response.status_code == 200
+    assert response.json()["url"].startswith(f"https://s3.test/{GROUP_ID}/photo.png?op=get_object")
+    params = s3_storage.generate_presigned_url.call_args.kwargs["Params"]
+    assert params["ResponseContentDisposition"] == 'attachment; filename="photo.png"'
+    assert params["ResponseContentType"] == "image/png"
+
+    response = test_client.get(f"/presign/download/{GROUP_ID}/photo.png?redirect=true", follow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"].startswith("https://s3.test/")
+
+    assert test_client.get(f"/presign/download/{GROUP_ID}/missing.png").status_code == 404
+
+
+def test_presigned_urls_require_s3(test_client, local_storage):
+    """
+    Test that presigned URLs are refused for the local storage backend.
+    """
+    response = test_client.post("/presign/upload", data={"file_name": "a.png", "media_type": GROUP_ID})
+    assert response.status_code == 400
+    assert "S3" in response.json()["detail"]
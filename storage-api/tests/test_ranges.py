@@ -0,0 +1,173 @@
+"""
+Tests for range and conditional requests on the download endpoint.
+"""
+
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+from main import app
+from storage import S3Storage, get_storage
+from ranges import parse_range_header, format_http_date, RangeNotSatisfiable
+
+CONTENT = b"0123456789abcdefghij"
+
+
+def test_parse_range_header():
+    """
+    Test parsing of single, open-ended, suffix, merged and invalid ranges.
+    """
+    assert parse_range_header("bytes=0-4", 20) == [(0, 4)]
+    assert parse_range_header("bytes=15-", 20) == [(15, 19)]
+    assert parse_range_header("bytes=-5", 20) == [(15, 19)]
+    assert parse_range_header("bytes=10-100", 20) == [(10, 19)]
+    assert parse_range_header("bytes=0-4,3-8,15-16", 20) == [(0, 8), (15, 16)]
+    assert parse_range_header(None, 20) is None
+    assert parse_range_header("bytes=5-1", 20) is None
+    assert parse_range_header("items=0-4", 20) is None
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header("bytes=20-30", 20)
+
+
+@pytest.fixture
+def local_file(local_storage, tmp_path):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "file.bin").write_bytes(CONTENT)
+    return "/download/images/file.bin"
+
+
+def test_format_http_date():
+    """
+    Test formatting dates in any time zone as HTTP dates.
+    """
+    from dateutil.tz import tzutc
+    assert format_http_date(datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)) == "Wed, 01 May 2024 12:00:00 GMT"
+    assert format_http_date(datetime(2024, 5, 1, 12, 0, tzinfo=tzutc())) == "Wed, 01 May 2024 12:00:00 GMT"
+
+
+def test_download_local(test_client, local_file):
+    """
+    Test that a full download sends the length and validators.
+    """
+    response = test_client.get(local_file)
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["content-length"] == str(len(CONTENT))
+    assert response.headers["accept-ranges"] == "bytes"
+    assert "etag" in response.headers
+    assert "last-modified" in response.headers
+
+
+def test_download_local_not_found(test_client, local_file):
+    """
+    Test that a missing file is reported as not found.
+    """
+    response = test_client.get("/download/images/idonotexist.bin")
+
+    assert response.status_code == 404
+
+
+def test_download_local_conditional(test_client, local_file):
+    """
+    Test that unchanged files are answered with 304 Not Modified.
+    """
+    first = test_client.get(local_file)
+
+    by_etag = test_client.get(local_file, headers={"If-None-Match": first.headers["etag"]})
+    by_date = test_client.get(local_file, headers={"If-Modified-Since": first.headers["last-modified"]})
+    changed = test_client.get(local_file, headers={"If-None-Match": '"other"'})
+
+    assert by_etag.status_code == 304
+    assert by_etag.content == b""
+    assert by_date.status_code == 304
+    assert changed.status_code == 200
+
+
+def test_download_local_single_range(test_client, local_file):
+    """
+    Test that a single range is answered with 206 Partial Content.
+    """
+    response = test_client.get(local_file, headers={"Range": "bytes=5-9"})
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[5:10]
+    assert response.headers["content-range"] == f"bytes 5-9/{len(CONTENT)}"
+    assert response.headers["content-length"] == "5"
+
+
+def test_download_local_multiple_ranges(test_client, local_file):
+    """
+    Test that several ranges are answered with a multipart/byteranges body.
+    """
+    response = test_client.get(local_file, headers={"Range": "bytes=0-1,10-11"})
+
+    assert response.status_code == 206
+    assert response.headers["content-type"].startswith("multipart/byteranges; boundary=")
+    assert response.headers["content-length"] == str(len(response.content))
+    assert b"Content-Range: bytes 0-1/20\r\n\r\n01\r\n" in response.content
+    assert b"Content-Range: bytes 10-11/20\r\n\r\nab\r\n" in response.content
+
+
+def test_download_local_range_not_satisfiable(test_client, local_file):
+    """
+    Test that a range outside the file is answered with 416.
+    """
+    response = test_client.get(local_file, headers={"Range": "bytes=100-200"})
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+
+def test_download_s3_range(test_client):
+    """
+    Test that a range request is mapped to a ranged S3 GET.
+    """
+    mock_s3 = MagicMock()
+    mock_s3.head_object.return_value = {
+        "ContentLength": len(CONTENT),
+        "ContentType": "application/octet-stream",
+        "ETag": '"abc"',
+        "LastModified": datetime(2024, 1, 1, tzinfo=timezone.utc),
+    }
+    mock_s3.get_object.return_value = {"Body": MagicMock(iter_chunks=lambda size: iter([CONTENT[2:6]]))}
+    app.dependency_overrides[get_storage] = lambda: S3Storage(mock_s3, "bucket")
+
+    try:
+        response = test_client.get("/download/images/file.bin", headers={"Range": "bytes=2-5"})
+        cached = test_client.get("/download/images/file.bin", headers={"If-None-Match": '"abc"'})
+    finally:
+        app.dependency_overrides.pop(get_storage, None)
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[2:6]
+    assert mock_s3.get_object.call_args.kwargs["Range"] == "bytes=2-5"
+    assert cached.status_code == 304
+    assert mock_s3.get_object.call_count == 1
+
+
+def test_download_s3_full(test_client):
+    """
+    Test that a request without a range reads the whole S3 object without a Range header, even when empty.
+    """
+    mock_s3 = MagicMock()
+    mock_s3.head_object.return_value = {
+        "ContentLength": len(CONTENT),
+        "ContentType": "application/octet-stream",
+        "ETag": '"abc"',
+        "LastModified": datetime(2024, 1, 1, tzinfo=timezone.utc),
+    }
+    mock_s3.get_object.return_value = {"Body": MagicMock(iter_chunks=lambda size: iter([CONTENT]))}
+    app.dependency_overrides[get_storage] = lambda: S3Storage(mock_s3, "bucket")
+
+    try:
+        response = test_client.get("/download/images/file.bin")
+        mock_s3.head_object.return_value = {**mock_s3.head_object.return_value, "ContentLength": 0}
+        mock_s3.get_object.return_value = {"Body": MagicMock(iter_chunks=lambda size: iter([]))}
+        empty = test_client.get("/download/images/empty.bin")
+    finally:
+        app.dependency_overrides.pop(get_storage, None)
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert empty.status_code == 200 and empty.content == b""
+    assert all("Range" not in call.kwargs for call in mock_s3.get_object.call_args_list)
@@ -0,0 +1,202 @@
+"""
+Tests for resumable upload sessions.
+"""
+
+import asyncio
+import hashlib
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+
+import resumable
+from main import app
+from database import get_store
+from models import FileMetadata
+from storage import S3Storage, get_storage
+
+GROUP_ID = "images"
+CONTENT = b"0123456789abcdefghij"
+
+
+@pytest.fixture(autouse=True)
+def session_dir(tmp_path, monkeypatch):
+    """
+    Fixture to stage resumable uploads in a temporary directory.
+    """
+    directory = tmp_path / "sessions"
+    monkeypatch.setattr(resumable, "UPLOAD_SESSION_DIR", str(directory))
+    yield directory
+
+
+def _create(test_client, **fields):
+    response = test_client.post("/uploads", data={"file_name": "photo.png", "content_type": "image/png",
+                                                  "media_type": GROUP_ID, **fields})
+    assert response.status_code == 201
+    assert response.headers["location"] == f"/uploads/{response.json()['session_id']}"
+    return response.json()
+
+
+def _patch(test_client, session_id, offset, content):
+    return test_client.patch(f"/uploads/{session_id}", content=content, headers={"Upload-Offset": str(offset)})
+
+
+def test_resumable_upload(test_client, local_storage, session_dir):
+    """
+    Test that content sent in several requests is stored and recorded as one upload.
+    """
+    session = _create(test_client, size=str(len(CONTENT)))
+    session_id = session["session_id"]
+    response = _patch(test_client, session_id, 0, CONTENT[:8])
+    assert response.status_code == 204
+    assert response.headers["upload-offset"] == "8"
+
+    # The offset is reported to resume from, and requests from another offset are refused
+    response = test_client.head(f"/uploads/{session_id}")
+    assert response.headers["upload-offset"] == "8"
+    assert response.headers["upload-length"] == str(len(CONTENT))
+    response = _patch(test_client, session_id, 4, CONTENT[4:])
+    assert response.status_code == 409
+    assert response.headers["upload-offset"] == "8"
+
+    # Finishing before all the content is received fails
+    assert test_client.post(f"/uploads/{session_id}/complete").status_code == 400
+
+    assert _patch(test_client, session_id, 8, CONTENT[8:]).status_code == 204
+    response = test_client.post(f"/uploads/{session_id}/complete")
+    assert response.status_code == 200
+    file_metadata = response.json()["file_metadata"]
+    assert file_metadata["file_size"] == len(CONTENT)
+    assert file_metadata["file_checksum"] == f"sha256:{hashlib.sha256(CONTENT).hexdigest()}"
+
+    response = test_client.get(f"/download/{GROUP_ID}/{session['file_id']}.png")
+    assert response.content == CONTENT
+    assert FileMetadata.get(session["file_id"]).file_size == len(CONTENT)
+    assert test_client.get(f"/uploads/{session_id}").status_code == 404
+    assert list(session_dir.iterdir()) == []
+
+
+def test_resumable_upload_again_releases_earlier_version(test_client, local_storage, tmp_path):
+    """
+    Test that a file uploaded again in a session drops the reference of its earlier content.
+    """
+    for content in (b"earlier", CONTENT):
+        session = _create(test_client, uuid="photo-1", size=str(len(content)))
+        _patch(test_client, session["session_id"], 0, content)
+        assert test_client.post(f"/uploads/{session['session_id']}/complete").status_code == 200
+
+    earlier = hashlib.sha256(b"earlier").hexdigest()
+    assert get_store().get_blob(earlier) is None
+    assert not (tmp_path / "blobs" / earlier[:2] / earlier).exists()
+    assert test_client.get(f"/download/{GROUP_ID}/photo-1.png").content == CONTENT
+
+
+def test_resumable_upload_keeps_received_bytes(test_client, local_storage):
+    """
+    Test that the bytes received before a stream fails are kept, and the upload resumes after them.
+    """
+    session = _create(test_client)
+
+    async def dropped():
+        yield CONTENT[:5]
+        raise ConnectionError("Connection dropped")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(resumable.append_to_session(local_storage, session["session_id"], 0, dropped()))
+    assert test_client.get(f"/uploads/{session['session_id']}").json()["offset"] == 5
+
+    assert _patch(test_client, session["session_id"], 5, CONTENT[5:]).status_code == 204
+    assert test_client.post(f"/uploads/{session['session_id']}/complete").status_code == 200
+    assert test_client.get(f"/download/{GROUP_ID}/{session['file_id']}.png").content == CONTENT
+
+
+def test_resumable_upload_beyond_size(test_client, local_storage):
+    """
+    Test that content beyond the declared size is refused.
+    """
+    session = _create(test_client, size="4")
+    assert _patch(test_client, session["session_id"], 0, CONTENT).status_code == 413
+    assert test_client.get(f"/uploads/{session['session_id']}").json()["offset"] == 0
+
+
+def test_resumable_upload_to_s3_parts(test_client, monkeypatch, session_dir):
+    """
+    Test that full parts are sent on to a multipart upload as they are received.
+    """
+    monkeypatch.setattr(resumable, "PART_SIZE", 8)
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+    s3.upload_part.side_effect = lambda **kwargs: {"ETag": f'"{hashlib.md5(kwargs["Body"]).hexdigest()}"'}
+    s3.head_object.return_value = {"ContentLength": len(CONTENT), "LastModified": datetime.now(timezone.utc)}
+    s3.get_object.side_effect = ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+    s3.list_objects_v2.return_value = {"Contents": [], "IsTruncated": False}
+    app.dependency_overrides[get_storage] = lambda: S3Storage(s3, "bucket", "https://s3.test")
+    try:
+        session = _create(test_client)
+        assert _patch(test_client, session["session_id"], 0, CONTENT[:6]).status_code == 204
+        assert s3.upload_part.call_count == 0
+        assert _patch(test_client, session["session_id"], 6, CONTENT[6:18]).status_code == 204
+        assert [call.kwargs["Body"] for call in s3.upload_part.call_args_list] == [CONTENT[:8], CONTENT[8:16]]
+        # Only the tail that does not fill a part is staged
+        staged = sorted(path.name for path in session_dir.iterdir() if path.suffix != ".lock")
+        assert staged == [f"{session['session_id']}.16"]
+
+        assert _patch(test_client, session["session_id"], 18, CONTENT[18:]).status_code == 204
+        response = test_client.post(f"/uploads/{session['session_id']}/complete")
+        assert response.status_code == 200
+        assert response.json()["deduplicated"] is False
+        assert s3.upload_part.call_args.kwargs["Body"] == CONTENT[16:]
+        completed = s3.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"]
+        assert [part["PartNumber"] for part in completed] == [1, 2, 3]
+        assert FileMetadata.get(session["file_id"]).file_checksum is None
+    finally:
+        app.dependency_overrides.pop(get_storage, None)
+
+
+def test_resumable_upload_to_s3_keeps_blobs(test_client, metadata_store, monkeypatch):
+    """
+    Test that a multipart upload to a key holding a blob is staged, and the blob moved out of the way.
+    """
+    monkeypatch.setattr(resumable, "PART_SIZE", 8)
+    file_key = f"{GROUP_ID}/photo-1.png"
+    sha256 = hashlib.sha256(b"shared").hexdigest()
+    metadata_store.acquire_blob(sha256, file_key, 6)
+    metadata_store.acquire_blob(sha256, file_key, 6)
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+    s3.upload_part.side_effect = lambda **kwargs: {"ETag": '"etag"'}
+    s3.head_object.return_value = {"ContentLength": len(CONTENT), "LastModified": datetime.now(timezone.utc)}
+    s3.get_object.side_effect = ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+    s3.list_objects_v2.return_value = {"Contents": [], "IsTruncated": False}
+    app.dependency_overrides[get_storage] = lambda: S3Storage(s3, "bucket", "https://s3.test")
+    try:
+        session = _create(test_client, uuid="photo-1")
+        staged_key = s3.create_multipart_upload.call_args.kwargs["Key"]
+        assert session["file_key"] == file_key
+        assert staged_key.startswith("blobs/incoming/")
+        _patch(test_client, session["session_id"], 0, CONTENT)
+        assert test_client.post(f"/uploads/{session['session_id']}/complete").status_code == 200
+    finally:
+        app.dependency_overrides.pop(get_storage, None)
+
+    assert s3.complete_multipart_upload.call_args.kwargs["Key"] == staged_key
+    moves = [(call.kwargs["CopySource"]["Key"], call.kwargs["Key"]) for call in s3.copy_object.call_args_list]
+    assert moves == [(file_key, f"blobs/{sha256[:2]}/{sha256}"), (staged_key, file_key)]
+    assert metadata_store.get_blob(sha256)["blob_key"] == f"blobs/{sha256[:2]}/{sha256}"
+    assert FileMetadata.get("photo-1").file_key == file_key
+
+
+def test_cancel_and_expire_upload_sessions(test_client, local_storage, session_dir, monkeypatch):
+    """
+    Test that cancelled and stale sessions are removed with their staged content.
+    """
+    cancelled = _create(test_client)
+    assert test_client.delete(f"/uploads/{cancelled['session_id']}").status_code == 204
+    assert test_client.get(f"/uploads/{cancelled['session_id']}").status_code == 404
+
+    stale = _create(test_client)
+    _patch(test_client, stale["session_id"], 0, CONTENT)
+    monkeypatch.setattr(resumable, "UPLOAD_SESSION_TTL", -1)
+    asyncio.run(resumable.expire_sessions(local_storage))
+    assert test_client.get(f"/uploads/{stale['session_id']}").status_code == 404
+    assert list(session_dir.iterdir()) == []
@@ -0,0 +1,58 @@
+"""
+Tests for the lazy imports and startup timing of the workers.
+"""
+
+import sys
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import startup
+import storage
+import database
+
+
+def test_heavy_dependencies_are_not_imported_with_the_app():
+    """
+    Test that importing the application loads neither rocrate nor boto3.
+    """
+    code = "import sys, main; print(sorted(name for name in ('rocrate', 'boto3') if name in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            env={"STORAGE_TYPE": "S3", "METADATA_DB_URL": "sqlite:///:memory:"}, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+def test_warm_up_records_its_duration(monkeypatch, tmp_path):
+    """
+    Test that warming up loads rocrate, creates the storage backend and records how long it took.
+    """
+    monkeypatch.setattr(storage, "STORAGE_TYPE", "local")
+    monkeypatch.setattr(storage, "STORAGE_PATH", str(tmp_path))
+    monkeypatch.setattr(storage, "_backend", None)
+
+    startup.warm_up()
+
+    assert "rocrate.rocrate" in sys.modules
+    assert isinstance(storage._backend, storage.LocalStorage)
+    assert startup.stats()["warmup"] > 0
+
+
+def test_metadata_store_is_created_once(monkeypatch):
+    """
+    Test that threads asking for the metadata store at the same time share a single store.
+    """
+    created = []
+
+    class SlowStore:
+        def __init__(self, url):
+            time.sleep(0.05)
+            created.append(url)
+
+    monkeypatch.setattr(database, "MetadataStore", SlowStore)
+    database.set_store(None)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        stores = list(pool.map(lambda _: database.get_store(), range(8)))
+
+    assert len(created) == 1
+    assert all(store is stores[0] for store in stores)
@@ -0,0 +1,127 @@
+"""
+Tests for the storage backends.
+"""
+
+import asyncio
+import pytest
+from unittest.mock import MagicMock
+from storage import LocalStorage, S3Storage, PreconditionFailed
+
+
+async def _chunks(parts):
+    for part in parts:
+        yield part
+
+
+async def _collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_local_storage(tmp_path):
+    """
+    Test storing, reading, listing and deleting objects in local storage.
+    """
+    storage = LocalStorage(str(tmp_path))
+
+    stored = asyncio.run(storage.put("images/a.jpg", _chunks([b"abc", b"def"])))
+    asyncio.run(storage.write("images/b.jpg", b"xyz"))
+    asyncio.run(storage.write("documents/c.pdf", b"pdf"))
+
+    assert stored["size"] == 6
+    assert asyncio.run(storage.read("images/a.jpg")) == b"abcdef"
+    assert b"".join(asyncio.run(_collect(storage.get("images/a.jpg", 2, 3)))) == b"cd"
+    assert asyncio.run(storage.head("images/a.jpg")).size == 6
+    assert asyncio.run(storage.head("images/missing.jpg")) is None
+    assert asyncio.run(storage.read("images/missing.jpg")) is None
+    assert [info.key for info in asyncio.run(_collect(storage.list("images/")))] == ["images/a.jpg", "images/b.jpg"]
+
+    asyncio.run(storage.delete("images/a.jpg"))
+    asyncio.run(storage.delete("images/a.jpg"))
+    assert asyncio.run(storage.head("images/a.jpg")) is None
+
+
+def test_local_storage_rejects_paths_outside_root(tmp_path):
+    """
+    Test that keys cannot escape the storage root.
+    """
+    storage = LocalStorage(str(tmp_path / "files"))
+
+    with pytest.raises(ValueError):
+        asyncio.run(storage.head("../secret.txt"))
+
+
+def test_s3_storage_list_pages():
+    """
+    Test that listing an S3 prefix follows continuation tokens.
+    """
+    mock_s3 = MagicMock()
+    mock_s3.list_objects_v2.side_effect = [
+        {"Contents": [{"Key": "images/a.jpg", "Size": 1}], "IsTruncated": True, "NextContinuationToken": "next"},
+        {"Contents": [{"Key": "images/b.jpg", "Size": 2}], "IsTruncated": False},
+    ]
+    storage = S3Storage(mock_s3, "bucket")
+
+    keys = [info.key for info in asyncio.run(_collect(storage.list("images/")))]
+
+    assert keys == ["images/a.jpg", "images/b.jpg"]
+    assert mock_s3.list_objects_v2.call_args.kwargs["ContinuationToken"] == "next"
+
+
+class AsyncS3Client:
+    """
+    Minimal stand-in for an aiobotocore client, whose calls are coroutines.
+    """
+    def __init__(self, objects):
+        self.objects = objects
+        self.calls = []
+
+    async def _make_api_call(self, operation, kwargs):
+        self.calls.append(operation)
+        if operation == "HeadObject":
+            return {"ContentLength": len(self.objects[kwargs["Key"]])}
+        if operation == "CopyObject":
+            self.objects[kwargs["Key"]] = self.objects[kwargs["CopySource"]["Key"]]
+        if operation == "DeleteObject":
+            self.objects.pop(kwargs["Key"], None)
+        return {}
+
+    def head_object(self, **kwargs):
+        return self._make_api_call("HeadObject", kwargs)
+
+    def copy_object(self, **kwargs):
+        return self._make_api_call("CopyObject", kwargs)
+
+    def delete_object(self, **kwargs):
+        return self._make_api_call("DeleteObject", kwargs)
+
+
+def test_s3_storage_async_client():
+    """
+    Test that the calls of an async S3 client are awaited rather than run on threads.
+    """
+    client = AsyncS3Client({"blobs/incoming/a": b"abc"})
+    storage = S3Storage(client, "bucket")
+
+    asyncio.run(storage.move("blobs/incoming/a", "blobs/aa/a"))
+
+    assert client.objects == {"blobs/aa/a": b"abc"}
+    assert client.calls == ["HeadObject", "CopyObject", "DeleteObject"]
+
+
+def test_local_storage_conditional_write(tmp_path):
+    """
+    Test that conditional writes fail when the object changed or already exists.
+    """
+    storage = LocalStorage(str(tmp_path))
+
+    asyncio.run(storage.write("crate.json", b"v1", if_none_match=True))
+    etag = asyncio.run(storage.head("crate.json")).etag
+
+    with pytest.raises(PreconditionFailed):
+        asyncio.run(storage.write("crate.json", b"other", if_none_match=True))
+    asyncio.run(storage.write("crate.json", b"v2", if_match=etag))
+    with pytest.raises(PreconditionFailed):
+        asyncio.run(storage.write("crate.json", b"v3", if_match=etag))
+
+    assert asyncio.run(storage.read("crate.json")) == b"v2"
+    assert [info.key for info in asyncio.run(_collect(storage.list()))] == ["crate.json"]
@@ -0,0 +1,67 @@
+"""
+Tests for the chunked streaming write path used for local storage.
+"""
+
+import os
+import asyncio
+import hashlib
+import pytest
+from streaming import write_stream_atomic
+from tests.conftest import FILE_NAME, FILE_PATH
+
+
+async def _chunks(parts):
+    for part in parts:
+        yield part
+
+
+def test_write_stream_atomic(tmp_path):
+    """
+    Test that a stream is written in full and hashed as it is written.
+    """
+    parts = [b"a" * 1000, b"b" * 1000, b"c" * 10]
+    dest_path = str(tmp_path / "images" / "file.bin")
+
+    size, checksum = asyncio.run(write_stream_atomic(_chunks(parts), dest_path))
+
+    content = b"".join(parts)
+    assert size == len(content)
+    assert checksum == hashlib.sha256(content).hexdigest()
+    with open(dest_path, "rb") as f:
+        assert f.read() == content
+    assert os.listdir(tmp_path / "images") == ["file.bin"]
+
+
+def test_write_stream_atomic_failure(tmp_path):
+    """
+    Test that a failed stream leaves neither a partial file nor a temporary file behind.
+    """
+    async def failing_chunks():
+        yield b"partial"
+        raise IOError("Connection lost")
+
+    dest_path = str(tmp_path / "images" / "file.bin")
+
+    with pytest.raises(IOError):
+        asyncio.run(write_stream_atomic(failing_chunks(), dest_path))
+
+    assert os.listdir(tmp_path / "images") == []
+
+
+def test_upload_file_local(test_client, setup_test_file, local_storage, tmp_path):
+    """
+    Test the file upload endpoint with local storage.
+    """
+    with open(FILE_PATH, "rb") as f:
+        response = test_client.post(
+            "/",
+            files={"file": (FILE_NAME, f, "text/plain")},
+            data={"uuid": "local-file", "media_type": "documents"}
+        )
+
+    assert response.status_code == 200
+    assert response.json()["file_path"] == "documents/local-file.txt"
+    file_metadata = response.json()["file_metadata"]
+    assert file_metadata["file_size"] == len(b"This is a test file.")
+    assert file_metadata["file_checksum"] == "sha256:" + hashlib.sha256(b"This is a test file.").hexdigest()
+    assert (tmp_path / "documents" / "local-file.txt").read_bytes() == b"This is a test file."
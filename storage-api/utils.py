@@ -2,45 +2,368 @@
 Utility functions for the File Storage API.
 
 This module provides utility functions for creating and updating RO-Crate metadata files.
+The metadata files are read and written through the configured storage backend.
+
+Each group keeps its RO-Crate as a compacted snapshot, `{group_id}/ro-crate-metadata.json`,
+and an append log of entity fragments, `{group_id}/ro-crate-log/{timestamp}-{file_id}.json`.
+Uploads only append their own fragment, so they cost the same however large the crate
+is and concurrent uploads to a group never overwrite each other. The crate is
+materialized from the snapshot and the newer log entries when it is read, and the log is
+folded into the snapshot in the background with a conditional write once
+CRATE_COMPACT_EVERY entries are waiting in it, counted from the storage listing so that
+the appends of every worker are seen.
+
+Materialized crates are kept in an in-process LRU cache together with their serialized
+JSON-LD, and revalidated before reuse against the snapshot ETag and the log entries
+listed after the snapshot's log position.
 """
 
+import os
 import json
-import io
-from rocrate.rocrate import ROCrate
-from rocrate.model.person import Person
-from config.aws_config import s3, BUCKET_NAME, ENDPOINT_URL
-from botocore.exceptions import ClientError
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from storage import StorageBackend, PreconditionFailed, get_storage
+from cache import LRUCache
+from metrics import CRATE_DURATION
+
+if TYPE_CHECKING:
+    from rocrate.rocrate import ROCrate
+
+
+logger = logging.getLogger(__name__)
+
+# Number of log entries waiting after which a group's log is compacted into its snapshot
+CRATE_COMPACT_EVERY = int(os.getenv("CRATE_COMPACT_EVERY", 100))
+# Log entries younger than this many seconds are left for the next compaction
+CRATE_COMPACT_GRACE = float(os.getenv("CRATE_COMPACT_GRACE", 30))
 
+# Number of materialized crates kept in memory, and seconds they are served without revalidation
+CRATE_CACHE_SIZE = int(os.getenv("CRATE_CACHE_SIZE", 128))
+CRATE_CACHE_TTL = float(os.getenv("CRATE_CACHE_TTL", 5))
 
-def get_ro_crate(crate_file_key):
+# Top-level key of the snapshot recording the last log entry folded into it
+LOG_POSITION = "_logPosition"
+
+# Contextual entities describing a file, whose IDs are made from the file's entity ID
+FILE_CONTEXT_ENTITIES = ("location", "vertex_count", "face_count")
+
+
+def file_context_id(file_entity_id: str, name: str) -> str:
     """
-    Retrieve the RO-Crate metadata from S3.
+    Build the ID of a contextual entity describing a file, such as the place it was captured at.
 
     Args:
-        crate_file_key (str): The S3 key for the RO-Crate metadata file.
+        file_entity_id (str): The ID of the file's entity.
+        name (str): The name of the entity, one of `FILE_CONTEXT_ENTITIES`.
 
     Returns:
-        ROCrate: The RO-Crate object, or None if the object is not found.
+        str: The ID `#{file_entity_id}-{name}`.
     """
-    try:
-        existing_crate_obj = s3.get_object(Bucket=BUCKET_NAME, Key=crate_file_key)
-        existing_crate_data = existing_crate_obj['Body'].read().decode('utf-8')
-        crate = ROCrate(json.loads(existing_crate_data))
-        return crate
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
-            return None
+    return f"#{file_entity_id}-{name}"
+
+# Compaction locks of the groups being compacted or rebuilt, with the number of tasks holding or waiting for each
+_compaction_locks = {}
+
+crate_cache = LRUCache(CRATE_CACHE_SIZE, CRATE_CACHE_TTL)
+# Log positions of the snapshots read by this worker, by group, with the snapshot ETag as version
+_log_positions = LRUCache(CRATE_CACHE_SIZE, CRATE_CACHE_TTL)
+
+
+class CachedCrate:
+    """
+    A materialized RO-Crate with its serialized JSON-LD.
+
+    Attributes:
+        crate (ROCrate): The parsed crate. It is shared between requests and must not be modified.
+        body (bytes): The JSON-LD generated from the crate, encoded as UTF-8.
+    """
+    __slots__ = ("crate", "body")
+
+    def __init__(self, crate: "ROCrate", body: bytes):
+        self.crate = crate
+        self.body = body
+
+
+def _rocrate() -> type:
+    """
+    Import the ROCrate class on first use, as the rocrate package is slow to import.
+    """
+    from rocrate.rocrate import ROCrate
+    return ROCrate
+
+
+def crate_key(group_id: str) -> str:
+    """
+    Get the storage key of the RO-Crate metadata snapshot of a group.
+    """
+    return f"{group_id}/ro-crate-metadata.json"
+
+
+def crate_log_prefix(group_id: str) -> str:
+    """
+    Get the storage prefix of the RO-Crate append log of a group.
+    """
+    return f"{group_id}/ro-crate-log/"
+
+
+def _new_crate_document(group_id: str, group_uri: str, file_metadata: dict) -> dict:
+    """
+    Generate the JSON-LD of an empty RO-Crate for a group.
+    """
+    crate = _rocrate()()
+    root_metadata = {
+        "@id": "./",
+        "identifier": group_id,
+        "name": f"Group {group_id}",
+        "description": f"RO-Crate for VTM object {group_id}",
+        "version": file_metadata['file_version'],
+        "url": group_uri,
+        "datePublished": file_metadata['file_upload_date']
+    }
+    crate.update_jsonld(root_metadata)
+    return crate.metadata.generate()
+
+
+def _apply_log_entry(document: dict, entry: dict):
+    """
+    Add or replace the entities of a log entry in a crate's JSON-LD graph, or remove
+    the files listed by a removal entry.
+    """
+    graph = document["@graph"]
+    removed = set(entry.get("removed_entity_ids", []))
+    if removed:
+        graph[:] = [entity for entity in graph if entity["@id"] not in removed]
+        root = next(entity for entity in graph if entity["@id"] == "./")
+        has_part = root.get("hasPart", [])
+        if isinstance(has_part, dict):
+            has_part = [has_part]
+        root["hasPart"] = [part for part in has_part if part.get("@id") not in removed]
+        return
+    positions = {entity["@id"]: index for index, entity in enumerate(graph)}
+    for entity in entry["entities"]:
+        if entity["@id"] in positions:
+            graph[positions[entity["@id"]]] = entity
         else:
-            raise
+            positions[entity["@id"]] = len(graph)
+            graph.append(entity)
+
+    root = graph[positions["./"]]
+    has_part = root.setdefault("hasPart", [])
+    if isinstance(has_part, dict):
+        has_part = root["hasPart"] = [has_part]
+    parts = {part.get("@id") for part in has_part}
+    # Batched entries list several files, single uploads name one
+    for file_entity_id in entry.get("file_entity_ids") or [entry["file_entity_id"]]:
+        if file_entity_id not in parts:
+            parts.add(file_entity_id)
+            has_part.append({"@id": file_entity_id})
 
 
-def create_ro_crate(group_id: str, file_metadata: dict):
+async def load_crate_document(group_id: str, storage: StorageBackend,
+                              before: Optional[str] = None) -> Tuple[Optional[dict], Optional[str], List[str]]:
     """
-    Create or update an RO-Crate metadata file for a group.
+    Materialize the JSON-LD of a group's RO-Crate from its snapshot and append log.
 
-    This function checks if an RO-Crate metadata file already exists for the given group in an S3 bucket.
-    If it exists, it updates the metadata with the provided file information. If it does not exist, it creates a new RO-Crate metadata file.
-    The updated or newly created RO-Crate metadata file is then uploaded to the S3 bucket.
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend): The storage backend.
+        before (str, optional): Only apply log entries whose keys sort before this key.
+
+    Returns:
+        tuple: The crate JSON-LD, or None if the group has no crate; the ETag of the
+            snapshot it is based on, or None; and the keys of the log entries applied to it.
+    """
+    snapshot_info = await storage.head(crate_key(group_id))
+    document = None
+    position = None
+    if snapshot_info is not None:
+        data = await storage.read(crate_key(group_id))
+        if data is not None:
+            document = json.loads(data.decode('utf-8'))
+            position = document.pop(LOG_POSITION, None)
+            _log_positions.put(group_id, position, snapshot_info.etag)
+
+    applied = []
+    async for info in storage.list(crate_log_prefix(group_id), start_after=position):
+        if before is not None and info.key >= before:
+            break
+        data = await storage.read(info.key)
+        if data is None:
+            # Deleted by a concurrent compaction, which has folded it into a newer snapshot
+            continue
+        entry = json.loads(data.decode('utf-8'))
+        if document is None:
+            document = _new_crate_document(group_id, entry["group_uri"], entry["file_metadata"])
+        _apply_log_entry(document, entry)
+        applied.append(info.key)
+
+    return document, snapshot_info.etag if snapshot_info else None, applied
+
+
+def _version(snapshot_etag: Optional[str], log_keys: List[str]) -> tuple:
+    """
+    Build the fingerprint of a crate from its snapshot ETag and the keys of the log entries after the snapshot.
+    """
+    return (snapshot_etag, len(log_keys), log_keys[-1] if log_keys else None)
+
+
+async def crate_version(group_id: str, storage: StorageBackend) -> Optional[tuple]:
+    """
+    Get a cheap fingerprint of a group's RO-Crate without reading it.
+
+    The fingerprint is made from the ETag of the snapshot and the log entries after the
+    snapshot's log position, which change whenever an entry is appended or the log is
+    compacted. Only the entries that compaction has not folded yet are listed. If the
+    snapshot was replaced since this worker last read it, its log position is not known
+    and the fingerprint matches no crate materialized before.
+
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend): The storage backend.
+
+    Returns:
+        tuple: The fingerprint, or None if the group has no crate.
+    """
+    snapshot_info = await storage.head(crate_key(group_id))
+    position = None
+    if snapshot_info is not None:
+        known = _log_positions.get(group_id)
+        if known is None or known.version != snapshot_info.etag:
+            return (snapshot_info.etag, None, None)
+        position = known.value
+    log_keys = [info.key async for info in storage.list(crate_log_prefix(group_id), start_after=position)]
+    if snapshot_info is None and not log_keys:
+        return None
+    return _version(snapshot_info.etag if snapshot_info else None, log_keys)
+
+
+async def get_crate_metadata(group_id: str, storage: StorageBackend = None) -> Optional[CachedCrate]:
+    """
+    Get a group's materialized RO-Crate and its serialized JSON-LD, from the cache if it is current.
+
+    Entries younger than CRATE_CACHE_TTL seconds are served directly. Older entries are
+    revalidated with `crate_version`, and only rebuilt if the crate has changed.
+
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend, optional): The storage backend. Defaults to the configured backend.
+
+    Returns:
+        CachedCrate: The crate and its JSON-LD, or None if the group has no crate.
+    """
+    storage = storage or get_storage()
+    key = crate_key(group_id)
+    entry = crate_cache.get(key)
+    if entry is not None and entry.age() < crate_cache.ttl:
+        crate_cache.hits += 1
+        return entry.value
+
+    if entry is not None and entry.version == await crate_version(group_id, storage):
+        entry.validated_at = time.monotonic()
+        crate_cache.revalidations += 1
+        crate_cache.hits += 1
+        return entry.value
+
+    crate_cache.misses += 1
+    started = time.perf_counter()
+    document, snapshot_etag, applied = await load_crate_document(group_id, storage)
+    CRATE_DURATION.labels("materialize").observe(time.perf_counter() - started)
+    if document is None:
+        crate_cache.invalidate(key)
+        return None
+    with CRATE_DURATION.labels("parse").time():
+        crate = _rocrate()(document)
+    with CRATE_DURATION.labels("generate").time():
+        body = json.dumps(crate.metadata.generate()).encode('utf-8')
+    cached = CachedCrate(crate, body)
+    # The ETag was taken before reading the snapshot, so a concurrent change is picked up on the next revalidation
+    crate_cache.put(key, cached, _version(snapshot_etag, applied))
+    return cached
+
+
+async def get_ro_crate(crate_file_key, storage: StorageBackend = None):
+    """
+    Retrieve the RO-Crate metadata from storage.
+
+    The crate is materialized from the group's snapshot and any newer log entries, and
+    cached in memory. The returned crate is shared and must not be modified.
+
+    Args:
+        crate_file_key (str): The storage key for the RO-Crate metadata file.
+        storage (StorageBackend, optional): The storage backend. Defaults to the configured backend.
+
+    Returns:
+        ROCrate: The RO-Crate object, or None if the object is not found.
+    """
+    cached = await get_crate_metadata(os.path.dirname(crate_file_key), storage)
+    if cached is None:
+        return None
+    return cached.crate
+
+
+def _file_entities(group_uri: str, file_metadata: dict) -> Tuple[str, List[dict]]:
+    """
+    Build the File entity of an uploaded file, the Person entity of its author, and the
+    contextual entities of its capture location and mesh size.
+
+    Returns:
+        tuple: The ID of the File entity, and the entities with None values dropped.
+    """
+    file_uri = f"{group_uri}%{file_metadata['file_id']}"
+    # The file is stored as {group_id}/{file_id}{ext}, next to the crate metadata
+    file_entity_id = f"{file_metadata['file_id']}{os.path.splitext(file_metadata['file_name'])[1]}"
+
+    new_file = {
+        "@id": file_entity_id,
+        "@type": "File",
+        "name": file_metadata['file_name'],
+        "identifier": file_uri,
+        "encodingFormat": file_metadata['file_encoding'],
+        "description": file_metadata.get('file_description', file_metadata.get('media_description')),
+        "version": file_metadata['file_version'],
+        "datePublished": file_metadata['file_upload_date']
+    }
+    properties = file_metadata.get("media_properties") or {}
+    new_file.update({
+        "width": properties.get("width"),
+        "height": properties.get("height"),
+        "numberOfPages": properties.get("page_count"),
+    })
+    entities = [new_file]
+    location = file_metadata.get("media_location")
+    if location:
+        place_id = file_context_id(file_entity_id, "location")
+        entities.append({"@id": place_id, "@type": "Place",
+                         "latitude": location["latitude"], "longitude": location["longitude"]})
+        new_file["contentLocation"] = {"@id": place_id}
+    for name in ("vertex_count", "face_count"):
+        if properties.get(name) is not None:
+            property_id = file_context_id(file_entity_id, name)
+            entities.append({"@id": property_id, "@type": "PropertyValue", "name": name, "value": properties[name]})
+            new_file.setdefault("additionalProperty", []).append({"@id": property_id})
+    file_author = file_metadata.get("file_author", file_metadata.get("media_author"))
+    if file_author and file_author.get("author_id"):
+        entities.append({
+            "@id": file_author["author_id"],
+            "@type": "Person",
+            "name": file_author["author_name"]
+        })
+        new_file["author"] = {"@id": file_author["author_id"]}
+    return file_entity_id, [{k: v for k, v in entity.items() if v is not None} for entity in entities]
+
+
+async def create_ro_crate(group_id: str, file_metadata: dict, storage: StorageBackend = None) -> str:
+    """
+    Add a file to the RO-Crate metadata of a group.
+
+    This function appends a log entry holding the file's entities to the group's RO-Crate log.
+    It does not read or rewrite the existing crate, which is materialized when it is read
+    and compacted by `compact_ro_crate`.
+    A file that is added again replaces its earlier entities.
 
     Args:
         group_id (str): The ID of the group.
@@ -54,61 +377,216 @@ def create_ro_crate(group_id: str, file_metadata: dict):
             - file_author (dict, optional): A dictionary containing author information. Expected keys are:
                 - author_id (str): The unique identifier of the author.
                 - author_name (str): The name of the author.
-        file (str): The path to the file to be added to the RO-Crate.
+            The `media_description` and `media_author` keys of the upload endpoint are
+            accepted in place of `file_description` and `file_author`.
+        storage (StorageBackend, optional): The storage backend. Defaults to the configured backend.
     Returns:
-        None
+        str: The storage key of the appended log entry.
     """
-    crate_file_key = f"{group_id}/ro-crate-metadata.json"
-    group_uri = f"{ENDPOINT_URL}/{BUCKET_NAME}/{group_id}"
-    file_uri = f"{group_uri}%{file_metadata['file_id']}"
-    
-
-    # Check if RO-Crate file already exists in S3
-    crate = get_ro_crate(crate_file_key)
-    if crate is None:
-        # If no existing RO-Crate file, create a new one
-        crate = ROCrate()
-        root_metadata = {
-            "@id": "./",
-            "identifier": group_id,
-            "name": f"Group {group_id}",
-            "description": f"RO-Crate for VTM object {group_id}",
-            "version": file_metadata['file_version'],
-            "url": group_uri,
-            "datePublished": file_metadata['file_upload_date']
-        }
-        crate.update_jsonld(root_metadata)
-
-    # Add or update file metadata in the RO-Crate
-    new_metadata = {
-        "name": file_metadata['file_name'],
-        "identifier": file_uri,
-        "encodingFormat": file_metadata['file_encoding'],
-        "description": file_metadata['file_description'],
-        "version": file_metadata['file_version'],
-        "datePublished": file_metadata['file_upload_date']
+    storage = storage or get_storage()
+    group_uri = storage.url(group_id)
+    file_entity_id, entities = _file_entities(group_uri, file_metadata)
+
+    entry = {
+        "group_uri": group_uri,
+        "file_metadata": {
+            "file_version": file_metadata['file_version'],
+            "file_upload_date": file_metadata['file_upload_date']
+        },
+        "file_entity_id": file_entity_id,
+        "entities": entities,
+    }
+
+    # Append the entry to the log; the timestamp keeps entries in order
+    log_key = f"{crate_log_prefix(group_id)}{time.time_ns():020d}-{file_metadata['file_id']}.json"
+    await storage.write(log_key, json.dumps(entry).encode('utf-8'), content_type="application/json")
+    crate_cache.invalidate(crate_key(group_id))
+    logger.info(f"Appended RO-Crate entry {log_key}.")
+    return log_key
+
+
+async def create_ro_crate_batch(group_id: str, files: List[dict], storage: StorageBackend = None) -> Optional[str]:
+    """
+    Add several files to the RO-Crate metadata of a group with a single log entry.
+
+    Args:
+        group_id (str): The ID of the group.
+        files (List[dict]): The metadata of the files, as expected by `create_ro_crate`.
+        storage (StorageBackend, optional): The storage backend. Defaults to the configured backend.
+
+    Returns:
+        str: The storage key of the appended log entry, or None if no files were given.
+    """
+    if not files:
+        return None
+    storage = storage or get_storage()
+    group_uri = storage.url(group_id)
+    file_entity_ids = []
+    entities = []
+    for file_metadata in files:
+        file_entity_id, file_entities = _file_entities(group_uri, file_metadata)
+        file_entity_ids.append(file_entity_id)
+        entities.extend(file_entities)
+
+    entry = {
+        "group_uri": group_uri,
+        "file_metadata": {
+            "file_version": files[0]['file_version'],
+            "file_upload_date": files[0]['file_upload_date']
+        },
+        "file_entity_ids": file_entity_ids,
+        "entities": entities,
+    }
+
+    log_key = f"{crate_log_prefix(group_id)}{time.time_ns():020d}-batch-{files[0]['file_id']}.json"
+    await storage.write(log_key, json.dumps(entry).encode('utf-8'), content_type="application/json")
+    crate_cache.invalidate(crate_key(group_id))
+    logger.info(f"Appended RO-Crate entry {log_key} for {len(files)} files.")
+    return log_key
+
+
+async def remove_from_ro_crate(group_id: str, file_entity_id: str, storage: StorageBackend = None) -> str:
+    """
+    Remove a file from the RO-Crate metadata of a group.
+
+    Like `create_ro_crate`, this only appends a log entry, which drops the file's
+    entity, its contextual entities and its `hasPart` reference when the crate is materialized.
+
+    Args:
+        group_id (str): The ID of the group.
+        file_entity_id (str): The ID of the file's entity, `{file_id}{ext}`.
+        storage (StorageBackend, optional): The storage backend. Defaults to the configured backend.
+
+    Returns:
+        str: The storage key of the appended log entry.
+    """
+    storage = storage or get_storage()
+    entry = {
+        "group_uri": storage.url(group_id),
+        "file_metadata": {
+            "file_version": 1,
+            "file_upload_date": str(datetime.now(timezone.utc))
+        },
+        "removed_entity_ids": [file_entity_id] + [file_context_id(file_entity_id, name) for name in FILE_CONTEXT_ENTITIES],
+        "entities": [],
     }
-    new_file = crate.add_file(new_metadata['name'], properties=new_metadata)
-    if file_metadata["file_author"]:
-        author_properties = {
-            "name": file_metadata["file_author"]["author_name"]
-        }
-        new_author = crate.add(Person(crate, file_metadata["file_author"]["author_id"], properties=author_properties))
-        new_file["author"] = new_author
-    
-    # print(f"Crate properties: {new_file.properties()}")
+    log_key = f"{crate_log_prefix(group_id)}{time.time_ns():020d}-removed-{os.path.splitext(file_entity_id)[0]}.json"
+    await storage.write(log_key, json.dumps(entry).encode('utf-8'), content_type="application/json")
+    crate_cache.invalidate(crate_key(group_id))
+    logger.info(f"Appended RO-Crate removal entry {log_key}.")
+    return log_key
+
+
+@asynccontextmanager
+async def compaction_lock(group_id: str):
+    """
+    Hold the lock that serializes the compactions and rebuilds of a group within this worker.
+
+    The lock is dropped once no task holds or waits for it, so idle groups keep no state.
+
+    Args:
+        group_id (str): The ID of the group.
+    """
+    lock = _compaction_locks.get(group_id)
+    if lock is None:
+        lock = _compaction_locks[group_id] = [asyncio.Lock(), 0]
+    lock[1] += 1
+    try:
+        async with lock[0]:
+            yield
+    finally:
+        lock[1] -= 1
+        if lock[1] == 0 and _compaction_locks.get(group_id) is lock:
+            del _compaction_locks[group_id]
+
+
+async def pending_log_entries(group_id: str, storage: StorageBackend, limit: Optional[int] = None) -> int:
+    """
+    Count the entries of a group's RO-Crate log that are not folded into its snapshot yet.
+
+    The log is listed from the position of the last snapshot this worker read, so entries
+    appended by every worker are counted. Without a known position, entries folded into
+    the snapshot but not yet deleted are counted too.
 
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend): The storage backend.
+        limit (int, optional): Stop counting at this number of entries.
+
+    Returns:
+        int: The number of entries, at most `limit`.
+    """
+    known = _log_positions.get(group_id)
+    count = 0
+    async for _ in storage.list(crate_log_prefix(group_id), start_after=known.value if known else None):
+        count += 1
+        if limit is not None and count >= limit:
+            break
+    return count
 
-    # Generate the RO-Crate metadata
-    crate_metadata = json.dumps(crate.metadata.generate())
-    print(f"Crate metadata: {crate_metadata}")
 
-    # Create an in-memory file-like object
-    crate_file_obj = io.BytesIO(crate_metadata.encode('utf-8'))
+async def compact_ro_crate(group_id: str, storage: StorageBackend = None, grace: float = CRATE_COMPACT_GRACE) -> int:
+    """
+    Fold a group's RO-Crate log into its snapshot.
 
-    # Define the S3 key for the RO-Crate metadata file
-    crate_file_key = f"{group_id}/ro-crate-metadata.json"
+    The snapshot is replaced with a conditional write against the ETag it was read with,
+    so a concurrent compaction in another worker makes this one give up instead of
+    overwriting newer entries. Log entries are only deleted once a snapshot holding them
+    has been written. Entries younger than `grace` seconds are left in the log, so that
+    an entry whose key was generated before the compaction started but written after it
+    is never skipped.
 
-    # Upload the in-memory file-like object to S3
-    s3.upload_fileobj(crate_file_obj, BUCKET_NAME, crate_file_key)
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend, optional): The storage backend. Defaults to the configured backend.
+        grace (float, optional): The minimum age in seconds of the entries to compact.
+
+    Returns:
+        int: The number of log entries folded into the snapshot.
+    """
+    storage = storage or get_storage()
+    async with compaction_lock(group_id):
+        cutoff = f"{crate_log_prefix(group_id)}{time.time_ns() - int(grace * 1e9):020d}"
+        document, snapshot_etag, compacted = await load_crate_document(group_id, storage, before=cutoff)
+        if not compacted:
+            return 0
 
+        document[LOG_POSITION] = compacted[-1]
+        try:
+            await storage.write(
+                crate_key(group_id),
+                json.dumps(document).encode('utf-8'),
+                content_type="application/ld+json",
+                if_match=snapshot_etag,
+                if_none_match=snapshot_etag is None
+            )
+        except PreconditionFailed:
+            logger.info(f"RO-Crate of group {group_id} changed during compaction, leaving it to the other writer.")
+            return 0
+
+        crate_cache.invalidate(crate_key(group_id))
+        # The ETag of the new snapshot is not known until it is read
+        _log_positions.put(group_id, compacted[-1], None)
+        for key in compacted:
+            await storage.delete(key)
+        logger.info(f"Compacted {len(compacted)} RO-Crate log entries of group {group_id}.")
+        return len(compacted)
+
+
+async def compact_ro_crate_if_due(group_id: str, storage: StorageBackend = None):
+    """
+    Compact a group's RO-Crate log once CRATE_COMPACT_EVERY entries are waiting in it.
+
+    The waiting entries are counted with `pending_log_entries`, which lists at most
+    CRATE_COMPACT_EVERY keys.
+
+    Args:
+        group_id (str): The ID of the group.
+        storage (StorageBackend, optional): The storage backend. Defaults to the configured backend.
+    """
+    storage = storage or get_storage()
+    try:
+        if await pending_log_entries(group_id, storage, CRATE_COMPACT_EVERY) >= CRATE_COMPACT_EVERY:
+            await compact_ro_crate(group_id, storage)
+    except Exception as e:
+        logger.error(f"Error compacting RO-Crate of group {group_id}: {str(e)}")